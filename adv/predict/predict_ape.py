@@ -7,6 +7,7 @@ import torch
 from utils.tqdm import tqdm
 
 from utils.h5serial import h5File
+from utils.bucket import bounds_batches, decode_batches, load_sentences, pad_sentences
 
 import cnfg.base as cnfg
 from cnfg.ihyp import *
@@ -68,11 +69,17 @@ length_penalty = cnfg.length_penalty
 ens = "\n".encode("utf-8")
 
 # using tgt instead of mt since data are processed by tools/mkiodata.py for the mt task
-src_grp, mt_grp = td["src"], td["tgt"]
-with open(sys.argv[1], "wb") as f, torch.no_grad():
-	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
-		seq_batch = torch.from_numpy(src_grp[str(i)][()])
-		seq_mt = torch.from_numpy(mt_grp[str(i)][()])
+# sentences are decoded in batches sorted by length with the decoding memory budget (or in the stored batches) and written in their stored order
+src, bounds = load_sentences(td, "src")
+mt = load_sentences(td, "tgt")[0]
+td.close()
+batches = bounds_batches(bounds) if max_decode_tokens is None else decode_batches([len(_) for _ in src], beam_size=beam_size, maxtoken=max_decode_tokens * len(cuda_devices) if multi_gpu else max_decode_tokens, minbsize=len(cuda_devices) if multi_gpu else 1, lext=[len(_) for _ in mt])
+
+rs = [None for _ in range(len(src))]
+with torch.no_grad():
+	for ind in tqdm(batches, mininterval=tqdm_mininterval):
+		seq_batch = torch.from_numpy(pad_sentences(src, ind))
+		seq_mt = torch.from_numpy(pad_sentences(mt, ind))
 		if cuda_device:
 			seq_batch = seq_batch.to(cuda_device, non_blocking=True)
 			seq_mt = seq_mt.to(cuda_device, non_blocking=True)
@@ -86,14 +93,16 @@ with open(sys.argv[1], "wb") as f, torch.no_grad():
 			output = tmp
 		else:
 			output = output.tolist()
-		for tran in output:
+		for _i, tran in zip(ind.tolist(), output):
 			tmp = []
 			for tmpu in tran:
 				if tmpu == eos_id:
 					break
 				else:
 					tmp.append(vcbt[tmpu])
-			f.write(" ".join(tmp).encode("utf-8"))
-			f.write(ens)
+			rs[_i] = " ".join(tmp)
 
-td.close()
+with open(sys.argv[1], "wb") as f:
+	for tran in rs:
+		f.write(tran.encode("utf-8"))
+		f.write(ens)
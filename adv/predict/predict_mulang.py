@@ -7,6 +7,7 @@ import torch
 from utils.tqdm import tqdm
 
 from utils.h5serial import h5File
+from utils.bucket import bounds_batches, decode_batches, load_sentences, pad_sentences
 
 import cnfg.mulang as cnfg
 from cnfg.ihyp import *
@@ -66,11 +67,22 @@ length_penalty = cnfg.length_penalty
 
 ens = "\n".encode("utf-8")
 
-ntest = [(str(i), _task,) for _nd, _task in zip(ntest, td["taskorder"][()].tolist()) for i in range(_nd)]
-
-with open(sys.argv[1], "wb") as f, torch.no_grad():
-	for i_d, taskid in tqdm(ntest, mininterval=tqdm_mininterval):
-		seq_batch = torch.from_numpy(td[str(taskid)]["src"][i_d][()])
+# sentences of each task are decoded in batches sorted by length with the decoding memory budget (or in the stored batches) and written in their stored order
+src, groups, batches = [], [], []
+for _nd, _task in zip(ntest, td["taskorder"][()].tolist()):
+	_src, _bounds = load_sentences(td[str(_task)], "src", ndata=_nd)
+	batches.extend(bounds_batches(_bounds + len(src)))
+	src.extend(_src)
+	groups.extend(_task for _ in range(len(_src)))
+td.close()
+if max_decode_tokens is not None:
+	batches = decode_batches([len(_) for _ in src], beam_size=beam_size, maxtoken=max_decode_tokens * len(cuda_devices) if multi_gpu else max_decode_tokens, minbsize=len(cuda_devices) if multi_gpu else 1, groups=groups)
+
+rs = [None for _ in range(len(src))]
+with torch.no_grad():
+	for ind in tqdm(batches, mininterval=tqdm_mininterval):
+		seq_batch = torch.from_numpy(pad_sentences(src, ind))
+		taskid = groups[ind[0]]
 		if cuda_device:
 			seq_batch = seq_batch.to(cuda_device, non_blocking=True)
 		seq_batch = seq_batch.long()
@@ -83,14 +95,16 @@ with open(sys.argv[1], "wb") as f, torch.no_grad():
 			output = tmp
 		else:
 			output = output.tolist()
-		for tran in output:
+		for _i, tran in zip(ind.tolist(), output):
 			tmp = []
 			for tmpu in tran:
 				if tmpu == eos_id:
 					break
 				else:
 					tmp.append(vcbt[tmpu])
-			f.write(" ".join(tmp).encode("utf-8"))
-			f.write(ens)
+			rs[_i] = " ".join(tmp)
 
-td.close()
+with open(sys.argv[1], "wb") as f:
+	for tran in rs:
+		f.write(tran.encode("utf-8"))
+		f.write(ens)
@@ -9,6 +9,7 @@ from parallel.parallelMT import DataParallelMT
 from parallel.optm import MultiGPUGradScaler
 
 from utils.base import *
+from utils.metric import DeferredCounter, MetricAccumulator
 from utils.init.base import init_model_params
 from utils.contpara import get_model_parameters
 from utils.state.holder import Holder
@@ -27,6 +28,7 @@ from random import shuffle
 from utils.tqdm import tqdm
 
 from utils.h5serial import h5File
+from utils.loader import H5BatchLoader
 
 import cnfg.mulang as cnfg
 from cnfg.ihyp import *
@@ -35,20 +37,13 @@ from transformer.NMT import NMT
 
 def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm=32768, nreport=None, save_every=None, chkpf=None, state_holder=None, statesf=None, num_checkpoint=1, cur_checkid=0, report_eva=True, remain_steps=None, save_loss=False, save_checkp_epoch=False, scaler=None):
 
-	sum_loss = part_loss = 0.0
-	sum_wd = part_wd = 0
-	_done_tokens, _cur_checkid, _cur_rstep, _use_amp = done_tokens, cur_checkid, remain_steps, scaler is not None
+	# loss and the number of tokens of the epoch and of the report interval are accumulated on device
+	_metric, _part_metric = MetricAccumulator(2, device=mv_device), MetricAccumulator(2, device=mv_device)
+	_done_tokens, _cur_checkid, _cur_rstep, _use_amp = DeferredCounter(done_tokens, device=mv_device), cur_checkid, remain_steps, scaler is not None
 	model.train()
 	cur_b, _ls = 1, {} if save_loss else None
-	for i_d, taskid in tqdm(tl, mininterval=tqdm_mininterval):
-		task_grp = td[str(taskid)]
-		seq_batch = torch.from_numpy(task_grp["src"][i_d][()])
-		seq_o = torch.from_numpy(task_grp["tgt"][i_d][()])
+	for (i_d, taskid,), (seq_batch, seq_o,) in tqdm(H5BatchLoader(td, tl, keys=("{1}/src/{0}", "{1}/tgt/{0}",), mv_device=mv_device), mininterval=tqdm_mininterval):
 		lo = seq_o.size(1) - 1
-		if mv_device:
-			seq_batch = seq_batch.to(mv_device, non_blocking=True)
-			seq_o = seq_o.to(mv_device, non_blocking=True)
-		seq_batch, seq_o = seq_batch.long(), seq_o.long()
 
 		oi = seq_o.narrow(1, 0, lo)
 		ot = seq_o.narrow(1, 1, lo).contiguous()
@@ -57,24 +52,23 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			loss = lossf(output, ot)
 			if multi_gpu:
 				loss = loss.sum()
-		loss_add = loss.data.item()
+		loss_add = loss.detach()
 
 		if scaler is None:
 			loss.backward()
 		else:
 			scaler.scale(loss).backward()
 
-		wd_add = ot.ne(pad_id).int().sum().item()
+		wd_add = ot.ne(pad_id).sum()
+		_done_tokens.add(wd_add, ot.numel())
 		loss = output = oi = ot = seq_batch = seq_o = None
-		sum_loss += loss_add
+		_metric.add(loss_add, wd_add)
 		if save_loss:
 			_ls[(i_d, t_d)] = loss_add / wd_add
-		sum_wd += wd_add
-		_done_tokens += wd_add
 
-		if _done_tokens >= tokens_optm:
+		if _done_tokens.ge(tokens_optm):
 			optm_step(optm, model=model, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer, zero_grad_none=optm_step_zero_grad_set_none)
-			_done_tokens = 0
+			_done_tokens.reset()
 			if _cur_rstep is not None:
 				if save_checkp_epoch and (save_every is not None) and (_cur_rstep % save_every == 0) and (chkpf is not None) and (_cur_rstep > 0):
 					if num_checkpoint > 1:
@@ -92,9 +86,9 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			lrsch.step()
 
 		if nreport is not None:
-			part_loss += loss_add
-			part_wd += wd_add
+			_part_metric.add(loss_add, wd_add)
 			if cur_b % nreport == 0:
+				part_loss, part_wd = _part_metric.get()
 				if report_eva:
 					_leva, _eeva = eva(ed, nd, model, lossf, mv_device, multi_gpu, _use_amp)
 					logger.info("Average loss over %d tokens: %.3f, valid loss/error: %.3f %.2f" % (part_wd, part_loss / part_wd, _leva, _eeva,))
@@ -102,8 +96,6 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 					model.train()
 				else:
 					logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-				part_loss = 0.0
-				part_wd = 0
 
 		if save_checkp_epoch and (_cur_rstep is None) and (save_every is not None) and (cur_b % save_every == 0) and (chkpf is not None) and (cur_b < ndata):
 			if num_checkpoint > 1:
@@ -116,24 +108,20 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			if statesf is not None:
 				save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]}), statesf, print_func=logger.info)
 		cur_b += 1
+	part_loss, part_wd = _part_metric.get()
 	if part_wd != 0.0:
 		logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-	return sum_loss / sum_wd, _done_tokens, _cur_checkid, _cur_rstep, _ls
+	if save_loss and _ls:
+		_ls = dict(zip(_ls.keys(), torch.stack(list(_ls.values())).tolist()))
+	sum_loss, sum_wd = _metric.get()
+	return sum_loss / sum_wd, _done_tokens.get(), _cur_checkid, _cur_rstep, _ls
 
 def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
-	r = w = 0
-	sum_loss = 0.0
+	_metric = MetricAccumulator(3, device=mv_device)
 	model.eval()
 	with torch.no_grad():
-		for i_d, taskid in tqdm(nd, mininterval=tqdm_mininterval):
-			task_grp = ed[str(taskid)]
-			seq_batch = torch.from_numpy(task_grp["src"][i_d][()])
-			seq_o = torch.from_numpy(task_grp["tgt"][i_d][()])
+		for (i_d, taskid,), (seq_batch, seq_o,) in tqdm(H5BatchLoader(ed, nd, keys=("{1}/src/{0}", "{1}/tgt/{0}",), mv_device=mv_device), mininterval=tqdm_mininterval):
 			lo = seq_o.size(1) - 1
-			if mv_device:
-				seq_batch = seq_batch.to(mv_device, non_blocking=True)
-				seq_o = seq_o.to(mv_device, non_blocking=True)
-			seq_batch, seq_o = seq_batch.long(), seq_o.long()
 			ot = seq_o.narrow(1, 1, lo).contiguous()
 			with autocast(enabled=use_amp):
 				output = model(seq_batch, seq_o.narrow(1, 0, lo))
@@ -143,13 +131,10 @@ def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
 					trans = torch.cat([outu.argmax(-1).to(mv_device, non_blocking=True) for outu in output], 0)
 				else:
 					trans = output.argmax(-1)
-			sum_loss += loss.data.item()
 			data_mask = ot.ne(pad_id)
-			correct = (trans.eq(ot) & data_mask).int()
-			w += data_mask.int().sum().item()
-			r += correct.sum().item()
-			correct = data_mask = trans = loss = output = ot = seq_batch = seq_o = None
-	w = float(w)
+			_metric.add(loss.data, data_mask.sum(), (trans.eq(ot) & data_mask).sum())
+			data_mask = trans = loss = output = ot = seq_batch = seq_o = None
+	sum_loss, w, r = _metric.get()
 	return sum_loss / w, (w - r) / w * 100.0
 
 def hook_lr_update(optm, flags=None):
@@ -9,6 +9,7 @@ from parallel.parallelMT import DataParallelMT
 from parallel.optm import MultiGPUGradScaler
 
 from utils.base import *
+from utils.metric import DeferredCounter, MetricAccumulator
 from utils.init.base import init_model_params
 from utils.contpara import get_model_parameters
 from utils.state.holder import Holder
@@ -18,15 +19,18 @@ from utils.fmt.base import tostr
 from cnfg.vocab.base import pad_id
 from utils.fmt.base4torch import parse_cuda, load_emb
 from utils.mulang import data_sampler
+from utils.robt import BackTranslator
 
 from lrsch import GoogleLR as LRScheduler
 from loss.base import MultiLabelSmoothingLoss as LabelSmoothingLoss
 
 from random import shuffle, randint
+from functools import partial
 
 from utils.tqdm import tqdm
 
 from utils.h5serial import h5File
+from utils.loader import H5BatchLoader
 
 import cnfg.mulang as cnfg
 from cnfg.ihyp import *
@@ -60,26 +64,31 @@ def back_translate(model, seq_in, taskid, beam_size, multi_gpu, enable_autocast=
 
 	return rs
 
+# sample the task to back-translate target sentences of taskid into, which is different from taskid
+
+def sample_bt_task(taskid):
+
+	rs = randint(0, ntask - 2)
+	if rs >= taskid:
+		rs += 1
+
+	return rs
+
 def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm=32768, nreport=None, save_every=None, chkpf=None, state_holder=None, statesf=None, num_checkpoint=1, cur_checkid=0, report_eva=True, remain_steps=None, save_loss=False, save_checkp_epoch=False, scaler=None):
 
-	sum_loss = part_loss = 0.0
-	sum_wd = part_wd = 0
-	_done_tokens, _cur_checkid, _cur_rstep, _use_amp = done_tokens, cur_checkid, remain_steps, scaler is not None
+	# loss and the number of tokens of the epoch and of the report interval are accumulated on device
+	_metric, _part_metric = MetricAccumulator(2, device=mv_device), MetricAccumulator(2, device=mv_device)
+	_done_tokens, _cur_checkid, _cur_rstep, _use_amp = DeferredCounter(done_tokens, device=mv_device), cur_checkid, remain_steps, scaler is not None
 	model.train()
 	cur_b, _ls = 1, {} if save_loss else None
-	global ntask, ro_beam_size
-	t_sample_max_id = ntask - 2
-	for i_d, taskid in tqdm(tl, mininterval=tqdm_mininterval):
-		seq_o = torch.from_numpy(td[str(taskid)]["tgt"][i_d][()])
+	global ro_beam_size, back_translator
+	_loader = H5BatchLoader(td, tl, keys=("{1}/tgt/{0}",), mv_device=mv_device)
+	# batches are back-translated ahead by back_translator if it is enabled, otherwise in the training loop
+	for (i_d, taskid,), (seq_o,), seq_batch in tqdm((((_bid, _batch, None,) for _bid, _batch in _loader) if back_translator is None else back_translator(_loader, lambda bid: sample_bt_task(bid[1]))), total=len(tl), mininterval=tqdm_mininterval):
 		lo = seq_o.size(1) - 1
-		if mv_device:
-			seq_o = seq_o.to(mv_device, non_blocking=True)
-		seq_o = seq_o.long()
-
-		_bt_taskid = randint(0, t_sample_max_id)
-		if _bt_taskid >= taskid:
-			_bt_taskid += 1
-		seq_batch = back_translate(model, seq_o, _bt_taskid, ro_beam_size, multi_gpu, enable_autocast=_use_amp)
+
+		if seq_batch is None:
+			seq_batch = back_translate(model, seq_o, sample_bt_task(taskid), ro_beam_size, multi_gpu, enable_autocast=_use_amp)
 		oi = seq_o.narrow(1, 0, lo)
 		ot = seq_o.narrow(1, 1, lo).contiguous()
 		with autocast(enabled=_use_amp):
@@ -87,24 +96,25 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			loss = lossf(output, ot, lang_id=taskid)
 			if multi_gpu:
 				loss = loss.sum()
-		loss_add = loss.data.item()
+		loss_add = loss.detach()
 
 		if scaler is None:
 			loss.backward()
 		else:
 			scaler.scale(loss).backward()
 
-		wd_add = ot.ne(pad_id).int().sum().item()
+		wd_add = ot.ne(pad_id).sum()
+		_done_tokens.add(wd_add, ot.numel())
 		loss = output = oi = ot = seq_batch = seq_o = None
-		sum_loss += loss_add
+		_metric.add(loss_add, wd_add)
 		if save_loss:
 			_ls[(i_d, t_d)] = loss_add / wd_add
-		sum_wd += wd_add
-		_done_tokens += wd_add
 
-		if _done_tokens >= tokens_optm:
+		if _done_tokens.ge(tokens_optm):
 			optm_step(optm, model=model, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer, zero_grad_none=optm_step_zero_grad_set_none)
-			_done_tokens = 0
+			if back_translator is not None:
+				back_translator.step()
+			_done_tokens.reset()
 			if _cur_rstep is not None:
 				if save_checkp_epoch and (save_every is not None) and (_cur_rstep % save_every == 0) and (chkpf is not None) and (_cur_rstep > 0):
 					if num_checkpoint > 1:
@@ -122,9 +132,9 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			lrsch.step()
 
 		if nreport is not None:
-			part_loss += loss_add
-			part_wd += wd_add
+			_part_metric.add(loss_add, wd_add)
 			if cur_b % nreport == 0:
+				part_loss, part_wd = _part_metric.get()
 				if report_eva:
 					_leva, _eeva = eva(ed, nd, model, lossf, mv_device, multi_gpu, _use_amp)
 					logger.info("Average loss over %d tokens: %.3f, valid loss/error: %.3f %.2f" % (part_wd, part_loss / part_wd, _leva, _eeva,))
@@ -132,8 +142,6 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 					model.train()
 				else:
 					logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-				part_loss = 0.0
-				part_wd = 0
 
 		if save_checkp_epoch and (_cur_rstep is None) and (save_every is not None) and (cur_b % save_every == 0) and (chkpf is not None) and (cur_b < ndata):
 			if num_checkpoint > 1:
@@ -146,24 +154,22 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			if statesf is not None:
 				save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]}), statesf, print_func=logger.info)
 		cur_b += 1
+	part_loss, part_wd = _part_metric.get()
 	if part_wd != 0.0:
 		logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-	return sum_loss / sum_wd, _done_tokens, _cur_checkid, _cur_rstep, _ls
+	if back_translator is not None:
+		logger.info(back_translator.report())
+	if save_loss and _ls:
+		_ls = dict(zip(_ls.keys(), torch.stack(list(_ls.values())).tolist()))
+	sum_loss, sum_wd = _metric.get()
+	return sum_loss / sum_wd, _done_tokens.get(), _cur_checkid, _cur_rstep, _ls
 
 def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
-	r = w = 0
-	sum_loss = 0.0
+	_metric = MetricAccumulator(3, device=mv_device)
 	model.eval()
 	with torch.no_grad():
-		for i_d, taskid in tqdm(nd, mininterval=tqdm_mininterval):
-			task_grp = ed[str(taskid)]
-			seq_batch = torch.from_numpy(task_grp["src"][i_d][()])
-			seq_o = torch.from_numpy(task_grp["tgt"][i_d][()])
+		for (i_d, taskid,), (seq_batch, seq_o,) in tqdm(H5BatchLoader(ed, nd, keys=("{1}/src/{0}", "{1}/tgt/{0}",), mv_device=mv_device), mininterval=tqdm_mininterval):
 			lo = seq_o.size(1) - 1
-			if mv_device:
-				seq_batch = seq_batch.to(mv_device, non_blocking=True)
-				seq_o = seq_o.to(mv_device, non_blocking=True)
-			seq_batch, seq_o = seq_batch.long(), seq_o.long()
 			ot = seq_o.narrow(1, 1, lo).contiguous()
 			with autocast(enabled=use_amp):
 				output = model(seq_batch, seq_o.narrow(1, 0, lo), taskid=taskid)
@@ -173,13 +179,10 @@ def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
 					trans = torch.cat([outu.argmax(-1).to(mv_device, non_blocking=True) for outu in output], 0)
 				else:
 					trans = output.argmax(-1)
-			sum_loss += loss.data.item()
 			data_mask = ot.ne(pad_id)
-			correct = (trans.eq(ot) & data_mask).int()
-			w += data_mask.int().sum().item()
-			r += correct.sum().item()
-			correct = data_mask = trans = loss = output = ot = seq_batch = seq_o = None
-	w = float(w)
+			_metric.add(loss.data, data_mask.sum(), (trans.eq(ot) & data_mask).sum())
+			data_mask = trans = loss = output = ot = seq_batch = seq_o = None
+	sum_loss, w, r = _metric.get()
 	return sum_loss / w, (w - r) / w * 100.0
 
 def hook_lr_update(optm, flags=None):
@@ -291,6 +294,9 @@ optimizer.zero_grad(set_to_none=optm_step_zero_grad_set_none)
 
 lrsch = LRScheduler(optimizer, cnfg.isize, cnfg.warm_step, scale=cnfg.lr_scale)
 
+# the model copy of back_translator is created after loading pre-trained models, and synchronized after optimizer steps
+back_translator = BackTranslator(mymodel.module if multi_gpu else mymodel, partial(back_translate, beam_size=ro_beam_size, multi_gpu=False, enable_autocast=use_amp), sync_steps=cnfg.robt_sync_steps, max_stale=cnfg.robt_max_stale, prefetch=cnfg.robt_prefetch) if cnfg.robt_async else None
+
 state_holder = None if statesf is None and cnt_states is None else Holder(**{"optm": optimizer, "lrsch": lrsch, "pyrand": PyRandomState(), "thrand": THRandomState(use_cuda=use_cuda)})
 
 num_checkpoint = cnfg.num_checkpoint
@@ -404,5 +410,8 @@ if statesf is not None:
 	save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
 logger.info("model saved")
 
+if back_translator is not None:
+	back_translator.close()
+
 td.close()
 vd.close()
@@ -42,6 +42,10 @@ use_cuda = True
 gpuid = "cuda:0"
 use_amp = False
 multi_gpu_optimizer = True
+# backend of torch.distributed for multi-process training launched with torchrun (one process for each GPU), None to use "nccl" on GPUs and "gloo" on CPUs.
+dist_backend = None
+# shard optimizer states across processes of distributed training (ZeRO-1), each process only keeps the optimizer states of its shard of parameters.
+dist_shard_optimizer = True
 
 bindDecoderEmb = True
 share_emb = False
@@ -68,6 +72,28 @@ weight_decay = 0
 
 beam_size = 4
 length_penalty = 0.0
+# remove finished sentences from the batch during decoding, which saves computation when target lengths in a batch are skewed. Not supported by ensembles, which always decode full batches.
+clip_decoding = False
+# lexical shortlists built by tools/shortlist.py, the target vocabulary of every batch is restricted to its candidates (the output projection of each decoding step only covers them) by `predict.py` and `translator.py` (except with continuous_batching) with a single model, None to decode with the full vocabulary.
+shortlist_file = None
+# queue sentences from all requests of the translation server (server.py) and decode them in shared batches, finished sentences are replaced with waiting ones during decoding.
+continuous_batching = False
+# maximum time (in seconds) to wait for more sentences before starting to decode with continuous_batching, larger values lead to larger batches at the cost of latency.
+batching_max_wait = 0.01
+# quantize weights of linear layers of models to int8 dynamically after loading for CPU decoding with `predict.py` and `translator.py` (see `utils/quant.py`), model files quantized by `tools/quantize_model.py` are loaded as quantized models regardless of this setting. Quantized models only run on CPU, they are decoded on CPU regardless of use_cuda and multi_gpu_decoding.
+quant_decoding = False
+# draft decoder distilled by `tools/distil_draft.py` for speculative decoding (`transformer/SpeculativeNMT.py`) of a single model by `predict.py` and `translator.py` (except with continuous_batching), None to disable. Translations are the same as without it, while each step of the model decodes several tokens proposed by the draft decoder. clip_decoding and shortlist_file are not used with it.
+draft_model_file = None
+# number of layers of the draft decoder.
+draft_nlayer = 1
+# number of tokens proposed by the draft decoder in each step.
+speculative_ntoken = 4
+# number of translations cached in memory by `translator.py` (keyed by BPE applied source sentences, the model and decoding settings, including `max_decode_tokens` of `cnfg/hyp.py`) to skip decoding repeated sentences across requests, 0 to disable.
+translation_cache_size = 0
+# time (in seconds) for which cached translations stay valid, None for no expiration.
+translation_cache_ttl = None
+# sqlite3 database file which keeps cached translations across restarts of the server, None to only cache in memory.
+translation_cache_file = None
 # use multi-gpu for translating or not. `predict.py` will take the last gpu rather than the first in case multi_gpu_decoding is set to False to avoid potential break due to out of memory, since the first gpu is the main device by default which takes more jobs.
 multi_gpu_decoding = False
 
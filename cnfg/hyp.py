@@ -23,6 +23,9 @@ disable_std_pemb = False
 # using fast implementation of label smoothing loss, but it cannot exclude the negative impact of special tokens, like <pad>, on training. `forbidden_indexes` in `cnfg/base.py` shall be set to None to enable.
 use_fast_loss = True
 
+# compute the classifier of the decoder and the label smoothing loss together on chunks of this number of tokens during training (loss.base.ChunkedLabelSmoothingLoss), log-probabilities of chunks are recomputed in backward so that the full (bsize, nquery, vocabulary size) tensor is never kept, which bounds the peak memory of the vocabulary projection and allows larger max_tokens_gpu with large vocabularies. None to disable, not used with multiple GPUs.
+loss_chunk_size = None
+
 # configure maximum batch size w.r.t GPU memory
 max_tokens_gpu = 6144
 max_sentences_gpu = max_tokens_gpu // 6
@@ -47,9 +50,33 @@ hdf5_perf_over_camp = True
 # whether to track creation order.
 hdf5_track_order = False
 
+# number of background workers to read batches from HDF5 data files during training (utils.loader.H5BatchLoader), 0 to read them on the main thread.
+data_loader_num_worker = 2
+# maximum number of batches read ahead by workers.
+data_loader_prefetch = 8
+# use processes instead of threads as workers, which avoids the global lock of h5py for decompression at the cost of passing batches across processes.
+data_loader_use_process = False
+# re-decide batches of flat token stores (data directories created by tools/mkiodata.py with a result path not ending with .h5, see utils/mmdata.py) for training with the batch size settings above and the number of GPUs when loading, instead of using batches decided at preprocessing.
+mmdata_rebatch = False
+# pack sentences of flat token stores into batches of at most max_tokens_gpu padded tokens (times the number of GPUs) with length buckets online during training (utils.bucket.BucketSampler), the composition of batches changes every epoch. Not used with dynamic sentence sampling (dss_ws in cnfg/base.py).
+bucket_sampling = False
+# width of length buckets, sentences whose total lengths differ less than it are shuffled together.
+bucket_width = 4
+# sort sentences of test sets by length and pack them into batches with an estimated decoding memory (beam_size * (source length + maximum decoding length of NMT.decode) per sentence, utils.bucket.decode_batches) of at most this number of tokens (times the number of GPUs) for `predict.py`, `adv/predict/` and `translator.py`, translations are written in the original order. As the default maximum decoding length of a batch is derived from its longest source sentence, translations of sentences which reach it may differ from those of batches decided by tools/mktest.py. None (default) to decode batches decided by tools/mktest.py, e.g. max_tokens_gpu * 16 to enable.
+max_decode_tokens = None
+
 # prune with length penalty in each beam decoding step
 clip_beam_with_lp = True
 
+# preallocate the self-attention key/value cache of the decoder for max_len steps and write it in place during decoding, which saves the concatenation of the decoding history in each step at the cost of memory.
+preallocate_kv_cache = False
+# share keys/values of cross-attentions (modules.base.CrossAttn/MultiHeadAttn) across beams of a sentence in beam search with queries of beams folded into one matrix multiplication, instead of repeating them beam_size times, which saves memory for long source sentences and large beams.
+broadcast_cross_attn_beam = True
+# run models of an ensemble (transformer/EnsembleNMT.py) which share the same standard architecture with batched matrix multiplications on stacked weights (transformer/EnsembleFused.py) instead of looping over models, other ensembles always loop over models.
+fuse_ensemble = True
+# number of sentences decoded in parallel by the decoder of the Average Attention Network (transformer/AvgDecoder.py) with clip_decoding, other sentences of the batch wait in a queue and take the places of finished sentences during decoding. None to decode all sentences of the batch in parallel.
+aan_decode_slots = None
+
 # optimize speed even if it sacrifices reproduction
 performance_over_reproduction = True
 
@@ -58,9 +85,17 @@ enable_torch_check = True
 
 # accelerate optimizer by using contigous parameters and gradients. Disabling it leads to better performance.
 contiguous_parameters = False
+# update all parameters of a param_group with a few multi-tensor (torch._foreach_*) kernel launches in optimizers of optm/ (RAdam, AdaBelief, Ranger and Lookahead), instead of launching several kernels for each parameter, results are identical to the per-parameter loops. None to use them only for parameters on GPUs, as they fall back to per-tensor loops on CPU.
+optm_foreach = None
 
 # the number of checkpoints kept for `cnfg.save_auto_clean`
 n_keep_best = 1
 
+# save checkpoints from host snapshots of parameters and training states in a background thread (utils/checkpoint.py), training only stalls for copying them to host memory.
+async_checkpoint = True
+
+# the maximum number of gradient elements of each bucket all-reduced during the backward pass in multi-process data parallel training (parallel/dist.py).
+dist_bucket_size = 2 ** 22
+
 # use C backend. Disabling it leads to better performance.
 use_c_backend = False
@@ -6,3 +6,11 @@ task_weight_T = None
 task_weight = None
 
 robt_beam_size = 1
+# back-translate upcoming batches for adv/train/mulang/train_mulang_robt.py with a copy of the model in a background worker (utils/robt.py, a thread with its own CUDA stream on GPU, or a forked process on CPU) instead of in the training loop. The model copy decodes in evaluation mode (without dropout), while the training loop decodes with the model in training mode, so back-translations differ from those without it.
+robt_async = False
+# synchronize the model copy with the trained model every this number of optimizer steps.
+robt_sync_steps = 1
+# batches back-translated with a model copy synchronized more than this number of optimizer steps ago are translated again with an up-to-date copy.
+robt_max_stale = 8
+# maximum number of batches back-translated ahead.
+robt_prefetch = 4
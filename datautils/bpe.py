@@ -3,10 +3,58 @@
 import codecs
 import re
 from random import random
+from heapq import heapify, heappush, heappop
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+
+# a word cache which keeps at most size entries and drops the least recently used ones, unbounded if size is None or not positive. It counts hits and misses for self.hit_rate(). Lookups and insertions are guarded by a lock, since the cache is shared by request threads of server.py and an insertion may evict an entry between the lookup and the reordering of another thread.
+
+class LRUCache(OrderedDict):
+
+	def __init__(self, size=1048576, *args, **kwargs):
+
+		self.lock = Lock()
+		super(LRUCache, self).__init__(*args, **kwargs)
+		self.size = size if (size is not None) and (size > 0) else None
+		self.hits = self.misses = 0
+
+	def get(self, key, default=None):
+
+		with self.lock:
+			try:
+				rs = self[key]
+			except KeyError:
+				self.misses += 1
+				return default
+			self.hits += 1
+			self.move_to_end(key)
+
+		return rs
+
+	def __setitem__(self, key, value):
+
+		with self.lock:
+			super(LRUCache, self).__setitem__(key, value)
+			if self.size is not None:
+				self.move_to_end(key)
+				if len(self) > self.size:
+					self.popitem(last=False)
+
+	def hit_rate(self):
+
+		_n = self.hits + self.misses
+
+		return float(self.hits) / float(_n) if _n > 0 else 0.0
+
+	def reset_stats(self):
+
+		self.hits = self.misses = 0
 
 class BPE(object):
 
-	def __init__(self, codes, merges=-1, separator="@@", vocab=None, glossaries=None):
+	def __init__(self, codes, merges=-1, separator="@@", vocab=None, glossaries=None, cache_size=1048576):
 
 		codes.seek(0)
 		offset=1
@@ -35,7 +83,11 @@ class BPE(object):
 
 		self.glossaries_regex = re.compile("^({})$".format("|".join(glossaries))) if glossaries else None
 
-		self.cache = {}
+		self.cache = LRUCache(cache_size)
+
+	def process_lines(self, lines, dropout=0):
+
+		return [self.process_line(line, dropout) for line in lines]
 
 	def process_line(self, line, dropout=0):
 		"""segment line, dealing with leading and trailing whitespace"""
@@ -84,8 +136,10 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
 	"""Encode word based on list of BPE merge operations, which are applied consecutively
 	"""
 
-	if not dropout and orig in cache:
-		return cache[orig]
+	if not dropout:
+		_rs = cache.get(orig)
+		if _rs is not None:
+			return _rs
 
 	if glossaries_regex and glossaries_regex.match(orig):
 		cache[orig] = (orig,)
@@ -101,6 +155,25 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
 	else:
 		raise NotImplementedError
 
+	word = merge_loop(word, bpe_codes, dropout) if dropout else merge_heap(word, bpe_codes)
+
+	# don"t print end-of-word symbols
+	if word[-1] == "</w>":
+		word = word[:-1]
+	elif word[-1].endswith("</w>"):
+		word[-1] = word[-1][:-4]
+
+	word = tuple(word)
+	if vocab:
+		word = check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
+
+	cache[orig] = word
+	return word
+
+# the merge loop of subword-nmt, which rebuilds the list of pairs after every merge, kept for BPE-dropout.
+
+def merge_loop(word, bpe_codes, dropout=0):
+
 	while len(word) > 1:
 
 		# get list of symbol pairs; optionally apply dropout
@@ -128,19 +201,66 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
 		new_word.extend(word[i:]) # add all symbols until end of word
 		word = new_word
 
-	# don"t print end-of-word symbols
-	if word[-1] == "</w>":
-		word = word[:-1]
-	elif word[-1].endswith("</w>"):
-		word[-1] = word[-1][:-4]
-
-	word = tuple(word)
-	if vocab:
-		word = check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
-
-	cache[orig] = word
 	return word
 
+# equivalent to merge_loop without dropout: symbols are kept in a linked list (prv/nxt) and candidate pairs in a priority queue of (rank, position of the first symbol). All occurrences of the best ranked pair are merged from left to right before pairs created by these merges are queued, which is what one iteration of merge_loop does. Queue entries whose symbols have changed are skipped when popped.
+
+def merge_heap(word, bpe_codes):
+
+	_nsym = len(word)
+	if _nsym < 2:
+		return word
+	sym = list(word)
+	nxt = list(range(1, _nsym + 1))
+	nxt[-1] = -1
+	prv = list(range(-1, _nsym - 1))
+	heap = [(bpe_codes[_pair], i,) for i, _pair in enumerate(zip(word, word[1:])) if _pair in bpe_codes]
+	heapify(heap)
+	while heap:
+		_rank, i = heappop(heap)
+		_j = nxt[i]
+		if (sym[i] is None) or (_j < 0) or (bpe_codes.get((sym[i], sym[_j],)) != _rank):
+			continue
+		_merged = [i]
+		_left, _right = sym[i], sym[_j]
+		while heap and heap[0][0] == _rank:
+			_merged.append(heappop(heap)[1])
+		_new = _left + _right
+		_done = []
+		for i in sorted(_merged):
+			_j = nxt[i]
+			# skip pairs overlapping with merged ones (x x x -> xx x), and stale entries
+			if (sym[i] != _left) or (_j < 0) or (sym[_j] != _right):
+				continue
+			sym[i] = _new
+			sym[_j] = None
+			_k = nxt[_j]
+			nxt[i] = _k
+			if _k >= 0:
+				prv[_k] = i
+			_done.append(i)
+		for i in _done:
+			if sym[i] is None:
+				continue
+			_k = prv[i]
+			if _k >= 0:
+				_pair = (sym[_k], sym[i],)
+				if _pair in bpe_codes:
+					heappush(heap, (bpe_codes[_pair], _k,))
+			_k = nxt[i]
+			if _k >= 0:
+				_pair = (sym[i], sym[_k],)
+				if _pair in bpe_codes:
+					heappush(heap, (bpe_codes[_pair], i,))
+
+	rs = []
+	i = 0
+	while i >= 0:
+		rs.append(sym[i])
+		i = nxt[i]
+
+	return rs
+
 def recursive_split(segment, bpe_codes, vocab, separator, final=False):
 	"""Recursively split segment into smaller units (by reversing BPE merges)
 	until all units are either in-vocabulary, or cannot be split futher."""
@@ -232,9 +352,25 @@ class BPERemover:
 		else:
 			return input.replace("@@ ", "")
 
+_process_bpe = None
+
+def init_process_worker(bpe):
+
+	global _process_bpe
+
+	# the lock of the cache may have been held by another thread of the parent process when forking
+	bpe.cache.lock = Lock()
+	_process_bpe = bpe
+
+def process_lines_worker(lines):
+
+	return _process_bpe.process_lines(lines)
+
+# num_worker: segment lists of at least chunk_size lines with a pool of num_worker forked processes, for offline preprocessing of corpora. The pool is created on the first use and released by self.close().
+
 class BPEApplier:
 
-	def __init__(self, codesf, bpe_vcb=None, vocabulary_threshold=None, separator="@@", merges=-1, glossaries=None):
+	def __init__(self, codesf, bpe_vcb=None, vocabulary_threshold=None, separator="@@", merges=-1, glossaries=None, cache_size=1048576, num_worker=0, chunk_size=4096):
 
 		if bpe_vcb is not None:
 			vocabulary = read_vocabulary(codecs.open(bpe_vcb, encoding="utf-8"), vocabulary_threshold)
@@ -242,14 +378,35 @@ class BPEApplier:
 			vocabulary = None
 		if glossaries is not None:
 			glossaries = [g.decode("utf-8") for g in glossaries]
-		self.bpe = BPE(codecs.open(codesf, encoding="utf-8"), merges, separator, vocabulary, glossaries)
+		self.bpe = BPE(codecs.open(codesf, encoding="utf-8"), merges, separator, vocabulary, glossaries, cache_size=cache_size)
+		self.num_worker = num_worker if "fork" in get_all_start_methods() else 0
+		self.chunk_size, self.pool = chunk_size, None
 
 	def __call__(self, input):
 
 		if isinstance(input, (list, tuple,)):
-			rs = []
-			for inputu in input:
-				rs.append(self.bpe.process_line(inputu))
-			return rs
+			if (self.num_worker > 0) and (len(input) > self.chunk_size):
+				if self.pool is None:
+					self.pool = ProcessPoolExecutor(max_workers=self.num_worker, mp_context=get_context("fork"), initializer=init_process_worker, initargs=(self.bpe,))
+				rs = []
+				for _ in self.pool.map(process_lines_worker, [input[i:i + self.chunk_size] for i in range(0, len(input), self.chunk_size)]):
+					rs.extend(_)
+				return rs
+			else:
+				return self.bpe.process_lines(input)
 		else:
 			return self.bpe.process_line(input)
+
+	def cache_hit_rate(self):
+
+		return self.bpe.cache.hit_rate()
+
+	def close(self):
+
+		if self.pool is not None:
+			self.pool.shutdown()
+			self.pool = None
+
+	def __del__(self):
+
+		self.close()
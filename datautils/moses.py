@@ -3,89 +3,208 @@
 import os
 from os.path import sep
 from subprocess import PIPE, Popen
+from threading import Thread, Lock
+from queue import Queue
+from collections import deque
+from concurrent.futures import Future
+from uuid import uuid4
 
 perl_exec = "perl"
-moses_scripts = os.environ.get("moses_scripts")
+moses_scripts = os.environ.get("moses_scripts", "")
 
-if not moses_scripts.endswith(sep):
+if moses_scripts and not moses_scripts.endswith(sep):
 	moses_scripts += sep
 
+# a word which processing scripts leave (nearly) untouched, with a random suffix for each process so that it does not occur in data. Its processed form is learned when a process starts.
+
+def new_sentinel():
+
+	return "NeutronPipeSentinel%s" % uuid4().hex
+
+# A subprocess fed by a writer thread and read by a reader thread. Each job (a list of lines) is written followed by the sentinel line without waiting for outputs, and the reader collects output lines until the processed sentinel to complete the Future of the oldest pending job, so that requests are pipelined instead of costing a pipe round trip per line. Once the process fails (exits, or outputs more sentinels than jobs), pending and later jobs get the exception.
+# sentinel: None for a random one, jobs with a line equal to a given sentinel (e.g. "<P>" for the sentence splitter) are rejected.
+
+class PipeProcess:
+
+	def __init__(self, cmd, sentinel=None):
+
+		self.process, self.cmd = Popen(cmd, stdin=PIPE, stdout=PIPE), " ".join(cmd)
+		self.sentinel = new_sentinel() if sentinel is None else sentinel
+		self.write_line(self.sentinel)
+		self.process.stdin.flush()
+		self.sentinel_output = self.read_line()
+		self.jobs, self.pending = Queue(), deque()
+		self.lock, self.error = Lock(), None
+		self.writer = Thread(target=self.write_loop, daemon=True)
+		self.reader = Thread(target=self.read_loop, daemon=True)
+		self.writer.start()
+		self.reader.start()
+
+	def write_line(self, line):
+
+		# line breaks inside a line would add output lines
+		self.process.stdin.write(("%s\n" % line.strip().replace("\n", " ")).encode("utf-8", "ignore"))
+
+	def read_line(self):
+
+		_line = self.process.stdout.readline()
+		if not _line:
+			raise EOFError("Process exited: %s" % self.cmd)
+
+		return _line.strip().decode("utf-8", "ignore")
+
+	def submit(self, lines):
+
+		rs = Future()
+		self.jobs.put((lines, rs,))
+
+		return rs
+
+	def __len__(self):
+
+		return self.jobs.qsize() + len(self.pending)
+
+	def write_loop(self):
+
+		while True:
+			_job = self.jobs.get()
+			if _job is None:
+				break
+			_lines, _future = _job
+			if any(_line.strip() == self.sentinel for _line in _lines):
+				_future.set_exception(ValueError("Input line equals the sentinel: %s" % self.sentinel))
+				continue
+			with self.lock:
+				if self.error is None:
+					self.pending.append(_future)
+				else:
+					_future.set_exception(self.error)
+					continue
+			try:
+				for _line in _lines:
+					self.write_line(_line)
+				self.write_line(self.sentinel)
+				self.process.stdin.flush()
+			except Exception as e:
+				self.fail(e)
+
+	def read_loop(self):
+
+		_rs = []
+		try:
+			while True:
+				_line = self.read_line()
+				if _line == self.sentinel_output:
+					with self.lock:
+						_future = self.pending.popleft() if self.pending else None
+					if _future is None:
+						raise Exception("Unexpected output of %s: more outputs than inputs" % self.cmd)
+					if not _future.done():
+						_future.set_result(_rs)
+					_rs = []
+				else:
+					_rs.append(_line)
+		except Exception as e:
+			self.fail(e)
+
+	# fail pending jobs and later jobs with e
+
+	def fail(self, e):
+
+		with self.lock:
+			if self.error is None:
+				self.error = e
+			while self.pending:
+				_future = self.pending.popleft()
+				if not _future.done():
+					_future.set_exception(e)
+
+	def close(self):
+
+		if self.process is not None:
+			self.jobs.put(None)
+			try:
+				self.process.stdin.close()
+			except Exception:
+				pass
+			self.process.terminate()
+			self.process = None
+
+# num_process subprocesses are started for a tool to serve concurrent requests (e.g. from threads of the server), each request goes to the process with the fewest pending jobs.
+
 class ProcessWrapper:
 
-	def __init__(self, cmd=None):
+	def __init__(self, cmd=None, num_process=1, sentinel=None):
 
 		self.process = None
 		self.cmd = [] if cmd is None else cmd
+		self.num_process, self.sentinel = num_process, sentinel
+		self.lock = Lock()
 
-	def start(self, stdin=PIPE, stdout=PIPE):
+	def start(self):
 
 		if self.process:
 			raise Exception("Process is already running")
-		self.process = Popen(self.cmd, stdin=stdin, stdout=stdout)
+		self.process = [PipeProcess(self.cmd, sentinel=self.sentinel) for _ in range(self.num_process)]
 
-	def __del__(self):
+	def submit(self, lines):
+
+		with self.lock:
+			return min(self.process, key=len).submit(lines)
+
+	def process_lines(self, lines):
+
+		rs = self.submit(lines).result()
+		if len(rs) != len(lines):
+			raise Exception("Misaligned outputs: %d lines for %d inputs" % (len(rs), len(lines),))
+
+		return rs
+
+	def close(self):
 
 		if self.process:
-			self.process.terminate()
+			for _ in self.process:
+				_.close()
+			self.process = None
+
+	def __del__(self):
+
+		self.close()
 
 class LineProcessor(ProcessWrapper):
 
 	def __call__(self, input):
 
-		self.process.stdin.write(("%s\n" % input.strip()).encode("utf-8", "ignore"))
-		self.process.stdin.flush()
-
-		return self.process.stdout.readline().strip().decode("utf-8", "ignore")
+		return self.process_lines([input])[0]
 
 class BatchProcessor(ProcessWrapper):
 
 	def __call__(self, input):
 
-		if isinstance(input, (list, tuple,)):
-			rs = []
-
-			for inputu in input:
-				self.process.stdin.write(("%s\n" % inputu.strip()).encode("utf-8", "ignore"))
-				self.process.stdin.flush()
-				rs.append(self.process.stdout.readline().strip().decode("utf-8", "ignore"))
-		else:
-			self.process.stdin.write(("%s\n" % input.strip()).encode("utf-8", "ignore"))
-			self.process.stdin.flush()
-			rs = self.process.stdout.readline().strip().decode("utf-8", "ignore")
-
-		return rs
+		return self.process_lines(input) if isinstance(input, (list, tuple,)) else self.process_lines([input])[0]
 
 class SentenceSplitter(ProcessWrapper):
 	"""Wrapper for standard Moses sentence splitter."""
 
-	def __init__(self, lang):
+	def __init__(self, lang, num_process=1):
 
 		ssplit_cmd = moses_scripts + sep.join(("ems", "support", "split-sentences.perl"))
-		self.cmd = [perl_exec, ssplit_cmd, "-b", "-q", "-l", lang]
-		self.process = None
+		# paragraphs are ended by <P>, which is kept as it is by the splitter
+		super(SentenceSplitter, self).__init__([perl_exec, ssplit_cmd, "-b", "-q", "-l", lang], num_process=num_process, sentinel="<P>")
 		self.start()
 
 	def __call__(self, input):
 
-		self.process.stdin.write((input.strip() + "\n<P>\n").encode("utf-8", "ignore"))
-		self.process.stdin.flush()
-		x = self.process.stdout.readline().strip().decode("utf-8", "ignore")
-		ret = []
-		while x != "<P>" and x != "":
-			ret.append(x)
-			x = self.process.stdout.readline().strip().decode("utf-8", "ignore")
-
-		return ret
+		return [_ for _ in self.submit([input]).result() if _]
 
 class Pretokenizer(BatchProcessor):
 	"""Pretokenizer wrapper.
 	The pretokenizer fixes known issues with the input.
 	"""
-	def __init__(self, lang):
+	def __init__(self, lang, num_process=1):
 
 		pretok_cmd = moses_scripts + sep.join(("tokenizer", "pre-tokenizer.perl"))
-		self.cmd = [perl_exec, pretok_cmd, "-b", "-q", "-l", lang]
-		self.process = None
+		super(Pretokenizer, self).__init__([perl_exec, pretok_cmd, "-b", "-q", "-l", lang], num_process=num_process)
 		self.start()
 
 class Tokenizer(BatchProcessor):
@@ -93,46 +212,41 @@ class Tokenizer(BatchProcessor):
 	The pretokenizer fixes known issues with the input.
 	"""
 	# default args: ["-a", "-no-escape"]
-	def __init__(self, lang, args=["-a"]):
+	def __init__(self, lang, args=["-a"], num_process=1):
 
 		tok_cmd = moses_scripts + sep.join(("tokenizer", "tokenizer.perl"))
-		self.cmd = [perl_exec, tok_cmd, "-b", "-q", "-l", lang] + args
-		self.process = None
+		super(Tokenizer, self).__init__([perl_exec, tok_cmd, "-b", "-q", "-l", lang] + args, num_process=num_process)
 		self.start()
 
 class Normalizepunctuation(BatchProcessor):
 
-	def __init__(self, lang):
+	def __init__(self, lang, num_process=1):
 
 		tok_cmd = moses_scripts + sep.join(("tokenizer", "normalize-punctuation.perl"))
-		self.cmd = [perl_exec, tok_cmd, "-b", "-q", "-l", lang]
-		self.process = None
+		super(Normalizepunctuation, self).__init__([perl_exec, tok_cmd, "-b", "-q", "-l", lang], num_process=num_process)
 		self.start()
 
 class Truecaser(BatchProcessor):
 	"""Truecaser wrapper."""
-	def __init__(self, model):
+	def __init__(self, model, num_process=1):
 
 		truecase_cmd = moses_scripts + sep.join(("recaser", "truecase.perl"))
-		self.cmd = [perl_exec, truecase_cmd, "-b", "--model", model]
-		self.process = None
+		super(Truecaser, self).__init__([perl_exec, truecase_cmd, "-b", "--model", model], num_process=num_process)
 		self.start()
 
 class Detruecaser(BatchProcessor):
 
-	def __init__(self):
+	def __init__(self, num_process=1):
 
 		truecase_cmd = moses_scripts + sep.join(("recaser", "detruecase.perl"))
-		self.cmd = [perl_exec, truecase_cmd, "-b"]
-		self.process = None
+		super(Detruecaser, self).__init__([perl_exec, truecase_cmd, "-b"], num_process=num_process)
 		self.start()
 
 class Detokenizer(BatchProcessor):
 
 	# default args: ["-a", "-no-escape"]
-	def __init__(self, lang):
+	def __init__(self, lang, num_process=1):
 
 		tok_cmd = moses_scripts + sep.join(("tokenizer", "detokenizer.perl"))
-		self.cmd = [perl_exec, tok_cmd, "-q", "-b", "-l", lang]
-		self.process = None
+		super(Detokenizer, self).__init__([perl_exec, tok_cmd, "-q", "-b", "-l", lang], num_process=num_process)
 		self.start()
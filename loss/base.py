@@ -3,7 +3,8 @@
 import torch
 from torch.nn.modules.loss import _Loss, NLLLoss as NLLLossBase
 
-from torch.nn.functional import kl_div, nll_loss
+from torch.nn.functional import kl_div, nll_loss, log_softmax
+from torch.utils.checkpoint import checkpoint
 
 from utils.base import clear_pad_mask, eq_indexes
 
@@ -120,6 +121,47 @@ class StdLabelSmoothingLoss(_Loss):
 
 LabelSmoothingLoss = FastLabelSmoothingLoss if use_fast_loss else StdLabelSmoothingLoss
 
+# compute the classifier, the log-softmax and LabelSmoothingLoss together on chunks of chunk_size tokens, the log-probabilities of a chunk are recomputed in backward instead of being kept, so that the full (bsize, nquery, nclass) tensor is never materialized and the peak memory of the vocabulary projection is bounded by chunk_size. Results equal to LabelSmoothingLoss on the output of the classifier up to the summation order of chunks.
+
+class ChunkedLabelSmoothingLoss(LabelSmoothingLoss):
+
+	def __init__(self, nclass, label_smoothing=0.1, ignore_index=-1, reduction="mean", forbidden_index=-1, chunk_size=4096, **kwargs):
+
+		super(ChunkedLabelSmoothingLoss, self).__init__(nclass, label_smoothing=label_smoothing, ignore_index=ignore_index, reduction="none" if reduction == "none" else "sum", forbidden_index=forbidden_index, **kwargs)
+		self.chunk_reduction, self.chunk_size = reduction, chunk_size
+		# StdLabelSmoothingLoss averages over all elements of kl_div
+		self.mean_scale = 1 if isinstance(self, FastLabelSmoothingLoss) else nclass
+
+	# input: hidden states before the classifier (bsize, nquery, isize), or log-probabilities if classifier is None
+	# target: (bsize, nquery)
+	# classifier: the classifier of the decoder, e.g. model.dec.classifier
+
+	def forward(self, input, target, classifier=None, mask=None):
+
+		if classifier is None:
+			rs = super(ChunkedLabelSmoothingLoss, self).forward(input, target, mask=mask)
+			return rs / float(target.numel() * self.mean_scale) if self.chunk_reduction == "mean" else rs
+
+		_input = input.view(-1, input.size(-1))
+		_target = target.view(-1)
+		_mask = None if mask is None else mask.view(-1)
+		_ntok = _target.size(0)
+		rs = []
+		for _i in range(0, _ntok, self.chunk_size):
+			_n = min(self.chunk_size, _ntok - _i)
+			_m = None if _mask is None else _mask.narrow(0, _i, _n)
+			rs.append(checkpoint(self.chunk_forward, _input.narrow(0, _i, _n), _target.narrow(0, _i, _n), classifier, _m, use_reentrant=False))
+		if self.chunk_reduction == "none":
+			rs = torch.cat(rs, 0)
+			return rs.view(*target.size(), -1)
+		rs = rs[0] if len(rs) == 1 else torch.stack(rs, 0).sum()
+
+		return rs / float(target.numel() * self.mean_scale) if self.chunk_reduction == "mean" else rs
+
+	def chunk_forward(self, input, target, classifier, mask):
+
+		return super(ChunkedLabelSmoothingLoss, self).forward(log_softmax(classifier(input), -1), target, mask=mask)
+
 class NLLLoss(NLLLossBase):
 
 	def forward(self, input, target):
@@ -8,6 +8,7 @@ from torch.autograd import Function
 from torch.utils.cpp_extension import load
 
 from utils.base import reduce_model_list, repeat_bsize_for_beam_tensor
+from utils.kvcache import KVCacheLayer
 from utils.relpos.bucket import build_rel_pos_bucket_map, build_rel_pos_bucket
 from modules.act import Custom_Act, LGLU, get_act, reduce_model as reduce_model_act
 from modules.dropout import Dropout, reduce_model as reduce_model_drop
@@ -259,9 +260,12 @@ class MultiHeadAttn(nn.Module):
 		self.register_buffer("real_iV", None)
 		self.register_buffer("iK", None)
 		self.register_buffer("iV", None)
+		# number of beams sharing each cached key/value sequence, see repeat_buffer
+		self.nbeam = 1
 
 		if self.c_available():
 			self.c_init()
+		self.broadcast_beam = broadcast_cross_attn_beam and (type(self) == MultiHeadAttn) and (self.rel_pemb is None) and (not self.c_available())
 
 	# iQ: query (bsize, num_query, vsize)
 	# iK: keys (bsize, seql, vsize)
@@ -279,20 +283,26 @@ class MultiHeadAttn(nn.Module):
 		# real_iK: MultiHead iK (bsize, seql, vsize) => (bsize, nheads, adim, seql)
 		# real_iV: MultiHead iV (bsize, seql, vsize) => (bsize, nheads, seql, adim)
 
-		real_iQ = self.query_adaptor(iQ).view(bsize, nquery, nheads, adim).transpose(1, 2)
+		real_iQ = self.query_adaptor(iQ)
 
 		if (self.real_iK is not None) and self.iK.is_set_to(iK) and (not self.training):
 			real_iK = self.real_iK
 		else:
-			real_iK = self.key_adaptor(iK).view(bsize, seql, nheads, adim).permute(0, 2, 3, 1)
+			real_iK = self.key_adaptor(iK).view(iK.size(0), seql, nheads, adim).permute(0, 2, 3, 1)
 			if not self.training:
-				self.iK, self.real_iK = iK, real_iK
+				self.iK, self.real_iK, self.nbeam = iK, real_iK, 1
 		if (self.real_iV is not None) and self.iV.is_set_to(iV) and (not self.training):
 			real_iV = self.real_iV
 		else:
-			real_iV = self.value_adaptor(iV).view(bsize, seql, nheads, adim).transpose(1, 2)
+			real_iV = self.value_adaptor(iV).view(iV.size(0), seql, nheads, adim).transpose(1, 2)
 			if not self.training:
 				self.iV, self.real_iV = iV, real_iV
+		# beams of a sentence are folded into queries: (bsize * nbeam, nquery, vsize) => (bsize, nheads, nbeam * nquery, adim), so that keys/values are not repeated for beams
+		_bsize = real_iK.size(0)
+		_nquery = (bsize * nquery) // _bsize
+		real_iQ = real_iQ.view(_bsize, _nquery, nheads, adim).transpose(1, 2)
+		if (mask is not None) and (mask.size(0) != _bsize):
+			mask = mask.view(_bsize, -1, *mask.size()[1:]).select(1, 0)
 
 		if states is not None:
 			_h_real_iK, _h_real_iV = states
@@ -349,16 +359,26 @@ class MultiHeadAttn(nn.Module):
 	def reset_buffer(self, value=None):
 
 		self.iK = self.iV = self.real_iK = self.real_iV = self.rel_pos_cache = value
+		self.nbeam = 1
+
+	# with broadcast_beam, cached keys/values are shared by the beam_size beams of each sentence instead of being repeated
 
 	def repeat_buffer(self, beam_size):
 
-		if self.real_iK is not None:
-			self.real_iK = repeat_bsize_for_beam_tensor(self.real_iK, beam_size)
-		if self.real_iV is not None:
-			self.real_iV = repeat_bsize_for_beam_tensor(self.real_iV, beam_size)
+		if self.broadcast_beam and (self.real_iK is not None) and (self.real_iV is not None) and self.iK.is_set_to(self.iV):
+			self.nbeam *= beam_size
+		else:
+			if self.real_iK is not None:
+				self.real_iK = repeat_bsize_for_beam_tensor(self.real_iK, beam_size)
+			if self.real_iV is not None:
+				self.real_iV = repeat_bsize_for_beam_tensor(self.real_iV, beam_size)
+
+	# indices: indices of beams (all beams of remaining sentences) with shared keys/values
 
 	def index_buffer(self, indices, dim=0):
 
+		if self.nbeam > 1:
+			indices = indices.view(-1, self.nbeam).select(1, 0) // self.nbeam
 		if self.real_iK is not None:
 			self.real_iK = self.real_iK.index_select(dim, indices)
 		if self.real_iV is not None:
@@ -496,12 +516,16 @@ class SelfAttn(nn.Module):
 		real_iQ, real_iK, real_iV = real_iQ.transpose(1, 2), real_iK.permute(0, 2, 3, 1), real_iV.transpose(1, 2)
 
 		if states is not None:
-			_h_real_iK, _h_real_iV = states
-			if _h_real_iK is None:
-				seql = nquery
+			if isinstance(states, KVCacheLayer):
+				real_iK, real_iV = states(real_iK, real_iV)
+				seql = real_iV.size(2)
 			else:
-				seql = nquery + _h_real_iK.size(-1)
-				real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
+				_h_real_iK, _h_real_iV = states
+				if _h_real_iK is None:
+					seql = nquery
+				else:
+					seql = nquery + _h_real_iK.size(-1)
+					real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
 
 		scores = real_iQ.matmul(real_iK)
 
@@ -528,7 +552,8 @@ class SelfAttn(nn.Module):
 		if states is None:
 			return out
 		else:
-			return out, (real_iK, real_iV,)
+			# the KVCacheLayer is returned as it is, since keys and values have been written into it
+			return out, (states if isinstance(states, KVCacheLayer) else (real_iK, real_iV,))
 
 	def get_rel_pos(self, length):
 
@@ -620,9 +645,12 @@ class CrossAttn(nn.Module):
 		self.register_buffer("real_iK", None)
 		self.register_buffer("real_iV", None)
 		self.register_buffer("iK", None)
+		# number of beams sharing each cached key/value sequence, see repeat_buffer
+		self.nbeam = 1
 
 		if self.c_available():
 			self.c_init()
+		self.broadcast_beam = broadcast_cross_attn_beam and (type(self) == CrossAttn) and (not self.c_available())
 
 	def forward(self, iQ, iK, mask=None):
 
@@ -631,14 +659,21 @@ class CrossAttn(nn.Module):
 		nheads = self.num_head
 		adim = self.attn_dim
 
-		real_iQ = self.query_adaptor(iQ).view(bsize, nquery, nheads, adim).transpose(1, 2)
+		real_iQ = self.query_adaptor(iQ)
 		if (self.real_iK is not None) and self.iK.is_set_to(iK) and (not self.training):
 			real_iK, real_iV = self.real_iK, self.real_iV
 		else:
-			real_iK, real_iV = self.kv_adaptor(iK).view(bsize, seql, 2, nheads, adim).unbind(2)
+			real_iK, real_iV = self.kv_adaptor(iK).view(iK.size(0), seql, 2, nheads, adim).unbind(2)
 			real_iK, real_iV = real_iK.permute(0, 2, 3, 1), real_iV.transpose(1, 2)
 			if not self.training:
-				self.iK, self.real_iK, self.real_iV = iK, real_iK, real_iV
+				self.iK, self.real_iK, self.real_iV, self.nbeam = iK, real_iK, real_iV, 1
+
+		# beams of a sentence are folded into queries: (bsize * nbeam, nquery, vsize) => (bsize, nheads, nbeam * nquery, adim), so that keys/values are not repeated for beams
+		_bsize = real_iK.size(0)
+		_nquery = (bsize * nquery) // _bsize
+		real_iQ = real_iQ.view(_bsize, _nquery, nheads, adim).transpose(1, 2)
+		if (mask is not None) and (mask.size(0) != _bsize):
+			mask = mask.view(_bsize, -1, *mask.size()[1:]).select(1, 0)
 
 		scores = real_iQ.matmul(real_iK) / sqrt(adim)
 
@@ -664,17 +699,42 @@ class CrossAttn(nn.Module):
 	def reset_buffer(self, value=None):
 
 		self.iK = self.real_iK = self.real_iV = value
+		self.nbeam = 1
+
+	# with broadcast_beam, cached keys/values are shared by the beam_size beams of each sentence instead of being repeated
 
 	def repeat_buffer(self, beam_size):
 
 		if self.real_iK is not None:
-			self.real_iK, self.real_iV = repeat_bsize_for_beam_tensor(self.real_iK, beam_size), repeat_bsize_for_beam_tensor(self.real_iV, beam_size)
+			if self.broadcast_beam:
+				self.nbeam *= beam_size
+			else:
+				self.real_iK, self.real_iV = repeat_bsize_for_beam_tensor(self.real_iK, beam_size), repeat_bsize_for_beam_tensor(self.real_iV, beam_size)
+
+	# indices: indices of beams (all beams of remaining sentences) with shared keys/values
 
 	def index_buffer(self, indices, dim=0):
 
 		if self.real_iK is not None:
+			if self.nbeam > 1:
+				indices = indices.view(-1, self.nbeam).select(1, 0) // self.nbeam
 			self.real_iK, self.real_iV = self.real_iK.index_select(dim, indices), self.real_iV.index_select(dim, indices)
 
+	# replace cached keys/values at indices (of beams, bsize * beam_size) with those of iK (bsize, seql, isize), each repeated beam_size times (or shared by the nbeam beams of each sentence), used to put new sentences into a running batch without recomputing keys/values of other sentences
+
+	def index_copy_buffer(self, indices, iK, beam_size=1):
+
+		if self.real_iK is not None:
+			bsize, seql = iK.size()[:2]
+			real_iK, real_iV = self.kv_adaptor(iK).view(bsize, seql, 2, self.num_head, self.attn_dim).unbind(2)
+			real_iK, real_iV = real_iK.permute(0, 2, 3, 1), real_iV.transpose(1, 2)
+			if self.nbeam > 1:
+				indices = indices.view(-1, self.nbeam).select(1, 0) // self.nbeam
+			elif beam_size > 1:
+				real_iK, real_iV = repeat_bsize_for_beam_tensor(real_iK, beam_size), repeat_bsize_for_beam_tensor(real_iV, beam_size)
+			self.real_iK.index_copy_(0, indices, real_iK)
+			self.real_iV.index_copy_(0, indices, real_iV)
+
 	def c_available(self):
 
 		return use_c_backend_crossattn and (type(self) == CrossAttn) and (type(self.normer) == nn.Softmax)
@@ -0,0 +1,209 @@
+#encoding: utf-8
+
+# Modules with the weights of several models of the same architecture stacked along a leading model dimension, which run all models with batched matrix multiplications instead of looping over them (used by transformer/EnsembleFused.py for ensemble decoding). Inputs and outputs are of shape (nmodel, bsize, seql, isize), attention is computed on the (nmodel * bsize) batch. Weights are copied from given modules into buffers, these modules are only for inference (no dropout).
+
+import torch
+from torch import nn
+from torch.nn import functional as nnFunc
+from math import sqrt
+
+from cnfg.ihyp import *
+
+# weight: stacked embedding weights (nmodel, nwd, isize)
+# inputs: token ids shared by all models (bsize, seql) => (nmodel, bsize, seql, isize)
+
+def stacked_embedding(weight, inputs):
+
+	nmodel, nwd, isize = weight.size()
+	_offset = torch.arange(0, nmodel * nwd, nwd, dtype=inputs.dtype, device=inputs.device).view(nmodel, *([1] * inputs.dim()))
+
+	return weight.view(nmodel * nwd, isize).index_select(0, (inputs.unsqueeze(0) + _offset).view(-1)).view(nmodel, *inputs.size(), isize)
+
+class StackedLinear(nn.Module):
+
+	# linears: nn.Linear of models
+	# stack_weight: False for weights shared with other modules (e.g. classifiers bound to embeddings), which are passed to forward
+
+	def __init__(self, linears, stack_weight=True):
+
+		super(StackedLinear, self).__init__()
+
+		# weight: (nmodel, isize, osize), bias: (nmodel, 1, osize)
+		self.register_buffer("weight", torch.stack([_.weight.detach().t() for _ in linears], 0).contiguous() if stack_weight else None)
+		self.register_buffer("bias", None if linears[0].bias is None else torch.stack([_.bias.detach() for _ in linears], 0).unsqueeze(1))
+
+	# x: (nmodel, ..., isize)
+	# weight: (nmodel, isize, osize), self.weight if None
+
+	def forward(self, x, weight=None):
+
+		_isize = x.size()
+		_x = x.reshape(_isize[0], -1, _isize[-1])
+		_w = self.weight if weight is None else weight
+		out = _x.bmm(_w) if self.bias is None else self.bias.baddbmm(_x, _w)
+
+		return out.view(*_isize[:-1], out.size(-1))
+
+class StackedLayerNorm(nn.Module):
+
+	def __init__(self, normers):
+
+		super(StackedLayerNorm, self).__init__()
+
+		self.normalized_shape, self.eps = normers[0].normalized_shape, normers[0].eps
+		self.register_buffer("weight", None if normers[0].weight is None else torch.stack([_.weight.detach() for _ in normers], 0))
+		self.register_buffer("bias", None if normers[0].bias is None else torch.stack([_.bias.detach() for _ in normers], 0))
+
+	def forward(self, x):
+
+		out = nnFunc.layer_norm(x, self.normalized_shape, None, None, self.eps)
+		_wsize = (x.size(0), *([1] * (x.dim() - 2)), -1,)
+		if self.weight is not None:
+			out = out * self.weight.view(_wsize)
+		if self.bias is not None:
+			out = out + self.bias.view(_wsize)
+
+		return out
+
+class SelfAttn(nn.Module):
+
+	# attns: modules.base.SelfAttn of models
+
+	def __init__(self, attns):
+
+		super(SelfAttn, self).__init__()
+
+		self.attn_dim, self.hsize, self.num_head = attns[0].attn_dim, attns[0].hsize, attns[0].num_head
+		self.adaptor = StackedLinear([_.adaptor for _ in attns])
+		self.outer = StackedLinear([_.outer for _ in attns])
+
+	# iQ: (nmodel, bsize, nquery, isize)
+	# mask: (nmodel * bsize, nquery, seql)
+	# states: (real_iK, real_iV) of decoding history on the (nmodel * bsize) batch
+
+	def forward(self, iQ, mask=None, states=None):
+
+		nmodel, bsize, nquery = iQ.size()[:3]
+		nheads = self.num_head
+		adim = self.attn_dim
+
+		real_iQ, real_iK, real_iV = self.adaptor(iQ).view(nmodel * bsize, nquery, 3, nheads, adim).unbind(2)
+		real_iQ, real_iK, real_iV = real_iQ.transpose(1, 2), real_iK.permute(0, 2, 3, 1), real_iV.transpose(1, 2)
+
+		if states is not None:
+			_h_real_iK, _h_real_iV = states
+			if _h_real_iK is not None:
+				real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
+
+		scores = real_iQ.matmul(real_iK) / sqrt(adim)
+
+		if mask is not None:
+			scores.masked_fill_(mask.unsqueeze(1), -inf_default)
+
+		out = self.outer(scores.softmax(-1).matmul(real_iV).transpose(1, 2).contiguous().view(nmodel, bsize, nquery, self.hsize))
+
+		if states is None:
+			return out
+		else:
+			return out, (real_iK, real_iV,)
+
+class CrossAttn(nn.Module):
+
+	# attns: modules.base.CrossAttn of models
+
+	def __init__(self, attns):
+
+		super(CrossAttn, self).__init__()
+
+		self.attn_dim, self.hsize, self.num_head = attns[0].attn_dim, attns[0].hsize, attns[0].num_head
+		self.query_adaptor = StackedLinear([_.query_adaptor for _ in attns])
+		self.kv_adaptor = StackedLinear([_.kv_adaptor for _ in attns])
+		self.outer = StackedLinear([_.outer for _ in attns])
+
+	# keys and values computed once for all decoding steps
+	# iK: (nmodel, bsize, seql, isize) => ((nmodel * bsize, nheads, adim, seql), (nmodel * bsize, nheads, seql, adim))
+
+	def get_kv(self, iK):
+
+		nmodel, bsize, seql = iK.size()[:3]
+		real_iK, real_iV = self.kv_adaptor(iK).view(nmodel * bsize, seql, 2, self.num_head, self.attn_dim).unbind(2)
+
+		return real_iK.permute(0, 2, 3, 1), real_iV.transpose(1, 2)
+
+	# kv: returned by get_kv
+	# mask: (nmodel * bsize, 1, seql)
+
+	def forward(self, iQ, kv, mask=None):
+
+		nmodel, bsize, nquery = iQ.size()[:3]
+		real_iK, real_iV = kv
+
+		real_iQ = self.query_adaptor(iQ).view(nmodel * bsize, nquery, self.num_head, self.attn_dim).transpose(1, 2)
+
+		scores = real_iQ.matmul(real_iK) / sqrt(self.attn_dim)
+
+		if mask is not None:
+			scores.masked_fill_(mask.unsqueeze(1), -inf_default)
+
+		return self.outer(scores.softmax(-1).matmul(real_iV).transpose(1, 2).contiguous().view(nmodel, bsize, nquery, self.hsize))
+
+class ResSelfAttn(nn.Module):
+
+	def __init__(self, attns):
+
+		super(ResSelfAttn, self).__init__()
+
+		self.net = SelfAttn([_.net for _ in attns])
+		self.normer = StackedLayerNorm([_.normer for _ in attns])
+		self.norm_residual = attns[0].norm_residual
+
+	def forward(self, iQ, *inputs, **kwargs):
+
+		_iQ = self.normer(iQ)
+
+		outs = self.net(_iQ, *inputs, **kwargs)
+
+		_res = _iQ if self.norm_residual else iQ
+		if isinstance(outs, tuple):
+			return outs[0] + _res, *outs[1:]
+		else:
+			return outs + _res
+
+class ResCrossAttn(nn.Module):
+
+	def __init__(self, attns):
+
+		super(ResCrossAttn, self).__init__()
+
+		self.net = CrossAttn([_.net for _ in attns])
+		self.normer = StackedLayerNorm([_.normer for _ in attns])
+		self.norm_residual = attns[0].norm_residual
+
+	def get_kv(self, iK):
+
+		return self.net.get_kv(iK)
+
+	def forward(self, iQ, kv, mask=None):
+
+		_iQ = self.normer(iQ)
+
+		return self.net(_iQ, kv, mask=mask) + (_iQ if self.norm_residual else iQ)
+
+class PositionwiseFF(nn.Module):
+
+	# ffs: modules.base.PositionwiseFF (without GLU) of models
+
+	def __init__(self, ffs):
+
+		super(PositionwiseFF, self).__init__()
+
+		_linears = [[_m for _m in _ff.net if isinstance(_m, nn.Linear)] for _ff in ffs]
+		self.net = nn.Sequential(StackedLinear([_[0] for _ in _linears]), ffs[0].net[1], StackedLinear([_[-1] for _ in _linears]))
+		self.normer = StackedLayerNorm([_.normer for _ in ffs])
+		self.norm_residual = ffs[0].norm_residual
+
+	def forward(self, x):
+
+		_out = self.normer(x)
+
+		return self.net(_out) + (_out if self.norm_residual else x)
@@ -7,14 +7,21 @@ from torch.optim.optimizer import Optimizer
 
 from math import sqrt
 
+from optm.base import foreach_maximum_, group_foreach_params, use_foreach
+
+from cnfg.ihyp import optm_foreach
+
 class AdaBelief(Optimizer):
 
-	def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, amsgrad=False, weight_decouple=False, fixed_decay=False, rectify=False):
+	# foreach: update parameters of each param_group with multi-tensor kernels, None to use them only for parameters on GPUs (optm/base.py)
+
+	def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, amsgrad=False, weight_decouple=False, fixed_decay=False, rectify=False, foreach=optm_foreach):
 
 		defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, amsgrad=amsgrad)
 		super(AdaBelief, self).__init__(params, defaults)
 
 		self.weight_decouple, self.rectify, self.fixed_decay = weight_decouple, rectify, fixed_decay
+		self.foreach = foreach
 
 	@torch.no_grad()
 	def step(self, closure=None):
@@ -26,65 +33,132 @@ class AdaBelief(Optimizer):
 				loss = closure()
 
 		for group in self.param_groups:
+			if use_foreach(self.foreach, group["params"]):
+				self.step_group_foreach(group)
+			else:
+				self.step_group(group)
 
-			for p in group["params"]:
-
-				if p.grad is not None:
+		return loss
 
-					grad = p.grad
-					amsgrad = group["amsgrad"]
+	def init_state(self, p, group):
+
+		state = self.state[p]
+		if len(state) == 0:
+			state["rho_inf"] = 2.0 / (1.0 - group["betas"][-1]) - 1.0
+			state["step"] = 0
+			state["exp_avg"] = p.data.new_zeros(p.data.size())
+			state["exp_avg_sq"] = p.data.new_zeros(p.data.size())
+			if group["amsgrad"]:
+				state["max_exp_avg_sq"] = p.data.new_zeros(p.data.size())
+
+		return state
+
+	# returns the step size, and whether parameters are updated with the adaptive learning rate, which is not used in early steps with rectify
+
+	def get_step_size(self, group, step, rho_inf):
+
+		beta1, beta2 = group["betas"]
+		bias_correction1 = 1.0 - beta1 ** step
+		if self.rectify:
+			rho_t = rho_inf - 2 * step * beta2 ** step / (1.0 - beta2 ** step)
+			if rho_t > 4:
+				rt = (rho_t - 4.0) * (rho_t - 2.0) * rho_inf / (rho_inf - 4.0) / (rho_inf - 2.0) / rho_t
+				rt = sqrt(rt)
+				return rt * group["lr"] / bias_correction1, True, rho_t
+			else:
+				return group["lr"], False, rho_t
+		else:
+			return group["lr"] / bias_correction1, True, None
 
-					state = self.state[p]
+	def step_group(self, group):
 
-					beta1, beta2 = group["betas"]
+		for p in group["params"]:
 
-					if len(state) == 0:
-						state["rho_inf"] = 2.0 / (1.0 - beta2) - 1.0
-						state["step"] = 0
-						state["exp_avg"] = p.data.new_zeros(p.data.size())
-						state["exp_avg_sq"] = p.data.new_zeros(p.data.size())
-						if amsgrad:
-							state["max_exp_avg_sq"] = p.data.new_zeros(p.data.size())
+			if p.grad is not None:
 
-					exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+				grad = p.grad
+				amsgrad = group["amsgrad"]
 
-					state["step"] += 1
-					bias_correction1 = 1.0 - beta1 ** state["step"]
-					bias_correction2 = 1.0 - beta2 ** state["step"]
+				state = self.init_state(p, group)
 
-					if self.weight_decouple:
-						if self.fixed_decay:
-							p.data.mul_(1.0 - group["weight_decay"])
-						else:
-							p.data.mul_(1.0 - group["lr"] * group["weight_decay"])
-					elif group["weight_decay"] != 0:
-						grad.add_(p.data, alpha=group["weight_decay"])
+				beta1, beta2 = group["betas"]
 
-					exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
-					grad_residual = grad - exp_avg
-					exp_avg_sq.mul_(beta2).addcmul_(grad_residual, grad_residual, value=1.0 - beta2)
+				exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
 
-					if amsgrad:
-						max_exp_avg_sq = state["max_exp_avg_sq"]
-						torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+				state["step"] += 1
+				bias_correction2 = 1.0 - beta2 ** state["step"]
 
-						denom = (max_exp_avg_sq.add_(group["eps"]).sqrt() / sqrt(bias_correction2)).add_(group["eps"])
-					else:
-						denom = (exp_avg_sq.add_(group["eps"]).sqrt() / sqrt(bias_correction2)).add_(group["eps"])
-
-					if self.rectify:
-						state["rho_t"] = state["rho_inf"] - 2 * state["step"] * beta2 ** state["step"] / (1.0 - beta2 ** state["step"])
-
-						if state["rho_t"] > 4:
-							rho_inf, rho_t = state["rho_inf"], state["rho_t"]
-							rt = (rho_t - 4.0) * (rho_t - 2.0) * rho_inf / (rho_inf - 4.0) / (rho_inf - 2.0) / rho_t
-							rt = sqrt(rt)
-							step_size = rt * group["lr"] / bias_correction1
-							p.data.addcdiv_(exp_avg, denom, value=-step_size)
-						else:
-							p.data.add_(exp_avg, alpha=-group["lr"])
+				if self.weight_decouple:
+					if self.fixed_decay:
+						p.data.mul_(1.0 - group["weight_decay"])
 					else:
-						step_size = group["lr"] / bias_correction1
-						p.data.addcdiv_(exp_avg, denom, value=-step_size)
-
-		return loss
+						p.data.mul_(1.0 - group["lr"] * group["weight_decay"])
+				elif group["weight_decay"] != 0:
+					grad.add_(p.data, alpha=group["weight_decay"])
+
+				exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
+				grad_residual = grad - exp_avg
+				exp_avg_sq.mul_(beta2).addcmul_(grad_residual, grad_residual, value=1.0 - beta2)
+
+				if amsgrad:
+					max_exp_avg_sq = state["max_exp_avg_sq"]
+					torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+
+					denom = (max_exp_avg_sq.add_(group["eps"]).sqrt() / sqrt(bias_correction2)).add_(group["eps"])
+				else:
+					denom = (exp_avg_sq.add_(group["eps"]).sqrt() / sqrt(bias_correction2)).add_(group["eps"])
+
+				step_size, adaptive, rho_t = self.get_step_size(group, state["step"], state["rho_inf"])
+				if rho_t is not None:
+					state["rho_t"] = rho_t
+				if adaptive:
+					p.data.addcdiv_(exp_avg, denom, value=-step_size)
+				else:
+					p.data.add_(exp_avg, alpha=-step_size)
+
+	def step_group_foreach(self, group):
+
+		amsgrad = group["amsgrad"]
+		beta1, beta2 = group["betas"]
+		for (_, _, _cur_step,), params in group_foreach_params(group["params"], self.state).items():
+
+			states = [self.init_state(p, group) for p in params]
+			grads = [p.grad for p in params]
+			params = [p.data for p in params]
+			exp_avgs, exp_avg_sqs = [_["exp_avg"] for _ in states], [_["exp_avg_sq"] for _ in states]
+
+			_cur_step += 1
+			for _ in states:
+				_["step"] = _cur_step
+			bias_correction2 = 1.0 - beta2 ** _cur_step
+
+			if self.weight_decouple:
+				torch._foreach_mul_(params, (1.0 - group["weight_decay"]) if self.fixed_decay else (1.0 - group["lr"] * group["weight_decay"]))
+			elif group["weight_decay"] != 0:
+				torch._foreach_add_(grads, params, alpha=group["weight_decay"])
+
+			torch._foreach_mul_(exp_avgs, beta1)
+			torch._foreach_add_(exp_avgs, grads, alpha=1.0 - beta1)
+			grad_residuals = torch._foreach_sub(grads, exp_avgs)
+			torch._foreach_mul_(exp_avg_sqs, beta2)
+			torch._foreach_addcmul_(exp_avg_sqs, grad_residuals, grad_residuals, value=1.0 - beta2)
+			grad_residuals = None
+
+			if amsgrad:
+				max_exp_avg_sqs = [_["max_exp_avg_sq"] for _ in states]
+				foreach_maximum_(max_exp_avg_sqs, exp_avg_sqs)
+				exp_avg_sqs = max_exp_avg_sqs
+			torch._foreach_add_(exp_avg_sqs, group["eps"])
+			denom = torch._foreach_sqrt(exp_avg_sqs)
+			torch._foreach_div_(denom, sqrt(bias_correction2))
+			torch._foreach_add_(denom, group["eps"])
+
+			# rho_inf is the same for parameters of the group
+			step_size, adaptive, rho_t = self.get_step_size(group, _cur_step, states[0]["rho_inf"])
+			if rho_t is not None:
+				for _ in states:
+					_["rho_t"] = rho_t
+			if adaptive:
+				torch._foreach_addcdiv_(params, exp_avgs, denom, value=-step_size)
+			else:
+				torch._foreach_add_(params, exp_avgs, alpha=-step_size)
@@ -0,0 +1,47 @@
+#encoding: utf-8
+
+# helpers for multi-tensor (torch._foreach_*) optimizer steps, which update lists of parameters with a few kernel launches instead of several launches for each parameter. Results are identical to those of per-parameter loops, as foreach kernels apply the same element-wise operations, but temporary tensors (e.g. denominators) are allocated for all parameters of a list at once.
+
+import torch
+
+foreach_available = hasattr(torch, "_foreach_addcdiv_")
+
+# foreach: True/False to enable/disable foreach implementations, None to use them only for param_groups with parameters on GPUs, where steps are bounded by kernel launches, while foreach kernels fall back to per-tensor loops on CPU.
+
+def use_foreach(foreach, params):
+
+	if foreach_available:
+		return any(p.is_cuda for p in params) if foreach is None else foreach
+
+	return False
+
+# group parameters with gradients by device, dtype and the step count in their states (0 for parameters without states), as a foreach kernel is launched on tensors of the same device and dtype, and step sizes depend on step counts. Parameters of a group keep their order in params.
+
+def group_foreach_params(params, state, step_key="step"):
+
+	rs = {}
+	for p in params:
+		if p.grad is not None:
+			_k = (p.device, p.dtype, state[p].get(step_key, 0) if p in state else 0,)
+			if _k in rs:
+				rs[_k].append(p)
+			else:
+				rs[_k] = [p]
+
+	return rs
+
+if hasattr(torch, "_foreach_copy_"):
+	foreach_copy_ = torch._foreach_copy_
+else:
+	def foreach_copy_(tgt, src):
+
+		for _t, _s in zip(tgt, src):
+			_t.copy_(_s)
+
+if hasattr(torch, "_foreach_maximum_"):
+	foreach_maximum_ = torch._foreach_maximum_
+else:
+	def foreach_maximum_(tgt, src):
+
+		for _t, _s in zip(tgt, src):
+			torch.max(_t, _s, out=_t)
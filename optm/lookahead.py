@@ -3,9 +3,15 @@
 import torch
 from torch.optim.optimizer import Optimizer
 
+from optm.base import foreach_copy_, group_foreach_params, use_foreach
+
+from cnfg.ihyp import optm_foreach
+
 class Lookahead(Optimizer):
 
-	def __init__(self, params, optimizer, steps=5, alpha=0.8, pullback_momentum=None):
+	# foreach: update parameters of each param_group with multi-tensor kernels, None to use them only for parameters on GPUs (optm/base.py)
+
+	def __init__(self, params, optimizer, steps=5, alpha=0.8, pullback_momentum=None, foreach=optm_foreach):
 
 		super(Lookahead, self).__init__(params, {})
 
@@ -13,8 +19,10 @@ class Lookahead(Optimizer):
 		self.cur_step = 0
 		self.alpha = alpha
 		self.steps = steps
-		self.pullback_momentum = pullback_momentum.lower()
+		self.pullback_momentum = None if pullback_momentum is None else pullback_momentum.lower()
+		self.foreach = foreach
 
+	@torch.no_grad()
 	def step(self, closure=None):
 
 		loss = self.optimizer.step(closure)
@@ -24,26 +32,63 @@ class Lookahead(Optimizer):
 			self.cur_step = 0
 			# Lookahead and cache the current optimizer parameters
 			for group in self.optimizer.param_groups:
+				if use_foreach(self.foreach, group["params"]):
+					self.step_group_foreach(group)
+				else:
+					self.step_group(group)
 
-				for p in group["params"]:
+		return loss
 
-					if p.grad is not None:
+	def init_state(self, p):
 
-						state = self.state[p]
+		state = self.state[p]
+		state["cached_params"] = p.data.clone()
+		if self.pullback_momentum == "pullback":
+			state["cached_mom"] = p.data.new_zeros(p.data.size())
 
-						if len(state) == 0:
-							state["cached_params"] = p.data.clone()
-							if self.pullback_momentum == "pullback":
-								state["cached_mom"] = p.data.new_zeros(p.data.size())
-						else:
-							p.data.mul_(self.alpha).add_(1.0 - self.alpha, state["cached_params"])
-							state["cached_params"].copy_(p.data)
-							if self.pullback_momentum == "pullback":
-								internal_momentum = self.optimizer.state[p]["momentum_buffer"]
-								self.optimizer.state[p]["momentum_buffer"] = internal_momentum.mul_(self.alpha).add_(
-									1.0 - self.alpha, state["cached_mom"])
-								state["cached_mom"] = self.optimizer.state[p]["momentum_buffer"]
-							elif self.pullback_momentum == "reset":
-								self.optimizer.state[p]["momentum_buffer"] = torch.zeros_like(p.data)
+	def step_group(self, group):
 
-		return loss
+		for p in group["params"]:
+
+			if p.grad is not None:
+
+				state = self.state[p]
+
+				if len(state) == 0:
+					self.init_state(p)
+				else:
+					p.data.mul_(self.alpha).add_(state["cached_params"], alpha=1.0 - self.alpha)
+					state["cached_params"].copy_(p.data)
+					if self.pullback_momentum == "pullback":
+						internal_momentum = self.optimizer.state[p]["momentum_buffer"]
+						self.optimizer.state[p]["momentum_buffer"] = internal_momentum.mul_(self.alpha).add_(state["cached_mom"], alpha=1.0 - self.alpha)
+						state["cached_mom"] = self.optimizer.state[p]["momentum_buffer"]
+					elif self.pullback_momentum == "reset":
+						self.optimizer.state[p]["momentum_buffer"] = torch.zeros_like(p.data)
+
+	def step_group_foreach(self, group):
+
+		_params = []
+		for p in group["params"]:
+			if p.grad is not None:
+				if (p in self.state) and (len(self.state[p]) > 0):
+					_params.append(p)
+				else:
+					self.init_state(p)
+		# the step count is not used, parameters are only grouped by device and dtype
+		for params in group_foreach_params(_params, {}).values():
+			states = [self.state[p] for p in params]
+			cached_params = [_["cached_params"] for _ in states]
+			_data = [p.data for p in params]
+			torch._foreach_mul_(_data, self.alpha)
+			torch._foreach_add_(_data, cached_params, alpha=1.0 - self.alpha)
+			foreach_copy_(cached_params, _data)
+			if self.pullback_momentum == "pullback":
+				internal_momentums = [self.optimizer.state[p]["momentum_buffer"] for p in params]
+				torch._foreach_mul_(internal_momentums, self.alpha)
+				torch._foreach_add_(internal_momentums, [_["cached_mom"] for _ in states], alpha=1.0 - self.alpha)
+				for _s, _m in zip(states, internal_momentums):
+					_s["cached_mom"] = _m
+			elif self.pullback_momentum == "reset":
+				for p in params:
+					self.optimizer.state[p]["momentum_buffer"] = torch.zeros_like(p.data)
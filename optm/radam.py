@@ -6,15 +6,22 @@ import torch
 from math import sqrt
 from torch.optim.optimizer import Optimizer
 
+from optm.base import group_foreach_params, use_foreach
+
+from cnfg.ihyp import optm_foreach
+
 class RAdam(Optimizer):
 
-	def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0, N_sma_threshhold=5, degenerated_to_sgd=True):
+	# foreach: update parameters of each param_group with multi-tensor kernels, None to use them only for parameters on GPUs (optm/base.py)
+
+	def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0, N_sma_threshhold=5, degenerated_to_sgd=True, foreach=optm_foreach):
 
 		defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, buffer=[[None, None, None] for _ in range(10)])
 		super(RAdam, self).__init__(params, defaults)
 
 		self.N_sma_threshhold = N_sma_threshhold
 		self.degenerated_to_sgd = degenerated_to_sgd
+		self.foreach = foreach
 
 	@torch.no_grad()
 	def step(self, closure=None):
@@ -26,52 +33,100 @@ class RAdam(Optimizer):
 				loss = closure()
 
 		for group in self.param_groups:
-
-			for p in group["params"]:
-
-				if p.grad is not None:
-
-					state = self.state[p]
-
-					if len(state) == 0:
-						state["step"] = 0
-						state["exp_avg"] = p.data.new_zeros(p.data.size())
-						state["exp_avg_sq"] = p.data.new_zeros(p.data.size())
-
-					exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
-					beta1, beta2 = group["betas"]
-
-					exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, p.grad, p.grad)
-					exp_avg.mul_(beta1).add_(1 - beta1, p.grad)
-
-					_cur_step = state["step"] = state["step"] + 1
-					buffered = group["buffer"][int(_cur_step % 10)]
-					if _cur_step == buffered[0]:
-						N_sma, step_size = buffered[1], buffered[2]
-					else:
-						buffered[0] = _cur_step
-						beta2_t = beta2 ** _cur_step
-						N_sma_max = 2 / (1 - beta2) - 1
-						N_sma = N_sma_max - 2 * _cur_step * beta2_t / (1 - beta2_t)
-						buffered[1] = N_sma
-
-						# more conservative since it"s an approximated value
-						if N_sma >= self.N_sma_threshhold:
-							step_size = sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** _cur_step)
-						elif self.degenerated_to_sgd:
-							step_size = 1.0 / (1 - beta1 ** _cur_step)
-						else:
-							step_size = -1
-						buffered[2] = step_size
-
-					if group["weight_decay"] > 0.0:
-						p.data.add_(-group["weight_decay"] * group["lr"], p.data)
-
-					# more conservative since it"s an approximated value
-					if N_sma >= self.N_sma_threshhold:
-						denom = exp_avg_sq.sqrt().add_(group["eps"])
-						p.data.addcdiv_(-step_size * group["lr"], exp_avg, denom)
-					elif step_size > 0:
-						p.data.add_(-step_size * group["lr"], exp_avg)
+			if use_foreach(self.foreach, group["params"]):
+				self.step_group_foreach(group)
+			else:
+				self.step_group(group)
 
 		return loss
+
+	def get_step_size(self, group, _cur_step):
+
+		beta1, beta2 = group["betas"]
+		buffered = group["buffer"][int(_cur_step % 10)]
+		if _cur_step == buffered[0]:
+			N_sma, step_size = buffered[1], buffered[2]
+		else:
+			buffered[0] = _cur_step
+			beta2_t = beta2 ** _cur_step
+			N_sma_max = 2 / (1 - beta2) - 1
+			N_sma = N_sma_max - 2 * _cur_step * beta2_t / (1 - beta2_t)
+			buffered[1] = N_sma
+
+			# more conservative since it"s an approximated value
+			if N_sma >= self.N_sma_threshhold:
+				step_size = sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** _cur_step)
+			elif self.degenerated_to_sgd:
+				step_size = 1.0 / (1 - beta1 ** _cur_step)
+			else:
+				step_size = -1
+			buffered[2] = step_size
+
+		return N_sma, step_size
+
+	def init_state(self, p):
+
+		state = self.state[p]
+		if len(state) == 0:
+			state["step"] = 0
+			state["exp_avg"] = p.data.new_zeros(p.data.size())
+			state["exp_avg_sq"] = p.data.new_zeros(p.data.size())
+
+		return state
+
+	def step_group(self, group):
+
+		for p in group["params"]:
+
+			if p.grad is not None:
+
+				state = self.init_state(p)
+
+				exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+				beta1, beta2 = group["betas"]
+
+				exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+				exp_avg.mul_(beta1).add_(p.grad, alpha=1 - beta1)
+
+				_cur_step = state["step"] = state["step"] + 1
+				N_sma, step_size = self.get_step_size(group, _cur_step)
+
+				if group["weight_decay"] > 0.0:
+					p.data.add_(p.data, alpha=-group["weight_decay"] * group["lr"])
+
+				# more conservative since it"s an approximated value
+				if N_sma >= self.N_sma_threshhold:
+					denom = exp_avg_sq.sqrt().add_(group["eps"])
+					p.data.addcdiv_(exp_avg, denom, value=-step_size * group["lr"])
+				elif step_size > 0:
+					p.data.add_(exp_avg, alpha=-step_size * group["lr"])
+
+	def step_group_foreach(self, group):
+
+		beta1, beta2 = group["betas"]
+		for (_, _, _cur_step,), params in group_foreach_params(group["params"], self.state).items():
+
+			states = [self.init_state(p) for p in params]
+			grads = [p.grad for p in params]
+			params = [p.data for p in params]
+			exp_avgs, exp_avg_sqs = [_["exp_avg"] for _ in states], [_["exp_avg_sq"] for _ in states]
+
+			torch._foreach_mul_(exp_avg_sqs, beta2)
+			torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+			torch._foreach_mul_(exp_avgs, beta1)
+			torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+			_cur_step += 1
+			for _ in states:
+				_["step"] = _cur_step
+			N_sma, step_size = self.get_step_size(group, _cur_step)
+
+			if group["weight_decay"] > 0.0:
+				torch._foreach_add_(params, params, alpha=-group["weight_decay"] * group["lr"])
+
+			if N_sma >= self.N_sma_threshhold:
+				denom = torch._foreach_sqrt(exp_avg_sqs)
+				torch._foreach_add_(denom, group["eps"])
+				torch._foreach_addcdiv_(params, exp_avgs, denom, value=-step_size * group["lr"])
+			elif step_size > 0:
+				torch._foreach_add_(params, exp_avgs, alpha=-step_size * group["lr"])
@@ -0,0 +1,193 @@
+#encoding: utf-8
+
+# Multi-process data parallel training with torch.distributed (launched with torchrun), as an alternative to the thread-based DataParallelModel: each process trains the model on its shard of batches, and gradients are summed across processes by all-reduce operations over buckets of gradients, which are launched by hooks during the backward pass of the last batch before an optimizer step so that communication overlaps with the computation of remaining gradients. Parameters are identical across processes after each step, as optimizers update them with the same gradients.
+
+import torch
+from torch import distributed as dist
+from os import environ
+from os.path import splitext
+from random import randint
+
+from cnfg.ihyp import dist_bucket_size
+
+def dist_enabled():
+
+	return dist.is_available() and dist.is_initialized()
+
+def get_rank_world():
+
+	return (dist.get_rank(), dist.get_world_size(),) if dist_enabled() else (0, 1,)
+
+# initialize the default process group from environment variables set by torchrun, returns (rank, world size, local rank), and (0, 1, 0) if not launched with more than one process.
+
+def init_dist(backend=None, use_cuda=False):
+
+	_nrank = int(environ.get("WORLD_SIZE", "1"))
+	if (_nrank > 1) and dist.is_available():
+		if not dist_enabled():
+			dist.init_process_group(("nccl" if use_cuda else "gloo") if backend is None else backend)
+		return dist.get_rank(), dist.get_world_size(), int(environ.get("LOCAL_RANK", "0"))
+
+	return 0, 1, 0
+
+def close_dist():
+
+	if dist_enabled():
+		dist.destroy_process_group()
+
+# a seed shared by all processes (that of rank 0 if seed is None), for the shuffling of batches which must be the same across processes.
+
+def dist_seed(seed=None):
+
+	if (seed is None) and dist_enabled():
+		_seed = [randint(0, 2 ** 31 - 1) if dist.get_rank() == 0 else None]
+		dist.broadcast_object_list(_seed, src=0)
+		return _seed[0]
+
+	return seed
+
+# the file of process rank, e.g. train.states.t7 -> train.states.1.t7 for rank 1 and train.states.t7 for rank 0.
+
+def rank_fname(fname, rank):
+
+	if (fname is None) or (rank == 0):
+		return fname
+	_base, _ext = splitext(fname)
+
+	return "%s.%d%s" % (_base, rank, _ext,)
+
+# shard batch ids (e.g. the shuffled list of training batches) into world_size shards of the same length by striding, the shortest shards are padded with batches from the beginning, so that all processes perform the same number of steps.
+
+def shard_batches(bids, rank, world_size):
+
+	if world_size <= 1:
+		return bids
+	_nb = len(bids)
+	_ns = (_nb + world_size - 1) // world_size
+	rs = list(bids[rank::world_size])
+	if len(rs) < _ns:
+		rs.extend(bids[i % _nb] for i in range(_ns - len(rs)))
+
+	return rs
+
+# merge dicts of all processes (e.g. losses of batches for dynamic sentence sampling, computed by each process on its shard), all processes get the same merged dict with keys of higher ranks taking precedence.
+
+def all_gather_dict(d):
+
+	if dist_enabled():
+		_l = [None for _ in range(dist.get_world_size())]
+		dist.all_gather_object(_l, d)
+		rs = {}
+		for _ in _l:
+			rs.update(_)
+		return rs
+
+	return d
+
+def broadcast_object(obj, src=0):
+
+	if dist_enabled():
+		_ = [obj if dist.get_rank() == src else None]
+		dist.broadcast_object_list(_, src=src)
+		return _[0]
+
+	return obj
+
+def broadcast_model(model, src=0):
+
+	if dist_enabled():
+		with torch.no_grad():
+			for _ in model.state_dict().values():
+				if isinstance(_, torch.Tensor):
+					dist.broadcast(_, src=src)
+
+class DistGradReducer:
+
+	# model: the trained model
+	# bucket_size: maximum number of gradient elements of a bucket
+	# group: process group, None for the default one
+
+	def __init__(self, model, bucket_size=dist_bucket_size, group=None):
+
+		self.group = group
+		# gradients of parameters registered later are usually computed earlier in the backward pass
+		_paras = [_ for _ in model.parameters() if _.requires_grad][::-1]
+		self.buckets, _cur, _cur_numel = [], [], 0
+		for _p in _paras:
+			if _cur and ((_cur_numel + _p.numel() > bucket_size) or (_p.dtype != _cur[0].dtype) or (_p.device != _cur[0].device)):
+				self.buckets.append(_cur)
+				_cur, _cur_numel = [], 0
+			_cur.append(_p)
+			_cur_numel += _p.numel()
+		if _cur:
+			self.buckets.append(_cur)
+		self.bufs = [torch.empty(sum(_.numel() for _ in _b), dtype=_b[0].dtype, device=_b[0].device) for _b in self.buckets]
+		self.para_bucket = {}
+		for i, _b in enumerate(self.buckets):
+			for _p in _b:
+				self.para_bucket[_p] = i
+		self.hooks = [_p.register_post_accumulate_grad_hook(self.grad_ready) for _p in _paras]
+		self.sync = False
+		self.reset_state()
+
+	def reset_state(self):
+
+		self.nready = [0 for _ in self.buckets]
+		self.handles = [None for _ in self.buckets]
+		# buckets are launched in the same order on all processes for all-reduce operations to match
+		self.next_bucket = 0
+
+	# sync: whether the next backward pass is the last one before an optimizer step, gradients are only accumulated locally otherwise
+
+	def set_sync(self, sync):
+
+		self.sync = sync
+
+	def grad_ready(self, para):
+
+		if self.sync:
+			_i = self.para_bucket[para]
+			self.nready[_i] += 1
+			_nb = len(self.buckets)
+			while (self.next_bucket < _nb) and (self.nready[self.next_bucket] >= len(self.buckets[self.next_bucket])):
+				self.launch(self.next_bucket)
+				self.next_bucket += 1
+
+	def launch(self, i):
+
+		_buf, _offset = self.bufs[i], 0
+		for _p in self.buckets[i]:
+			_n = _p.numel()
+			if _p.grad is None:
+				_buf.narrow(0, _offset, _n).zero_()
+			else:
+				_buf.narrow(0, _offset, _n).copy_(_p.grad.view(-1))
+			_offset += _n
+		self.handles[i] = dist.all_reduce(_buf, group=self.group, async_op=True)
+
+	# wait for all-reduce operations and write summed gradients back (also to parameters without gradients in this process), buckets not launched during the backward pass (which have unused parameters, or when gradients are accumulated without sync) are reduced here. To be called before optimizer steps.
+
+	def collect_gradients(self):
+
+		for i in range(self.next_bucket, len(self.buckets)):
+			self.launch(i)
+		with torch.no_grad():
+			for _h, _buf, _b in zip(self.handles, self.bufs, self.buckets):
+				_h.wait()
+				_offset = 0
+				for _p in _b:
+					_n = _p.numel()
+					# parameters without local gradients get the reduced ones, so that all processes apply the same update
+					if _p.grad is None:
+						_p.grad = _buf.narrow(0, _offset, _n).view_as(_p).clone()
+					else:
+						_p.grad.copy_(_buf.narrow(0, _offset, _n).view_as(_p.grad))
+					_offset += _n
+		self.reset_state()
+		self.sync = False
+
+	def close(self):
+
+		for _ in self.hooks:
+			_.remove()
+		self.hooks = []
@@ -1,8 +1,10 @@
 #encoding: utf-8
 
 import torch
+from torch import distributed as dist
 from torch.optim.optimizer import Optimizer
-from utils.base import GradScaler#, autocast, is_autocast_enabled
+from utils.base import GradScaler, divide_para_ind, filter_para_grad#, autocast, is_autocast_enabled
+from utils.contpara import get_contiguous_parameters_p
 
 from collections import defaultdict
 from threading import Thread
@@ -38,6 +40,81 @@ class MultiGPUOptimizer(Optimizer):
 		for optm, sdu in zip(self.optms, state_dict):
 			optm.load_state_dict(sdu)
 
+# ZeRO-1 style optimizer for multi-process data parallel training (parallel/dist.py): parameters are divided into contiguous shards across processes like MultiGPUOptimizer, each process holds the states of the wrapped optimizer only for its shard and updates only parameters of its shard, which are then broadcast to other processes. param_groups contain all parameters, so that lr schedulers, zero_grad and GradScaler work on the whole model, while hyper-parameters are copied to the wrapped optimizer before each step. state_dict only contains the states of the shard, and has to be saved and loaded by each process with the same number of processes.
+
+class DistShardedOptimizer(Optimizer):
+
+	# model: the trained model
+	# optm_func: the optimizer class (e.g. torch.optim.Adam, optm.radam.RAdam, optm.adabelief.AdaBelief, optm.ranger.Ranger) built with optm_args and optm_kwargs on the shard of this process
+	# contiguous_parameters: shards are bound to contiguous parameters, which are broadcast without copies
+
+	def __init__(self, model, optm_func, *optm_args, contiguous_parameters=False, group=None, **optm_kwargs):
+
+		self.group, self.rank, self.nrank = group, dist.get_rank(group), dist.get_world_size(group)
+		paras = filter_para_grad(model.parameters())
+		# there are less shards than processes for models with very few parameters
+		self.shards = [paras[lind:rind] for lind, rind in divide_para_ind(paras, self.nrank)]
+		self.contiguous_parameters = contiguous_parameters
+		if contiguous_parameters:
+			self.shards = [[_] for _ in get_contiguous_parameters_p(self.shards, model=model)]
+			self.bufs = [_[0].data.view(-1) for _ in self.shards]
+		else:
+			self.bufs = [_[0].new_empty(sum(_p.numel() for _p in _)) for _ in self.shards]
+		self.src_ranks = [dist.get_global_rank(group, i) if group is not None else i for i in range(len(self.shards))]
+		self.optm = optm_func(self.shards[self.rank], *optm_args, **optm_kwargs) if self.rank < len(self.shards) else None
+
+		super(DistShardedOptimizer, self).__init__([_p for _ in self.shards for _p in _], {} if self.optm is None else self.optm.defaults)
+
+	@torch.no_grad()
+	def step(self, closure=None):
+
+		loss = None
+		if self.optm is not None:
+			self.sync_hyper_parameters(self.param_groups, self.optm.param_groups)
+			loss = self.optm.step(closure=closure)
+		self.broadcast_shards()
+
+		return loss
+
+	def broadcast_shards(self):
+
+		if not self.contiguous_parameters and (self.optm is not None):
+			_buf, _offset = self.bufs[self.rank], 0
+			for _p in self.shards[self.rank]:
+				_n = _p.numel()
+				_buf.narrow(0, _offset, _n).copy_(_p.data.view(-1))
+				_offset += _n
+		_handles = [dist.broadcast(_buf, src=_src, group=self.group, async_op=True) for _buf, _src in zip(self.bufs, self.src_ranks)]
+		for _ in _handles:
+			_.wait()
+		if not self.contiguous_parameters:
+			for i, (_buf, _shard,) in enumerate(zip(self.bufs, self.shards)):
+				if i != self.rank:
+					_offset = 0
+					for _p in _shard:
+						_n = _p.numel()
+						_p.data.copy_(_buf.narrow(0, _offset, _n).view_as(_p))
+						_offset += _n
+
+	def sync_hyper_parameters(self, src_groups, tgt_groups):
+
+		for _src, _tgt in zip(src_groups, tgt_groups):
+			for _k, _v in _src.items():
+				if _k != "params":
+					_tgt[_k] = _v
+
+	def state_dict(self):
+
+		return {"rank": self.rank, "nrank": self.nrank, "optm": None if self.optm is None else self.optm.state_dict()}
+
+	def load_state_dict(self, state_dict):
+
+		if (state_dict["rank"] != self.rank) or (state_dict["nrank"] != self.nrank):
+			raise ValueError("optimizer states of rank %d of %d processes cannot be loaded by rank %d of %d processes" % (state_dict["rank"], state_dict["nrank"], self.rank, self.nrank,))
+		if self.optm is not None:
+			self.optm.load_state_dict(state_dict["optm"])
+			self.sync_hyper_parameters(self.optm.param_groups, self.param_groups)
+
 class MultiGPUGradScaler(GradScaler):
 
 	def step(self, optimizer, *args, **kwargs):
@@ -6,13 +6,18 @@ import torch
 
 from utils.tqdm import tqdm
 
-from utils.h5serial import h5File
+from utils.mmdata import open_data
+from utils.bucket import bounds_batches, decode_batches, load_sentences, pad_sentences
+from utils.shortlist import load_shortlist
+from utils.quant import is_quantized_model, load_model_cpu_quant
 
 import cnfg.base as cnfg
 from cnfg.ihyp import *
 
 from transformer.NMT import NMT
 from transformer.EnsembleNMT import NMT as Ensemble
+from transformer.Decoder import Decoder
+from transformer.SpeculativeNMT import NMT as SpeculativeNMT
 from parallel.parallelMT import DataParallelMT
 
 from utils.base import *
@@ -24,7 +29,7 @@ def load_fixing(module):
 	if hasattr(module, "fix_load"):
 		module.fix_load()
 
-td = h5File(cnfg.test_data, "r")
+td = open_data(cnfg.test_data, "r")
 
 ntest = td["ndata"][()].item()
 nwordi = td["nword"][()].tolist()[0]
@@ -34,23 +39,32 @@ vcbt = reverse_dict(vcbt)
 if len(sys.argv) == 4:
 	mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
 
-	mymodel = load_model_cpu(sys.argv[3], mymodel)
-	mymodel.apply(load_fixing)
+	mymodel = load_model_cpu_quant(sys.argv[3], mymodel, quantize=cnfg.quant_decoding, fix_func=load_fixing)
+
+	if cnfg.draft_model_file is not None:
+		draft = Decoder(cnfg.isize, nwordt, cnfg.draft_nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, None, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+		draft = load_model_cpu(cnfg.draft_model_file, draft)
+		draft.apply(load_fixing)
+		mymodel = SpeculativeNMT(mymodel, draft, nspec=cnfg.speculative_ntoken)
 
 else:
 	models = []
 	for modelf in sys.argv[3:]:
 		tmp = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
 
-		tmp = load_model_cpu(modelf, tmp)
-		tmp.apply(load_fixing)
+		tmp = load_model_cpu_quant(modelf, tmp, quantize=cnfg.quant_decoding, fix_func=load_fixing)
 
 		models.append(tmp)
 	mymodel = Ensemble(models)
 
 mymodel.eval()
+# checked before the model is wrapped by DataParallelMT, clip decoding and shortlists are only supported by a single standard model
+speculative_decoding = isinstance(mymodel, SpeculativeNMT)
+ensemble_decoding = isinstance(mymodel, Ensemble)
+# quantized models only run on CPU
+quantized = is_quantized_model(mymodel)
 
-use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda_decode(cnfg.use_cuda, cnfg.gpuid, cnfg.multi_gpu_decoding)
+use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda_decode(cnfg.use_cuda and not quantized, cnfg.gpuid, cnfg.multi_gpu_decoding and not quantized)
 use_amp = cnfg.use_amp and use_cuda
 
 # Important to make cudnn methods deterministic
@@ -63,18 +77,29 @@ if cuda_device:
 
 beam_size = cnfg.beam_size
 length_penalty = cnfg.length_penalty
+clip_decoding = cnfg.clip_decoding
+# shortlists are only supported by a single model
+shortlist = None if (cnfg.shortlist_file is None) or (len(sys.argv) != 4) else load_shortlist(cnfg.shortlist_file)
+if (shortlist is not None) and cuda_device:
+	shortlist.to(cuda_device)
+_decode_kwargs = {} if speculative_decoding or ensemble_decoding else ({"clip": clip_decoding} if shortlist is None else {"clip": clip_decoding, "shortlist": shortlist})
 
 ens = "\n".encode("utf-8")
 
-src_grp = td["src"]
-with open(sys.argv[1], "wb") as f, torch.no_grad():
-	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
-		seq_batch = torch.from_numpy(src_grp[str(i)][()])
+# sentences are decoded in batches sorted by length with the decoding memory budget (or in the stored batches) and written in their stored order
+src, bounds = load_sentences(td, "src")
+td.close()
+batches = bounds_batches(bounds) if max_decode_tokens is None else decode_batches([len(_) for _ in src], beam_size=beam_size, maxtoken=max_decode_tokens * len(cuda_devices) if multi_gpu else max_decode_tokens, minbsize=len(cuda_devices) if multi_gpu else 1)
+
+rs = [None for _ in range(len(src))]
+with torch.no_grad():
+	for ind in tqdm(batches, mininterval=tqdm_mininterval):
+		seq_batch = torch.from_numpy(pad_sentences(src, ind))
 		if cuda_device:
 			seq_batch = seq_batch.to(cuda_device)
 		seq_batch = seq_batch.long()
 		with autocast(enabled=use_amp):
-			output = mymodel.decode(seq_batch, beam_size, None, length_penalty)
+			output = mymodel.decode(seq_batch, beam_size, None, length_penalty, **_decode_kwargs)
 			#output = mymodel.train_decode(seq_batch, beam_size, None, length_penalty)
 		if multi_gpu:
 			tmp = []
@@ -83,14 +108,16 @@ with open(sys.argv[1], "wb") as f, torch.no_grad():
 			output = tmp
 		else:
 			output = output.tolist()
-		for tran in output:
+		for _i, tran in zip(ind.tolist(), output):
 			tmp = []
 			for tmpu in tran:
 				if tmpu == eos_id:
 					break
 				else:
 					tmp.append(vcbt[tmpu])
-			f.write(" ".join(tmp).encode("utf-8"))
-			f.write(ens)
+			rs[_i] = " ".join(tmp)
 
-td.close()
+with open(sys.argv[1], "wb") as f:
+	for tran in rs:
+		f.write(tran.encode("utf-8"))
+		f.write(ens)
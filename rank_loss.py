@@ -10,7 +10,8 @@ import torch
 
 from utils.tqdm import tqdm
 
-from utils.h5serial import h5File
+from utils.mmdata import open_data
+from utils.loader import H5BatchLoader
 
 import cnfg.base as cnfg
 from cnfg.ihyp import *
@@ -31,7 +32,7 @@ def load_fixing(module):
 	if hasattr(module, "fix_load"):
 		module.fix_load()
 
-td = h5File(sys.argv[2], "r")
+td = open_data(sys.argv[2], "r")
 
 ntest = td["ndata"][()].item()
 nword = td["nword"][()].tolist()
@@ -73,16 +74,8 @@ if cuda_device:
 
 ens = "\n".encode("utf-8")
 
-src_grp, tgt_grp = td["src"], td["tgt"]
 with open(sys.argv[1], "wb") as f, torch.no_grad():
-	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
-		_curid = str(i)
-		seq_batch = torch.from_numpy(src_grp[_curid][()])
-		seq_o = torch.from_numpy(tgt_grp[_curid][()])
-		if cuda_device:
-			seq_batch = seq_batch.to(cuda_device)
-			seq_o = seq_o.to(cuda_device)
-		seq_batch, seq_o = seq_batch.long(), seq_o.long()
+	for _curid, (seq_batch, seq_o,) in tqdm(H5BatchLoader(td, [str(i) for i in range(ntest)], mv_device=cuda_device), mininterval=tqdm_mininterval):
 		lo = seq_o.size(1) - 1
 		ot = seq_o.narrow(1, 1, lo).contiguous()
 		with autocast(enabled=use_amp):
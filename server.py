@@ -58,6 +58,12 @@ def translate_core_api():
 
 	return json.dumps({"tgt": trans(srclang)})
 
+# hit/miss/eviction counters of the translation cache of tran_core
+@app.route("/stats", methods=["GET"])
+def cache_stats():
+
+	return json.dumps({"cache": tran_core.cache_stats()})
+
 # send everything from client as static content
 @app.route("/favicon.ico")
 def favicon():
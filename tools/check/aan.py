@@ -0,0 +1,117 @@
+#encoding: utf-8
+
+# usage: python tools/check/aan.py $model.h5 [$aan_model.h5] [$nslot]
+# compare the decoding speed of the standard decoder (transformer/Decoder.py) of a model with the decoder of the Average Attention Network (transformer/AvgDecoder.py) on cnfg.dev_data with cnfg.beam_size, with and without removing finished sentences during decoding, and with $nslot (cnfg.aan_decode_slots by default) sentences decoded in parallel with waiting sentences taking the places of finished ones. The AAN model is randomly initialized without $aan_model.h5 (use "-" to skip it) and speed is measured only. The number of translations of the AAN decoder which change with the decoding method (which should be 0) is reported.
+
+import sys
+
+import torch
+
+from time import time
+
+from utils.tqdm import tqdm
+
+from utils.base import load_model_cpu
+from utils.mmdata import open_data
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+from cnfg.vocab.base import eos_id
+
+from transformer.NMT import NMT
+from transformer.AvgDecoder import Decoder as AvgDecoder
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def cut_eos(output):
+
+	rs = []
+	for tran in output.tolist():
+		tmp = []
+		for tmpu in tran:
+			if tmpu == eos_id:
+				break
+			else:
+				tmp.append(tmpu)
+		rs.append(tmp)
+
+	return rs
+
+td = open_data(cnfg.dev_data, "r")
+
+ntest = td["ndata"][()].item()
+nword = td["nword"][()].tolist()
+nwordi, nwordt = nword[0], nword[-1]
+
+def build_model():
+
+	return NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+
+mymodel = build_model()
+mymodel = load_model_cpu(sys.argv[1], mymodel)
+mymodel.apply(load_fixing)
+mymodel.eval()
+
+aan_model = build_model()
+aan_model.dec = AvgDecoder(cnfg.isize, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, aan_model.enc.wemb.weight if cnfg.share_emb else None, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+if (len(sys.argv) > 2) and (sys.argv[2] != "-"):
+	aan_model = load_model_cpu(sys.argv[2], aan_model)
+aan_model.apply(load_fixing)
+aan_model.eval()
+nslot = int(sys.argv[3]) if len(sys.argv) > 3 else aan_decode_slots
+
+cuda_device = torch.device(cnfg.gpuid) if cnfg.use_cuda and torch.cuda.is_available() else False
+if cuda_device:
+	torch.cuda.set_device(cuda_device.index)
+	mymodel.to(cuda_device, non_blocking=True)
+	aan_model.to(cuda_device, non_blocking=True)
+
+beam_size = cnfg.beam_size
+length_penalty = cnfg.length_penalty
+
+def sync():
+
+	if cuda_device:
+		torch.cuda.synchronize(cuda_device)
+
+def aan_decode(seq_batch):
+
+	mask = seq_batch.eq(0).unsqueeze(1)
+
+	return aan_model.dec.decode_clip(aan_model.enc(seq_batch, mask), mask, beam_size, seq_batch.size(1) + max(64, seq_batch.size(1) // 4), length_penalty, nslot=nslot)
+
+methods = [("Decoder", lambda x: mymodel.decode(x, beam_size, None, length_penalty),), ("Decoder (clip)", lambda x: mymodel.decode(x, beam_size, None, length_penalty, clip=True),), ("AvgDecoder", lambda x: aan_model.decode(x, beam_size, None, length_penalty),), ("AvgDecoder (clip)", lambda x: aan_model.decode(x, beam_size, None, length_penalty, clip=True),)]
+if nslot is not None:
+	methods.append(("AvgDecoder (%d slots)" % nslot, aan_decode,))
+
+src_grp = td["src"]
+times = [0.0 for _ in methods]
+nsent = ndiff = 0
+with torch.no_grad():
+	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
+		seq_batch = torch.from_numpy(src_grp[str(i)][()])
+		if cuda_device:
+			seq_batch = seq_batch.to(cuda_device, non_blocking=True)
+		seq_batch = seq_batch.long()
+		nsent += seq_batch.size(0)
+		_aan_outputs = []
+		for _ind, (_name, _decode,) in enumerate(methods):
+			sync()
+			_st = time()
+			output = _decode(seq_batch)
+			sync()
+			times[_ind] += time() - _st
+			if _ind > 1:
+				_aan_outputs.append(cut_eos(output))
+		_ref = _aan_outputs[0]
+		ndiff += sum(1 for _output in _aan_outputs[1:] for _r, _o in zip(_ref, _output) if _r != _o)
+
+td.close()
+
+print("Sentences: %d, batches: %d, beam size: %d" % (nsent, ntest, beam_size,))
+for (_name, _decode,), _t in zip(methods, times):
+	print("%s: %.3f s, %.2f sentences/s, speed up: %.3f" % (_name, _t, nsent / _t, times[0] / _t,))
+print("Different translations of AvgDecoder: %d" % (ndiff,))
@@ -0,0 +1,42 @@
+#encoding: utf-8
+
+# usage: python tools/check/bpe.py $codes $text [$bpe_vocab vocabulary_threshold] [number of processes]
+# segment $text with datautils.bpe using the merge loop of subword-nmt and the priority queue based merging (without the word cache), check that the results are identical, compare their speed, and report the speed of the cached BPEApplier with and without a process pool.
+
+import sys
+
+from time import time
+
+from datautils.bpe import BPEApplier, merge_heap, merge_loop
+import datautils.bpe as bpe_module
+
+codesf, textf = sys.argv[1:3]
+bpe_vcb, vthres = (sys.argv[3], int(sys.argv[4]),) if len(sys.argv) > 4 else (None, None,)
+nproc = int(sys.argv[5]) if len(sys.argv) > 5 else 4
+
+with open(textf, "rb") as f:
+	lines = [_.decode("utf-8").strip() for _ in f]
+
+def run(merge_func, **kwargs):
+
+	bpe_module_merge_heap = bpe_module.merge_heap
+	bpe_module.merge_heap = merge_func
+	_applier = BPEApplier(codesf, bpe_vcb, vthres, **kwargs)
+	_st = time()
+	rs = _applier(lines)
+	_t = time() - _st
+	_hit_rate = _applier.cache_hit_rate()
+	_applier.close()
+	bpe_module.merge_heap = bpe_module_merge_heap
+
+	return rs, _t, _hit_rate
+
+rs_loop, t_loop, _ = run(merge_loop, cache_size=1)
+rs_heap, t_heap, _ = run(merge_heap, cache_size=1)
+rs_cache, t_cache, hit_rate = run(merge_heap)
+rs_pool, t_pool, _ = run(merge_heap, num_worker=nproc)
+
+print("Lines: %d" % len(lines))
+print("Merge loop: %.3f s, priority queue: %.3f s, speed up: %.3f, identical: %s" % (t_loop, t_heap, t_loop / t_heap, rs_loop == rs_heap,))
+print("Cached: %.3f s, cache hit rate: %.2f%%, identical: %s" % (t_cache, hit_rate * 100.0, rs_cache == rs_loop,))
+print("%d processes: %.3f s, identical: %s" % (nproc, t_pool, rs_pool == rs_loop,))
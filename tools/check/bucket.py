@@ -0,0 +1,30 @@
+#encoding: utf-8
+
+# usage: python tools/check/bucket.py $data.mm [maximum number of tokens per batch]
+# compare the padding efficiency (real tokens / padded tokens) and the number of batches of a flat token store (see utils/mmdata.py) between batches decided at preprocessing and batches packed online by utils.bucket.BucketSampler with different bucket widths, and check that every sentence is sampled exactly once per epoch.
+
+import sys
+
+import numpy
+
+from time import time
+
+from utils.mmdata import MMapData
+from utils.bucket import BucketSampler, padding_efficiency
+
+from cnfg.ihyp import *
+
+td = MMapData(sys.argv[1])
+maxtoken = int(sys.argv[2]) if len(sys.argv) > 2 else max_tokens_gpu
+lsrc, ltgt = td.lens("src"), (td.lens("tgt") if "tgt" in td else None)
+nsent = len(lsrc)
+
+print("Sentences: %d, preprocessed batches: %d, padding efficiency: %.2f%%" % (nsent, td["ndata"][()].item(), padding_efficiency(td.bounds, lsrc, ltgt) * 100.0,))
+for width in (1, 2, 4, 8, 16,):
+	sampler = BucketSampler(lsrc, ltgt, maxtoken=maxtoken, width=width, seed=666)
+	_st = time()
+	_batches = sampler.generate()
+	_t = time() - _st
+	_ind = numpy.sort(numpy.concatenate(_batches))
+	_ntok = max(int(((lsrc[_] if ltgt is None else (lsrc[_] + ltgt[_])).max()) * len(_)) for _ in _batches)
+	print("Bucket width %d: %d batches, padding efficiency: %.2f%%, maximum padded tokens: %d, packing time: %.3f s, each sentence once: %s" % (width, len(_batches), sampler.efficiency * 100.0, _ntok, _t, numpy.array_equal(_ind, numpy.arange(nsent)),))
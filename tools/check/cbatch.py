@@ -0,0 +1,90 @@
+#encoding: utf-8
+
+# usage: python tools/check/cbatch.py [number of clients] [number of requests per client] [number of sentences per request]
+# simulate concurrent requests to the translation server with a tiny randomly initialized NMT model on the CPU, compare the throughput of decoding requests one by one with continuous batching (translator.ContinuousBatcher), and report the agreement of translations.
+
+import sys
+
+import torch
+
+from random import seed as rpyseed, randint
+from threading import Thread, Lock
+from time import time
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+from transformer.NMT import NMT
+from translator import ContinuousBatcher
+
+from utils.base import set_random_seed
+from utils.fmt.base import eos_id, map_batch_core, pad_batch
+
+nclient, nreq, nsent = [int(_) for _ in sys.argv[1:4]] if len(sys.argv) > 3 else (4, 8, 4,)
+nwordi, nwordt = 50, 60
+vcbi = {str(i): i for i in range(4, nwordi)}
+vcbt = {i: str(i) for i in range(nwordt)}
+
+set_random_seed(1, False)
+rpyseed(666)
+
+# a tiny model whose parameters are initialized with a large variance produces confident predictions, and the bias of <eos> makes target lengths vary from sentence to sentence.
+mymodel = NMT(32, nwordi, nwordt, 2, 64, 0.0, 0.0, False, 4, cache_len_default, 32, True, True, None)
+with torch.no_grad():
+	for _ in mymodel.parameters():
+		_.normal_(std=0.3)
+	mymodel.dec.classifier.bias[eos_id] += 1.4
+mymodel.eval()
+
+requests = [[[" ".join(str(randint(4, nwordi - 1)) for _ in range(randint(1, 48))) for k in range(nsent)] for j in range(nreq)] for i in range(nclient)]
+
+beam_size = cnfg.beam_size
+length_penalty = cnfg.length_penalty
+
+# decoding of the model is not thread-safe because of buffers of cross-attention keys/values
+decode_lock = Lock()
+
+def translate(sentences):
+
+	_ids = [map_batch_core(_.split(), vcbi) for _ in sentences]
+	seq_batch = torch.tensor(pad_batch(_ids, max(len(_) for _ in _ids)), dtype=torch.long)
+	rs = []
+	with torch.no_grad(), decode_lock:
+		output = mymodel.decode(seq_batch, beam_size, None, length_penalty)
+	for tran in output.tolist():
+		tmp = []
+		for tmpu in tran:
+			if tmpu == eos_id:
+				break
+			else:
+				tmp.append(vcbt[tmpu])
+		rs.append(" ".join(tmp))
+
+	return rs
+
+def run(func):
+
+	rs = [[] for i in range(nclient)]
+	def client(i):
+		for _ in requests[i]:
+			rs[i].append(func(_))
+	_threads = [Thread(target=client, args=(i,)) for i in range(nclient)]
+	_st = time()
+	for _ in _threads:
+		_.start()
+	for _ in _threads:
+		_.join()
+
+	return rs, time() - _st
+
+rs_sep, t_sep = run(translate)
+batcher = ContinuousBatcher(mymodel, vcbi, vcbt, beam_size=beam_size, length_penalty=length_penalty, bsize=64, maxtoken=1536, max_wait=cnfg.batching_max_wait)
+rs_cb, t_cb = run(batcher)
+batcher.close()
+
+_ntotal = nclient * nreq * nsent
+_nsame = sum(_s == _c for _cs, _cc in zip(rs_sep, rs_cb) for _rs, _rc in zip(_cs, _cc) for _s, _c in zip(_rs, _rc))
+print("Clients: %d, requests: %d, sentences: %d" % (nclient, nclient * nreq, _ntotal,))
+print("Separate decoding: %.3f s, %.2f sentences/s" % (t_sep, _ntotal / t_sep,))
+print("Continuous batching: %.3f s, %.2f sentences/s, speed up: %.3f" % (t_cb, _ntotal / t_cb, t_sep / t_cb,))
+print("Identical translations: %d/%d" % (_nsame, _ntotal,))
@@ -0,0 +1,64 @@
+#encoding: utf-8
+
+# usage: python tools/check/chunk_loss.py [vocabulary size] [batch size] [target length] [chunk size]
+# compare the standard classifier + LabelSmoothingLoss with loss.base.ChunkedLabelSmoothingLoss on random hidden states: check that losses and gradients agree, and report the time of forward + backward and the peak memory (on GPU if available, otherwise the size of the log-probability tensor which is kept).
+
+import sys
+
+import torch
+from torch.nn.functional import log_softmax
+from time import time
+
+from loss.base import LabelSmoothingLoss, ChunkedLabelSmoothingLoss
+from modules.base import Linear
+
+from cnfg.ihyp import *
+
+nword, bsize, seql, chunk_size = [int(_) for _ in sys.argv[1:5]] if len(sys.argv) > 4 else (32768, 64, 64, 2048,)
+isize = 512
+
+device = torch.device("cuda", 0) if torch.cuda.is_available() else torch.device("cpu")
+
+def sync():
+
+	if device.type == "cuda":
+		torch.cuda.synchronize(device)
+
+torch.manual_seed(666)
+classifier = Linear(isize, nword).to(device)
+hidden = torch.randn(bsize, seql, isize, device=device)
+target = torch.randint(1, nword, (bsize, seql,), device=device)
+target[:, seql * 3 // 4:] = 0
+
+lossf = LabelSmoothingLoss(nword, 0.1, ignore_index=0, reduction="sum").to(device)
+chunk_lossf = ChunkedLabelSmoothingLoss(nword, 0.1, ignore_index=0, reduction="sum", chunk_size=chunk_size).to(device)
+
+def run(func):
+
+	_h = hidden.clone().requires_grad_(True)
+	classifier.zero_grad(set_to_none=True)
+	if device.type == "cuda":
+		torch.cuda.reset_peak_memory_stats(device)
+	_mem = torch.cuda.memory_allocated(device) if device.type == "cuda" else 0
+	sync()
+	_st = time()
+	loss = func(_h)
+	loss.backward()
+	sync()
+	_t = time() - _st
+	_peak = (torch.cuda.max_memory_allocated(device) - _mem) if device.type == "cuda" else 0
+
+	return loss.item(), _h.grad, classifier.weight.grad.clone(), _t, _peak
+
+# warm up
+run(lambda h: chunk_lossf(h, target, classifier))
+l_std, gh_std, gw_std, t_std, m_std = run(lambda h: lossf(log_softmax(classifier(h), -1), target))
+l_chk, gh_chk, gw_chk, t_chk, m_chk = run(lambda h: chunk_lossf(h, target, classifier))
+
+print("Vocabulary: %d, tokens: %d, chunk size: %d" % (nword, bsize * seql, chunk_size,))
+print("Loss: %.4f %.4f, gradients agree: %s" % (l_std, l_chk, torch.allclose(gh_std, gh_chk, rtol=1e-4, atol=1e-6) and torch.allclose(gw_std, gw_chk, rtol=1e-4, atol=1e-6),))
+print("Standard: %.3f s, chunked: %.3f s" % (t_std, t_chk,))
+if device.type == "cuda":
+	print("Peak memory, standard: %.1f MB, chunked: %.1f MB" % (m_std / 1048576.0, m_chk / 1048576.0,))
+else:
+	print("Log-probabilities kept for backward, standard: %.1f MB, chunked: %.1f MB" % (bsize * seql * nword * 4 / 1048576.0, min(chunk_size, bsize * seql) * nword * 4 / 1048576.0,))
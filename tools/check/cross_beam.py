@@ -0,0 +1,69 @@
+#encoding: utf-8
+
+# usage: python tools/check/cross_beam.py [batch size] [source length] [decoding steps] [vocabulary size]
+# compare beam search of a randomly initialized standard model (with sizes of cnfg/base.py) with keys/values of cross-attentions repeated for beams and shared by beams (broadcast_cross_attn_beam in cnfg/hyp.py) at beam sizes of 4, 8 and 12: report the decoding time, the memory of cached cross-attention keys/values and the peak memory (on GPU only), and check that translations are identical.
+
+import sys
+
+import torch
+from time import time
+
+from transformer.NMT import NMT
+from modules.base import CrossAttn, MultiHeadAttn
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+bsize, seql, max_len, nword = [int(_) for _ in sys.argv[1:5]] if len(sys.argv) > 4 else (16, 64, 32, 8192,)
+
+device = torch.device("cuda", 0) if torch.cuda.is_available() else torch.device("cpu")
+
+def sync():
+
+	if device.type == "cuda":
+		torch.cuda.synchronize(device)
+
+torch.manual_seed(666)
+mymodel = NMT(cnfg.isize, nword, nword, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+mymodel.eval()
+mymodel.to(device)
+cross_attns = [_m for _m in mymodel.dec.modules() if isinstance(_m, (CrossAttn, MultiHeadAttn,))]
+
+seq_batch = torch.randint(4, nword, (bsize, seql,), device=device)
+seq_batch[:bsize // 2, seql * 3 // 4:] = 0
+
+def buffer_size():
+
+	return sum(_t.numel() * _t.element_size() for _m in cross_attns for _t in (_m.real_iK, _m.real_iV,) if _t is not None)
+
+def run(beam_size, broadcast):
+
+	for _m in cross_attns:
+		_m.broadcast_beam = broadcast
+	if device.type == "cuda":
+		torch.cuda.reset_peak_memory_stats(device)
+	_mem = torch.cuda.memory_allocated(device) if device.type == "cuda" else 0
+	sync()
+	_st = time()
+	output = mymodel.decode(seq_batch, beam_size, max_len, cnfg.length_penalty)
+	sync()
+	_t = time() - _st
+	_peak = (torch.cuda.max_memory_allocated(device) - _mem) if device.type == "cuda" else 0
+	_buf = buffer_size()
+	mymodel.dec.reset_cross_attn_buffer()
+
+	return output, _t, _buf, _peak
+
+print("Batch size: %d, source length: %d, decoding steps: %d, isize: %d, layers: %d" % (bsize, seql, max_len, cnfg.isize, cnfg.nlayer,))
+with torch.no_grad():
+	# warm up
+	run(2, True)
+	for beam_size in (4, 8, 12,):
+		_rs = {}
+		for broadcast in (False, True,):
+			_rs[broadcast] = run(beam_size, broadcast)
+		(_o, _t, _buf, _peak,), (_ob, _tb, _bufb, _peakb,) = _rs[False], _rs[True]
+		_msg = "beam %d: repeated %.3f s, shared %.3f s, speed up %.3f, cached keys/values %.1f MB => %.1f MB" % (beam_size, _t, _tb, _t / _tb, _buf / 1048576.0, _bufb / 1048576.0,)
+		if device.type == "cuda":
+			_msg += ", peak memory %.1f MB => %.1f MB" % (_peak / 1048576.0, _peakb / 1048576.0,)
+		print("%s, identical translations: %s" % (_msg, _o.equal(_ob),))
@@ -0,0 +1,138 @@
+#encoding: utf-8
+
+# usage: python tools/check/ddp.py [number of processes] [optimizer steps] [batch size] [sequence length]
+# compare the training throughput of a randomly initialized standard model (with sizes of cnfg/base.py without dropout) between one process (with DataParallelMT over all GPUs, or the model on CPU) and multi-process data parallel training (parallel/dist.py, with the nccl backend on GPUs and gloo on CPUs), where each optimizer step accumulates gradients of 2 batches for each process, and report the maximum difference between parameters after training.
+
+import sys
+
+import torch
+from torch import multiprocessing as mp
+from os import environ
+from time import time
+
+from transformer.NMT import NMT
+from parallel.base import DataParallelCriterion
+from parallel.parallelMT import DataParallelMT
+from parallel.dist import DistGradReducer, broadcast_model, close_dist, init_dist
+from loss.base import LabelSmoothingLoss
+from utils.base import optm_step
+from utils.fmt.base import pad_id
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+nproc, nstep, bsize, seql = [int(_) for _ in sys.argv[1:5]] if len(sys.argv) > 4 else (2, 8, 32, 32,)
+nword, nacc = 8192, 2
+
+def build_model():
+
+	torch.manual_seed(666)
+	rs = NMT(cnfg.isize, nword, nword, cnfg.nlayer, cnfg.ff_hsize, 0.0, 0.0, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	rs.train()
+
+	return rs
+
+# batches of each optimizer step, those of process i are batches[step][i * nacc:(i + 1) * nacc]
+
+def build_batches():
+
+	_g = torch.Generator().manual_seed(999)
+
+	return [[(torch.randint(4, nword, (bsize, seql,), generator=_g), torch.randint(4, nword, (bsize, seql + 1,), generator=_g),) for _ in range(nproc * nacc)] for _ in range(nstep)]
+
+def train_step(model, lossf, batches, device, multi_gpu=False):
+
+	for seq_batch, seq_o in batches:
+		if device is not None:
+			seq_batch, seq_o = seq_batch.to(device), seq_o.to(device)
+		ot = seq_o.narrow(1, 1, seql)
+		loss = lossf(model(seq_batch, seq_o.narrow(1, 0, seql)), ot)
+		if multi_gpu:
+			loss = loss.sum()
+		loss.backward()
+
+def sync():
+
+	if torch.cuda.is_available():
+		torch.cuda.synchronize()
+
+def run_single():
+
+	ngpu = torch.cuda.device_count()
+	device = torch.device("cuda", 0) if ngpu > 0 else None
+	multi_gpu = ngpu > 1
+	model, lossf = build_model(), LabelSmoothingLoss(nword, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum")
+	if device is not None:
+		model.to(device)
+		lossf.to(device)
+	if multi_gpu:
+		model = DataParallelMT(model, device_ids=list(range(ngpu)), output_device=0, host_replicate=True, gather_output=False)
+		lossf = DataParallelCriterion(lossf, device_ids=list(range(ngpu)), output_device=0, replicate_once=True)
+		optm = model.build_optimizer(torch.optim.Adam, lr=1e-4, multi_gpu_optimizer=False)
+	else:
+		optm = torch.optim.Adam(model.parameters(), lr=1e-4)
+	batches = build_batches()
+	_st = None
+	for i, _b in enumerate(batches):
+		# the first step is for warm up
+		if i == 1:
+			sync()
+			_st = time()
+		train_step(model, lossf, _b, device, multi_gpu)
+		optm_step(optm, model=model, multi_gpu=multi_gpu)
+	sync()
+	_t = time() - _st
+
+	return _t, [_.data.cpu() for _ in (model.module if multi_gpu else model).parameters()]
+
+def run_dist(rank, rsq):
+
+	environ.update({"RANK": str(rank), "LOCAL_RANK": str(rank), "WORLD_SIZE": str(nproc), "MASTER_ADDR": "127.0.0.1", "MASTER_PORT": environ.get("MASTER_PORT", "29533")})
+	use_cuda = torch.cuda.device_count() >= nproc
+	init_dist(None, use_cuda)
+	device = torch.device("cuda", rank) if use_cuda else None
+	if use_cuda:
+		torch.cuda.set_device(rank)
+	else:
+		torch.set_num_threads(max(torch.get_num_threads() // nproc, 1))
+	model, lossf = build_model(), LabelSmoothingLoss(nword, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum")
+	if device is not None:
+		model.to(device)
+		lossf.to(device)
+	broadcast_model(model)
+	optm = torch.optim.Adam(model.parameters(), lr=1e-4)
+	grad_reducer = DistGradReducer(model)
+	batches = build_batches()
+	_st = None
+	for i, _b in enumerate(batches):
+		if i == 1:
+			sync()
+			_st = time()
+		_b = _b[rank * nacc:(rank + 1) * nacc]
+		grad_reducer.set_sync(False)
+		train_step(model, lossf, _b[:-1], device)
+		grad_reducer.set_sync(True)
+		train_step(model, lossf, _b[-1:], device)
+		grad_reducer.collect_gradients()
+		optm_step(optm, model=model)
+	sync()
+	_t = time() - _st
+	if rank == 0:
+		# numpy arrays are pickled by value, while tensors are shared with the exiting process
+		rsq.put((_t, [_.data.cpu().numpy() for _ in model.parameters()],))
+	close_dist()
+
+if __name__ == "__main__":
+	_ntoken = (nstep - 1) * nproc * nacc * bsize * seql
+	_t, _ref = run_single()
+	print("single process: %.2f s, %.1f tokens/s" % (_t, _ntoken / _t,))
+	_ctx = mp.get_context("spawn")
+	rsq = _ctx.SimpleQueue()
+	_procs = [_ctx.Process(target=run_dist, args=(i, rsq,)) for i in range(nproc)]
+	for _ in _procs:
+		_.start()
+	_t, _paras = rsq.get()
+	for _ in _procs:
+		_.join()
+	print("%d processes: %.2f s, %.1f tokens/s" % (nproc, _t, _ntoken / _t,))
+	print("maximum difference of parameters: %.3e" % max((_a - torch.from_numpy(_b)).abs().max().item() for _a, _b in zip(_ref, _paras)))
@@ -0,0 +1,97 @@
+#encoding: utf-8
+
+# usage: python tools/check/decode_clip.py $model_file.h5
+# compare the decoding speed with and without removing finished sentences from batches (cnfg.clip_decoding) on cnfg.dev_data, and check that translations are identical. The ratio between the longest and the average translation length of batches is reported as the skewness of target lengths.
+
+import sys
+
+import torch
+
+from time import time
+
+from utils.tqdm import tqdm
+
+from utils.h5serial import h5File
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+from transformer.NMT import NMT
+
+from utils.base import load_model_cpu
+from utils.fmt.base import eos_id
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def cut_eos(output):
+
+	rs = []
+	for tran in output.tolist():
+		tmp = []
+		for tmpu in tran:
+			if tmpu == eos_id:
+				break
+			else:
+				tmp.append(tmpu)
+		rs.append(tmp)
+
+	return rs
+
+td = h5File(cnfg.dev_data, "r")
+
+ntest = td["ndata"][()].item()
+nword = td["nword"][()].tolist()
+nwordi, nwordt = nword[0], nword[-1]
+
+mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+mymodel = load_model_cpu(sys.argv[1], mymodel)
+mymodel.apply(load_fixing)
+mymodel.eval()
+
+cuda_device = torch.device(cnfg.gpuid) if cnfg.use_cuda and torch.cuda.is_available() else False
+if cuda_device:
+	torch.cuda.set_device(cuda_device.index)
+	mymodel.to(cuda_device, non_blocking=True)
+
+beam_size = cnfg.beam_size
+length_penalty = cnfg.length_penalty
+
+def sync():
+
+	if cuda_device:
+		torch.cuda.synchronize(cuda_device)
+
+src_grp = td["src"]
+t_full = t_clip = 0.0
+nsent = ndiff = 0
+skew = []
+with torch.no_grad():
+	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
+		seq_batch = torch.from_numpy(src_grp[str(i)][()])
+		if cuda_device:
+			seq_batch = seq_batch.to(cuda_device, non_blocking=True)
+		seq_batch = seq_batch.long()
+		sync()
+		_st = time()
+		output = mymodel.decode(seq_batch, beam_size, None, length_penalty)
+		sync()
+		_et = time()
+		output_clip = mymodel.decode(seq_batch, beam_size, None, length_penalty, clip=True)
+		sync()
+		t_full += _et - _st
+		t_clip += time() - _et
+		output, output_clip = cut_eos(output), cut_eos(output_clip)
+		ndiff += sum(1 for _s, _c in zip(output, output_clip) if _s != _c)
+		nsent += len(output)
+		_lens = [len(_) + 1 for _ in output]
+		skew.append(float(max(_lens)) * len(_lens) / sum(_lens))
+
+td.close()
+
+print("Sentences: %d, batches: %d, average skewness of target lengths: %.3f" % (nsent, ntest, sum(skew) / len(skew),))
+print("Full batch: %.3f s, %.2f sentences/s" % (t_full, nsent / t_full,))
+print("Clipped batch: %.3f s, %.2f sentences/s, speed up: %.3f" % (t_clip, nsent / t_clip, t_full / t_clip,))
+print("Different translations: %d" % (ndiff,))
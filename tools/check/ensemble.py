@@ -0,0 +1,69 @@
+#encoding: utf-8
+
+# usage: python tools/check/ensemble.py $model1.h5 $model2.h5 ...
+# compare the decoding speed of an ensemble of models (of the same configuration in cnfg) which loops over models (transformer/EnsembleDecoder.py) with the fused ensemble (transformer/EnsembleFused.py) on the development set, and report the number of different translations (which should be 0 up to floating point differences).
+
+import sys
+
+import torch
+
+from time import time
+
+from utils.tqdm import tqdm
+
+from utils.base import load_model_cpu
+from utils.mmdata import open_data
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+from transformer.NMT import NMT
+from transformer.EnsembleNMT import NMT as Ensemble
+from transformer.EnsembleFused import is_fusable
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+td = open_data(cnfg.dev_data, "r")
+
+ntest = td["ndata"][()].item()
+nword = td["nword"][()].tolist()
+nwordi, nwordt = nword[0], nword[-1]
+
+models = []
+for modelf in sys.argv[1:]:
+	tmp = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	tmp = load_model_cpu(modelf, tmp)
+	tmp.apply(load_fixing)
+	tmp.eval()
+	models.append(tmp)
+if not is_fusable(models):
+	print("Models cannot be fused")
+	sys.exit(1)
+ensembles = {"loop": Ensemble(models, fuse=False).eval(), "fused": Ensemble(models, fuse=True).eval()}
+
+beam_size = cnfg.beam_size
+length_penalty = cnfg.length_penalty
+
+src_grp = td["src"]
+nsent = 0
+hyps = {k: [] for k in ensembles.keys()}
+times = {k: 0.0 for k in ensembles.keys()}
+with torch.no_grad():
+	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
+		seq_batch = torch.from_numpy(src_grp[str(i)][()]).long()
+		nsent += seq_batch.size(0)
+		for k, v in ensembles.items():
+			_st = time()
+			output = v.decode(seq_batch, beam_size, None, length_penalty)
+			times[k] += time() - _st
+			hyps[k].extend(output.tolist())
+
+td.close()
+
+print("Models: %d, sentences: %d, batches: %d, beam size: %d, threads: %d" % (len(models), nsent, ntest, beam_size, torch.get_num_threads(),))
+for k in ensembles.keys():
+	print("%s: %.3f s, %.2f sentences/s" % (k, times[k], nsent / times[k],))
+print("Speed up: %.3f, different translations: %d" % (times["loop"] / times["fused"], sum(1 for _l, _f in zip(hyps["loop"], hyps["fused"]) if _l != _f),))
@@ -0,0 +1,92 @@
+#encoding: utf-8
+
+# usage: python tools/check/foreach.py [optimizer steps] [isize,nlayer ...]
+# compare the time of optimizer steps between per-parameter loops and multi-tensor (foreach) implementations of RAdam, AdaBelief, Ranger and Lookahead (optm/) on randomly initialized standard models of given sizes with random gradients, on separate parameters and on contiguous parameters (utils/contpara.py), and check that parameters and optimizer states after these steps are bitwise identical.
+
+import sys
+
+import torch
+from time import time
+
+from transformer.NMT import NMT
+from optm.radam import RAdam
+from optm.adabelief import AdaBelief
+from optm.ranger import Ranger
+from optm.lookahead import Lookahead
+from utils.contpara import get_model_parameters
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+nstep = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+sizes = [tuple(int(_) for _ in _s.split(",")) for _s in sys.argv[2:]] if len(sys.argv) > 2 else [(256, 3,), (512, 6,)]
+nword = 8192
+
+device = torch.device("cuda", 0) if torch.cuda.is_available() else torch.device("cpu")
+
+def sync():
+
+	if device.type == "cuda":
+		torch.cuda.synchronize(device)
+
+def build_lookahead(params, foreach):
+
+	params = list(params)
+
+	return Lookahead(params, torch.optim.SGD(params, lr=1e-3, momentum=0.9), steps=3, pullback_momentum="pullback", foreach=foreach)
+
+optms = (("RAdam", lambda params, foreach: RAdam(params, weight_decay=1e-2, foreach=foreach),), ("AdaBelief", lambda params, foreach: AdaBelief(params, weight_decay=1e-2, foreach=foreach),), ("AdaBelief (amsgrad, rectify)", lambda params, foreach: AdaBelief(params, amsgrad=True, weight_decouple=True, rectify=True, foreach=foreach),), ("Ranger", lambda params, foreach: Ranger(params, weight_decay=1e-2, foreach=foreach),), ("Lookahead (SGD)", build_lookahead,),)
+
+def build_model(isize, nlayer):
+
+	torch.manual_seed(666)
+	rs = NMT(isize, nword, nword, nlayer, isize * 4, 0.0, 0.0, cnfg.share_emb, max(1, isize // 64), cache_len_default, None, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+
+	return rs.to(device)
+
+def set_random_grads(model, step):
+
+	_g = torch.Generator().manual_seed(step)
+	for _p in model.parameters():
+		_grad = torch.randn(_p.size(), generator=_g).to(device)
+		if _p.grad is None:
+			_p.grad = _grad
+		else:
+			_p.grad.copy_(_grad)
+
+def state_tensors(optm):
+
+	return [_v for _s in optm.state_dict()["state"].values() for _k, _v in sorted(_s.items()) if isinstance(_v, torch.Tensor)]
+
+def run(isize, nlayer, optm_func, foreach, contiguous_parameters):
+
+	model = build_model(isize, nlayer)
+	optm = optm_func(get_model_parameters(model, contiguous_parameters=contiguous_parameters), foreach)
+	_t = 0.0
+	for i in range(nstep):
+		set_random_grads(model, i)
+		sync()
+		_st = time()
+		optm.step()
+		sync()
+		# the first step which initializes states is excluded
+		if i > 0:
+			_t += time() - _st
+
+	return _t / max(nstep - 1, 1), [_.data for _ in model.parameters()] + state_tensors(optm)
+
+def identical(a, b):
+
+	return (len(a) == len(b)) and all(torch.equal(_a, _b) for _a, _b in zip(a, b))
+
+with torch.no_grad():
+	for isize, nlayer in sizes:
+		_model = build_model(isize, nlayer)
+		print("isize %d, %d layers: %d parameter tensors, %d parameters" % (isize, nlayer, len(list(_model.parameters())), sum(_.numel() for _ in _model.parameters()),))
+		_model = None
+		for contiguous_parameters in (False, True,):
+			for name, optm_func in optms:
+				_t_loop, _rs_loop = run(isize, nlayer, optm_func, False, contiguous_parameters)
+				_t_foreach, _rs_foreach = run(isize, nlayer, optm_func, True, contiguous_parameters)
+				print("%s%s: loop %.2f ms, foreach %.2f ms per step (%.2fx), identical: %s" % (name, " with contiguous parameters" if contiguous_parameters else "", _t_loop * 1000.0, _t_foreach * 1000.0, _t_loop / _t_foreach, identical(_rs_loop, _rs_foreach),))
+				_rs_loop = _rs_foreach = None
@@ -0,0 +1,42 @@
+#encoding: utf-8
+
+# usage: python tools/check/h5loader.py [$data.h5] [simulated computation time per batch in ms]
+# compare the throughput of reading batches of a training data file ($data.h5, cnfg.train_data by default) on the main thread with utils.loader.H5BatchLoader (with threads and with processes), while the computation of each batch is simulated by sleeping, and check that loaded batches are identical.
+
+import sys
+
+from time import time, sleep
+
+from utils.h5serial import h5File
+from utils.loader import H5BatchLoader
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+data_file = sys.argv[1] if len(sys.argv) > 1 else cnfg.train_data
+t_compute = float(sys.argv[2]) / 1000.0 if len(sys.argv) > 2 else 0.005
+
+td = h5File(data_file, "r")
+bids = [str(i) for i in range(td["ndata"][()].item())]
+
+def run(**kwargs):
+
+	rs = []
+	_st = time()
+	for _, _batch in H5BatchLoader(td, bids, **kwargs):
+		rs.append(_batch)
+		if t_compute > 0.0:
+			sleep(t_compute)
+
+	return rs, time() - _st
+
+rs_inline, t_inline = run(num_worker=0)
+print("Batches: %d, simulated computation: %.1f ms per batch" % (len(bids), t_compute * 1000.0,))
+print("Main thread: %.3f s, %.2f batches/s" % (t_inline, len(bids) / t_inline,))
+for _use_process in (False, True,):
+	for _nworker in (1, 2, 4,):
+		_rs, _t = run(num_worker=_nworker, prefetch=max(data_loader_prefetch, _nworker), use_process=_use_process)
+		_same = all(all(_a.equal(_b) for _a, _b in zip(_ri, _rl)) for _ri, _rl in zip(rs_inline, _rs)) and (len(_rs) == len(rs_inline))
+		print("%d %s: %.3f s, %.2f batches/s, speed up: %.3f, identical: %s" % (_nworker, "processes" if _use_process else "threads", _t, len(bids) / _t, t_inline / _t, _same,))
+
+td.close()
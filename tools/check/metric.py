@@ -0,0 +1,79 @@
+#encoding: utf-8
+
+# usage: python tools/check/metric.py [number of batches] [batch size] [sequence length] [tokens_optm]
+# compare the per-batch overhead of bookkeeping losses, token counts and optimizer step decisions of the training loop with .item() calls against the on-device accumulation of utils/metric.py, with random losses and padded target batches (a matrix multiplication is queued for each batch to simulate the computation on GPU), and check that accumulated metrics and optimizer step decisions are identical.
+
+import sys
+
+import torch
+from time import time
+
+from utils.metric import DeferredCounter, MetricAccumulator
+from utils.fmt.base import pad_id
+
+nbatch, bsize, seql, tokens_optm = [int(_) for _ in sys.argv[1:5]] if len(sys.argv) > 4 else (2000, 64, 48, 25000,)
+
+device = torch.device("cuda", 0) if torch.cuda.is_available() else torch.device("cpu")
+
+def sync():
+
+	if device.type == "cuda":
+		torch.cuda.synchronize(device)
+
+torch.manual_seed(666)
+batches = []
+for _ in range(nbatch):
+	_lens = torch.randint(seql // 4, seql + 1, (bsize,))
+	_ot = torch.randint(4, 100, (bsize, seql,))
+	_ot.masked_fill_(torch.arange(seql).unsqueeze(0).ge(_lens.unsqueeze(1)), pad_id)
+	batches.append((_ot.to(device), torch.rand((), device=device),))
+_w = torch.randn(256, 256, device=device) if device.type == "cuda" else None
+
+def work():
+
+	if _w is not None:
+		_w.mm(_w)
+
+def run_item():
+
+	sum_loss, sum_wd, _done_tokens, steps = 0.0, 0, 0, []
+	for i, (ot, loss,) in enumerate(batches):
+		work()
+		loss_add = loss.data.item()
+		wd_add = ot.ne(pad_id).int().sum().item()
+		sum_loss += loss_add
+		sum_wd += wd_add
+		_done_tokens += wd_add
+		if _done_tokens >= tokens_optm:
+			steps.append(i)
+			_done_tokens = 0
+
+	return sum_loss, sum_wd, steps
+
+def run_acc():
+
+	_metric, _done_tokens, steps = MetricAccumulator(2, device=device), DeferredCounter(0, device=device), []
+	for i, (ot, loss,) in enumerate(batches):
+		work()
+		loss_add = loss.detach()
+		wd_add = ot.ne(pad_id).sum()
+		_done_tokens.add(wd_add, ot.numel())
+		_metric.add(loss_add, wd_add)
+		if _done_tokens.ge(tokens_optm):
+			steps.append(i)
+			_done_tokens.reset()
+	sum_loss, sum_wd = _metric.get()
+
+	return sum_loss, int(sum_wd), steps
+
+rs = {}
+for name, func in (("item", run_item,), ("accumulator", run_acc,),):
+	func()
+	sync()
+	_st = time()
+	rs[name] = func()
+	sync()
+	_t = time() - _st
+	print("%s: %.2f us per batch" % (name, _t * 1e6 / nbatch,))
+_ref, _acc = rs["item"], rs["accumulator"]
+print("%d optimizer steps, loss difference: %.3e, same token count: %s, same steps: %s" % (len(_ref[-1]), abs(_ref[0] - _acc[0]), _ref[1] == _acc[1], _ref[-1] == _acc[-1],))
@@ -0,0 +1,76 @@
+#encoding: utf-8
+
+# usage: python tools/check/moses.py [number of clients] [number of requests per client] [number of lines per request] [number of processes]
+# compare the line-by-line round trips of the former Moses wrappers with the pipelined processors of datautils/moses.py (with a pool of processes serving concurrent clients), using a perl-free stub script which echoes upper-cased lines like a line-based Moses tool, and check that outputs are aligned with inputs. The pool of processes only pays off with more than one CPU core.
+
+import sys
+
+from random import seed as rpyseed, randint
+from subprocess import PIPE, Popen
+from threading import Thread, Lock
+from time import time
+
+from datautils.moses import BatchProcessor
+
+nclient, nreq, nline, nproc = [int(_) for _ in sys.argv[1:5]] if len(sys.argv) > 4 else (8, 16, 32, 4,)
+
+stub_cmd = [sys.executable, "-u", "-c", "import sys\nfor line in sys.stdin:\n\tsys.stdout.write(line.upper())"]
+
+rpyseed(666)
+requests = [[[" ".join("w%d" % randint(0, 99) for _ in range(randint(1, 32))) for k in range(nline)] for j in range(nreq)] for i in range(nclient)]
+
+class RoundTripProcessor:
+
+	def __init__(self, cmd):
+
+		self.process = Popen(cmd, stdin=PIPE, stdout=PIPE)
+		self.lock = Lock()
+
+	def __call__(self, input):
+
+		rs = []
+		with self.lock:
+			for inputu in input:
+				self.process.stdin.write(("%s\n" % inputu.strip()).encode("utf-8", "ignore"))
+				self.process.stdin.flush()
+				rs.append(self.process.stdout.readline().strip().decode("utf-8", "ignore"))
+
+		return rs
+
+	def close(self):
+
+		self.process.stdin.close()
+		self.process.terminate()
+
+class StubProcessor(BatchProcessor):
+
+	def __init__(self, num_process=1):
+
+		super(StubProcessor, self).__init__(stub_cmd, num_process=num_process)
+		self.start()
+
+def run(func):
+
+	rs = [[] for i in range(nclient)]
+	def client(i):
+		for _ in requests[i]:
+			rs[i].append(func(_))
+	_threads = [Thread(target=client, args=(i,)) for i in range(nclient)]
+	_st = time()
+	for _ in _threads:
+		_.start()
+	for _ in _threads:
+		_.join()
+
+	return rs, time() - _st
+
+def aligned(rs):
+
+	return all(_o == [_.upper() for _ in _i] for _ri, _rc in zip(requests, rs) for _i, _o in zip(_ri, _rc))
+
+_ntotal = nclient * nreq * nline
+print("Clients: %d, requests: %d, lines: %d" % (nclient, nclient * nreq, _ntotal,))
+for _name, _processor in (("Round trips", RoundTripProcessor(stub_cmd),), ("Pipelined, 1 process", StubProcessor(),), ("Pipelined, %d processes" % nproc, StubProcessor(nproc),),):
+	_rs, _t = run(_processor)
+	_processor.close()
+	print("%s: %.3f s, %.2f lines/s, aligned: %s" % (_name, _t, _ntotal / _t, aligned(_rs),))
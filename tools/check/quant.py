@@ -0,0 +1,104 @@
+#encoding: utf-8
+
+# usage: python tools/check/quant.py $model_file.h5
+# compare the CPU decoding speed and the BLEU (computed on token ids against references of cnfg.dev_data, i.e. on the sub-word level) of a fp32 model and its dynamically int8 quantized version (utils/quant.py). The model file can be a fp32 one or a quantized one (saved by tools/quantize_model.py), only the quantized model is evaluated in the latter case.
+
+import sys
+
+import torch
+
+from time import time
+from math import exp, log
+from collections import Counter
+
+from utils.tqdm import tqdm
+
+from utils.mmdata import open_data
+from utils.quant import is_quantized_model_file, load_model_cpu_quant, quantize_model
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+from transformer.NMT import NMT
+
+from utils.fmt.base import eos_id, pad_id, sos_id
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def cut_eos(output):
+
+	rs = []
+	for tran in output:
+		tmp = []
+		for tmpu in tran:
+			if tmpu == eos_id:
+				break
+			elif (tmpu != sos_id) and (tmpu != pad_id):
+				tmp.append(tmpu)
+		rs.append(tmp)
+
+	return rs
+
+# corpus BLEU-4 like multi-bleu.perl
+
+def bleu(refs, hyps, ngram=4):
+
+	_match, _total = [0] * ngram, [0] * ngram
+	_lr = _lh = 0
+	for _r, _h in zip(refs, hyps):
+		_lr += len(_r)
+		_lh += len(_h)
+		for n in range(ngram):
+			_rc = Counter(tuple(_r[i:i + n + 1]) for i in range(len(_r) - n))
+			_hc = Counter(tuple(_h[i:i + n + 1]) for i in range(len(_h) - n))
+			_match[n] += sum((_rc & _hc).values())
+			_total[n] += max(0, len(_h) - n)
+	if min(_match) == 0:
+		return 0.0
+	_bp = 1.0 if _lh > _lr else exp(1.0 - float(_lr) / max(_lh, 1))
+
+	return 100.0 * _bp * exp(sum(log(float(_m) / _t) for _m, _t in zip(_match, _total)) / ngram)
+
+td = open_data(cnfg.dev_data, "r")
+
+ntest = td["ndata"][()].item()
+nword = td["nword"][()].tolist()
+nwordi, nwordt = nword[0], nword[-1]
+
+mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+if is_quantized_model_file(sys.argv[1]):
+	models = {"int8": load_model_cpu_quant(sys.argv[1], mymodel)}
+else:
+	mymodel = load_model_cpu_quant(sys.argv[1], mymodel, fix_func=load_fixing)
+	mymodel.eval()
+	models = {"fp32": mymodel, "int8": quantize_model(mymodel)}
+
+beam_size = cnfg.beam_size
+length_penalty = cnfg.length_penalty
+
+src_grp, tgt_grp = td["src"], td["tgt"]
+refs = []
+hyps = {k: [] for k in models.keys()}
+times = {k: 0.0 for k in models.keys()}
+with torch.no_grad():
+	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
+		_bid = str(i)
+		seq_batch = torch.from_numpy(src_grp[_bid][()]).long()
+		refs.extend(cut_eos(tgt_grp[_bid][()].tolist()))
+		for k, v in models.items():
+			_st = time()
+			output = v.decode(seq_batch, beam_size, None, length_penalty)
+			times[k] += time() - _st
+			hyps[k].extend(cut_eos(output.tolist()))
+
+td.close()
+
+nsent = len(refs)
+print("Sentences: %d, batches: %d, threads: %d" % (nsent, ntest, torch.get_num_threads(),))
+for k in models.keys():
+	print("%s: BLEU %.2f, %.3f s, %.2f sentences/s" % (k, bleu(refs, hyps[k]), times[k], nsent / times[k],))
+if len(models) > 1:
+	print("BLEU delta: %.2f, speed up: %.3f, different translations: %d" % (bleu(refs, hyps["int8"]) - bleu(refs, hyps["fp32"]), times["fp32"] / times["int8"], sum(1 for _f, _q in zip(hyps["fp32"], hyps["int8"]) if _f != _q),))
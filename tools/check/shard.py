@@ -0,0 +1,70 @@
+#encoding: utf-8
+
+# usage: python tools/check/shard.py $src.txt $tgt.txt $src_vcb $tgt_vcb $cache_dir [minbsize] [number of processes]
+# compare the output of tools/mkiodata.py (source and target) and tools/mktest.py (source only) between the serial run and sharded parallel processing (utils/shard.py), for both HDF5 files and flat token stores (see utils/mmdata.py). (minbsize - 1) long pairs are appended to the (sorted) inputs, so that the last batch has fewer than minbsize sentences, and the numbers of batches and the contents of all batches are checked to be identical.
+
+import sys
+
+import numpy
+
+from os import makedirs
+from os.path import join as pjoin
+
+from utils.fmt.base import list_reader
+from utils.h5serial import h5File
+from utils.mmdata import MMapData, is_mmdata
+from tools.mkiodata import handle as handle_dual
+from tools.mktest import handle as handle_single
+
+from cnfg.ihyp import *
+
+fsrc, ftgt, fvcb_src, fvcb_tgt, cache_dir = sys.argv[1:6]
+minbsize = int(sys.argv[6]) if len(sys.argv) > 6 else 4
+num_process = int(sys.argv[7]) if len(sys.argv) > 7 else 3
+
+# copy inputs with (minbsize - 1) appended pairs which are longer than the maximum length of any batch containing previous pairs.
+
+def build_inputs():
+
+	makedirs(cache_dir, exist_ok=True)
+	rs = []
+	for _f, _name in ((fsrc, "src.txt",), (ftgt, "tgt.txt",),):
+		_lines = [" ".join(_) for _ in list_reader(_f, keep_empty_line=True)]
+		rs.append((pjoin(cache_dir, _name), _lines,))
+	_mlen = max(len(_s.split()) + len(_t.split()) for _s, _t in zip(rs[0][1], rs[1][1]))
+	_tail = " ".join(rs[0][1][-1].split()[:1] * (_mlen + max_pad_tokens_sentence + 1))
+	for _f, _lines in rs:
+		with open(_f, "wb") as f:
+			f.write("\n".join(_lines + [_tail] * (minbsize - 1)).encode("utf-8"))
+			f.write("\n".encode("utf-8"))
+
+	return [_[0] for _ in rs]
+
+def load_data(fname):
+
+	return MMapData(fname) if is_mmdata(fname) else h5File(fname, "r")
+
+def batch_sizes(td, ndata):
+
+	return [td["src/%d" % i][()].shape[0] for i in range(ndata)]
+
+def compare(fserial, fshard, fields):
+
+	_ts, _tp = load_data(fserial), load_data(fshard)
+	_nd_s, _nd_p = int(_ts["ndata"][()][0]), int(_tp["ndata"][()][0])
+	rs = (_nd_s == _nd_p) and all(numpy.array_equal(_ts["%s/%d" % (_field, i,)][()], _tp["%s/%d" % (_field, i,)][()]) for _field in fields for i in range(_nd_s))
+	_bsizes = batch_sizes(_ts, _nd_s)
+	if not is_mmdata(fserial):
+		_ts.close()
+		_tp.close()
+
+	return rs, _nd_s, _nd_p, _bsizes
+
+fsrc, ftgt = build_inputs()
+for _suf in (".h5", ".mm",):
+	for _name, _fields, _handle in (("mkiodata", ("src", "tgt",), lambda frs, nproc: handle_dual(fsrc, ftgt, fvcb_src, fvcb_tgt, frs, minbsize, num_process=nproc),), ("mktest", ("src",), lambda frs, nproc: handle_single(fsrc, fvcb_src, frs, minbsize, num_process=nproc),),):
+		_fserial, _fshard = pjoin(cache_dir, "%s_serial%s" % (_name, _suf,)), pjoin(cache_dir, "%s_shard%s" % (_name, _suf,))
+		_handle(_fserial, 1)
+		_handle(_fshard, num_process)
+		_identical, _nd_s, _nd_p, _bsizes = compare(_fserial, _fshard, _fields)
+		print("%s (%s), minbsize %d, %d processes: serial %d batches, sharded %d batches, last batch sizes: %s, identical: %s" % (_name, "HDF5" if _suf == ".h5" else "flat token store", minbsize, num_process, _nd_s, _nd_p, " ".join(str(_) for _ in _bsizes[-3:]), _identical,))
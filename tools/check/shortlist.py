@@ -0,0 +1,111 @@
+#encoding: utf-8
+
+# usage: python tools/check/shortlist.py $model_file.h5 $shortlist.h5 [$topk] [$nfreq]
+# compare the decoding speed and translations with the full target vocabulary and with lexical shortlists (utils/shortlist.py, built by tools/shortlist.py) on cnfg.dev_data. The average candidate set size, the number of different translations and the token-level F1 of shortlisted translations against full-vocabulary translations are reported.
+
+import sys
+
+import torch
+
+from time import time
+
+from utils.tqdm import tqdm
+
+from collections import Counter
+
+from utils.mmdata import open_data
+from utils.shortlist import load_shortlist
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+from transformer.NMT import NMT
+
+from utils.base import load_model_cpu
+from utils.fmt.base import eos_id
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def cut_eos(output):
+
+	rs = []
+	for tran in output.tolist():
+		tmp = []
+		for tmpu in tran:
+			if tmpu == eos_id:
+				break
+			else:
+				tmp.append(tmpu)
+		rs.append(tmp)
+
+	return rs
+
+td = open_data(cnfg.dev_data, "r")
+
+ntest = td["ndata"][()].item()
+nword = td["nword"][()].tolist()
+nwordi, nwordt = nword[0], nword[-1]
+
+mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+mymodel = load_model_cpu(sys.argv[1], mymodel)
+mymodel.apply(load_fixing)
+mymodel.eval()
+
+cuda_device = torch.device(cnfg.gpuid) if cnfg.use_cuda and torch.cuda.is_available() else False
+if cuda_device:
+	torch.cuda.set_device(cuda_device.index)
+	mymodel.to(cuda_device, non_blocking=True)
+
+shortlist = load_shortlist(sys.argv[2], *[int(_) for _ in sys.argv[3:5]])
+if cuda_device:
+	shortlist.to(cuda_device)
+
+beam_size = cnfg.beam_size
+length_penalty = cnfg.length_penalty
+
+def sync():
+
+	if cuda_device:
+		torch.cuda.synchronize(cuda_device)
+
+def f1(ref, hyp):
+
+	_ref, _hyp = Counter(ref), Counter(hyp)
+	_match = sum((_ref & _hyp).values())
+
+	return 2.0 * _match / max(1, len(ref) + len(hyp))
+
+src_grp = td["src"]
+t_full = t_sl = 0.0
+nsent = ndiff = ncand = 0
+sf1 = 0.0
+with torch.no_grad():
+	for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
+		seq_batch = torch.from_numpy(src_grp[str(i)][()])
+		if cuda_device:
+			seq_batch = seq_batch.to(cuda_device, non_blocking=True)
+		seq_batch = seq_batch.long()
+		sync()
+		_st = time()
+		output = mymodel.decode(seq_batch, beam_size, None, length_penalty)
+		sync()
+		_et = time()
+		output_sl = mymodel.decode(seq_batch, beam_size, None, length_penalty, shortlist=shortlist)
+		sync()
+		t_full += _et - _st
+		t_sl += time() - _et
+		ncand += shortlist(seq_batch).numel()
+		output, output_sl = cut_eos(output), cut_eos(output_sl)
+		ndiff += sum(1 for _s, _c in zip(output, output_sl) if _s != _c)
+		sf1 += sum(f1(_s, _c) for _s, _c in zip(output, output_sl))
+		nsent += len(output)
+
+td.close()
+
+print("Sentences: %d, batches: %d, target vocabulary: %d, average candidates per batch: %.2f" % (nsent, ntest, nwordt, float(ncand) / ntest,))
+print("Full vocabulary: %.3f s, %.2f sentences/s" % (t_full, nsent / t_full,))
+print("Shortlist: %.3f s, %.2f sentences/s, speed up: %.3f" % (t_sl, nsent / t_sl, t_full / t_sl,))
+print("Different translations: %d (%.2f%%), token F1 against full vocabulary: %.4f" % (ndiff, ndiff * 100.0 / nsent, sf1 / nsent,))
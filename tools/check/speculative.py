@@ -0,0 +1,88 @@
+#encoding: utf-8
+
+# usage: python tools/check/speculative.py $model.h5 $draft.h5 [$nspec]
+# compare the decoding speed of a model with speculative decoding (transformer/SpeculativeNMT.py) with a draft decoder distilled by tools/distil_draft.py on the development set, for greedy decoding and beam search with cnfg.beam_size. The number of tokens decoded per forward pass of the model and the number of different translations (which should be 0) are reported.
+
+import sys
+
+import torch
+
+from time import time
+
+from utils.tqdm import tqdm
+
+from utils.base import load_model_cpu
+from utils.mmdata import open_data
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+from cnfg.vocab.base import eos_id, pad_id
+
+from transformer.NMT import NMT
+from transformer.Decoder import Decoder
+from transformer.SpeculativeNMT import NMT as SpeculativeNMT
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def cut_eos(output):
+
+	rs = []
+	for tran in output:
+		tmp = []
+		for tmpu in tran:
+			if tmpu == eos_id:
+				break
+			elif tmpu != pad_id:
+				tmp.append(tmpu)
+		rs.append(tmp)
+
+	return rs
+
+td = open_data(cnfg.dev_data, "r")
+
+ntest = td["ndata"][()].item()
+nword = td["nword"][()].tolist()
+nwordi, nwordt = nword[0], nword[-1]
+
+mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+mymodel = load_model_cpu(sys.argv[1], mymodel)
+mymodel.apply(load_fixing)
+mymodel.eval()
+draft = Decoder(cnfg.isize, nwordt, cnfg.draft_nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, None, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+draft = load_model_cpu(sys.argv[2], draft)
+draft.apply(load_fixing)
+draft.eval()
+spec_model = SpeculativeNMT(mymodel, draft, nspec=int(sys.argv[3]) if len(sys.argv) > 3 else cnfg.speculative_ntoken)
+
+length_penalty = cnfg.length_penalty
+
+src_grp = td["src"]
+nsent = 0
+_beams = (1,) if cnfg.beam_size < 2 else (1, cnfg.beam_size,)
+hyps = {(_b, _s,): [] for _b in _beams for _s in (False, True,)}
+times = {_k: 0.0 for _k in hyps.keys()}
+nstep = {}
+with torch.no_grad():
+	for beam_size in _beams:
+		spec_model.dec.reset_stats()
+		for i in tqdm(range(ntest), mininterval=tqdm_mininterval):
+			seq_batch = torch.from_numpy(src_grp[str(i)][()]).long()
+			if beam_size == 1:
+				nsent += seq_batch.size(0)
+			for _spec, _model in ((False, mymodel,), (True, spec_model,),):
+				_st = time()
+				output = _model.decode(seq_batch, beam_size, None, length_penalty)
+				times[(beam_size, _spec,)] += time() - _st
+				hyps[(beam_size, _spec,)].extend(cut_eos(output.tolist()))
+		nstep[beam_size] = (spec_model.dec.nstep, spec_model.dec.ntoken,)
+
+td.close()
+
+print("Sentences: %d, batches: %d, proposals per step: %d, threads: %d" % (nsent, ntest, spec_model.dec.nspec, torch.get_num_threads(),))
+for beam_size in _beams:
+	_t, _ts = times[(beam_size, False,)], times[(beam_size, True,)]
+	_nstep, _ntoken = nstep[beam_size]
+	print("beam %d: %.3f s => %.3f s, speed up %.3f, tokens per step %.3f, different translations: %d" % (beam_size, _t, _ts, _t / _ts, float(_ntoken) / _nstep, sum(1 for _h, _hs in zip(hyps[(beam_size, False,)], hyps[(beam_size, True,)]) if _h != _hs),))
@@ -0,0 +1,132 @@
+#encoding: utf-8
+
+# usage: python tools/check/zero.py [number of processes] [optimizer steps] [batch size] [sequence length]
+# train a randomly initialized standard model (with sizes of cnfg/base.py without dropout) with Adam, RAdam, AdaBelief and Ranger with optimizer states sharded across processes (DistShardedOptimizer of parallel/optm.py, with the gloo backend on CPUs), report the memory of optimizer states of each process and the time per step, and check that parameters after training agree with those trained in one process with the full optimizer, also when training states are saved with utils.state.holder.Holder in the middle of training and loaded into new optimizers.
+
+import sys
+
+import torch
+from torch import multiprocessing as mp
+from os import environ
+from io import BytesIO
+from time import time
+
+from transformer.NMT import NMT
+from parallel.dist import DistGradReducer, broadcast_model, close_dist, init_dist
+from parallel.optm import DistShardedOptimizer
+from loss.base import LabelSmoothingLoss
+from optm.radam import RAdam
+from optm.adabelief import AdaBelief
+from optm.ranger import Ranger
+from utils.state.holder import Holder
+from utils.fmt.base import pad_id
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+nproc, nstep, bsize, seql = [int(_) for _ in sys.argv[1:5]] if len(sys.argv) > 4 else (2, 6, 8, 16,)
+nword = 8192
+optms = (("Adam", torch.optim.Adam,), ("RAdam", RAdam,), ("AdaBelief", AdaBelief,), ("Ranger", Ranger,),)
+
+def build_model():
+
+	torch.manual_seed(666)
+	rs = NMT(cnfg.isize, nword, nword, cnfg.nlayer, cnfg.ff_hsize, 0.0, 0.0, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	rs.train()
+
+	return rs
+
+# batches of each optimizer step, one for each process
+
+def build_batches():
+
+	_g = torch.Generator().manual_seed(999)
+
+	return [[(torch.randint(4, nword, (bsize, seql,), generator=_g), torch.randint(4, nword, (bsize, seql + 1,), generator=_g),) for _ in range(nproc)] for _ in range(nstep)]
+
+def train_step(model, lossf, batches):
+
+	for seq_batch, seq_o in batches:
+		lossf(model(seq_batch, seq_o.narrow(1, 0, seql)), seq_o.narrow(1, 1, seql)).backward()
+
+def state_size(optm):
+
+	return sum(_v.numel() * _v.element_size() for _s in optm.state.values() for _v in _s.values() if isinstance(_v, torch.Tensor))
+
+def run_single(optm_func):
+
+	model, lossf = build_model(), LabelSmoothingLoss(nword, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum")
+	optm = optm_func(model.parameters(), lr=1e-4)
+	for _b in build_batches():
+		train_step(model, lossf, _b)
+		optm.step()
+		optm.zero_grad(set_to_none=True)
+
+	return [_.data for _ in model.parameters()], state_size(optm)
+
+def run_dist(rank, rsq):
+
+	environ.update({"RANK": str(rank), "LOCAL_RANK": str(rank), "WORLD_SIZE": str(nproc), "MASTER_ADDR": "127.0.0.1", "MASTER_PORT": environ.get("MASTER_PORT", "29555")})
+	init_dist("gloo")
+	torch.set_num_threads(max(torch.get_num_threads() // nproc, 1))
+	batches = build_batches()
+	for name, optm_func in optms:
+		rs = []
+		# train, and train again from the training states saved after half of the steps
+		for resume in (False, True,):
+			model, lossf = build_model(), LabelSmoothingLoss(nword, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum")
+			broadcast_model(model)
+			optm = DistShardedOptimizer(model, optm_func, lr=1e-4)
+			grad_reducer = DistGradReducer(model)
+			_st = time()
+			for i, _b in enumerate(batches):
+				if resume and (i == nstep // 2):
+					_f = BytesIO()
+					torch.save(Holder(optm=optm).state_dict(update=False, remain_steps=nstep - i), _f)
+					_paras = [_.data.clone() for _ in model.parameters()]
+					grad_reducer.close()
+					model = optm = grad_reducer = None
+					model = build_model()
+					with torch.no_grad():
+						for _p, _s in zip(model.parameters(), _paras):
+							_p.copy_(_s)
+					optm = DistShardedOptimizer(model, optm_func, lr=1e-4)
+					grad_reducer = DistGradReducer(model)
+					_f.seek(0)
+					Holder(optm=optm).load_state_dict(torch.load(_f, weights_only=False))
+				grad_reducer.set_sync(True)
+				train_step(model, lossf, _b[rank:rank + 1])
+				grad_reducer.collect_gradients()
+				optm.step()
+				optm.zero_grad(set_to_none=True)
+			_t = (time() - _st) / nstep
+			grad_reducer.close()
+			rs.append([_.data for _ in model.parameters()])
+			_size = state_size(optm.optm)
+			model = optm = grad_reducer = None
+		# the single process reference is trained by rank 0, while other processes wait for the next collective operation
+		if rank == 0:
+			_ref = run_single(optm_func)[0]
+			_diff, _diff_resume = [max((_a - _b).abs().max().item() for _a, _b in zip(_ref, _)) for _ in rs]
+			_ref = None
+		else:
+			_diff = _diff_resume = None
+		rs = None
+		rsq.put((rank, name, _size, _t, _diff, _diff_resume,))
+	close_dist()
+
+if __name__ == "__main__":
+	_ctx = mp.get_context("spawn")
+	rsq = _ctx.SimpleQueue()
+	_procs = [_ctx.Process(target=run_dist, args=(i, rsq,)) for i in range(nproc)]
+	for _ in _procs:
+		_.start()
+	_rs = {}
+	for _ in range(nproc * len(optms)):
+		rank, name, _size, _t, _diff, _diff_resume = rsq.get()
+		_rs.setdefault(name, {})[rank] = (_size, _t, _diff, _diff_resume,)
+	for _ in _procs:
+		_.join()
+	for name, _ in optms:
+		_size, _t, _diff, _diff_resume = _rs[name][0]
+		print("%s: optimizer states of %d processes: %s MB (%.2f MB in total), %.2f s per step, maximum difference of parameters to one process: %.3e, after resuming: %.3e" % (name, nproc, " ".join("%.2f" % (_rs[name][i][0] / 1048576.0) for i in range(nproc)), sum(_rs[name][i][0] for i in range(nproc)) / 1048576.0, _t, _diff, _diff_resume,))
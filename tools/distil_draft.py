@@ -0,0 +1,94 @@
+#encoding: utf-8
+
+""" this file distils a small draft decoder for speculative decoding (see transformer/SpeculativeDecoder.py) from a trained model, it has to be executed at the root path of the project. Usage:
+	python tools/distil_draft.py path/to/train.h5 path/to/model.h5 path/to/draft.h5 $nepoch $lr
+the draft decoder (with cnfg.draft_nlayer layers) is initialized with the embedding, the classifier and the first layers of the decoder of the model, and trained on greedy translations of the model for source sentences of the data (sequence-level knowledge distillation) with the representation of the frozen encoder of the model, which maximizes the agreement of its proposals with the model. The agreement (token accuracy) is reported after each epoch.
+"""
+
+import sys
+
+import torch
+from random import shuffle
+from torch.nn import functional as nnFunc
+
+from utils.base import load_model_cpu, save_model, set_random_seed
+from utils.fmt.base4torch import parse_cuda_decode
+from utils.mmdata import open_data
+from utils.tqdm import tqdm
+from transformer.NMT import NMT
+from transformer.Decoder import Decoder
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+from cnfg.vocab.base import eos_id, pad_id, sos_id
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def handle(datf, modf, rsf, nepoch=1, lr=1e-4, nlayer=cnfg.draft_nlayer):
+
+	use_cuda, cuda_device = parse_cuda_decode(cnfg.use_cuda, cnfg.gpuid, False)[:2]
+	set_random_seed(cnfg.seed, use_cuda)
+
+	with open_data(datf, "r") as td:
+		ndata = td["ndata"][()].item()
+		nwordi, nwordt = td["nword"][()].tolist()[:2]
+		src_grp = td["src"]
+		srcs = [torch.from_numpy(src_grp[str(i)][()]).long() for i in range(ndata)]
+
+	model = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	model = load_model_cpu(modf, model)
+	model.apply(load_fixing)
+	model.eval()
+
+	draft = Decoder(cnfg.isize, nwordt, nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, None, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	# parameters of layers beyond nlayer are ignored
+	draft.load_state_dict(model.dec.state_dict(), strict=False)
+
+	if cuda_device:
+		model.to(cuda_device)
+		draft.to(cuda_device)
+
+	optimizer = torch.optim.Adam(draft.parameters(), lr=lr, betas=adam_betas_default, eps=ieps_adam_default)
+
+	# greedy translations of the model are computed once and kept for all epochs, tokens after <eos> are padded
+	tgts = []
+	with torch.no_grad():
+		for seq_batch in tqdm(srcs, mininterval=tqdm_mininterval):
+			if cuda_device:
+				seq_batch = seq_batch.to(cuda_device)
+			output = model.decode(seq_batch, 1)
+			output = output.masked_fill(output.eq(eos_id).long().cumsum(1).gt(0) & output.ne(eos_id), pad_id)
+			tgts.append(torch.cat((output.new_full((output.size(0), 1,), sos_id), output,), 1).cpu())
+
+	_inds = list(range(ndata))
+	for epoch in range(1, nepoch + 1):
+		draft.train()
+		shuffle(_inds)
+		sum_loss = 0.0
+		ntok = ncorrect = 0
+		for i in tqdm(_inds, mininterval=tqdm_mininterval):
+			seq_batch, seq_o = srcs[i], tgts[i]
+			if cuda_device:
+				seq_batch, seq_o = seq_batch.to(cuda_device), seq_o.to(cuda_device)
+			_mask = seq_batch.eq(pad_id).unsqueeze(1)
+			with torch.no_grad():
+				ence = model.enc(seq_batch, _mask)
+			oi, ot = seq_o.narrow(1, 0, seq_o.size(1) - 1), seq_o.narrow(1, 1, seq_o.size(1) - 1)
+			out = draft(ence, oi, _mask)
+			_ntok = ot.ne(pad_id).int().sum().item()
+			loss = nnFunc.nll_loss(out.view(-1, out.size(-1)), ot.reshape(-1), ignore_index=pad_id, reduction="sum")
+			optimizer.zero_grad(set_to_none=True)
+			(loss / _ntok).backward()
+			optimizer.step()
+			sum_loss += loss.item()
+			ntok += _ntok
+			ncorrect += (out.argmax(-1).eq(ot) & ot.ne(pad_id)).int().sum().item()
+		print("Epoch %d: loss %.4f, agreement %.2f%%" % (epoch, sum_loss / ntok, 100.0 * ncorrect / ntok,))
+		draft.eval()
+		save_model(draft, rsf, False, print)
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2], sys.argv[3], *[_t(_) for _t, _ in zip((int, float,), sys.argv[4:6])])
@@ -0,0 +1,46 @@
+#encoding: utf-8
+
+""" this file exports a trained model to a self-contained TorchScript file (see transformer/ScriptNMT.py) together with its vocabularies, which can be used by tools/ts_translate.py without the code and configurations of this project, it has to be executed at the root path of the project. Usage:
+	python tools/export_ts.py path/to/src.vcb path/to/tgt.vcb path/to/model.h5 path/to/model.pt
+beam_size and length_penalty in cnfg/base.py are saved as the default decoding settings, models are quantized for CPU decoding with quant_decoding.
+"""
+
+import sys
+import torch
+from json import dumps
+
+from utils.fmt.base import ldvocab
+from utils.quant import load_model_cpu_quant
+from transformer.NMT import NMT
+from transformer.ScriptNMT import NMT as ScriptNMT, is_scriptable
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+from cnfg.vocab.base import unk_id
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def handle(src, tgt, srcm, rsm, minfreq=False, vsize=False):
+
+	vcbi, nwordi = ldvocab(src, minf=minfreq, omit_vsize=vsize, vanilla=False)
+	vcbt, nwordt = ldvocab(tgt, minf=minfreq, omit_vsize=vsize, vanilla=False)
+
+	mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	mymodel = load_model_cpu_quant(srcm, mymodel, quantize=cnfg.quant_decoding, fix_func=load_fixing)
+	mymodel.eval()
+	if not is_scriptable(mymodel):
+		print("The model is not supported by transformer/ScriptNMT.py")
+		sys.exit(1)
+
+	with torch.no_grad():
+		smodel = torch.jit.script(ScriptNMT(mymodel))
+	_vcbt = [None for _ in range(nwordt)]
+	for _k, _v in vcbt.items():
+		_vcbt[_v] = _k
+	torch.jit.save(smodel, rsm, _extra_files={"vocab_i.json": dumps(vcbi, ensure_ascii=False), "vocab_t.json": dumps(_vcbt, ensure_ascii=False), "config.json": dumps({"use_unk": use_unk, "unk_id": unk_id, "beam_size": cnfg.beam_size, "length_penalty": cnfg.length_penalty})})
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -0,0 +1,28 @@
+#encoding: utf-8
+
+# usage: python tools/h5/tommdata.py $data.h5 $rs_dir
+# convert a data file created by tools/mkiodata.py or tools/mktest.py to a flat token store (see utils/mmdata.py), batches and their order are kept. Only the plain layout (src, tgt and mt groups of padded batches) is supported.
+
+import sys
+
+from utils.h5serial import h5File
+from utils.mmdata import MMapWriter
+
+from utils.tqdm import tqdm
+
+from cnfg.ihyp import *
+
+def handle(srcf, rsf, fields=("src", "mt", "tgt",)):
+
+	with h5File(srcf, "r") as td:
+		_fields = tuple(_ for _ in fields if _ in td)
+		ndata = td["ndata"][()].item()
+		with MMapWriter(rsf, fields=_fields, nword=td["nword"][()].tolist()) as rsd:
+			_grps = [td[_] for _ in _fields]
+			for i in tqdm(range(ndata), mininterval=tqdm_mininterval):
+				_bid = str(i)
+				rsd.write(*[_grp[_bid][()] for _grp in _grps])
+	print("Number of batches: %d" % ndata)
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2])
@@ -4,13 +4,15 @@ import sys
 
 from numpy import array as np_array, int32 as np_int32
 from utils.h5serial import h5File
+from utils.mmdata import MMapWriter, is_mmdata
+from utils.shard import handle_sharded
 
 from utils.fmt.base import ldvocab
-from utils.fmt.dual import batch_padder
+from utils.fmt.dual import batch_mapper, batch_padder
 
 from cnfg.ihyp import *
 
-def handle(finput, ftarget, fvocab_i, fvocab_t, frs, minbsize=1, expand_for_mulgpu=True, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minfreq=False, vsize=False):
+def handle(finput, ftarget, fvocab_i, fvocab_t, frs, minbsize=1, expand_for_mulgpu=True, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minfreq=False, vsize=False, num_process=1):
 	vcbi, nwordi = ldvocab(fvocab_i, minf=minfreq, omit_vsize=vsize, vanilla=False)
 	vcbt, nwordt = ldvocab(fvocab_t, minf=minfreq, omit_vsize=vsize, vanilla=False)
 	if expand_for_mulgpu:
@@ -19,22 +21,33 @@ def handle(finput, ftarget, fvocab_i, fvocab_t, frs, minbsize=1, expand_for_mulg
 	else:
 		_bsize = bsize
 		_maxtoken = maxtoken
-	with h5File(frs, "w", libver=h5_libver) as rsf:
-		src_grp = rsf.create_group("src")
-		tgt_grp = rsf.create_group("tgt")
-		curd = 0
-		for i_d, td in batch_padder(finput, ftarget, vcbi, vcbt, _bsize, maxpad, maxpart, _maxtoken, minbsize):
-			rid = np_array(i_d, dtype=np_int32)
-			rtd = np_array(td, dtype=np_int32)
-			#rld = np_array(ld, dtype=np_int32)
-			wid = str(curd)
-			src_grp.create_dataset(wid, data=rid, **h5datawargs)
-			tgt_grp.create_dataset(wid, data=rtd, **h5datawargs)
-			#rsf["l" + wid] = rld
-			curd += 1
-		rsf["ndata"] = np_array([curd], dtype=np_int32)
-		rsf["nword"] = np_array([nwordi, nwordt], dtype=np_int32)
+	# map and pad shards of inputs with num_process processes, see utils/shard.py
+	if num_process > 1:
+		curd = handle_sharded((finput, ftarget,), (vcbi, vcbt,), frs, [nwordi, nwordt], bsize=_bsize, maxpad=maxpad, maxpart=maxpart, maxtoken=_maxtoken, minbsize=minbsize, num_process=num_process)
+	# write a flat token store (see utils/mmdata.py) if frs does not end with .h5
+	elif is_mmdata(frs):
+		with MMapWriter(frs, fields=("src", "tgt",), nword=[nwordi, nwordt]) as rsf:
+			curd = 0
+			for i_d, td, _, _ in batch_mapper(finput, ftarget, vcbi, vcbt, _bsize, maxpad, maxpart, _maxtoken, minbsize):
+				rsf.write(i_d, td)
+				curd += 1
+	else:
+		with h5File(frs, "w", libver=h5_libver) as rsf:
+			src_grp = rsf.create_group("src")
+			tgt_grp = rsf.create_group("tgt")
+			curd = 0
+			for i_d, td in batch_padder(finput, ftarget, vcbi, vcbt, _bsize, maxpad, maxpart, _maxtoken, minbsize):
+				rid = np_array(i_d, dtype=np_int32)
+				rtd = np_array(td, dtype=np_int32)
+				#rld = np_array(ld, dtype=np_int32)
+				wid = str(curd)
+				src_grp.create_dataset(wid, data=rid, **h5datawargs)
+				tgt_grp.create_dataset(wid, data=rtd, **h5datawargs)
+				#rsf["l" + wid] = rld
+				curd += 1
+			rsf["ndata"] = np_array([curd], dtype=np_int32)
+			rsf["nword"] = np_array([nwordi, nwordt], dtype=np_int32)
 	print("Number of batches: %d\nSource Vocabulary Size: %d\nTarget Vocabulary Size: %d" % (curd, nwordi, nwordt,))
 
 if __name__ == "__main__":
-	handle(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], int(sys.argv[6]))
+	handle(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], int(sys.argv[6]), num_process=int(sys.argv[7]) if len(sys.argv) > 7 else 1)
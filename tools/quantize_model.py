@@ -0,0 +1,31 @@
+#encoding: utf-8
+
+""" this file quantizes weights of linear layers of a trained model to int8 for CPU decoding (see utils/quant.py), it has to be executed at the root path of the project. Usage:
+	python tools/quantize_model.py path/to/src.vcb path/to/tgt.vcb path/to/model.h5 path/to/quantized_model.h5
+"""
+
+import sys
+
+from utils.fmt.base import ldvocab
+from utils.quant import load_model_cpu_quant, save_quantized_model
+from transformer.NMT import NMT
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def handle(src, tgt, srcm, rsm, minfreq=False, vsize=False):
+
+	_, nwordi = ldvocab(src, minf=minfreq, omit_vsize=vsize, vanilla=False)
+	_, nwordt = ldvocab(tgt, minf=minfreq, omit_vsize=vsize, vanilla=False)
+
+	mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	mymodel = load_model_cpu_quant(srcm, mymodel, quantize=True, fix_func=load_fixing)
+	save_quantized_model(mymodel, rsm, h5args=h5zipargs)
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -0,0 +1,81 @@
+#encoding: utf-8
+
+# usage: python tools/shortlist.py $train.h5 $rsf.h5 $topk $nfreq
+# build lexical shortlists (see utils/shortlist.py) from a data file created by tools/mkiodata.py (either format): for every source token, the $topk target tokens with the highest co-occurrence probability p(t|s) (estimated on sentence level, excluding the $nfreq most frequent target tokens which are always kept in candidate sets) are saved.
+
+import sys
+import numpy
+
+from utils.h5serial import h5File
+from utils.mmdata import open_data
+from utils.tqdm import tqdm
+from cnfg.vocab.base import init_normal_token_id, pad_id
+
+from cnfg.ihyp import *
+
+# merge accumulated pair counts when they exceed this number of entries
+merge_size = 1 << 24
+
+def merge_counts(codes, counts):
+
+	_codes, _inv = numpy.unique(numpy.concatenate(codes), return_inverse=True)
+
+	return _codes, numpy.bincount(_inv, weights=numpy.concatenate(counts)).astype(numpy.int64)
+
+def handle(srcf, rsf, topk=64, nfreq=512):
+
+	with open_data(srcf, "r") as td:
+		ndata = td["ndata"][()].item()
+		nwordi, nwordt = td["nword"][()].tolist()[:2]
+		src_grp, tgt_grp = td["src"], td["tgt"]
+		codes, counts = [], []
+		_csize = 0
+		src_count = numpy.zeros(nwordi, dtype=numpy.int64)
+		tgt_freq = numpy.zeros(nwordt, dtype=numpy.int64)
+		for i in tqdm(range(ndata), mininterval=tqdm_mininterval):
+			_bid = str(i)
+			_codes = []
+			for _s, _t in zip(src_grp[_bid][()].tolist(), tgt_grp[_bid][()].tolist()):
+				_s = numpy.unique(numpy.array(_s, dtype=numpy.int64))
+				_s = _s[_s >= init_normal_token_id]
+				_t = numpy.array(_t, dtype=numpy.int64)
+				_t = _t[_t >= init_normal_token_id]
+				tgt_freq += numpy.bincount(_t, minlength=nwordt)
+				_t = numpy.unique(_t)
+				src_count[_s] += 1
+				_codes.append((_s[:, None] * nwordt + _t[None, :]).reshape(-1))
+			_codes, _counts = numpy.unique(numpy.concatenate(_codes), return_counts=True)
+			codes.append(_codes)
+			counts.append(_counts)
+			_csize += _codes.size
+			if _csize > merge_size:
+				codes, counts = merge_counts(codes, counts)
+				_csize = codes.size
+				codes, counts = [codes], [counts]
+	codes, counts = merge_counts(codes, counts)
+
+	freq = numpy.argsort(-tgt_freq, kind="stable")[:nfreq]
+	freq = freq[tgt_freq[freq] > 0]
+	_is_freq = numpy.zeros(nwordt, dtype=bool)
+	_is_freq[freq] = True
+	_src, _tgt = codes // nwordt, codes % nwordt
+	_keep = ~_is_freq[_tgt]
+	_src, _tgt, counts = _src[_keep], _tgt[_keep], counts[_keep]
+	# sort pairs by source token, then by p(t|s) (descending), which is the order of counts given the source token
+	_ind = numpy.lexsort((-counts, _src,))
+	_src, _tgt = _src[_ind], _tgt[_ind]
+	_bounds = numpy.searchsorted(_src, numpy.arange(nwordi + 1))
+	lex = numpy.full((nwordi, topk,), pad_id, dtype=numpy.int32)
+	for _sid, (_sb, _eb,) in enumerate(zip(_bounds[:-1].tolist(), _bounds[1:].tolist())):
+		if _eb > _sb:
+			_tmp = _tgt[_sb:min(_eb, _sb + topk)]
+			lex[_sid, :_tmp.size] = _tmp
+
+	with h5File(rsf, "w", libver=h5_libver) as f:
+		f.create_dataset("lex", data=lex, **h5datawargs)
+		f["freq"] = freq.astype(numpy.int32)
+		f["nword"] = numpy.array([nwordi, nwordt], dtype=numpy.int32)
+	print("Source tokens with shortlists: %d/%d, average shortlist size: %.2f" % (int((src_count > 0).sum()), nwordi, float((lex != pad_id).sum()) / max(1, int((src_count > 0).sum())),))
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2], *[int(_) for _ in sys.argv[3:5]])
@@ -0,0 +1,84 @@
+#encoding: utf-8
+
+""" this file translates pre-processed (e.g. tokenized and BPE applied) sentences with a model exported by tools/export_ts.py, and only depends on PyTorch, so that it can be copied and used without the code and configurations of this project. Usage:
+	python tools/ts_translate.py path/to/model.pt path/to/input.txt path/to/output.txt [$beam_size] [$length_penalty]
+"-" for stdin/stdout. Sentences are sorted by length and decoded in batches of at most max_sentences sentences and max_tokens source tokens, translations are written in the original order. Decoding settings saved by tools/export_ts.py are used if not given.
+"""
+
+import sys
+import torch
+from json import loads
+
+max_sentences = 64
+max_tokens = 2560
+pad_id, sos_id, eos_id = 0, 1, 2
+
+def load(fname):
+
+	_extra_files = {"vocab_i.json": "", "vocab_t.json": "", "config.json": ""}
+	model = torch.jit.load(fname, map_location="cpu", _extra_files=_extra_files)
+	model.eval()
+
+	return model, loads(_extra_files["vocab_i.json"]), loads(_extra_files["vocab_t.json"]), loads(_extra_files["config.json"])
+
+def map_sentence(line, vcbi, use_unk=True, unk_id=3):
+
+	rs = [sos_id]
+	for _ in line.split():
+		if _ in vcbi:
+			rs.append(vcbi[_])
+		elif use_unk:
+			rs.append(unk_id)
+	rs.append(eos_id)
+
+	return rs
+
+def batch_iter(sents):
+
+	_ind = sorted(range(len(sents)), key=lambda _: len(sents[_]), reverse=True)
+	_b = []
+	_mlen = 0
+	for _i in _ind:
+		_l = max(_mlen, len(sents[_i]))
+		if _b and ((len(_b) >= max_sentences) or (_l * (len(_b) + 1) > max_tokens)):
+			yield _b, _mlen
+			_b, _l = [], len(sents[_i])
+		_b.append(_i)
+		_mlen = _l
+	if _b:
+		yield _b, _mlen
+
+def translate(model, vcbi, vcbt, lines, beam_size=1, length_penalty=0.0, use_unk=True, unk_id=3):
+
+	sents = [map_sentence(_, vcbi, use_unk=use_unk, unk_id=unk_id) for _ in lines]
+	rs = [None for _ in sents]
+	with torch.no_grad():
+		for _b, _mlen in batch_iter(sents):
+			seq_batch = torch.full((len(_b), _mlen,), pad_id, dtype=torch.long)
+			for _i, _s in enumerate(_b):
+				seq_batch[_i, :len(sents[_s])] = torch.as_tensor(sents[_s], dtype=torch.long)
+			output = model.translate(seq_batch, beam_size, -1, length_penalty).tolist()
+			for _s, tran in zip(_b, output):
+				tmp = []
+				for tmpu in tran:
+					if tmpu == eos_id:
+						break
+					tmp.append(vcbt[tmpu])
+				rs[_s] = " ".join(tmp)
+
+	return rs
+
+def handle(modf, srcf, rsf, beam_size=None, length_penalty=None):
+
+	model, vcbi, vcbt, cnfg = load(modf)
+	with sys.stdin.buffer if srcf == "-" else open(srcf, "rb") as f:
+		lines = [_.decode("utf-8").strip() for _ in f]
+	rs = translate(model, vcbi, vcbt, lines, beam_size=cnfg["beam_size"] if beam_size is None else beam_size, length_penalty=cnfg["length_penalty"] if length_penalty is None else length_penalty, use_unk=cnfg["use_unk"], unk_id=cnfg["unk_id"])
+	ens = "\n".encode("utf-8")
+	with sys.stdout.buffer if rsf == "-" else open(rsf, "wb") as f:
+		for tran in rs:
+			f.write(tran.encode("utf-8"))
+			f.write(ens)
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2], sys.argv[3], *[_t(_) for _t, _ in zip((int, float,), sys.argv[4:6])])
@@ -7,56 +7,67 @@ from torch.optim import Adam as Optimizer
 
 from parallel.base import DataParallelCriterion
 from parallel.parallelMT import DataParallelMT
-from parallel.optm import MultiGPUGradScaler
+from parallel.optm import DistShardedOptimizer, MultiGPUGradScaler
+from parallel.dist import DistGradReducer, all_gather_dict, broadcast_model, broadcast_object, close_dist, dist_seed, get_rank_world, init_dist, rank_fname, shard_batches
 
 from utils.base import *
+from utils.metric import DeferredCounter, DistDeferredCounter, DistMetricAccumulator, MetricAccumulator
 from utils.init.base import init_model_params
 from utils.contpara import get_model_parameters
 from utils.state.holder import Holder
+from utils.checkpoint import CheckpointManager
 from utils.state.pyrand import PyRandomState
 from utils.state.thrand import THRandomState
 from utils.fmt.base import tostr, pad_id
 from utils.fmt.base4torch import parse_cuda, load_emb
 
 from lrsch import GoogleLR as LRScheduler
-from loss.base import LabelSmoothingLoss
+from loss.base import LabelSmoothingLoss, ChunkedLabelSmoothingLoss
 
 from random import shuffle
 
 from utils.tqdm import tqdm
 
-from utils.h5serial import h5File
+from utils.mmdata import MMapData, open_data
+from utils.bucket import BucketSampler
+from utils.loader import H5BatchLoader
 
 import cnfg.base as cnfg
 from cnfg.ihyp import *
 
 from transformer.NMT import NMT
 
-def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm=32768, nreport=None, save_every=None, chkpf=None, state_holder=None, statesf=None, num_checkpoint=1, cur_checkid=0, report_eva=True, remain_steps=None, save_loss=False, save_checkp_epoch=False, scaler=None):
+def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm=32768, nreport=None, save_every=None, chkpf=None, state_holder=None, statesf=None, num_checkpoint=1, cur_checkid=0, report_eva=True, remain_steps=None, save_loss=False, save_checkp_epoch=False, scaler=None, ckpt_manager=None, grad_reducer=None):
 
-	sum_loss = part_loss = 0.0
-	sum_wd = part_wd = 0
-	_done_tokens, _cur_checkid, _cur_rstep, _use_amp = done_tokens, cur_checkid, remain_steps, scaler is not None
+	# loss and the number of tokens of the epoch and of the report interval are accumulated on device, and summed over processes in distributed training
+	_dist = get_rank_world()[-1] > 1
+	_metric_cls = DistMetricAccumulator if _dist else MetricAccumulator
+	_metric, _part_metric = _metric_cls(2, device=mv_device), _metric_cls(2, device=mv_device)
+	_done_tokens, _cur_checkid, _cur_rstep, _use_amp = (DistDeferredCounter if _dist else DeferredCounter)(done_tokens, device=mv_device), cur_checkid, remain_steps, scaler is not None
 	model.train()
 	cur_b, _ls = 1, {} if save_loss else None
-	src_grp, tgt_grp = td["src"], td["tgt"]
-	for i_d in tqdm(tl, mininterval=tqdm_mininterval):
-		seq_batch = torch.from_numpy(src_grp[i_d][()])
-		seq_o = torch.from_numpy(tgt_grp[i_d][()])
+	_chunk_loss = isinstance(lossf, ChunkedLabelSmoothingLoss)
+	for i_d, (seq_batch, seq_o,) in tqdm(H5BatchLoader(td, tl, mv_device=mv_device), mininterval=tqdm_mininterval):
 		lo = seq_o.size(1) - 1
-		if mv_device:
-			seq_batch = seq_batch.to(mv_device)
-			seq_o = seq_o.to(mv_device)
-		seq_batch, seq_o = seq_batch.long(), seq_o.long()
 
 		oi = seq_o.narrow(1, 0, lo)
 		ot = seq_o.narrow(1, 1, lo).contiguous()
+		wd_add = ot.ne(pad_id).sum()
+		_done_tokens.add(wd_add, ot.numel())
 		with autocast(enabled=_use_amp):
-			output = model(seq_batch, oi)
-			loss = lossf(output, ot)
+			if _chunk_loss:
+				output = model(seq_batch, oi, classify=False)
+				loss = lossf(output, ot, model.dec.classifier)
+			else:
+				output = model(seq_batch, oi)
+				loss = lossf(output, ot)
 			if multi_gpu:
 				loss = loss.sum()
-		loss_add = loss.data.item()
+		loss_add = loss.detach()
+		# optimizer steps are decided before the backward pass, so that gradients of the last batch before a step are all-reduced during it in distributed training
+		_do_optm_step = _done_tokens.ge(tokens_optm)
+		if grad_reducer is not None:
+			grad_reducer.set_sync(_do_optm_step)
 
 		# scale the sum of losses down according to the number of tokens adviced by: https://mp.weixin.qq.com/s/qAHZ4L5qK3rongCIIq5hQw, I think not reasonable.
 		#loss /= wd_add
@@ -65,17 +76,16 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 		else:
 			scaler.scale(loss).backward()
 
-		wd_add = ot.ne(pad_id).int().sum().item()
 		loss = output = oi = ot = seq_batch = seq_o = None
-		sum_loss += loss_add
+		_metric.add(loss_add, wd_add)
 		if save_loss:
-			_ls[(i_d, t_d)] = loss_add / wd_add
-		sum_wd += wd_add
-		_done_tokens += wd_add
+			_ls[i_d] = loss_add / wd_add
 
-		if _done_tokens >= tokens_optm:
+		if _do_optm_step:
+			if grad_reducer is not None:
+				grad_reducer.collect_gradients()
 			optm_step(optm, model=model, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer, zero_grad_none=optm_step_zero_grad_set_none)
-			_done_tokens = 0
+			_done_tokens.reset()
 			if _cur_rstep is not None:
 				if save_checkp_epoch and (save_every is not None) and (_cur_rstep % save_every == 0) and (chkpf is not None) and (_cur_rstep > 0):
 					if num_checkpoint > 1:
@@ -84,18 +94,16 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 						_cur_checkid = (_cur_checkid + 1) % num_checkpoint
 					else:
 						_chkpf = chkpf
-					save_model(model, _chkpf, multi_gpu, print_func=logger.info)
-					if statesf is not None:
-						save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]}), statesf, print_func=logger.info)
+					ckpt_manager.save(_chkpf, statesf=statesf, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]})
 				_cur_rstep -= 1
 				if _cur_rstep <= 0:
 					break
 			lrsch.step()
 
 		if nreport is not None:
-			part_loss += loss_add
-			part_wd += wd_add
+			_part_metric.add(loss_add, wd_add)
 			if cur_b % nreport == 0:
+				part_loss, part_wd = _part_metric.get()
 				if report_eva:
 					_leva, _eeva = eva(ed, nd, model, lossf, mv_device, multi_gpu, _use_amp)
 					logger.info("Average loss over %d tokens: %.3f, valid loss/error: %.3f %.2f" % (part_wd, part_loss / part_wd, _leva, _eeva,))
@@ -103,8 +111,6 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 					model.train()
 				else:
 					logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-				part_loss = 0.0
-				part_wd = 0
 
 		if save_checkp_epoch and (_cur_rstep is None) and (save_every is not None) and (cur_b % save_every == 0) and (chkpf is not None) and (cur_b < ndata):
 			if num_checkpoint > 1:
@@ -114,29 +120,24 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			else:
 				_chkpf = chkpf
 			#save_model(model, _chkpf, isinstance(model, nn.DataParallel), print_func=logger.info)
-			save_model(model, _chkpf, multi_gpu, print_func=logger.info)
-			if statesf is not None:
-				save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]}), statesf, print_func=logger.info)
+			ckpt_manager.save(_chkpf, statesf=statesf, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]})
 		cur_b += 1
+	part_loss, part_wd = _part_metric.get()
 	if part_wd != 0.0:
 		logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-	return sum_loss / sum_wd, _done_tokens, _cur_checkid, _cur_rstep, _ls
+	if save_loss and _ls:
+		_ls = dict(zip(_ls.keys(), torch.stack(list(_ls.values())).tolist()))
+	sum_loss, sum_wd = _metric.get()
+	return sum_loss / sum_wd, _done_tokens.get(), _cur_checkid, _cur_rstep, _ls
 
 def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
-	r = w = 0
-	sum_loss = 0.0
+	# processes of distributed training evaluate their shards of the development set
+	_rank, _nrank = get_rank_world()
+	_metric = (DistMetricAccumulator if _nrank > 1 else MetricAccumulator)(3, device=mv_device)
 	model.eval()
-	src_grp, tgt_grp = ed["src"], ed["tgt"]
 	with torch.no_grad():
-		for i in tqdm(range(nd), mininterval=tqdm_mininterval):
-			bid = str(i)
-			seq_batch = torch.from_numpy(src_grp[bid][()])
-			seq_o = torch.from_numpy(tgt_grp[bid][()])
+		for bid, (seq_batch, seq_o,) in tqdm(H5BatchLoader(ed, [str(i) for i in range(_rank, nd, _nrank)], mv_device=mv_device), mininterval=tqdm_mininterval):
 			lo = seq_o.size(1) - 1
-			if mv_device:
-				seq_batch = seq_batch.to(mv_device)
-				seq_o = seq_o.to(mv_device)
-			seq_batch, seq_o = seq_batch.long(), seq_o.long()
 			ot = seq_o.narrow(1, 1, lo).contiguous()
 			with autocast(enabled=use_amp):
 				output = model(seq_batch, seq_o.narrow(1, 0, lo))
@@ -146,13 +147,10 @@ def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
 					trans = torch.cat([outu.argmax(-1).to(mv_device) for outu in output], 0)
 				else:
 					trans = output.argmax(-1)
-			sum_loss += loss.data.item()
 			data_mask = ot.ne(pad_id)
-			correct = (trans.eq(ot) & data_mask).int()
-			w += data_mask.int().sum().item()
-			r += correct.sum().item()
-			correct = data_mask = trans = loss = output = ot = seq_batch = seq_o = None
-	w = float(w)
+			_metric.add(loss.data, data_mask.sum(), (trans.eq(ot) & data_mask).sum())
+			data_mask = trans = loss = output = ot = seq_batch = seq_o = None
+	sum_loss, w, r = _metric.get()
 	return sum_loss / w, (w - r) / w * 100.0
 
 def hook_lr_update(optm, flags=None):
@@ -164,6 +162,15 @@ def init_fixing(module):
 	if hasattr(module, "fix_init"):
 		module.fix_init()
 
+# pack a new composition of batches for the next epoch with the bucket sampler, and return the list of their ids.
+
+def bucket_batches(td, sampler, logger):
+
+	td.set_batches(sampler.generate())
+	logger.info("Bucketed batches: %d, padding efficiency: %.2f%%" % (len(td.batches), sampler.efficiency * 100.0,))
+
+	return [str(i) for i in range(len(td.batches))]
+
 def load_fixing(module):
 
 	if hasattr(module, "fix_load"):
@@ -192,18 +199,33 @@ chkpf = None
 statesf = None
 if save_every is not None:
 	chkpf = wkdir + "checkpoint.h5"
+# multi-process data parallel training when launched by torchrun, each process saves its own training states and log
+rank, nrank, local_rank = init_dist(cnfg.dist_backend, cnfg.use_cuda and torch.cuda.is_available())
 if cnfg.save_train_state:
-	statesf = wkdir + "train.states.t7"
+	statesf = rank_fname(wkdir + "train.states.t7", rank)
 
-logger = get_logger(wkdir + "train.log")
+logger = get_logger(rank_fname(wkdir + "train.log", rank))
 
 use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda(cnfg.use_cuda, cnfg.gpuid)
+if nrank > 1:
+	# one GPU for each process
+	if use_cuda:
+		cuda_device = torch.device("cuda", local_rank)
+		torch.cuda.set_device(cuda_device.index)
+	cuda_devices, multi_gpu = None, False
 multi_gpu_optimizer = multi_gpu and cnfg.multi_gpu_optimizer
 
-set_random_seed(cnfg.seed, use_cuda)
+# the shuffling of batches has to be the same across processes
+_seed = dist_seed(cnfg.seed)
+set_random_seed(_seed, use_cuda)
+
+_minbsize = len(cuda_devices) if multi_gpu else 1
+td = open_data(cnfg.train_data, "r", rebatch=mmdata_rebatch, minbsize=_minbsize)
+vd = open_data(cnfg.dev_data, "r", rebatch=mmdata_rebatch, minbsize=_minbsize)
 
-td = h5File(cnfg.train_data, "r")
-vd = h5File(cnfg.dev_data, "r")
+use_bucket_sampling = bucket_sampling and isinstance(td, MMapData) and not (cnfg.dss_ws is not None and cnfg.dss_ws > 0.0 and cnfg.dss_ws < 1.0)
+if use_bucket_sampling:
+	train_sampler = BucketSampler(td.lens("src"), td.lens("tgt"), maxtoken=max_tokens_gpu * _minbsize, bsize=max_sentences_gpu * _minbsize, minbsize=_minbsize, seed=_seed)
 
 ntrain = td["ndata"][()].item()
 nvalid = vd["ndata"][()].item()
@@ -225,7 +247,11 @@ if fine_tune_m is not None:
 	mymodel.apply(load_fixing)
 
 #lossf = NLLLoss(ignore_index=pad_id, reduction="sum")
-lossf = LabelSmoothingLoss(nwordt, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum", forbidden_index=cnfg.forbidden_indexes)
+# the chunked loss takes hidden states of the decoder and the classifier, which is not supported by DataParallelCriterion
+if (loss_chunk_size is not None) and (loss_chunk_size > 0) and (not multi_gpu):
+	lossf = ChunkedLabelSmoothingLoss(nwordt, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum", forbidden_index=cnfg.forbidden_indexes, chunk_size=loss_chunk_size)
+else:
+	lossf = LabelSmoothingLoss(nwordt, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum", forbidden_index=cnfg.forbidden_indexes)
 
 if cnfg.src_emb is not None:
 	logger.info("Load source embedding from: " + cnfg.src_emb)
@@ -238,6 +264,11 @@ if cuda_device:
 	mymodel.to(cuda_device)
 	lossf.to(cuda_device)
 
+if nrank > 1:
+	broadcast_model(mymodel)
+	# different dropout masks across processes
+	torch.manual_seed(torch.initial_seed() + rank)
+
 use_amp = cnfg.use_amp and use_cuda
 scaler = (MultiGPUGradScaler() if multi_gpu_optimizer else GradScaler()) if use_amp else None
 
@@ -248,15 +279,19 @@ if multi_gpu:
 
 if multi_gpu:
 	optimizer = mymodel.build_optimizer(Optimizer, lr=init_lr, betas=adam_betas_default, eps=ieps_adam_default, weight_decay=cnfg.weight_decay, amsgrad=use_ams, multi_gpu_optimizer=multi_gpu_optimizer, contiguous_parameters=contiguous_parameters)
+elif (nrank > 1) and cnfg.dist_shard_optimizer:
+	optimizer = DistShardedOptimizer(mymodel, Optimizer, lr=init_lr, betas=adam_betas_default, eps=ieps_adam_default, weight_decay=cnfg.weight_decay, amsgrad=use_ams, contiguous_parameters=contiguous_parameters)
 else:
 	# lr will be over written by LRScheduler before used
 	optimizer = Optimizer(get_model_parameters(mymodel, contiguous_parameters=contiguous_parameters), lr=init_lr, betas=adam_betas_default, eps=ieps_adam_default, weight_decay=cnfg.weight_decay, amsgrad=use_ams)
 optimizer.zero_grad(set_to_none=optm_step_zero_grad_set_none)
+grad_reducer = DistGradReducer(mymodel) if nrank > 1 else None
 
 # lrsch.step() will be automatically called with the constructor
 lrsch = LRScheduler(optimizer, cnfg.isize, cnfg.warm_step, scale=cnfg.lr_scale)
 
 state_holder = None if statesf is None and cnt_states is None else Holder(**{"optm": optimizer, "lrsch": lrsch, "pyrand": PyRandomState(), "thrand": THRandomState(use_cuda=use_cuda)})
+ckpt_manager = CheckpointManager(mymodel, state_holder, sub_module=multi_gpu, print_func=logger.info, use_thread=async_checkpoint, save_model=(rank == 0))
 
 num_checkpoint = cnfg.num_checkpoint
 cur_checkid = 0
@@ -267,25 +302,25 @@ minloss, minerr = eva(vd, nvalid, mymodel, lossf, cuda_device, multi_gpu, use_am
 logger.info("Init lr: %s, Dev Loss/Error: %.3f %.2f" % (" ".join(tostr(getlr(optimizer))), minloss, minerr,))
 
 if fine_tune_m is None:
-	save_model(mymodel, wkdir + "init.h5", multi_gpu, print_func=logger.info)
+	ckpt_manager.save(wkdir + "init.h5")
 	logger.info("Initial model saved")
 else:
 	if cnt_states is not None:
 		logger.info("Loading training states")
-		_remain_states = state_holder.load_state_dict(torch.load(cnt_states))
+		_remain_states = state_holder.load_state_dict(torch.load(rank_fname(cnt_states, rank)))
 		remain_steps, cur_checkid = _remain_states["remain_steps"], _remain_states["checkpoint_id"]
-		if "training_list" in _remain_states:
+		if ("training_list" in _remain_states) and not use_bucket_sampling:
 			_ctl = _remain_states["training_list"]
+		elif use_bucket_sampling:
+			_ctl = shard_batches(bucket_batches(td, train_sampler, logger), rank, nrank)
 		else:
 			shuffle(tl)
-			_ctl = tl
-		tminerr, done_tokens, cur_checkid, remain_steps, _ = train(td, _ctl, vd, nvalid, optimizer, lrsch, mymodel, lossf, cuda_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm, batch_report, save_every, chkpf, state_holder, statesf, num_checkpoint, cur_checkid, report_eva, remain_steps, False, False, scaler)
+			_ctl = shard_batches(tl, rank, nrank)
+		tminerr, done_tokens, cur_checkid, remain_steps, _ = train(td, _ctl, vd, nvalid, optimizer, lrsch, mymodel, lossf, cuda_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm, batch_report, save_every, chkpf, state_holder, statesf, num_checkpoint, cur_checkid, report_eva, remain_steps, False, False, scaler, ckpt_manager, grad_reducer)
 		_ctl = _remain_states = None
 		vloss, vprec = eva(vd, nvalid, mymodel, lossf, cuda_device, multi_gpu, use_amp)
 		logger.info("Epoch: 0, train loss: %.3f, valid loss/error: %.3f %.2f" % (tminerr, vloss, vprec,))
-		save_model(mymodel, wkdir + "train_0_%.3f_%.3f_%.2f.h5" % (tminerr, vloss, vprec,), multi_gpu, print_func=logger.info, mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None)
-		if statesf is not None:
-			save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
+		ckpt_manager.save(wkdir + "train_0_%.3f_%.3f_%.2f.h5" % (tminerr, vloss, vprec,), mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None, statesf=statesf, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid})
 		logger.info("New best model saved")
 
 if cnfg.dss_ws is not None and cnfg.dss_ws > 0.0 and cnfg.dss_ws < 1.0:
@@ -305,16 +340,17 @@ else:
 namin = 0
 
 for i in range(1, maxrun + 1):
-	shuffle(tl)
+	if use_bucket_sampling:
+		tl = bucket_batches(td, train_sampler, logger)
+	else:
+		shuffle(tl)
 	free_cache(use_cuda)
-	terr, done_tokens, cur_checkid, remain_steps, _Dws = train(td, tl, vd, nvalid, optimizer, lrsch, mymodel, lossf, cuda_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm, batch_report, save_every, chkpf, state_holder, statesf, num_checkpoint, cur_checkid, report_eva, remain_steps, dss_ws > 0, i >= start_chkp_save, scaler)
+	terr, done_tokens, cur_checkid, remain_steps, _Dws = train(td, shard_batches(tl, rank, nrank), vd, nvalid, optimizer, lrsch, mymodel, lossf, cuda_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm, batch_report, save_every, chkpf, state_holder, statesf, num_checkpoint, cur_checkid, report_eva, remain_steps, dss_ws > 0, i >= start_chkp_save, scaler, ckpt_manager, grad_reducer)
 	vloss, vprec = eva(vd, nvalid, mymodel, lossf, cuda_device, multi_gpu, use_amp)
 	logger.info("Epoch: %d, train loss: %.3f, valid loss/error: %.3f %.2f" % (i, terr, vloss, vprec,))
 
 	if (vprec <= minerr) or (vloss <= minloss):
-		save_model(mymodel, wkdir + "eva_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu, print_func=logger.info, mtyp="eva" if save_auto_clean else None)
-		if statesf is not None:
-			save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
+		ckpt_manager.save(wkdir + "eva_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), mtyp="eva" if save_auto_clean else None, statesf=statesf, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid})
 		logger.info("New best model saved")
 
 		namin = 0
@@ -327,17 +363,15 @@ for i in range(1, maxrun + 1):
 	else:
 		if terr < tminerr:
 			tminerr = terr
-			save_model(mymodel, wkdir + "train_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu, print_func=logger.info, mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None)
-			if statesf is not None:
-				save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
+			ckpt_manager.save(wkdir + "train_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None, statesf=statesf, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid})
 		elif epoch_save:
-			save_model(mymodel, wkdir + "epoch_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu, print_func=logger.info)
-			if statesf is not None:
-				save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
+			ckpt_manager.save(wkdir + "epoch_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), statesf=statesf, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid})
 
 		namin += 1
 		if namin >= earlystop:
 			if done_tokens > 0:
+				if grad_reducer is not None:
+					grad_reducer.collect_gradients()
 				optm_step(optimizer, model=mymodel, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer)
 				lrsch.step()
 				done_tokens = 0
@@ -349,12 +383,14 @@ for i in range(1, maxrun + 1):
 		break
 
 	if dss_ws > 0:
+		# each process only has losses of its shard, the sampled training list has to be the same across processes for shards of the same length
+		_Dws = all_gather_dict(_Dws)
 		if _prev_Dws:
 			for _key, _value in _Dws.items():
 				if _key in _prev_Dws:
 					_ploss = _prev_Dws[_key]
 					_crit_inc[_key] = (_ploss - _value) / _ploss
-			tl = dynamic_sample(_crit_inc, dss_ws, dss_rm)
+			tl = broadcast_object(dynamic_sample(_crit_inc, dss_ws, dss_rm))
 		_prev_Dws = _Dws
 
 	#oldlr = getlr(optimizer)
@@ -365,14 +401,17 @@ for i in range(1, maxrun + 1):
 		#hook_lr_update(optimizer, use_ams)
 
 if done_tokens > 0:
+	if grad_reducer is not None:
+		grad_reducer.collect_gradients()
 	optm_step(optimizer, model=mymodel, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer)
 	lrsch.step()
 	#done_tokens = 0
 
-save_model(mymodel, wkdir + "last.h5", multi_gpu, print_func=logger.info)
-if statesf is not None:
-	save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
+ckpt_manager.save(wkdir + "last.h5", statesf=statesf, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid})
+ckpt_manager.close()
+logger.info(ckpt_manager.report())
 logger.info("model saved")
 
 td.close()
 vd.close()
+close_dist()
@@ -4,11 +4,12 @@ import torch
 from torch import nn
 from modules.aan import AverageAttn
 from utils.sampler import SampleMax
-from utils.base import all_done, index_tensors, expand_bsize_for_beam, select_zero_
+from utils.base import all_done, index_tensors, expand_bsize_for_beam, select_zero_, repeat_bsize_for_beam_tensor, pad_tensors
 from utils.aan import share_aan_cache
+from modules.base import CrossAttn
 from math import sqrt
 
-from cnfg.vocab.base import pad_id
+from cnfg.vocab.base import eos_id, pad_id, sos_id
 
 from transformer.Decoder import DecoderLayer as DecoderLayerBase, Decoder as DecoderBase
 
@@ -78,6 +79,29 @@ class DecoderLayer(DecoderLayerBase):
 		else:
 			return context, states_return
 
+	# inpute: encoded representation from encoder (bsize, seql, isize)
+	# state: sum of layer normed inputs of previous steps (bsize, 1, isize), updated in-place with query_unit
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql)
+	# query_unit: single query to decode (bsize, 1, isize)
+	# step: number of decoded tokens including query_unit, an integer or a tensor (bsize, 1, 1) for sentences at different steps
+
+	def step(self, inpute, state, src_pad_mask, query_unit, step):
+
+		_query_unit = self.layer_normer1(query_unit)
+
+		state.add_(_query_unit)
+
+		context = self.self_attn(_query_unit, state / step, True)
+
+		if self.drop is not None:
+			context = self.drop(context)
+
+		context = context + (_query_unit if self.norm_residual else query_unit)
+
+		context = self.cross_attn(context, inpute, mask=src_pad_mask)
+
+		return self.ff(context)
+
 class Decoder(DecoderBase):
 
 	# construction function is needed, since DecoderLayer should be re-assigned.
@@ -323,7 +347,7 @@ class Decoder(DecoderBase):
 			_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
 
 			if length_penalty > 0.0:
-				lpv = lpv.masked_fill(1 - done_trans.view(real_bsize, 1), ((step + 5.0) ** length_penalty) / lpv_base)
+				lpv = lpv.masked_fill(~done_trans.view(real_bsize, 1), ((step + 5.0) ** length_penalty) / lpv_base)
 
 			# clip from k ** 2 candidate and remain the top-k for each path
 			# scores: (bsize, beam_size * beam_size) => (bsize, beam_size)
@@ -390,3 +414,229 @@ class Decoder(DecoderBase):
 		else:
 
 			return trans.view(bsize, beam_size, -1).select(1, 0)
+
+	# the self-attention state of each layer of the average decoder is a sum of the same size regardless of the decoding step, which allows sentences of a batch to be decoded in a fixed number of slots: finished sentences are removed at each step, and their slots are taken by waiting sentences of the batch, so that the running batch stays full.
+
+	# inpute: encoded representation from encoder (bsize, seql, isize)
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
+	#	src_pad_mask = input.eq(0).unsqueeze(1)
+	# beam_size: the beam size for beam search
+	# max_len: maximum length to generate
+	# nslot: number of sentences decoded in parallel, None for all sentences of the batch
+
+	def decode_clip(self, inpute, src_pad_mask, beam_size=1, max_len=512, length_penalty=0.0, return_mat=True, nslot=aan_decode_slots):
+
+		return self.beam_decode_clip(inpute, src_pad_mask, beam_size, max_len, length_penalty, return_mat, nslot=nslot) if beam_size > 1 else self.greedy_decode_clip(inpute, src_pad_mask, max_len, return_mat, nslot=nslot)
+
+	def greedy_decode_clip(self, inpute, src_pad_mask=None, max_len=512, return_mat=True, nslot=aan_decode_slots):
+
+		rs = self.slot_decode(inpute, src_pad_mask, 1, max_len, nslot=nslot)
+
+		return torch.stack(pad_tensors(rs), 0) if return_mat else rs
+
+	def beam_decode_clip(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_mat=True, return_all=False, clip_beam=clip_beam_with_lp, nslot=aan_decode_slots):
+
+		rs = self.slot_decode(inpute, src_pad_mask, beam_size, max_len, length_penalty, nslot=nslot, return_all=return_all, clip_beam=clip_beam)
+		if return_all:
+			rs, rscore = rs
+		if return_mat:
+			rs = torch.stack(pad_tensors(rs), 0)
+
+		if return_all:
+
+			return rs, torch.stack(rscore, 0)
+		else:
+
+			return rs
+
+	# returns the list of translations of sentences in the batch (and their scores with return_all), which is the same as greedy_decode/beam_decode.
+
+	def slot_decode(self, inpute, src_pad_mask=None, beam_size=1, max_len=512, length_penalty=0.0, nslot=None, return_all=False, clip_beam=clip_beam_with_lp):
+
+		nsent, seql, isize = inpute.size()
+		bsize = nsent if (nslot is None) or (nslot > nsent) else max(nslot, 1)
+		real_bsize = bsize * beam_size
+		beam_size2 = beam_size * beam_size
+		use_beam = beam_size > 1
+		use_lp = use_beam and (length_penalty > 0.0)
+		if use_lp:
+			lpv_base = 6.0 ** length_penalty
+		sqrt_isize = sqrt(isize)
+
+		# inpute and src_pad_mask of running beams, inpute is only used for the first step, after which the cross-attention buffers of running beams are indexed and updated in-place
+		_inpute = inpute.narrow(0, 0, bsize)
+		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.narrow(0, 0, bsize)
+		if use_beam:
+			_inpute = repeat_bsize_for_beam_tensor(_inpute, beam_size)
+			if _src_pad_mask is not None:
+				_src_pad_mask = repeat_bsize_for_beam_tensor(_src_pad_mask, beam_size)
+		elif (_src_pad_mask is not None) and (bsize < nsent):
+			_src_pad_mask = _src_pad_mask.clone()
+
+		# per slot: the sentence id and the number of decoded tokens
+		mapper = list(range(bsize))
+		nstep = inpute.new_zeros(bsize, dtype=torch.long)
+		nwait = bsize
+		# per beam: the states of all layers in one tensor, the last decoded words and translations written at their steps
+		states = inpute.new_zeros(len(self.nets), real_bsize, 1, isize)
+		wds = nstep.new_full((real_bsize, 1,), sos_id)
+		trans = nstep.new_full((real_bsize, max_len,), pad_id)
+		if use_beam:
+			# the first step of a sentence is taken from its first beam, with scores of other beams initialized to -inf
+			init_scores = inpute.new_full((bsize, beam_size,), -inf_default)
+			init_scores.select(1, 0).zero_()
+			sum_scores = scores = init_scores.clone()
+			done_trans = torch.zeros(bsize, beam_size, dtype=torch.bool, device=inpute.device)
+			if use_lp:
+				lpv = inpute.new_ones(real_bsize, 1)
+			_inds_add_beam2 = torch.arange(0, bsize * beam_size2, beam_size2, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+			_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+			_inds_beam = torch.arange(beam_size, dtype=wds.dtype, device=wds.device)
+
+		rs = [None for i in range(nsent)]
+		if return_all:
+			rscore = [None for i in range(nsent)]
+
+		i = 0
+		while bsize > 0:
+
+			_nstep = nstep.repeat_interleave(beam_size) if use_beam else nstep
+			out = self.wemb(wds)
+			if self.pemb is not None:
+				# i bounds the number of decoded tokens of all sentences
+				_pos = self.pemb.w.index_select(0, _nstep) if i < self.pemb.num_pos else torch.stack([self.pemb.get_pos(_s) for _s in _nstep.tolist()], 0)
+				out = _pos.unsqueeze(1).add(out, alpha=sqrt_isize)
+			if self.drop is not None:
+				out = self.drop(out)
+
+			_step = (_nstep + 1).to(out.dtype, non_blocking=True).view(real_bsize, 1, 1)
+			for _tmp, net in enumerate(self.nets):
+				out = net.step(_inpute, states[_tmp], _src_pad_mask, out, _step)
+
+			if self.out_normer is not None:
+				out = self.out_normer(out)
+
+			if use_beam:
+				bsizeb2 = bsize * beam_size2
+
+				# the same as beam_decode except that sentences are at different steps
+
+				out = self.lsm(self.classifier(out)).view(bsize, beam_size, -1)
+
+				_scores, _wds = out.topk(beam_size, dim=-1)
+				_done_trans_unsqueeze = done_trans.unsqueeze(2)
+				_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
+
+				if use_lp:
+					lpv = torch.where(done_trans.view(real_bsize, 1), lpv, ((_nstep.to(out.dtype) + 6.0) ** length_penalty / lpv_base).unsqueeze(1))
+
+				if clip_beam and use_lp:
+					scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
+					_tinds = (_inds + _inds_add_beam2.narrow(0, 0, bsize)).view(real_bsize)
+					sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
+				else:
+					scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
+					_tinds = (_inds + _inds_add_beam2.narrow(0, 0, bsize)).view(real_bsize)
+					sum_scores = scores
+
+				wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
+				_inds = (_inds // beam_size + _inds_add_beam.narrow(0, 0, bsize)).view(real_bsize)
+				trans = trans.index_select(0, _inds).scatter_(1, _nstep.unsqueeze(1), wds)
+				done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(eos_id).squeeze(1)).view(bsize, beam_size)
+				if use_lp:
+					lpv = lpv.index_select(0, _inds)
+				states = states.index_select(1, _inds)
+
+				_done_trans_u = done_trans.all(1) if use_lp or return_all else done_trans.select(1, 0)
+			else:
+				# out: (bsize, 1, nwd), omit self.lsm for efficiency
+				wds = self.classifier(out).argmax(dim=-1)
+				trans.scatter_(1, nstep.unsqueeze(1), wds)
+				_done_trans_u = wds.squeeze(1).eq(eos_id)
+
+			nstep += 1
+			i += 1
+			_done_trans_u = _done_trans_u | nstep.ge(max_len)
+			_ndone = _done_trans_u.int().sum().item()
+
+			if _ndone > 0:
+				_dind = _done_trans_u.nonzero().squeeze(1)
+				_dlist = _dind.tolist()
+				_lens = nstep.index_select(0, _dind).tolist()
+				if use_beam:
+					_trans = trans.view(bsize, beam_size, -1).index_select(0, _dind)
+					_scores = scores.index_select(0, _dind)
+					if (not clip_beam) and use_lp:
+						_scores, _sinds = (_scores / lpv.view(bsize, beam_size).index_select(0, _dind)).topk(beam_size, dim=-1)
+						_trans = _trans.gather(1, _sinds.unsqueeze(-1).expand_as(_trans))
+					if return_all:
+						for _iu, _len, _tran, _score in zip(_dlist, _lens, _trans.unbind(0), _scores.unbind(0)):
+							_rid = mapper[_iu]
+							rs[_rid] = _tran.narrow(-1, 0, _len)
+							rscore[_rid] = _score
+					else:
+						for _iu, _len, _tran in zip(_dlist, _lens, _trans.select(1, 0).unbind(0)):
+							rs[mapper[_iu]] = _tran.narrow(-1, 0, _len)
+				else:
+					for _iu, _len, _tran in zip(_dlist, _lens, trans.index_select(0, _dind).unbind(0)):
+						rs[mapper[_iu]] = _tran.narrow(-1, 0, _len)
+
+				# put waiting sentences into slots of finished sentences
+				_nnew = min(_ndone, nsent - nwait)
+				if _nnew > 0:
+					_nind = _dind.narrow(0, 0, _nnew)
+					_sind = torch.arange(nwait, nwait + _nnew, dtype=_nind.dtype, device=_nind.device)
+					for _iu, _rid in zip(_dlist[:_nnew], range(nwait, nwait + _nnew)):
+						mapper[_iu] = _rid
+					nwait += _nnew
+					_nind_beam = (_nind.unsqueeze(1) * beam_size + _inds_beam).view(-1) if use_beam else _nind
+					self.index_copy_cross_attn_buffer(_nind_beam, inpute.index_select(0, _sind), beam_size)
+					if _src_pad_mask is not None:
+						_src_mask = src_pad_mask.index_select(0, _sind)
+						_src_pad_mask.index_copy_(0, _nind_beam, repeat_bsize_for_beam_tensor(_src_mask, beam_size) if use_beam else _src_mask)
+					states.index_fill_(1, _nind_beam, 0.0)
+					wds.index_fill_(0, _nind_beam, sos_id)
+					nstep.index_fill_(0, _nind, 0)
+					if use_beam:
+						_init_scores = init_scores.narrow(0, 0, _nnew)
+						sum_scores.index_copy_(0, _nind, _init_scores)
+						if scores is not sum_scores:
+							scores.index_copy_(0, _nind, _init_scores)
+						done_trans.index_fill_(0, _nind, False)
+						if use_lp:
+							lpv.index_fill_(0, _nind_beam, 1.0)
+					_done_trans_u.index_fill_(0, _nind, False)
+					_ndone -= _nnew
+
+				# remove remaining finished sentences when no sentence is waiting
+				if _ndone > 0:
+					_kind = (~_done_trans_u).nonzero().squeeze(1)
+					bsize = _kind.size(0)
+					if bsize > 0:
+						real_bsize = bsize * beam_size
+						_kind_beam = (_kind.unsqueeze(1) * beam_size + _inds_beam).view(real_bsize) if use_beam else _kind
+						for _ind, _iu in enumerate(_kind.tolist()):
+							mapper[_ind] = mapper[_iu]
+						nstep = nstep.index_select(0, _kind)
+						self.index_cross_attn_buffer(_kind_beam)
+						if _src_pad_mask is not None:
+							_src_pad_mask = _src_pad_mask.index_select(0, _kind_beam)
+						states = states.index_select(1, _kind_beam)
+						wds, trans = wds.index_select(0, _kind_beam), trans.index_select(0, _kind_beam)
+						if use_beam:
+							scores, sum_scores, done_trans = scores.index_select(0, _kind), sum_scores.index_select(0, _kind), done_trans.index_select(0, _kind)
+							if use_lp:
+								lpv = lpv.index_select(0, _kind_beam)
+
+		if return_all:
+
+			return rs, rscore
+		else:
+
+			return rs
+
+	def index_copy_cross_attn_buffer(self, indices, inpute, beam_size=1):
+
+		for _m in self.modules():
+			if isinstance(_m, CrossAttn):
+				_m.index_copy_buffer(indices, inpute, beam_size=beam_size)
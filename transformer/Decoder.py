@@ -4,8 +4,11 @@ import torch
 from torch import nn
 from modules.base import *
 from utils.sampler import SampleMax
-from utils.base import all_done, index_tensors, expand_bsize_for_beam, select_zero_, mask_tensor_type
+from utils.base import all_done, index_tensors, expand_bsize_for_beam, select_zero_, mask_tensor_type, pad_tensors
+from utils.kvcache import KVCache
+from utils.shortlist import shortlist_modules
 from math import sqrt
+from copy import copy
 
 from cnfg.vocab.base import pad_id
 
@@ -37,7 +40,7 @@ class DecoderLayer(nn.Module):
 	# inputo: embedding of decoded translation (bsize, nquery, isize)
 	# src_pad_mask: mask for given encoding source sentence (bsize, nquery, seql), see Encoder, expanded after generated with:
 	#	src_pad_mask = input.eq(0).unsqueeze(1)
-	# tgt_pad_mask: mask to hide the future input
+	# tgt_pad_mask: mask to hide the future input, or to hide padded decoding history (bsize, nquery, seql) when query_unit is given
 	# query_unit: single query to decode, used to support decoding for given step
 
 	def forward(self, inpute, inputo, src_pad_mask=None, tgt_pad_mask=None, query_unit=None):
@@ -45,7 +48,7 @@ class DecoderLayer(nn.Module):
 		if query_unit is None:
 			context = self.self_attn(inputo, mask=tgt_pad_mask)
 		else:
-			context, states_return = self.self_attn(query_unit, states=inputo)
+			context, states_return = self.self_attn(query_unit, mask=tgt_pad_mask, states=inputo)
 
 		context = self.cross_attn(context, inpute, mask=src_pad_mask)
 
@@ -93,7 +96,7 @@ class NAWDecoderLayer(DecoderLayer):
 		else:
 			_query_unit = self.layer_normer1(query_unit)
 
-			context, states_return = self.self_attn(_query_unit, states=inputo)
+			context, states_return = self.self_attn(_query_unit, mask=tgt_pad_mask, states=inputo)
 
 			if self.drop is not None:
 				context = self.drop(context)
@@ -168,8 +171,9 @@ class Decoder(nn.Module):
 	# inputo: decoded translation (bsize, nquery)
 	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
 	#	src_pad_mask = input.eq(0).unsqueeze(1)
+	# classify: return log-probabilities over the vocabulary, or hidden states before the classifier (bsize, nquery, isize) for loss.base.ChunkedLabelSmoothingLoss
 
-	def forward(self, inpute, inputo, src_pad_mask=None):
+	def forward(self, inpute, inputo, src_pad_mask=None, classify=True):
 
 		nquery = inputo.size(-1)
 
@@ -192,7 +196,8 @@ class Decoder(nn.Module):
 		if self.out_normer is not None:
 			out = self.out_normer(out)
 
-		out = self.lsm(self.classifier(out))
+		if classify:
+			out = self.lsm(self.classifier(out))
 
 		return out
 
@@ -220,11 +225,18 @@ class Decoder(nn.Module):
 
 	# this function repeats buffers of all cross-attention keys/values, corresponding inputs do not need to be repeated in beam search.
 
+	# returns whether buffers of all cross-attentions are shared by beams (broadcast_cross_attn_beam), in which case the source mask does not need to be repeated either.
+
 	def repeat_cross_attn_buffer(self, beam_size):
 
+		rs = True
 		for _m in self.modules():
 			if isinstance(_m, (CrossAttn, MultiHeadAttn,)):
 				_m.repeat_buffer(beam_size)
+				if (_m.real_iK is not None) and (_m.nbeam == 1):
+					rs = False
+
+		return rs
 
 	# inpute: encoded representation from encoder (bsize, seql, isize)
 	# src_pad_mask: mask for given encoding source sentence (bsize, seql), see Encoder, get by:
@@ -242,7 +254,7 @@ class Decoder(nn.Module):
 	# max_len: maximum length to generate
 	# sample: for back translation
 
-	def greedy_decode(self, inpute, src_pad_mask=None, max_len=512, fill_pad=False, sample=False):
+	def greedy_decode(self, inpute, src_pad_mask=None, max_len=512, fill_pad=False, sample=False, kv_cache=preallocate_kv_cache):
 
 		bsize = inpute.size(0)
 
@@ -256,10 +268,12 @@ class Decoder(nn.Module):
 		if self.drop is not None:
 			out = self.drop(out)
 
+		_kv_cache = self.build_kv_cache(bsize, max_len) if kv_cache else None
+
 		states = {}
 
 		for _tmp, net in enumerate(self.nets):
-			out, _state = net(inpute, (None, None,), src_pad_mask, None, out)
+			out, _state = net(inpute, (None, None,) if _kv_cache is None else _kv_cache[_tmp], src_pad_mask, None, out)
 			states[_tmp] = _state
 
 		if self.out_normer is not None:
@@ -309,7 +323,7 @@ class Decoder(nn.Module):
 	# beam_size: beam size
 	# max_len: maximum length to generate
 
-	def beam_decode(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_all=False, clip_beam=clip_beam_with_lp, fill_pad=False):
+	def beam_decode(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_all=False, clip_beam=clip_beam_with_lp, fill_pad=False, kv_cache=preallocate_kv_cache):
 
 		bsize, seql = inpute.size()[:2]
 
@@ -332,10 +346,13 @@ class Decoder(nn.Module):
 		if self.drop is not None:
 			out = self.drop(out)
 
+		# the cache is allocated for bsize * beam_size rows, but only the first bsize rows are used in the first step
+		_kv_cache = self.build_kv_cache(real_bsize, max_len, nrow=bsize) if kv_cache else None
+
 		states = {}
 
 		for _tmp, net in enumerate(self.nets):
-			out, _state = net(inpute, (None, None,), src_pad_mask, None, out)
+			out, _state = net(inpute, (None, None,) if _kv_cache is None else _kv_cache[_tmp], src_pad_mask, None, out)
 			states[_tmp] = _state
 
 		if self.out_normer is not None:
@@ -364,15 +381,18 @@ class Decoder(nn.Module):
 		# instead of update inpute: (bsize, seql, isize) => (bsize * beam_size, seql, isize) with the following line, we only update cross-attention buffers.
 		#inpute = inpute.repeat(1, beam_size, 1).view(real_bsize, seql, isize)
 
-		self.repeat_cross_attn_buffer(beam_size)
+		_shared_buf = self.repeat_cross_attn_buffer(beam_size)
 
-		# _src_pad_mask: (bsize, 1, seql) => (bsize * beam_size, 1, seql)
+		# _src_pad_mask: (bsize, 1, seql) => (bsize * beam_size, 1, seql), unless it is shared by beams
 
-		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, seql)
+		_src_pad_mask = src_pad_mask if (src_pad_mask is None) or _shared_buf else src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, seql)
 
 		# states[i]: (bsize, 1, isize) => (bsize * beam_size, 1, isize)
 
-		states = expand_bsize_for_beam(states, beam_size=beam_size)
+		if _kv_cache is None:
+			states = expand_bsize_for_beam(states, beam_size=beam_size)
+		else:
+			_kv_cache.expand_bsize_for_beam(beam_size)
 
 		for step in range(1, max_len):
 
@@ -460,7 +480,10 @@ class Decoder(nn.Module):
 			# states[i]: (bsize * beam_size, nquery, isize)
 			# _inds: (bsize, beam_size) => (bsize * beam_size)
 
-			states = index_tensors(states, indices=_inds, dim=0)
+			if _kv_cache is None:
+				states = index_tensors(states, indices=_inds, dim=0)
+			else:
+				_kv_cache.index_select(_inds)
 
 		# if length penalty is only applied in the last step, apply length penalty
 		if (not clip_beam) and (length_penalty > 0.0):
@@ -476,6 +499,32 @@ class Decoder(nn.Module):
 
 			return trans.view(bsize, beam_size, -1).select(1, 0)
 
+	# bsize: number of rows of the cache, bsize * beam_size for beam search
+	# max_len: maximum length to generate
+	# nrow: number of rows used by the first decoding step
+	# returns None if any layer cannot decode with the preallocated cache (e.g. customized self-attention or the C backend).
+
+	def build_kv_cache(self, bsize, max_len, nrow=None):
+
+		return KVCache(len(self.nets), bsize, max_len, nrow=nrow) if self.std_self_attn() else None
+
+	# check whether all layers use the standard self-attention in python, which supports the preallocated key/value cache and masked decoding history.
+
+	def std_self_attn(self):
+
+		if use_c_backend_selfattn:
+			return False
+		for net in self.nets:
+			if not isinstance(net, DecoderLayer):
+				return False
+			_sattn = net.self_attn
+			if type(_sattn) == ResSelfAttn:
+				_sattn = _sattn.net
+			if type(_sattn) != SelfAttn:
+				return False
+
+		return True
+
 	# inpute: encoded representation from encoder (bsize, seql, isize)
 
 	def get_sos_emb(self, inpute, bsize=None):
@@ -535,12 +584,30 @@ class Decoder(nn.Module):
 				_classifier.bias.copy_(self.classifier.bias.index_select(0, indices))
 		self.classifier = _classifier
 
+	# a shallow copy of the decoder with the embedding and the classifier restricted to sorted candidate indices (see utils/shortlist.py) for decoding, ids of decoded tokens are positions in indices. Other sub-modules are shared, while the decoder itself is left unchanged, so that it can be used by other threads during decoding.
+
+	def shortlist_decoder(self, indices):
+
+		rs = copy(self)
+		rs._modules = rs._modules.copy()
+		rs.wemb, rs.classifier = shortlist_modules(self.wemb, self.classifier, indices)
+
+		return rs
+
 	def index_cross_attn_buffer(self, indices, dim=0):
 
 		for _m in self.modules():
 			if isinstance(_m, (CrossAttn, MultiHeadAttn,)):
 				_m.index_buffer(indices, dim=dim)
 
+	# release buffers of all cross-attention keys/values
+
+	def reset_cross_attn_buffer(self):
+
+		for _m in self.modules():
+			if isinstance(_m, (CrossAttn, MultiHeadAttn,)):
+				_m.reset_buffer()
+
 	def set_emb(self, emb_weight):
 
 		_bindemb = self.classifier.weight.is_set_to(self.wemb.weight)
@@ -553,6 +620,7 @@ class Decoder(nn.Module):
 	#	src_pad_mask = input.eq(0).unsqueeze(1)
 	# beam_size: the beam size for beam search
 	# max_len: maximum length to generate
+	# finished sentences are removed from the batch during decoding, which saves computation on batches with skewed target lengths.
 
 	def decode_clip(self, inpute, src_pad_mask, beam_size=1, max_len=512, length_penalty=0.0, return_mat=True):
 
@@ -563,7 +631,7 @@ class Decoder(nn.Module):
 	#	src_pad_mask = input.eq(0).unsqueeze(1)
 	# max_len: maximum length to generate
 
-	def greedy_decode_clip(self, inpute, src_pad_mask=None, max_len=512, return_mat=True):
+	def greedy_decode_clip(self, inpute, src_pad_mask=None, max_len=512, return_mat=True, kv_cache=preallocate_kv_cache):
 
 		bsize = inpute.size(0)
 
@@ -577,18 +645,20 @@ class Decoder(nn.Module):
 		if self.drop is not None:
 			out = self.drop(out)
 
+		_kv_cache = self.build_kv_cache(bsize, max_len) if kv_cache else None
+
 		states = {}
 
 		for _tmp, net in enumerate(self.nets):
-			out, _state = net(inpute, (None, None,), src_pad_mask, None, out)
+			out, _state = net(inpute, (None, None,) if _kv_cache is None else _kv_cache[_tmp], src_pad_mask, None, out)
 			states[_tmp] = _state
 
 		if self.out_normer is not None:
 			out = self.out_normer(out)
 
 		# out: (bsize, 1, nwd)
-
-		out = self.lsm(self.classifier(out))
+		# omit self.lsm for efficiency
+		out = self.classifier(out)
 
 		# wds: (bsize, 1)
 
@@ -599,32 +669,13 @@ class Decoder(nn.Module):
 
 		trans = [wds]
 
-		for i in range(1, max_len):
-
-			out = self.wemb(wds)
-			if self.pemb is not None:
-				out = self.pemb.get_pos(i).add(out, alpha=sqrt_isize)
-			if self.drop is not None:
-				out = self.drop(out)
-
-			for _tmp, net in enumerate(self.nets):
-				out, _state = net(inpute, states[_tmp], src_pad_mask, None, out)
-				states[_tmp] = _state
-
-			if self.out_normer is not None:
-				out = self.out_normer(out)
-
-			# out: (bsize, 1, nwd)
-			out = self.lsm(self.classifier(out))
-			wds = out.argmax(dim=-1)
-
-			trans.append(wds)
+		# done_trans: (bsize)
+		done_trans = wds.squeeze(1).eq(2)
 
-			# done_trans: (bsize)
-			done_trans = wds.squeeze(1).eq(2)
+		for i in range(1, max_len + 1):
 
 			_ndone = done_trans.int().sum().item()
-			if _ndone == bsize:
+			if (_ndone == bsize) or (i == max_len):
 				for _iu, _tran in enumerate(torch.cat(trans, 1).unbind(0)):
 					rs[mapper[_iu]] = _tran
 				break
@@ -642,13 +693,37 @@ class Decoder(nn.Module):
 				self.index_cross_attn_buffer(_ndid)
 				if src_pad_mask is not None:
 					src_pad_mask = src_pad_mask.index_select(0, _ndid)
-				states = index_tensors(states, indices=_ndid, dim=0)
-				trans = list(_trans.index_select(0, _ndid).unbind(1))
+				if _kv_cache is None:
+					states = index_tensors(states, indices=_ndid, dim=0)
+				else:
+					_kv_cache.index_select(_ndid)
+				trans = [_trans.index_select(0, _ndid)]
 
 				# update mapper
 				for _ind, _iu in enumerate(_ndid.tolist()):
 					mapper[_ind] = mapper[_iu]
 
+			out = self.wemb(wds)
+			if self.pemb is not None:
+				out = self.pemb.get_pos(i).add(out, alpha=sqrt_isize)
+			if self.drop is not None:
+				out = self.drop(out)
+
+			for _tmp, net in enumerate(self.nets):
+				out, _state = net(inpute, states[_tmp], src_pad_mask, None, out)
+				states[_tmp] = _state
+
+			if self.out_normer is not None:
+				out = self.out_normer(out)
+
+			# out: (bsize, 1, nwd)
+			out = self.classifier(out)
+			wds = out.argmax(dim=-1)
+
+			trans.append(wds)
+
+			done_trans = wds.squeeze(1).eq(2)
+
 		return torch.stack(pad_tensors(rs), 0) if return_mat else rs
 
 	# inpute: encoded representation from encoder (bsize, seql, isize)
@@ -657,7 +732,7 @@ class Decoder(nn.Module):
 	# beam_size: beam size
 	# max_len: maximum length to generate
 
-	def beam_decode_clip(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_mat=True, return_all=False, clip_beam=clip_beam_with_lp):
+	def beam_decode_clip(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_mat=True, return_all=False, clip_beam=clip_beam_with_lp, kv_cache=preallocate_kv_cache):
 
 		bsize, seql = inpute.size()[:2]
 
@@ -679,10 +754,12 @@ class Decoder(nn.Module):
 		if self.drop is not None:
 			out = self.drop(out)
 
+		_kv_cache = self.build_kv_cache(real_bsize, max_len, nrow=bsize) if kv_cache else None
+
 		states = {}
 
 		for _tmp, net in enumerate(self.nets):
-			out, _state = net(inpute, (None, None,), src_pad_mask, None, out)
+			out, _state = net(inpute, (None, None,) if _kv_cache is None else _kv_cache[_tmp], src_pad_mask, None, out)
 			states[_tmp] = _state
 
 		if self.out_normer is not None:
@@ -701,6 +778,10 @@ class Decoder(nn.Module):
 		sum_scores = scores
 		wds = wds.view(real_bsize, 1)
 		trans = wds
+		# offsets are computed for the full batch, and narrowed to the remaining batch size in each step.
+		_inds_add_beam2 = torch.arange(0, bsizeb2, beam_size2, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		_inds_beam = torch.arange(beam_size, dtype=wds.dtype, device=wds.device)
 
 		# done_trans: (bsize, beam_size)
 
@@ -709,15 +790,18 @@ class Decoder(nn.Module):
 		# inpute: (bsize, seql, isize) => (bsize * beam_size, seql, isize)
 		#inpute = inpute.repeat(1, beam_size, 1).view(real_bsize, seql, isize)
 
-		self.repeat_cross_attn_buffer(beam_size)
+		_shared_buf = self.repeat_cross_attn_buffer(beam_size)
 
-		# _src_pad_mask: (bsize, 1, seql) => (bsize * beam_size, 1, seql)
+		# _src_pad_mask: (bsize, 1, seql) => (bsize * beam_size, 1, seql), unless it is shared by beams
 
-		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, seql)
+		_src_pad_mask = src_pad_mask if (src_pad_mask is None) or _shared_buf else src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, seql)
 
 		# states[i]: (bsize, 1, isize) => (bsize * beam_size, 1, isize)
 
-		states = expand_bsize_for_beam(states, beam_size=beam_size)
+		if _kv_cache is None:
+			states = expand_bsize_for_beam(states, beam_size=beam_size)
+		else:
+			_kv_cache.expand_bsize_for_beam(beam_size)
 
 		mapper = list(range(bsize))
 		rs = [None for i in range(bsize)]
@@ -764,11 +848,11 @@ class Decoder(nn.Module):
 
 			if clip_beam and (length_penalty > 0.0):
 				scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + torch.arange(0, bsizeb2, beam_size2, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
+				_tinds = (_inds + _inds_add_beam2.narrow(0, 0, bsize)).view(real_bsize)
 				sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
 			else:
 				scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + torch.arange(0, bsizeb2, beam_size2, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
+				_tinds = (_inds + _inds_add_beam2.narrow(0, 0, bsize)).view(real_bsize)
 				sum_scores = scores
 
 			# select the top-k candidate with higher route score and update translation record
@@ -780,8 +864,7 @@ class Decoder(nn.Module):
 			# thus the fore path of the top-k candidate is pointed out
 			# _inds: indexes for the top-k candidate (bsize, beam_size)
 
-			# using "_inds / beam_size" in case old pytorch does not support "//" operation
-			_inds = (_inds // beam_size + torch.arange(0, real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
+			_inds = (_inds // beam_size + _inds_add_beam.narrow(0, 0, bsize)).view(real_bsize)
 
 			# select the corresponding translation history for the top-k candidate and update translation records
 			# trans: (bsize * beam_size, nquery) => (bsize * beam_size, nquery + 1)
@@ -796,20 +879,20 @@ class Decoder(nn.Module):
 
 			if length_penalty > 0.0:
 				lpv = lpv.index_select(0, _inds)
-				_done_trans_u = done_trans.sum(1).eq(beam_size)
+				_done_trans_u = done_trans.int().sum(1).eq(beam_size)
 			elif return_all:
-				_done_trans_u = done_trans.sum(1).eq(beam_size)
+				_done_trans_u = done_trans.int().sum(1).eq(beam_size)
 			else:
 				_done_trans_u = done_trans.select(1, 0)
 
 			# check beam states(done or not)
 
 			_ndone = _done_trans_u.int().sum().item()
-			if _ndone == bsize:
+			if (_ndone == bsize) or (step == max_len - 1):
 				if (not clip_beam) and (length_penalty > 0.0):
 					scores = scores / lpv.view(bsize, beam_size)
 					scores, _inds = scores.topk(beam_size, dim=-1)
-					_inds = (_inds + torch.arange(0, real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
+					_inds = (_inds + _inds_add_beam.narrow(0, 0, bsize)).view(real_bsize)
 					trans = trans.view(real_bsize, -1).index_select(0, _inds)
 				if return_all:
 					for _iu, (_tran, _score) in enumerate(zip(trans.view(bsize, beam_size, -1).unbind(0), scores.view(bsize, beam_size).unbind(0))):
@@ -821,61 +904,68 @@ class Decoder(nn.Module):
 						rs[mapper[_iu]] = _tran[0]
 				break
 
-			# update the corresponding hidden states
-			# states[i]: (bsize * beam_size, nquery, isize)
-			# _inds: (bsize, beam_size) => (bsize * beam_size)
-
-			states = index_tensors(states, indices=_inds, dim=0)
-
 			if _ndone > 0:
 				_dind = _done_trans_u.nonzero().squeeze(1)
 				_trans = trans.view(bsize, beam_size, -1)
 				_trans_sel = _trans.index_select(0, _dind)
+				_scores_sel = scores.index_select(0, _dind)
 
 				if (not clip_beam) and (length_penalty > 0.0):
-					_scores_sel = scores.index_select(0, _dind) / lpv.view(bsize, beam_size).index_select(0, _dind)
+					_scores_sel = _scores_sel / lpv.view(bsize, beam_size).index_select(0, _dind)
 					_sel_bsize = _dind.size(0)
 					_sel_real_bsize = _sel_bsize * beam_size
-					_scores_sel, _inds = _scores_sel.topk(beam_size, dim=-1)
-					_inds = (_inds + torch.arange(0, _sel_real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(_sel_real_bsize)
-					_trans_sel = _trans_sel.view(_sel_real_bsize, -1).index_select(0, _inds).view(_sel_bsize, beam_size, -1)
+					_scores_sel, _sinds = _scores_sel.topk(beam_size, dim=-1)
+					_sinds = (_sinds + _inds_add_beam.narrow(0, 0, _sel_bsize)).view(_sel_real_bsize)
+					_trans_sel = _trans_sel.view(_sel_real_bsize, -1).index_select(0, _sinds).view(_sel_bsize, beam_size, -1)
 				if return_all:
-						for _iu, _tran, _score in zip(_dind.tolist(), _trans_sel.unbind(0), _scores_sel.unbind(0)):
-							_rid = mapper[_iu]
-							rs[_rid] = _tran
-							rscore[_rid] = _score
+					for _iu, _tran, _score in zip(_dind.tolist(), _trans_sel.unbind(0), _scores_sel.unbind(0)):
+						_rid = mapper[_iu]
+						rs[_rid] = _tran
+						rscore[_rid] = _score
 				else:
-						for _iu, _tran in zip(_dind.tolist(), _trans_sel.unbind(0)):
-							rs[mapper[_iu]] = _tran[0]
+					for _iu, _tran in zip(_dind.tolist(), _trans_sel.unbind(0)):
+						rs[mapper[_iu]] = _tran[0]
 
 				# reduce bsize for not finished decoding
+				# _ndid: remaining sentences (_bsize)
+				# _ndid_beam: remaining beams (_bsize * beam_size)
+
 				_ndid = (~_done_trans_u).nonzero().squeeze(1)
 
 				_bsize = _ndid.size(0)
-				bsizeb2 = _bsize * beam_size2
 				_real_bsize = _bsize * beam_size
+				_ndid_beam = (_ndid.unsqueeze(1) * beam_size + _inds_beam).view(_real_bsize)
 
-				wds = wds.view(bsize, beam_size).index_select(0, _ndid).view(_real_bsize, 1)
+				wds = wds.index_select(0, _ndid_beam)
 				#inpute = inpute.view(bsize, beam_size, seql, isize).index_select(0, _ndid).view(_real_bsize, seql, isize)
-				for _m in self.modules():
-					if isinstance(layer, (CrossAttn, MultiHeadAttn,)) and layer.real_iK is not None:
-						layer.real_iK, layer.real_iV = tuple(_vu.view(bsize, beam_size, *list(_vu.size()[1:])).index_select(0, _ndid).view(_real_bsize, *list(_vu.size()[1:])) for _vu in (layer.real_iK, layer.real_iV,))
+				self.index_cross_attn_buffer(_ndid_beam)
 				if _src_pad_mask is not None:
-					_src_pad_mask = _src_pad_mask.view(bsize, beam_size, 1, seql).index_select(0, _ndid).view(_real_bsize, 1, seql)
-				for k, value in states.items():
-					states[k] = [_vu.view(bsize, beam_size, *list(_vu.size()[1:])).index_select(0, _ndid).view(_real_bsize, *list(_vu.size()[1:])) for _vu in value]
+					_src_pad_mask = _src_pad_mask.index_select(0, _ndid if _shared_buf else _ndid_beam)
+				# merge the pruning into the reordering of states
+				_inds = _inds.index_select(0, _ndid_beam)
+				scores = scores.index_select(0, _ndid)
 				sum_scores = sum_scores.index_select(0, _ndid)
 				trans = _trans.index_select(0, _ndid).view(_real_bsize, -1)
 				if length_penalty > 0.0:
-					lpv = lpv.view(bsize, beam_size).index_select(0, _ndid).view(_real_bsize, 1)
+					lpv = lpv.index_select(0, _ndid_beam)
 				done_trans = done_trans.index_select(0, _ndid)
 
 				bsize, real_bsize = _bsize, _real_bsize
+				bsizeb2 = bsize * beam_size2
 
 				# update mapper
 				for _ind, _iu in enumerate(_ndid.tolist()):
 					mapper[_ind] = mapper[_iu]
 
+			# update the corresponding hidden states
+			# states[i]: (bsize * beam_size, nquery, isize)
+			# _inds: (bsize, beam_size) => (bsize * beam_size)
+
+			if _kv_cache is None:
+				states = index_tensors(states, indices=_inds, dim=0)
+			else:
+				_kv_cache.index_select(_inds)
+
 		if return_mat:
 			rs = torch.stack(pad_tensors(rs), 0)
 
@@ -79,7 +79,9 @@ class Decoder(nn.Module):
 
 		outs = []
 
-		for model, inputu in zip(self.nets, inpute):
+		states = {}
+
+		for _inum, (model, inputu) in enumerate(zip(self.nets, inpute)):
 
 			out = model.get_sos_emb(inputu)
 
@@ -90,11 +92,11 @@ class Decoder(nn.Module):
 			if model.drop is not None:
 				out = model.drop(out)
 
-			states = {}
+			states[_inum] = {}
 
 			for _tmp, net in enumerate(model.nets):
-				out, _state = net(inputu, None, src_pad_mask, None, out)
-				states[_tmp] = _state
+				out, _state = net(inputu, (None, None,), src_pad_mask, None, out)
+				states[_inum][_tmp] = _state
 
 			if model.out_normer is not None:
 				out = model.out_normer(out)
@@ -116,7 +118,7 @@ class Decoder(nn.Module):
 
 			outs = []
 
-			for model, inputu in zip(self.nets, inpute):
+			for _inum, (model, inputu) in enumerate(zip(self.nets, inpute)):
 
 				out = model.wemb(wds)
 				if model.pemb is not None:
@@ -125,8 +127,8 @@ class Decoder(nn.Module):
 					out = model.drop(out)
 
 				for _tmp, net in enumerate(model.nets):
-					out, _state = net(inputu, states[_tmp], src_pad_mask, None, out)
-					states[_tmp] = _state
+					out, _state = net(inputu, states[_inum][_tmp], src_pad_mask, None, out)
+					states[_inum][_tmp] = _state
 
 				if model.out_normer is not None:
 					out = model.out_normer(out)
@@ -181,7 +183,7 @@ class Decoder(nn.Module):
 			states[_inum] = {}
 
 			for _tmp, net in enumerate(model.nets):
-				out, _state = net(inputu, None, src_pad_mask, None, out)
+				out, _state = net(inputu, (None, None,), src_pad_mask, None, out)
 				states[_inum][_tmp] = _state
 
 			if model.out_normer is not None:
@@ -0,0 +1,363 @@
+#encoding: utf-8
+
+# Fused ensemble of standard transformer models (transformer.Encoder/Decoder) which share the same architecture and shapes (e.g. checkpoints of the same training run): every layer runs all models with one batched matrix multiplication on weights stacked along a leading model dimension (see modules/stacked.py), representations are of shape (nmodel, bsize, seql, isize), and log-probabilities of models are combined with logsumexp (equal to the log of their averaged probabilities, as transformer/EnsembleDecoder.py). Decoding states of all models are kept in single tensors, and reordered for all models at once in beam search. Use is_fusable to check whether models can be fused, transformer/EnsembleNMT.py falls back to the loop over models otherwise.
+
+import torch
+from torch import nn
+from math import log, sqrt
+
+from modules.act import LGLU
+from modules.base import CrossAttn as CrossAttnBase, PositionwiseFF as PositionwiseFFBase, ResCrossAttn as ResCrossAttnBase, ResSelfAttn as ResSelfAttnBase, SelfAttn as SelfAttnBase
+from modules.stacked import PositionwiseFF, ResCrossAttn, ResSelfAttn, StackedLayerNorm, StackedLinear, stacked_embedding
+from utils.base import all_done
+from utils.sampler import SampleMax
+from transformer.Encoder import Encoder as EncoderBase, EncoderLayer as EncoderLayerBase
+from transformer.Decoder import Decoder as DecoderBase, DecoderLayer as DecoderLayerBase
+
+from cnfg.vocab.base import pad_id
+
+from cnfg.ihyp import *
+
+def para_sizes(model):
+
+	return [_.size() for _ in model.parameters()]
+
+def is_fusable_layer(layer):
+
+	_attns = [layer.attn] if isinstance(layer, EncoderLayerBase) else [layer.self_attn, layer.cross_attn]
+	_ffn = layer.ff.net
+
+	return all((type(_m) in (ResSelfAttnBase, ResCrossAttnBase,)) and (type(_m.net) in (SelfAttnBase, CrossAttnBase,)) and (type(_m.net.normer) == nn.Softmax) and (getattr(_m.net, "rel_pemb", None) is None) for _m in _attns) and (type(layer.ff) == PositionwiseFFBase) and (type(_ffn[0]) == nn.Linear) and (sum(1 for _m in _ffn if isinstance(_m, nn.Linear)) == 2) and (not any(isinstance(_m, (nn.GLU, LGLU,)) for _m in _ffn))
+
+# models: list of transformer.NMT.NMT
+
+def is_fusable(models):
+
+	if len(models) < 2:
+		return False
+	for model in models:
+		if (type(model.enc) != EncoderBase) or (type(model.dec) != DecoderBase) or (type(model.dec.classifier) != nn.Linear) or (not all(type(_l) == EncoderLayerBase for _l in model.enc.nets)) or (not all(type(_l) == DecoderLayerBase for _l in model.dec.nets)) or (not all(is_fusable_layer(_l) for _l in model.enc.nets)) or (not all(is_fusable_layer(_l) for _l in model.dec.nets)):
+			return False
+	_m0 = models[0]
+	_ref = (para_sizes(_m0), len(_m0.enc.nets), len(_m0.dec.nets), _m0.enc.pemb is None, _m0.dec.pemb is None, _m0.enc.out_normer is None, _m0.dec.out_normer is None, _m0.dec.classifier.weight.is_set_to(_m0.dec.wemb.weight), _m0.enc.nets[0].attn.norm_residual,)
+	for model in models[1:]:
+		if (para_sizes(model), len(model.enc.nets), len(model.dec.nets), model.enc.pemb is None, model.dec.pemb is None, model.enc.out_normer is None, model.dec.out_normer is None, model.dec.classifier.weight.is_set_to(model.dec.wemb.weight), model.enc.nets[0].attn.norm_residual,) != _ref:
+			return False
+
+	return True
+
+class EncoderLayer(nn.Module):
+
+	def __init__(self, layers):
+
+		super(EncoderLayer, self).__init__()
+
+		self.attn = ResSelfAttn([_.attn for _ in layers])
+		self.ff = PositionwiseFF([_.ff for _ in layers])
+
+	def forward(self, inputs, mask=None):
+
+		return self.ff(self.attn(inputs, mask=mask))
+
+class Encoder(nn.Module):
+
+	# models: list of transformer.Encoder.Encoder
+
+	def __init__(self, models):
+
+		super(Encoder, self).__init__()
+
+		self.nmodel = len(models)
+		self.register_buffer("wemb", torch.stack([_.wemb.weight.detach() for _ in models], 0))
+		self.pemb = models[0].pemb
+		self.nets = nn.ModuleList([EncoderLayer([_.nets[i] for _ in models]) for i in range(len(models[0].nets))])
+		self.out_normer = None if models[0].out_normer is None else StackedLayerNorm([_.out_normer for _ in models])
+
+	# inputs: (bsize, seql)
+	# mask: (bsize, 1, seql), generated with:
+	#	mask = inputs.eq(0).unsqueeze(1)
+	# return: (nmodel, bsize, seql, isize), iterating over it gives the representation of each model like transformer/EnsembleEncoder.py
+
+	def forward(self, inputs, mask=None):
+
+		out = stacked_embedding(self.wemb, inputs)
+		out = out * sqrt(out.size(-1))
+		if self.pemb is not None:
+			out = out + self.pemb(inputs, expand=False)
+
+		_mask = None if mask is None else mask.repeat(self.nmodel, 1, 1)
+		for net in self.nets:
+			out = net(out, _mask)
+
+		return out if self.out_normer is None else self.out_normer(out)
+
+class DecoderLayer(nn.Module):
+
+	def __init__(self, layers):
+
+		super(DecoderLayer, self).__init__()
+
+		self.self_attn = ResSelfAttn([_.self_attn for _ in layers])
+		self.cross_attn = ResCrossAttn([_.cross_attn for _ in layers])
+		self.ff = PositionwiseFF([_.ff for _ in layers])
+
+	# kv: keys and values of the cross attention, returned by self.cross_attn.get_kv
+	# inputo: embedding of decoded translation (nmodel, bsize, nquery, isize), or decoding states when query_unit is given
+	# src_pad_mask: (nmodel * bsize, 1, seql)
+
+	def forward(self, kv, inputo, src_pad_mask=None, tgt_pad_mask=None, query_unit=None):
+
+		if query_unit is None:
+			context = self.self_attn(inputo, mask=tgt_pad_mask)
+		else:
+			context, states_return = self.self_attn(query_unit, mask=tgt_pad_mask, states=inputo)
+
+		context = self.ff(self.cross_attn(context, kv, mask=src_pad_mask))
+
+		if query_unit is None:
+			return context
+		else:
+			return context, states_return
+
+class Decoder(nn.Module):
+
+	# models: list of transformer.Decoder.Decoder
+
+	def __init__(self, models):
+
+		super(Decoder, self).__init__()
+
+		_m0 = models[0]
+		self.nmodel = len(models)
+		self.xseql = _m0.xseql
+		self.register_buffer("mask", _m0.mask)
+		self.register_buffer("wemb", torch.stack([_.wemb.weight.detach() for _ in models], 0))
+		self.pemb = _m0.pemb
+		self.nets = nn.ModuleList([DecoderLayer([_.nets[i] for _ in models]) for i in range(len(_m0.nets))])
+		# the classifier uses the stacked embedding weight if they are bound
+		self.bindemb = _m0.classifier.weight.is_set_to(_m0.wemb.weight)
+		self.classifier = StackedLinear([_.classifier for _ in models], stack_weight=not self.bindemb)
+		self.out_normer = None if _m0.out_normer is None else StackedLayerNorm([_.out_normer for _ in models])
+		self.lp_nmodel = log(self.nmodel)
+
+	def _get_subsequent_mask(self, length):
+
+		return self.mask.narrow(1, 0, length).narrow(2, 0, length).contiguous() if length <= self.xseql else self.mask.new_ones(length, length).triu(1).unsqueeze(0)
+
+	# out: (nmodel, bsize, nquery, isize) => log-probabilities of the ensemble (bsize, nquery, nwd)
+
+	def classify(self, out):
+
+		if self.out_normer is not None:
+			out = self.out_normer(out)
+
+		return self.classifier(out, weight=self.wemb.transpose(1, 2) if self.bindemb else None).log_softmax(-1).logsumexp(0) - self.lp_nmodel
+
+	def get_kv(self, inpute):
+
+		return [net.cross_attn.get_kv(inpute) for net in self.nets]
+
+	# inpute: encoded representation from the fused encoder (nmodel, bsize, seql, isize), or representations of models [(bsize, seql, isize)...]
+	# inputo: decoded translation (bsize, nquery)
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
+	#	src_pad_mask = input.eq(0).unsqueeze(1)
+
+	def forward(self, inpute, inputo, src_pad_mask=None):
+
+		_inpute = torch.stack(inpute, 0) if isinstance(inpute, (list, tuple,)) else inpute
+		nquery = inputo.size(-1)
+
+		out = stacked_embedding(self.wemb, inputo)
+		if self.pemb is not None:
+			out = self.pemb(inputo, expand=False).add(out, alpha=sqrt(out.size(-1)))
+
+		_mask = self._get_subsequent_mask(nquery)
+		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.repeat(self.nmodel, 1, 1)
+		for net, _kv in zip(self.nets, self.get_kv(_inpute)):
+			out = net(_kv, out, _src_pad_mask, _mask)
+
+		return self.classify(out)
+
+	def decode(self, inpute, src_pad_mask=None, beam_size=1, max_len=512, length_penalty=0.0, fill_pad=False):
+
+		return self.beam_decode(inpute, src_pad_mask, beam_size, max_len, length_penalty, fill_pad=fill_pad) if beam_size > 1 else self.greedy_decode(inpute, src_pad_mask, max_len, fill_pad=fill_pad)
+
+	def greedy_decode(self, inpute, src_pad_mask=None, max_len=512, fill_pad=False, sample=False):
+
+		_inpute = torch.stack(inpute, 0) if isinstance(inpute, (list, tuple,)) else inpute
+		nmodel, bsize, seql, isize = _inpute.size()
+
+		sqrt_isize = sqrt(isize)
+
+		_kvs = self.get_kv(_inpute)
+		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.repeat(nmodel, 1, 1)
+
+		# out: input to the decoder for the first step (nmodel, bsize, 1, isize)
+		out = self.wemb.select(1, 1).view(nmodel, 1, 1, isize).expand(nmodel, bsize, 1, isize)
+		if self.pemb is not None:
+			out = self.pemb.get_pos(0).add(out, alpha=sqrt_isize)
+
+		states = {}
+		for _tmp, (net, _kv) in enumerate(zip(self.nets, _kvs)):
+			out, states[_tmp] = net(_kv, (None, None,), _src_pad_mask, None, out)
+
+		out = self.classify(out)
+		wds = SampleMax(out.exp(), dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
+
+		trans = [wds]
+
+		# done_trans: (bsize, 1)
+
+		done_trans = wds.eq(2)
+
+		for i in range(1, max_len):
+
+			out = stacked_embedding(self.wemb, wds)
+			if self.pemb is not None:
+				out = self.pemb.get_pos(i).add(out, alpha=sqrt_isize)
+
+			for _tmp, (net, _kv) in enumerate(zip(self.nets, _kvs)):
+				out, states[_tmp] = net(_kv, states[_tmp], _src_pad_mask, None, out)
+
+			out = self.classify(out)
+			wds = SampleMax(out.exp(), dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
+
+			trans.append(wds.masked_fill(done_trans, pad_id) if fill_pad else wds)
+
+			done_trans = done_trans | wds.eq(2)
+			if all_done(done_trans, bsize):
+				break
+
+		return torch.cat(trans, 1)
+
+	def beam_decode(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_all=False, clip_beam=clip_beam_with_lp, fill_pad=False):
+
+		_inpute = torch.stack(inpute, 0) if isinstance(inpute, (list, tuple,)) else inpute
+		nmodel, bsize, seql, isize = _inpute.size()
+
+		beam_size2 = beam_size * beam_size
+		bsizeb2 = bsize * beam_size2
+		real_bsize = bsize * beam_size
+
+		sqrt_isize = sqrt(isize)
+
+		if length_penalty > 0.0:
+			# lpv: length penalty vector for each beam (bsize * beam_size, 1)
+			lpv = _inpute.new_ones(real_bsize, 1)
+			lpv_base = 6.0 ** length_penalty
+
+		_kvs = self.get_kv(_inpute)
+		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.repeat(nmodel, 1, 1)
+
+		out = self.wemb.select(1, 1).view(nmodel, 1, 1, isize).expand(nmodel, bsize, 1, isize)
+		if self.pemb is not None:
+			out = self.pemb.get_pos(0).add(out, alpha=sqrt_isize)
+
+		states = {}
+		for _tmp, (net, _kv) in enumerate(zip(self.nets, _kvs)):
+			out, states[_tmp] = net(_kv, (None, None,), _src_pad_mask, None, out)
+
+		out = self.classify(out)
+
+		# scores: (bsize, 1, beam_size) => (bsize, beam_size)
+		# wds: (bsize * beam_size, 1)
+		# trans: (bsize * beam_size, 1)
+
+		scores, wds = out.topk(beam_size, dim=-1)
+		scores = scores.squeeze(1)
+		sum_scores = scores
+		wds = wds.view(real_bsize, 1)
+		trans = wds
+		_inds_add_beam2 = torch.arange(0, bsizeb2, beam_size2, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		# offsets of models in the (nmodel * bsize * beam_size) batch of states
+		_inds_add_model = torch.arange(0, nmodel * real_bsize, real_bsize, dtype=wds.dtype, device=wds.device).unsqueeze(1)
+
+		# done_trans: (bsize, beam_size)
+
+		done_trans = wds.view(bsize, beam_size).eq(2)
+
+		# keys/values of the cross attention and decoding states: (nmodel * bsize, ...) => (nmodel * bsize * beam_size, ...)
+
+		_kvs = [tuple(expand_stacked_bsize_for_beam(_t, nmodel, beam_size) for _t in _kv) for _kv in _kvs]
+		states = {_k: tuple(expand_stacked_bsize_for_beam(_t, nmodel, beam_size) for _t in _v) for _k, _v in states.items()}
+
+		# _src_pad_mask: (bsize, 1, seql) => (nmodel * bsize * beam_size, 1, seql)
+
+		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, seql).repeat(nmodel, 1, 1)
+
+		for step in range(1, max_len):
+
+			out = stacked_embedding(self.wemb, wds)
+			if self.pemb is not None:
+				out = self.pemb.get_pos(step).add(out, alpha=sqrt_isize)
+
+			for _tmp, (net, _kv) in enumerate(zip(self.nets, _kvs)):
+				out, states[_tmp] = net(_kv, states[_tmp], _src_pad_mask, None, out)
+
+			# out: (bsize, beam_size, nwd)
+
+			out = self.classify(out).view(bsize, beam_size, -1)
+
+			# find the top k ** 2 candidates and calculate route scores for them
+			# _scores: (bsize, beam_size, beam_size)
+			# _wds: (bsize, beam_size, beam_size)
+
+			_scores, _wds = out.topk(beam_size, dim=-1)
+			_scores = (_scores.masked_fill(done_trans.unsqueeze(2).expand(bsize, beam_size, beam_size), 0.0) + scores.unsqueeze(2).expand(bsize, beam_size, beam_size))
+
+			if length_penalty > 0.0:
+				lpv.masked_fill_(~done_trans.view(real_bsize, 1), ((step + 6.0) ** length_penalty) / lpv_base)
+
+			if clip_beam and (length_penalty > 0.0):
+				scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
+				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+				sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
+			else:
+				scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
+				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+				sum_scores = scores
+
+			wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
+
+			_inds = (_inds // beam_size + _inds_add_beam).view(real_bsize)
+
+			trans = torch.cat((trans.index_select(0, _inds), wds.masked_fill(done_trans.view(real_bsize, 1), pad_id) if fill_pad else wds), 1)
+
+			done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(2).squeeze(1)).view(bsize, beam_size)
+
+			_done = False
+			if length_penalty > 0.0:
+				lpv = lpv.index_select(0, _inds)
+			elif (not return_all) and all_done(done_trans.select(1, 0), bsize):
+				_done = True
+
+			if _done or all_done(done_trans, real_bsize):
+				break
+
+			# reorder decoding states of all models with the same beam indexes
+			# _inds: (bsize * beam_size) => (nmodel * bsize * beam_size)
+
+			_m_inds = (_inds.unsqueeze(0) + _inds_add_model).view(-1)
+			states = {_k: tuple(_t.index_select(0, _m_inds) for _t in _v) for _k, _v in states.items()}
+
+		if (not clip_beam) and (length_penalty > 0.0):
+			scores = scores / lpv.view(bsize, beam_size)
+			scores, _inds = scores.topk(beam_size, dim=-1)
+			_inds = (_inds + _inds_add_beam).view(real_bsize)
+			trans = trans.view(real_bsize, -1).index_select(0, _inds)
+
+		if return_all:
+
+			return trans.view(bsize, beam_size, -1), scores
+		else:
+
+			return trans.view(bsize, beam_size, -1).select(1, 0)
+
+# tin: (nmodel * bsize, ...) => (nmodel * bsize * beam_size, ...), ordered consistently with utils.base.repeat_bsize_for_beam_tensor for every model
+
+def expand_stacked_bsize_for_beam(tin, nmodel, beam_size):
+
+	_isize = tin.size()
+
+	return tin.view(nmodel, -1, *_isize[1:]).repeat_interleave(beam_size, dim=1).view(-1, *_isize[1:])
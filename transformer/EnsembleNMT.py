@@ -6,6 +6,7 @@ from torch import nn
 from utils.base import all_done, select_zero_
 
 from transformer.EnsembleEncoder import Encoder
+from transformer.EnsembleFused import Decoder as FusedDecoder, Encoder as FusedEncoder, is_fusable
 
 # switch the comment between the following two lines to choose standard decoder or average decoder
 from transformer.EnsembleDecoder import Decoder
@@ -15,12 +16,19 @@ from cnfg.ihyp import *
 
 class NMT(nn.Module):
 
-	def __init__(self, models):
+	# models: list of models
+	# fuse: run models of the same architecture with batched computation (see transformer/EnsembleFused.py) instead of looping over them, ignored if models cannot be fused
+
+	def __init__(self, models, fuse=fuse_ensemble):
 
 		super(NMT, self).__init__()
 
-		self.enc = Encoder([model.enc for model in models])
-		self.dec = Decoder([model.dec for model in models])
+		if fuse and is_fusable(models):
+			self.enc = FusedEncoder([model.enc for model in models])
+			self.dec = FusedDecoder([model.dec for model in models])
+		else:
+			self.enc = Encoder([model.enc for model in models])
+			self.dec = Decoder([model.dec for model in models])
 
 	# inpute: source sentences from encoder (bsize, seql)
 	# inputo: decoded translation (bsize, nquery)
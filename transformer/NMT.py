@@ -49,23 +49,33 @@ class NMT(nn.Module):
 	# mask: user specified mask, otherwise it will be:
 	#	inpute.eq(0).unsqueeze(1)
 
-	def forward(self, inpute, inputo, mask=None):
+	def forward(self, inpute, inputo, mask=None, **kwargs):
 
 		_mask = inpute.eq(0).unsqueeze(1) if mask is None else mask
 
-		return self.dec(self.enc(inpute, _mask), inputo, _mask)
+		return self.dec(self.enc(inpute, _mask), inputo, _mask, **kwargs)
 
 	# inpute: source sentences from encoder (bsize, seql)
 	# beam_size: the beam size for beam search
 	# max_len: maximum length to generate
 
-	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0):
+	# clip: remove finished sentences from the batch during decoding
+	# shortlist: a utils.shortlist.Shortlist to restrict the target vocabulary of the batch to its candidates
+
+	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, clip=False, shortlist=None):
 
 		mask = inpute.eq(0).unsqueeze(1)
 
 		_max_len = (inpute.size(1) + max(64, inpute.size(1) // 4)) if max_len is None else max_len
 
-		return self.dec.decode(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty)
+		if shortlist is None:
+			_dec = self.dec
+		else:
+			_indices = shortlist(inpute)
+			_dec = self.dec.shortlist_decoder(_indices)
+		rs = (_dec.decode_clip if clip else _dec.decode)(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty)
+
+		return rs if shortlist is None else _indices[rs]
 
 	def load_base(self, base_nmt):
 
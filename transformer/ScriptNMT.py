@@ -0,0 +1,366 @@
+#encoding: utf-8
+
+# TorchScript version of the standard transformer (transformer/NMT.py) for inference, which can be compiled with torch.jit.script and saved as a self-contained file (see tools/export_ts.py). Parameters are shared with the given model. The encoder (encode), the pre-computation of cross-attention keys/values (cross_kv) and the step decoder with explicit self-attention key/value caches (step) are exported together with greedy decoding and beam search loops (translate), so that the saved file can be used without the code and configurations of this project (see tools/ts_translate.py).
+
+import torch
+from torch import nn
+from typing import List, Tuple
+from math import sqrt, log
+
+from modules.base import ResSelfAttn, ResCrossAttn, SelfAttn, CrossAttn
+from modules.dropout import Dropout
+from transformer.Encoder import EncoderLayer as EncoderLayerBase
+from transformer.Decoder import DecoderLayer as DecoderLayerBase
+
+from cnfg.vocab.base import pad_id, sos_id, eos_id
+
+from cnfg.ihyp import *
+
+# check whether a model (transformer.NMT.NMT) only consists of modules supported by this file
+
+def is_scriptable(model):
+
+	for _m in model.modules():
+		if isinstance(_m, (SelfAttn, CrossAttn,)) and ((type(_m.normer) != nn.Softmax) or (getattr(_m, "rel_pemb", None) is not None)):
+			return False
+	for _nets, _cls in ((model.enc.nets, EncoderLayerBase,), (model.dec.nets, DecoderLayerBase,),):
+		for _net in _nets:
+			if type(_net) != _cls:
+				return False
+			for _attn in (_net.attn,) if _cls == EncoderLayerBase else (_net.self_attn, _net.cross_attn,):
+				if type(_attn) not in (ResSelfAttn, ResCrossAttn,):
+					return False
+
+	return True
+
+# the feed-forward network of PositionwiseFF without dropout
+
+def build_ff(ff):
+
+	return nn.Sequential(*[_ for _ in ff.net if not isinstance(_, Dropout)])
+
+class EncoderLayer(nn.Module):
+
+	# layer: transformer.Encoder.EncoderLayer
+
+	def __init__(self, layer):
+
+		super(EncoderLayer, self).__init__()
+
+		_attn = layer.attn.net
+		self.num_head, self.attn_dim, self.hsize = _attn.num_head, _attn.attn_dim, _attn.hsize
+		self.attn_normer, self.adaptor, self.outer = layer.attn.normer, _attn.adaptor, _attn.outer
+		self.ff_normer = layer.ff.normer
+		self.ff = build_ff(layer.ff)
+		self.attn_norm_residual, self.ff_norm_residual = layer.attn.norm_residual, layer.ff.norm_residual
+		self.inf = float(inf_default)
+
+	# x: (bsize, seql, isize)
+	# mask: (bsize, 1, seql)
+
+	def forward(self, x, mask):
+
+		bsize, seql = x.size(0), x.size(1)
+
+		_x = self.attn_normer(x)
+		q, k, v = self.adaptor(_x).view(bsize, seql, 3, self.num_head, self.attn_dim).unbind(2)
+		scores = q.transpose(1, 2).matmul(k.permute(0, 2, 3, 1))
+		scores = (scores / sqrt(self.attn_dim)).masked_fill(mask.unsqueeze(1), -self.inf).softmax(-1)
+		out = self.outer(scores.matmul(v.transpose(1, 2)).transpose(1, 2).contiguous().view(bsize, seql, self.hsize))
+		out = out + (_x if self.attn_norm_residual else x)
+
+		_out = self.ff_normer(out)
+
+		return self.ff(_out) + (_out if self.ff_norm_residual else out)
+
+class DecoderLayer(nn.Module):
+
+	# layer: transformer.Decoder.DecoderLayer
+
+	def __init__(self, layer):
+
+		super(DecoderLayer, self).__init__()
+
+		_attn, _cattn = layer.self_attn.net, layer.cross_attn.net
+		self.num_head, self.attn_dim, self.hsize = _attn.num_head, _attn.attn_dim, _attn.hsize
+		self.attn_normer, self.adaptor, self.outer = layer.self_attn.normer, _attn.adaptor, _attn.outer
+		self.cross_normer, self.query_adaptor, self.kv_adaptor, self.cross_outer = layer.cross_attn.normer, _cattn.query_adaptor, _cattn.kv_adaptor, _cattn.outer
+		self.ff_normer = layer.ff.normer
+		self.ff = build_ff(layer.ff)
+		self.attn_norm_residual, self.cross_norm_residual, self.ff_norm_residual = layer.self_attn.norm_residual, layer.cross_attn.norm_residual, layer.ff.norm_residual
+		self.inf = float(inf_default)
+
+	# keys (bsize, num_head, attn_dim, seql) and values (bsize, num_head, seql, attn_dim) of the cross-attention
+	# inpute: (bsize, seql, isize)
+
+	def cross_kv(self, inpute) -> Tuple[torch.Tensor, torch.Tensor]:
+
+		bsize, seql = inpute.size(0), inpute.size(1)
+		k, v = self.kv_adaptor(inpute).view(bsize, seql, 2, self.num_head, self.attn_dim).unbind(2)
+
+		return k.permute(0, 2, 3, 1), v.transpose(1, 2)
+
+	# x: (bsize, nquery, isize)
+	# cross_k, cross_v: see cross_kv
+	# src_mask: (bsize, 1, seql)
+	# k_cache: keys of the decoding history (bsize, num_head, attn_dim, nstep)
+	# v_cache: values of the decoding history (bsize, num_head, nstep, attn_dim)
+	# tgt_mask: (1 or bsize, nquery, nstep + nquery) for nquery > 1, an empty tensor for nquery == 1
+	# returns the output and the updated k_cache/v_cache
+
+	def forward(self, x, cross_k, cross_v, src_mask, k_cache, v_cache, tgt_mask) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+
+		bsize, nquery = x.size(0), x.size(1)
+
+		_x = self.attn_normer(x)
+		q, k, v = self.adaptor(_x).view(bsize, nquery, 3, self.num_head, self.attn_dim).unbind(2)
+		k, v = k.permute(0, 2, 3, 1), v.transpose(1, 2)
+		if k_cache.size(-1) > 0:
+			k, v = torch.cat((k_cache, k,), dim=-1), torch.cat((v_cache, v,), dim=2)
+		scores = q.transpose(1, 2).matmul(k) / sqrt(self.attn_dim)
+		if tgt_mask.numel() > 0:
+			scores = scores.masked_fill(tgt_mask.unsqueeze(1), -self.inf)
+		out = self.outer(scores.softmax(-1).matmul(v).transpose(1, 2).contiguous().view(bsize, nquery, self.hsize))
+		out = out + (_x if self.attn_norm_residual else x)
+
+		_x = self.cross_normer(out)
+		scores = self.query_adaptor(_x).view(bsize, nquery, self.num_head, self.attn_dim).transpose(1, 2).matmul(cross_k) / sqrt(self.attn_dim)
+		scores = scores.masked_fill(src_mask.unsqueeze(1), -self.inf)
+		out = self.cross_outer(scores.softmax(-1).matmul(cross_v).transpose(1, 2).contiguous().view(bsize, nquery, self.hsize)) + (_x if self.cross_norm_residual else out)
+
+		_out = self.ff_normer(out)
+
+		return self.ff(_out) + (_out if self.ff_norm_residual else out), k, v
+
+class NMT(nn.Module):
+
+	# model: transformer.NMT.NMT (in evaluation mode), see is_scriptable for supported configurations
+	# clip_beam: prune with length penalty in each beam decoding step
+
+	def __init__(self, model, clip_beam=clip_beam_with_lp):
+
+		super(NMT, self).__init__()
+
+		enc, dec = model.enc, model.dec
+		self.isize = enc.wemb.weight.size(-1)
+		self.enc_wemb, self.dec_wemb = enc.wemb, dec.wemb
+		self.enc_layers = nn.ModuleList([EncoderLayer(_) for _ in enc.nets])
+		self.dec_layers = nn.ModuleList([DecoderLayer(_) for _ in dec.nets])
+		self.enc_normer = nn.Identity() if enc.out_normer is None else enc.out_normer
+		self.dec_normer = nn.Identity() if dec.out_normer is None else dec.out_normer
+		self.classifier = dec.classifier
+		self.enc_pemb, self.dec_pemb = enc.pemb is not None, dec.pemb is not None
+		_pemb = dec.pemb if enc.pemb is None else enc.pemb
+		self.register_buffer("pemb", (_pemb.w if _pemb is not None else enc.wemb.weight.new_zeros(1, self.isize)).clone())
+		self.num_head, self.attn_dim = self.dec_layers[0].num_head, self.dec_layers[0].attn_dim
+		self.clip_beam = clip_beam
+		self.inf = float(inf_default)
+		self.pad_id, self.sos_id, self.eos_id = pad_id, sos_id, eos_id
+
+	# positional embeddings of positions [start, end) which are not cached
+
+	def get_ext(self, start: int, end: int):
+
+		pos = torch.arange(start, end, dtype=self.pemb.dtype, device=self.pemb.device).unsqueeze(1)
+		_tmp = pos * (torch.arange(0, self.isize, 2, dtype=self.pemb.dtype, device=self.pemb.device) * -(log(1e4) / self.isize)).exp()
+		rs = self.pemb.new_empty(end - start, self.isize)
+		rs[:, 0::2] = _tmp.sin()
+		rs[:, 1::2] = _tmp.narrow(-1, 0, _tmp.size(-1) - 1).cos() if self.isize % 2 == 1 else _tmp.cos()
+
+		return rs
+
+	def get_pos(self, start: int, end: int):
+
+		npos = self.pemb.size(0)
+		if end <= npos:
+			return self.pemb[start:end]
+		elif start >= npos:
+			return self.get_ext(start, end)
+		else:
+			return torch.cat((self.pemb[start:], self.get_ext(npos, end),), 0)
+
+	def forward(self, inpute, beam_size: int = 1, max_len: int = -1, length_penalty: float = 0.0):
+
+		return self.translate(inpute, beam_size, max_len, length_penalty)
+
+	# inpute: source sentences (bsize, seql) with <sos> and <eos>, padded with <pad>
+	# max_len: maximum number of decoding steps, the heuristic of transformer.NMT.NMT.decode is used if max_len <= 0
+
+	@torch.jit.export
+	def translate(self, inpute, beam_size: int = 1, max_len: int = -1, length_penalty: float = 0.0):
+
+		seql = inpute.size(1)
+		_max_len = (seql + max(64, seql // 4)) if max_len <= 0 else max_len
+		ence, src_mask = self.encode(inpute)
+
+		return self.greedy_decode(ence, src_mask, _max_len) if beam_size < 2 else self.beam_decode(ence, src_mask, beam_size, _max_len, length_penalty)
+
+	# returns the representation of the encoder (bsize, seql, isize) and the source mask (bsize, 1, seql)
+
+	@torch.jit.export
+	def encode(self, inpute) -> Tuple[torch.Tensor, torch.Tensor]:
+
+		src_mask = inpute.eq(self.pad_id).unsqueeze(1)
+		out = self.enc_wemb(inpute)
+		out = out * sqrt(self.isize)
+		if self.enc_pemb:
+			out = out + self.get_pos(0, inpute.size(1)).unsqueeze(0)
+		for layer in self.enc_layers:
+			out = layer(out, src_mask)
+
+		return self.enc_normer(out), src_mask
+
+	# keys and values of cross-attentions of all decoder layers
+
+	@torch.jit.export
+	def cross_kv(self, ence) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+
+		keys: List[torch.Tensor] = []
+		values: List[torch.Tensor] = []
+		for layer in self.dec_layers:
+			k, v = layer.cross_kv(ence)
+			keys.append(k)
+			values.append(v)
+
+		return keys, values
+
+	# empty self-attention key/value caches for bsize sentences
+
+	@torch.jit.export
+	def init_cache(self, bsize: int) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+
+		keys: List[torch.Tensor] = []
+		values: List[torch.Tensor] = []
+		for layer in self.dec_layers:
+			keys.append(self.pemb.new_empty(bsize, self.num_head, self.attn_dim, 0))
+			values.append(self.pemb.new_empty(bsize, self.num_head, 0, self.attn_dim))
+
+		return keys, values
+
+	# one decoding step
+	# wds: input tokens (bsize, nquery), the first step starts with <sos>
+	# step: the position of the first token of wds
+	# cross_k, cross_v: see cross_kv
+	# k_cache, v_cache: self-attention caches of the decoding history (see init_cache), updated ones are returned
+	# returns log-probabilities (bsize, nquery, nwd)
+
+	@torch.jit.export
+	def step(self, wds, step: int, cross_k: List[torch.Tensor], cross_v: List[torch.Tensor], src_mask, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Tensor], List[torch.Tensor]]:
+
+		return self.step_classify(wds, step, cross_k, cross_v, src_mask, k_cache, v_cache, True)
+
+	def step_classify(self, wds, step: int, cross_k: List[torch.Tensor], cross_v: List[torch.Tensor], src_mask, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], normalize: bool) -> Tuple[torch.Tensor, List[torch.Tensor], List[torch.Tensor]]:
+
+		nquery = wds.size(1)
+		out = self.dec_wemb(wds)
+		if self.dec_pemb:
+			out = torch.add(self.get_pos(step, step + nquery).unsqueeze(0), out, alpha=sqrt(self.isize))
+		if nquery > 1:
+			tgt_mask = torch.cat((torch.zeros(nquery, step, dtype=torch.bool, device=wds.device), torch.ones(nquery, nquery, dtype=torch.bool, device=wds.device).triu(1),), 1).unsqueeze(0)
+		else:
+			tgt_mask = torch.zeros(0, dtype=torch.bool, device=wds.device)
+		keys: List[torch.Tensor] = []
+		values: List[torch.Tensor] = []
+		for i, layer in enumerate(self.dec_layers):
+			out, k, v = layer(out, cross_k[i], cross_v[i], src_mask, k_cache[i], v_cache[i], tgt_mask)
+			keys.append(k)
+			values.append(v)
+		out = self.classifier(self.dec_normer(out))
+
+		return (out.log_softmax(-1) if normalize else out), keys, values
+
+	def greedy_decode(self, ence, src_mask, max_len: int):
+
+		bsize = ence.size(0)
+		cross_k, cross_v = self.cross_kv(ence)
+		k_cache, v_cache = self.init_cache(bsize)
+		wds = torch.full((bsize, 1,), self.sos_id, dtype=torch.long, device=ence.device)
+		trans: List[torch.Tensor] = []
+		done_trans = torch.zeros(bsize, 1, dtype=torch.bool, device=ence.device)
+		for i in range(max_len):
+			out, k_cache, v_cache = self.step_classify(wds, i, cross_k, cross_v, src_mask, k_cache, v_cache, False)
+			wds = out.argmax(dim=-1)
+			trans.append(wds)
+			done_trans = done_trans | wds.eq(self.eos_id)
+			# at least 2 steps are decoded like transformer.Decoder.Decoder.greedy_decode
+			if (i > 0) and bool(done_trans.all()):
+				break
+
+		return torch.cat(trans, 1)
+
+	def beam_decode(self, ence, src_mask, beam_size: int, max_len: int, length_penalty: float):
+
+		bsize, seql = ence.size(0), ence.size(1)
+		beam_size2 = beam_size * beam_size
+		bsizeb2 = bsize * beam_size2
+		real_bsize = bsize * beam_size
+
+		cross_k, cross_v = self.cross_kv(ence)
+		k_cache, v_cache = self.init_cache(bsize)
+		wds = torch.full((bsize, 1,), self.sos_id, dtype=torch.long, device=ence.device)
+		out, k_cache, v_cache = self.step_classify(wds, 0, cross_k, cross_v, src_mask, k_cache, v_cache, True)
+
+		lpv = ence.new_ones(real_bsize, 1)
+		lpv_base = 6.0 ** length_penalty
+
+		scores, wds = out.topk(beam_size, dim=-1)
+		sum_scores = scores.squeeze(1)
+		wds = wds.view(real_bsize, 1)
+		trans = wds
+		_inds_add_beam2 = torch.arange(0, bsizeb2, beam_size2, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		done_trans = wds.view(bsize, beam_size).eq(self.eos_id)
+		scores = sum_scores
+
+		cross_k = [_.repeat_interleave(beam_size, dim=0) for _ in cross_k]
+		cross_v = [_.repeat_interleave(beam_size, dim=0) for _ in cross_v]
+		k_cache = [_.repeat_interleave(beam_size, dim=0) for _ in k_cache]
+		v_cache = [_.repeat_interleave(beam_size, dim=0) for _ in v_cache]
+		_src_mask = src_mask.repeat_interleave(beam_size, dim=0)
+
+		for step in range(1, max_len):
+
+			out, k_cache, v_cache = self.step_classify(wds, step, cross_k, cross_v, _src_mask, k_cache, v_cache, True)
+			out = out.view(bsize, beam_size, -1)
+
+			_scores, _wds = out.topk(beam_size, dim=-1)
+			_done_trans_unsqueeze = done_trans.unsqueeze(2)
+			_mask_done = _done_trans_unsqueeze.repeat(1, 1, beam_size)
+			_mask_done.select(2, 0).fill_(False)
+			_scores = _scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill(_mask_done, -self.inf)
+
+			if length_penalty > 0.0:
+				lpv = lpv.masked_fill(~done_trans.view(real_bsize, 1), ((step + 6.0) ** length_penalty) / lpv_base)
+
+			if self.clip_beam and (length_penalty > 0.0):
+				scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
+				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+				sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
+			else:
+				scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
+				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+				sum_scores = scores
+
+			wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
+			_inds = (torch.div(_inds, beam_size, rounding_mode="floor") + _inds_add_beam).view(real_bsize)
+			trans = torch.cat((trans.index_select(0, _inds), wds,), 1)
+			done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(self.eos_id).squeeze(1)).view(bsize, beam_size)
+
+			_done = False
+			if length_penalty > 0.0:
+				lpv = lpv.index_select(0, _inds)
+			elif bool(done_trans.select(1, 0).all()):
+				_done = True
+			if _done or bool(done_trans.all()):
+				break
+
+			k_cache = [_.index_select(0, _inds) for _ in k_cache]
+			v_cache = [_.index_select(0, _inds) for _ in v_cache]
+
+		if (not self.clip_beam) and (length_penalty > 0.0):
+			scores = scores / lpv.view(bsize, beam_size)
+			scores, _inds = scores.topk(beam_size, dim=-1)
+			_inds = (_inds + _inds_add_beam).view(real_bsize)
+			trans = trans.view(real_bsize, -1).index_select(0, _inds)
+
+		return trans.view(bsize, beam_size, -1).select(1, 0)
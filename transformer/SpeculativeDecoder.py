@@ -0,0 +1,297 @@
+#encoding: utf-8
+
+# Speculative decoding: in each step, a small draft decoder (e.g. a 1-layer transformer.Decoder.Decoder distilled by tools/distil_draft.py, which reads the representation of the encoder of the main model) proposes nspec tokens autoregressively, and the main decoder scores the last decoded token with all proposals in one parallel forward pass (with the subsequent mask over proposals and its cached decoding history). The longest prefix of proposals which agrees with the predictions of the main decoder is accepted together with the prediction of the main decoder following it, so that each step of the main decoder decodes 1 to nspec + 1 tokens.
+# Outputs are the same as transformer.Decoder.Decoder.greedy_decode/beam_decode with fill_pad=True: in greedy decoding, proposals are accepted up to the shortest agreeing prefix of unfinished sentences in the batch; in beam search, steps of the beam search are performed on scores of the main decoder for proposals as long as every unfinished hypothesis extends its hypothesis of the last step with the proposed token.
+
+import torch
+from torch import nn
+from math import sqrt
+
+from utils.base import all_done, expand_bsize_for_beam, index_tensors, select_zero_
+
+from cnfg.vocab.base import eos_id, pad_id, sos_id
+
+from cnfg.ihyp import *
+
+# positional embeddings of positions [start, start + length) (length, isize)
+
+def get_pos_range(pemb, start, length):
+
+	return pemb.w.narrow(0, start, length) if start + length <= pemb.num_pos else torch.stack([pemb.get_pos(i) for i in range(start, start + length)], 0)
+
+# keep the decoding history of the first length positions in self-attention states
+
+def narrow_states(states, length):
+
+	return {k: (v[0].narrow(-1, 0, length), v[1].narrow(2, 0, length),) for k, v in states.items()}
+
+class Decoder(nn.Module):
+
+	# model: the main decoder (transformer.Decoder.Decoder)
+	# draft: the draft decoder sharing the target vocabulary and the encoder representation with model
+	# nspec: number of tokens proposed by the draft decoder in each step
+
+	def __init__(self, model, draft, nspec=4):
+
+		super(Decoder, self).__init__()
+
+		self.model, self.draft, self.nspec = model, draft, nspec
+		self.reset_stats()
+
+	# nstep: number of forward passes of the main decoder, ntoken: number of decoding steps (tokens per sentence or hypothesis) performed by them
+
+	def reset_stats(self):
+
+		self.nstep = self.ntoken = 0
+
+	# run decoder on tokens inputo (bsize, nquery) at positions [pos, pos + nquery) given the decoding history of previous positions in states
+	# return: logits (bsize, nquery, nwd) and states extended with inputo
+
+	def step(self, decoder, inpute, states, inputo, pos, src_pad_mask=None):
+
+		nquery = inputo.size(1)
+
+		out = decoder.wemb(inputo)
+		if decoder.pemb is not None:
+			out = get_pos_range(decoder.pemb, pos, nquery).add(out, alpha=sqrt(out.size(-1)))
+
+		# queries attend to the history and to previous queries
+		_mask = None if nquery == 1 else torch.cat((decoder.mask.new_zeros(1, nquery, pos), decoder._get_subsequent_mask(nquery),), -1)
+
+		rs = {}
+		for _tmp, net in enumerate(decoder.nets):
+			out, rs[_tmp] = net(inpute, states.get(_tmp, (None, None,)), src_pad_mask, _mask, out)
+
+		if decoder.out_normer is not None:
+			out = decoder.out_normer(out)
+
+		return decoder.classifier(out), rs
+
+	# propose nspec tokens with the draft decoder, whose decoding history covers dlen positions, trans: decoded tokens (bsize, ntoken)
+	# return: proposals (bsize, nspec), states and the length of the decoding history of the draft decoder
+
+	def propose(self, inpute, dstates, trans, dlen, nspec, src_pad_mask=None):
+
+		# feed tokens of positions [dlen, ntoken] which the draft decoder has not read
+		_inputs = trans.narrow(1, dlen - 1, trans.size(1) - dlen + 1)
+		rs = []
+		for _ in range(nspec):
+			_out, dstates = self.step(self.draft, inpute, dstates, _inputs, dlen, src_pad_mask)
+			dlen += _inputs.size(1)
+			_inputs = _out.narrow(1, _out.size(1) - 1, 1).argmax(-1)
+			rs.append(_inputs)
+
+		return torch.cat(rs, 1), dstates, dlen
+
+	def decode(self, inpute, src_pad_mask=None, beam_size=1, max_len=512, length_penalty=0.0):
+
+		return self.beam_decode(inpute, src_pad_mask, beam_size, max_len, length_penalty) if beam_size > 1 else self.greedy_decode(inpute, src_pad_mask, max_len)
+
+	# inpute: encoded representation from encoder (bsize, seql, isize)
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
+	#	src_pad_mask = input.eq(0).unsqueeze(1)
+	# max_len: maximum length to generate
+
+	def greedy_decode(self, inpute, src_pad_mask=None, max_len=512):
+
+		bsize = inpute.size(0)
+
+		_sos = inpute.new_full((bsize, 1,), sos_id, dtype=torch.long)
+		out, states = self.step(self.model, inpute, {}, _sos, 0, src_pad_mask)
+		_, dstates = self.step(self.draft, inpute, {}, _sos, 0, src_pad_mask)
+		dlen = 1
+
+		# trans: (bsize, ntoken)
+		trans = out.argmax(dim=-1)
+		done_trans = trans.squeeze(1).eq(eos_id)
+		ntoken = 1
+		self.nstep += 1
+		self.ntoken += 1
+		# number of proposals of the next step, adapted to the number of accepted proposals of the last step
+		_npro = self.nspec
+
+		while (ntoken < max_len) and (not all_done(done_trans, bsize)):
+
+			_nspec = min(_npro, max_len - ntoken - 1)
+			if _nspec > 0:
+				_drafts, dstates, dlen = self.propose(inpute, dstates, trans, dlen, _nspec, src_pad_mask)
+				_inputs = torch.cat((trans.narrow(1, ntoken - 1, 1), _drafts,), 1)
+			else:
+				_inputs = trans.narrow(1, ntoken - 1, 1)
+
+			out, _states = self.step(self.model, inpute, states, _inputs, ntoken, src_pad_mask)
+			# wds: predictions following the last decoded token and each proposal (bsize, _nspec + 1)
+			wds = out.argmax(dim=-1)
+
+			if _nspec > 0:
+				# _nacc: number of leading proposals which agree with the main decoder
+				_nacc = _drafts.eq(wds.narrow(1, 0, _nspec)).long().cumprod(1).sum(1)
+				# sentences which finish within valid predictions do not restrict the acceptance of other sentences
+				_fin = (wds.eq(eos_id) & torch.arange(_nspec + 1, dtype=_nacc.dtype, device=_nacc.device).unsqueeze(0).le(_nacc.unsqueeze(1))).any(1)
+				nacc = _nacc.masked_fill(done_trans | _fin, _nspec).min().item()
+				wds = wds.narrow(1, 0, nacc + 1)
+			else:
+				nacc = 0
+
+			# tokens after <eos> are replaced with <pad>
+			_done = torch.cat((done_trans.unsqueeze(1), wds.narrow(1, 0, nacc).eq(eos_id),), 1).long().cumsum(1).gt(0)
+			trans = torch.cat((trans, wds.masked_fill(_done, pad_id),), 1)
+			done_trans = done_trans | wds.eq(eos_id).any(1)
+
+			ntoken += nacc + 1
+			states = narrow_states(_states, ntoken)
+			if dlen > ntoken:
+				dlen = ntoken
+				dstates = narrow_states(dstates, dlen)
+			self.nstep += 1
+			self.ntoken += nacc + 1
+			_npro = max(1, min(self.nspec, nacc + 1))
+
+		# remove steps after all sentences finished, which are not performed by greedy decoding (which performs at least 2 steps)
+		if all_done(done_trans, bsize):
+			_len = min(max_len, max(2, trans.eq(eos_id).long().argmax(1).max().item() + 1))
+			if _len > ntoken:
+				trans = torch.cat((trans, trans.new_full((bsize, _len - ntoken,), pad_id),), 1)
+			elif _len < ntoken:
+				trans = trans.narrow(1, 0, _len)
+
+		return trans
+
+	# inpute: encoded representation from encoder (bsize, seql, isize)
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
+	#	src_pad_mask = input.eq(0).unsqueeze(1)
+	# beam_size: beam size
+	# max_len: maximum length to generate
+
+	def beam_decode(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_all=False, clip_beam=clip_beam_with_lp):
+
+		bsize, seql = inpute.size()[:2]
+
+		beam_size2 = beam_size * beam_size
+		bsizeb2 = bsize * beam_size2
+		real_bsize = bsize * beam_size
+
+		_sos = inpute.new_full((bsize, 1,), sos_id, dtype=torch.long)
+		out, states = self.step(self.model, inpute, {}, _sos, 0, src_pad_mask)
+		_, dstates = self.step(self.draft, inpute, {}, _sos, 0, src_pad_mask)
+		dlen = 1
+
+		# out: (bsize, 1, nwd)
+
+		out = out.log_softmax(-1)
+
+		if length_penalty > 0.0:
+			# lpv: length penalty vector for each beam (bsize * beam_size, 1)
+			lpv = out.new_ones(real_bsize, 1)
+			lpv_base = 6.0 ** length_penalty
+
+		scores, wds = out.topk(beam_size, dim=-1)
+		scores = scores.squeeze(1)
+		sum_scores = scores
+		wds = wds.view(real_bsize, 1)
+		trans = wds
+		_inds_add_beam2 = torch.arange(0, bsizeb2, beam_size2, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		_inds_base = torch.arange(real_bsize, dtype=wds.dtype, device=wds.device)
+
+		done_trans = wds.view(bsize, beam_size).eq(eos_id)
+
+		_shared_buf = self.model.repeat_cross_attn_buffer(beam_size) & self.draft.repeat_cross_attn_buffer(beam_size)
+
+		_src_pad_mask = src_pad_mask if (src_pad_mask is None) or _shared_buf else src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, seql)
+
+		states = expand_bsize_for_beam(states, beam_size=beam_size)
+		dstates = expand_bsize_for_beam(dstates, beam_size=beam_size)
+
+		step = 1
+		self.nstep += 1
+		self.ntoken += 1
+		_finished = False
+		_npro = self.nspec
+
+		while step < max_len:
+
+			# the last selected tokens (wds) instead of the last column of trans are fed to the main decoder like transformer.Decoder.Decoder.beam_decode, as trans may be padded at positions of finished hypotheses of the last step
+			_nspec = min(_npro, max_len - step - 1)
+			if _nspec > 0:
+				_drafts, dstates, dlen = self.propose(inpute, dstates, trans, dlen, _nspec, _src_pad_mask)
+				_inputs = torch.cat((wds, _drafts,), 1)
+			else:
+				_inputs = wds
+
+			_out, _states = self.step(self.model, inpute, states, _inputs, step, _src_pad_mask)
+			_out = _out.log_softmax(-1)
+			self.nstep += 1
+			_step = step
+
+			# _orig: hypotheses of the verification batch which current hypotheses extend with proposals
+			_orig = _inds_base
+			for _spec_step in range(_nspec + 1):
+
+				out = _out.select(1, _spec_step).index_select(0, _orig).view(bsize, beam_size, -1)
+
+				# the same as a step of transformer.Decoder.Decoder.beam_decode
+				_scores, _wds = out.topk(beam_size, dim=-1)
+				_done_trans_unsqueeze = done_trans.unsqueeze(2)
+				_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
+
+				if length_penalty > 0.0:
+					lpv.masked_fill_(~done_trans.view(real_bsize, 1), ((step + 6.0) ** length_penalty) / lpv_base)
+
+				if clip_beam and (length_penalty > 0.0):
+					scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
+					_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+					sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
+				else:
+					scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
+					_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+					sum_scores = scores
+
+				wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
+
+				_inds = (_inds // beam_size + _inds_add_beam).view(real_bsize)
+
+				trans = torch.cat((trans.index_select(0, _inds), wds.masked_fill(done_trans.view(real_bsize, 1), pad_id),), 1)
+
+				done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(eos_id).squeeze(1)).view(bsize, beam_size)
+
+				_orig = _orig.index_select(0, _inds)
+				step += 1
+				self.ntoken += 1
+
+				_done = False
+				if length_penalty > 0.0:
+					lpv = lpv.index_select(0, _inds)
+				elif (not return_all) and all_done(done_trans.select(1, 0), bsize):
+					_done = True
+
+				if _done or all_done(done_trans, real_bsize):
+					_finished = True
+					break
+
+				# scores of the next step are only available if all unfinished hypotheses are extended with proposals
+				if (_spec_step < _nspec) and (not (wds.view(real_bsize).eq(_drafts.select(1, _spec_step).index_select(0, _orig)) | done_trans.view(real_bsize)).all().item()):
+					break
+
+			if _finished:
+				break
+			_npro = max(1, min(self.nspec, step - _step))
+
+			states = index_tensors(narrow_states(_states, step), indices=_orig, dim=0)
+			if dlen > step:
+				dlen = step
+			dstates = index_tensors(narrow_states(dstates, dlen), indices=_orig, dim=0)
+
+		# if length penalty is only applied in the last step, apply length penalty
+		if (not clip_beam) and (length_penalty > 0.0):
+			scores = scores / lpv.view(bsize, beam_size)
+			scores, _inds = scores.topk(beam_size, dim=-1)
+			_inds = (_inds + _inds_add_beam).view(real_bsize)
+			trans = trans.view(real_bsize, -1).index_select(0, _inds)
+
+		if return_all:
+
+			return trans.view(bsize, beam_size, -1), scores
+		else:
+
+			return trans.view(bsize, beam_size, -1).select(1, 0)
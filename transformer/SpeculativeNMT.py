@@ -0,0 +1,43 @@
+#encoding: utf-8
+
+from torch import nn
+
+from transformer.SpeculativeDecoder import Decoder
+
+from cnfg.ihyp import *
+
+class NMT(nn.Module):
+
+	# model: transformer.NMT.NMT with the standard decoder
+	# draft: the draft decoder (transformer.Decoder.Decoder) which reads the representation of model.enc, see tools/distil_draft.py
+	# nspec: number of tokens proposed by the draft decoder in each step
+
+	def __init__(self, model, draft, nspec=4):
+
+		super(NMT, self).__init__()
+
+		self.enc = model.enc
+		self.dec = Decoder(model.dec, draft, nspec=nspec)
+
+	# inpute: source sentences from encoder (bsize, seql)
+	# inputo: decoded translation (bsize, nquery)
+	# mask: user specified mask, otherwise it will be:
+	#	inpute.eq(0).unsqueeze(1)
+
+	def forward(self, inpute, inputo, mask=None):
+
+		_mask = inpute.eq(0).unsqueeze(1) if mask is None else mask
+
+		return self.dec.model(self.enc(inpute, _mask), inputo, _mask)
+
+	# inpute: source sentences from encoder (bsize, seql)
+	# beam_size: the beam size for beam search
+	# max_len: maximum length to generate
+
+	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0):
+
+		mask = inpute.eq(0).unsqueeze(1)
+
+		_max_len = (inpute.size(1) + max(64, inpute.size(1) // 4)) if max_len is None else max_len
+
+		return self.dec.decode(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty)
@@ -2,13 +2,26 @@
 
 import torch
 
+from threading import Thread
+from queue import Queue, Empty
+from concurrent.futures import Future
+from time import time
+from math import sqrt
+from os.path import getmtime
+
 from transformer.NMT import NMT
 from transformer.EnsembleNMT import NMT as Ensemble
+from transformer.Decoder import Decoder
+from transformer.SpeculativeNMT import NMT as SpeculativeNMT
 from parallel.parallelMT import DataParallelMT
 
 from utils.base import *
-from utils.fmt.base import ldvocab, clean_str, reverse_dict, eos_id, clean_liststr_lentok, dict_insert_set, iter_dict_sort
+from utils.fmt.base import ldvocab, clean_str, reverse_dict, eos_id, sos_id, pad_id, clean_list, clean_liststr_lentok, dict_insert_set, iter_dict_sort, get_bsize, map_batch_core, pad_batch
 from utils.fmt.base4torch import parse_cuda_decode
+from utils.shortlist import load_shortlist
+from utils.quant import is_quantized_model, load_model_cpu_quant
+from utils.transcache import TranslationCache
+from utils.bucket import decode_batches, pad_sentences
 
 from utils.fmt.single import batch_padder
 
@@ -44,6 +57,320 @@ def restore(src, tsrc, trs):
 
 	return [data.get(clean_str(line.strip()), line) for line in src]
 
+# continuous batching for translation servers: sentences from all requests are queued and decoded in shared token-budgeted batches by a background thread, a finished sentence is removed from the running batch and waiting sentences take its place in the next decoding step. Results are returned through futures.
+
+class ContinuousBatcher:
+
+	# model: NMT model in evaluation mode, whose decoder shall support masked decoding history (see transformer.Decoder.Decoder.std_self_attn)
+	# vcbi: source vocabulary, vcbt: reversed target vocabulary
+	# bsize, maxtoken: limits on the number of running sentences and on the number of padded source tokens, the same as batch_padder
+	# max_wait: time (in seconds) to wait for more sentences before starting to decode from an empty batch
+	# max_len: maximum length to generate, computed from the source length of each sentence like transformer.NMT.NMT.decode by default
+
+	def __init__(self, model, vcbi, vcbt, beam_size=1, length_penalty=0.0, bsize=64, maxtoken=1536, max_wait=0.01, cuda_device=None, use_amp=False, max_len=None, clip_beam=clip_beam_with_lp):
+
+		self.model, self.vcbi, self.vcbt = model, vcbi, vcbt
+		self.beam_size, self.length_penalty, self.clip_beam = beam_size, length_penalty, clip_beam
+		self.bsize, self.maxtoken, self.max_wait, self.max_len = bsize, maxtoken, max_wait, max_len
+		self.cuda_device, self.use_amp = (cuda_device if cuda_device else None), use_amp
+		if length_penalty > 0.0:
+			self.lpv_base = 6.0 ** length_penalty
+
+		self.queue = Queue()
+		self.pending = None
+		self.reset()
+		self.running = True
+		self.thread = Thread(target=self.loop, daemon=True)
+		self.thread.start()
+
+	# sentence: tokenized (and BPE applied) source sentence
+	# returns a future of the translation
+
+	def submit(self, sentence):
+
+		_ = clean_list(sentence.split())
+		rs = Future()
+		self.queue.put((map_batch_core(_, self.vcbi) if _ else [sos_id, eos_id], rs,))
+
+		return rs
+
+	def __call__(self, sentences_iter, timeout=None):
+
+		return [_.result(timeout=timeout) for _ in [self.submit(sentence) for sentence in sentences_iter]]
+
+	def close(self):
+
+		if self.running:
+			self.running = False
+			self.queue.put(None)
+			self.thread.join()
+
+	def reset(self):
+
+		# per sentence: future, number of decoded tokens and maximum length
+		self.futures, self.nstep, self.maxlen = [], [], []
+		# per sentence: encoder output and source mask
+		self.enc = self.src_mask = None
+		# per beam: encoder output (kept for the cross-attention buffers) and source mask, self-attention states, mask and translations of the decoding history, the last decoded words and length penalties
+		self.inpute = self.rsrc_mask = self.states = self.hmask = self.trans = self.wds = self.lpv = None
+		# per sentence (bsize, beam_size): scores and states of beams
+		self.scores = self.sum_scores = self.done_trans = None
+
+	def loop(self):
+
+		with torch.no_grad(), autocast(enabled=self.use_amp):
+			while self.running:
+				_ = self.queue.get()
+				if _ is None:
+					break
+				self.pending = _
+				try:
+					self.decode()
+				except Exception as e:
+					for _ in self.futures:
+						_.set_exception(e)
+					self.reset()
+					self.model.dec.reset_cross_attn_buffer()
+
+	# collect sentences from the queue that fit into the running batch
+	# timeout: wait at most timeout seconds for filling the batch, do not wait if None
+
+	def fetch(self, timeout=None):
+
+		rs = []
+		nsent = len(self.futures)
+		seql = 0 if self.enc is None else self.enc.size(1)
+		_et = None if timeout is None else (time() + timeout)
+		while True:
+			if self.pending is None:
+				try:
+					_wt = 0.0 if _et is None else (_et - time())
+					self.pending = self.queue.get(timeout=_wt) if _wt > 0.0 else self.queue.get_nowait()
+				except Empty:
+					break
+				if self.pending is None:
+					self.running = False
+					break
+			_seql = max(seql, len(self.pending[0]))
+			if (nsent == 0) or (nsent < get_bsize(_seql, self.maxtoken, self.bsize)):
+				rs.append(self.pending)
+				self.pending = None
+				nsent += 1
+				seql = _seql
+			else:
+				break
+
+		return rs
+
+	def decode(self):
+
+		_new = self.fetch(self.max_wait)
+		while _new or self.futures:
+			if _new:
+				self.join(_new)
+			self.step()
+			_new = self.fetch()
+		self.reset()
+		self.model.dec.reset_cross_attn_buffer()
+
+	# encode newly arrived sentences and add them to the running batch
+
+	def join(self, sents):
+
+		model, beam_size = self.model, self.beam_size
+		self.futures.extend([_[-1] for _ in sents])
+		_ids = [_[0] for _ in sents]
+		_lens = [len(_) for _ in _ids]
+		seql = max(_lens)
+		seq_batch = torch.tensor(pad_batch(_ids, seql), dtype=torch.long, device=self.cuda_device)
+		src_mask = seq_batch.eq(pad_id).unsqueeze(1)
+		enc = model.enc(seq_batch, src_mask)
+		bsize = len(sents)
+		real_bsize = bsize * beam_size
+
+		self.nstep.extend([0 for _ in range(bsize)])
+		self.maxlen.extend([(_l + max(64, _l // 4)) if self.max_len is None else self.max_len for _l in _lens])
+
+		sum_scores = enc.new_full((bsize, beam_size,), -inf_default)
+		sum_scores.select(1, 0).zero_()
+		done_trans = torch.zeros(bsize, beam_size, dtype=torch.bool, device=enc.device)
+		wds = seq_batch.new_full((real_bsize, 1,), sos_id)
+		if self.enc is None:
+			self.enc, self.src_mask = enc, src_mask
+			self.states = {_tmp: (None, None,) for _tmp in range(len(model.dec.nets))}
+			self.hmask = torch.zeros(real_bsize, 0, dtype=torch.bool, device=enc.device)
+			self.trans = wds.new_zeros(real_bsize, 0)
+			self.wds, self.sum_scores, self.scores, self.done_trans = wds, sum_scores, sum_scores, done_trans
+			if self.length_penalty > 0.0:
+				self.lpv = enc.new_ones(real_bsize, 1)
+		else:
+			_seql = max(seql, self.enc.size(1))
+			self.enc = torch.cat((pad_seql(self.enc, _seql, 0.0), pad_seql(enc, _seql, 0.0),), 0)
+			self.src_mask = torch.cat((pad_seql(self.src_mask, _seql, True, dim=-1), pad_seql(src_mask, _seql, True, dim=-1),), 0)
+			# the decoding history of new sentences is padded and masked
+			nhist = self.hmask.size(-1)
+			for _tmp, (_K, _V,) in self.states.items():
+				if _K is not None:
+					_bsize, _nhead, _adim = _K.size()[:3]
+					self.states[_tmp] = (torch.cat((_K, _K.new_zeros(real_bsize, _nhead, _adim, nhist),), 0), torch.cat((_V, _V.new_zeros(real_bsize, _nhead, nhist, _adim),), 0),)
+			self.hmask = torch.cat((self.hmask, self.hmask.new_ones(real_bsize, nhist),), 0)
+			self.trans = torch.cat((self.trans, self.trans.new_zeros(real_bsize, nhist),), 0)
+			self.wds = torch.cat((self.wds, wds,), 0)
+			self.sum_scores = torch.cat((self.sum_scores, sum_scores,), 0)
+			self.scores = torch.cat((self.scores, sum_scores,), 0)
+			self.done_trans = torch.cat((self.done_trans, done_trans,), 0)
+			if self.length_penalty > 0.0:
+				self.lpv = torch.cat((self.lpv, enc.new_ones(real_bsize, 1),), 0)
+
+		# a new tensor is passed as the encoder output so that keys/values of cross-attentions are recomputed in the next step
+		if beam_size > 1:
+			self.inpute, self.rsrc_mask = self.enc.repeat_interleave(beam_size, dim=0), self.src_mask.repeat_interleave(beam_size, dim=0)
+		else:
+			self.inpute, self.rsrc_mask = self.enc, self.src_mask
+
+	# decode one step for all running sentences, and return finished translations
+
+	def step(self):
+
+		dec, beam_size, length_penalty = self.model.dec, self.beam_size, self.length_penalty
+		bsize = len(self.futures)
+		real_bsize = bsize * beam_size
+		beam_size2 = beam_size * beam_size
+		bsizeb2 = bsize * beam_size2
+
+		out = dec.wemb(self.wds)
+		if dec.pemb is not None:
+			_steps = self.nstep if beam_size == 1 else [_s for _s in self.nstep for _ in range(beam_size)]
+			if max(self.nstep) < dec.pemb.num_pos:
+				_pos = dec.pemb.w.index_select(0, torch.as_tensor(_steps, dtype=torch.long, device=out.device))
+			else:
+				_pos = torch.stack([dec.pemb.get_pos(_s) for _s in _steps], 0)
+			out = _pos.unsqueeze(1).add(out, alpha=sqrt(out.size(-1)))
+		if dec.drop is not None:
+			out = dec.drop(out)
+
+		self.hmask = torch.cat((self.hmask, self.hmask.new_zeros(real_bsize, 1),), -1)
+		_hmask = self.hmask.unsqueeze(1)
+		for _tmp, net in enumerate(dec.nets):
+			out, _state = net(self.inpute, self.states[_tmp], self.rsrc_mask, _hmask, out)
+			self.states[_tmp] = _state
+
+		if dec.out_normer is not None:
+			out = dec.out_normer(out)
+
+		out = dec.lsm(dec.classifier(out)).view(bsize, beam_size, -1)
+
+		# the same as transformer.Decoder.Decoder.beam_decode except that sentences are at different steps, the first step of new sentences is taken from the first beam with scores of other beams initialized to -inf.
+
+		_scores, _wds = out.topk(beam_size, dim=-1)
+		done_trans = self.done_trans
+		_done_trans_unsqueeze = done_trans.unsqueeze(2)
+		_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + self.sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
+
+		if length_penalty > 0.0:
+			lpv = torch.where(done_trans.view(real_bsize, 1), self.lpv, ((torch.as_tensor(self.nstep, dtype=out.dtype, device=out.device) + 6.0) ** length_penalty / self.lpv_base).repeat_interleave(beam_size).unsqueeze(1))
+
+		_inds_add_beam2 = torch.arange(0, bsizeb2, beam_size2, dtype=_wds.dtype, device=_wds.device).unsqueeze(1).expand(bsize, beam_size)
+		if self.clip_beam and (length_penalty > 0.0):
+			scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
+			_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+			sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
+		else:
+			scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
+			_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+			sum_scores = scores
+
+		wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
+		if beam_size > 1:
+			_inds = (_inds // beam_size + torch.arange(0, real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand(bsize, beam_size)).view(real_bsize)
+			self.trans = torch.cat((self.trans.index_select(0, _inds), wds,), 1)
+			done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(eos_id).squeeze(1)).view(bsize, beam_size)
+			if length_penalty > 0.0:
+				lpv = lpv.index_select(0, _inds)
+			self.states = index_tensors(self.states, indices=_inds, dim=0)
+		else:
+			self.trans = torch.cat((self.trans, wds,), 1)
+			done_trans = done_trans | wds.eq(eos_id)
+		self.wds, self.scores, self.sum_scores, self.done_trans = wds, scores, sum_scores, done_trans
+		if length_penalty > 0.0:
+			self.lpv = lpv
+
+		if (length_penalty > 0.0) or (beam_size == 1):
+			_done_trans_u = done_trans.all(1)
+		else:
+			_done_trans_u = done_trans.select(1, 0)
+
+		self.nstep = [_ + 1 for _ in self.nstep]
+		_keep = []
+		_done = []
+		for _iu, (_d, _s, _m,) in enumerate(zip(_done_trans_u.tolist(), self.nstep, self.maxlen)):
+			(_done if _d or (_s >= _m) else _keep).append(_iu)
+		if _done:
+			self.finish(_done)
+			self.remove(_keep)
+
+	# set results of finished sentences
+
+	def finish(self, dind):
+
+		beam_size = self.beam_size
+		_dind = torch.as_tensor(dind, dtype=torch.long, device=self.trans.device)
+		if beam_size > 1:
+			if (not self.clip_beam) and (self.length_penalty > 0.0):
+				_sind = (self.scores.index_select(0, _dind) / self.lpv.view(-1, beam_size).index_select(0, _dind)).topk(1, dim=-1)[-1].squeeze(-1)
+			else:
+				_sind = 0
+			_trans = self.trans.index_select(0, _dind * beam_size + _sind)
+		else:
+			_trans = self.trans.index_select(0, _dind)
+		nhist = _trans.size(-1)
+		for _iu, _tran in zip(dind, _trans.tolist()):
+			tmp = []
+			for tmpu in _tran[nhist - self.nstep[_iu]:]:
+				if tmpu == eos_id:
+					break
+				else:
+					tmp.append(self.vcbt[tmpu])
+			self.futures[_iu].set_result(" ".join(tmp))
+
+	# remove finished sentences from the running batch
+	# kind: indices of remaining sentences
+
+	def remove(self, kind):
+
+		if kind:
+			beam_size = self.beam_size
+			self.futures, self.nstep, self.maxlen = [self.futures[_] for _ in kind], [self.nstep[_] for _ in kind], [self.maxlen[_] for _ in kind]
+			_kind = torch.as_tensor(kind, dtype=torch.long, device=self.trans.device)
+			_kind_beam = (_kind.unsqueeze(1) * beam_size + torch.arange(beam_size, dtype=_kind.dtype, device=_kind.device)).view(-1) if beam_size > 1 else _kind
+			self.enc, self.src_mask = self.enc.index_select(0, _kind), self.src_mask.index_select(0, _kind)
+			self.model.dec.index_cross_attn_buffer(_kind_beam)
+			self.rsrc_mask = self.rsrc_mask.index_select(0, _kind_beam)
+			self.scores, self.sum_scores, self.done_trans = self.scores.index_select(0, _kind), self.sum_scores.index_select(0, _kind), self.done_trans.index_select(0, _kind)
+			self.wds, self.hmask, self.trans = self.wds.index_select(0, _kind_beam), self.hmask.index_select(0, _kind_beam), self.trans.index_select(0, _kind_beam)
+			self.states = index_tensors(self.states, indices=_kind_beam, dim=0)
+			if self.length_penalty > 0.0:
+				self.lpv = self.lpv.index_select(0, _kind_beam)
+			# drop the decoding history which is padding for all remaining sentences
+			nhist = self.hmask.size(-1)
+			_ncut = nhist - max(self.nstep)
+			if _ncut > 0:
+				_nkeep = nhist - _ncut
+				self.hmask, self.trans = self.hmask.narrow(-1, _ncut, _nkeep), self.trans.narrow(-1, _ncut, _nkeep)
+				self.states = {_tmp: (_K.narrow(-1, _ncut, _nkeep), _V.narrow(2, _ncut, _nkeep),) for _tmp, (_K, _V,) in self.states.items()}
+		else:
+			self.reset()
+
+def pad_seql(x, seql, value, dim=1):
+
+	_seql = x.size(dim)
+	if _seql < seql:
+		_size = list(x.size())
+		_size[dim] = seql - _seql
+		return torch.cat((x, x.new_full(_size, value),), dim)
+
+	return x
+
 class TranslatorCore:
 
 	def __init__(self, modelfs, fvocab_i, fvocab_t, cnfg, minbsize=1, expand_for_mulgpu=True, bsize=64, maxpad=16, maxpart=4, maxtoken=1536, minfreq = False, vsize = False):
@@ -58,6 +385,7 @@ class TranslatorCore:
 		else:
 			self.bsize = bsize
 			self.maxtoken = maxtoken
+		self.max_decode_tokens = None if max_decode_tokens is None else (max_decode_tokens * minbsize if expand_for_mulgpu else max_decode_tokens)
 		self.maxpad = maxpad
 		self.maxpart = maxpart
 		self.minbsize = minbsize
@@ -67,8 +395,7 @@ class TranslatorCore:
 			for modelf in modelfs:
 				tmp = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
 
-				tmp = load_model_cpu(modelf, tmp)
-				tmp.apply(load_fixing)
+				tmp = load_model_cpu_quant(modelf, tmp, quantize=cnfg.quant_decoding, fix_func=load_fixing)
 
 				models.append(tmp)
 			model = Ensemble(models)
@@ -76,12 +403,23 @@ class TranslatorCore:
 		else:
 			model = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
 
-			model = load_model_cpu(modelfs, model)
-			model.apply(load_fixing)
+			model = load_model_cpu_quant(modelfs, model, quantize=cnfg.quant_decoding, fix_func=load_fixing)
+
+			# continuous batching decodes with the model itself
+			if (cnfg.draft_model_file is not None) and (not cnfg.continuous_batching):
+				draft = Decoder(cnfg.isize, nwordt, cnfg.draft_nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, None, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+				draft = load_model_cpu(cnfg.draft_model_file, draft)
+				draft.apply(load_fixing)
+				model = SpeculativeNMT(model, draft, nspec=cnfg.speculative_ntoken)
 
 		model.eval()
+		# checked before the model is wrapped by DataParallelMT, clip decoding and shortlists are only supported by a single standard model
+		speculative_decoding = isinstance(model, SpeculativeNMT)
+		ensemble_decoding = isinstance(model, Ensemble)
+		# quantized models only run on CPU
+		quantized = is_quantized_model(model)
 
-		self.use_cuda, self.cuda_device, cuda_devices, self.multi_gpu = parse_cuda_decode(cnfg.use_cuda, cnfg.gpuid, cnfg.multi_gpu_decoding)
+		self.use_cuda, self.cuda_device, cuda_devices, self.multi_gpu = parse_cuda_decode(cnfg.use_cuda and not quantized, cnfg.gpuid, cnfg.multi_gpu_decoding and not quantized)
 
 		if self.use_cuda:
 			model.to(self.cuda_device)
@@ -90,16 +428,59 @@ class TranslatorCore:
 		self.use_amp = cnfg.use_amp and self.use_cuda
 		self.beam_size = cnfg.beam_size
 		self.length_penalty = cnfg.length_penalty
+		self.clip_decoding = cnfg.clip_decoding
+		# shortlists are only supported by a single model
+		shortlist = None if (cnfg.shortlist_file is None) or isinstance(modelfs, (list, tuple,)) else load_shortlist(cnfg.shortlist_file)
+		if (shortlist is not None) and self.use_cuda:
+			shortlist.to(self.cuda_device)
+		self.decode_kwargs = {} if speculative_decoding or ensemble_decoding else ({"clip": self.clip_decoding} if shortlist is None else {"clip": self.clip_decoding, "shortlist": shortlist})
 		self.net = model
+		# continuous batching is only supported by a single standard NMT model on one device
+		self.batcher = ContinuousBatcher(model, self.vcbi, self.vcbt, beam_size=self.beam_size, length_penalty=self.length_penalty, bsize=self.bsize, maxtoken=self.maxtoken, max_wait=cnfg.batching_max_wait, cuda_device=self.cuda_device, use_amp=self.use_amp) if cnfg.continuous_batching and isinstance(model, NMT) and model.dec.std_self_attn() else None
+		# keys of cached translations include model files (with their modification time) and decoding settings which affect translations, max_decode_tokens re-batches sentences which changes their maximum decoding length
+		if cnfg.translation_cache_size > 0:
+			_model_id = ",".join("%s@%d" % (_, int(getmtime(_)),) for _ in (modelfs if isinstance(modelfs, (list, tuple,)) else [modelfs]))
+			self.cache = TranslationCache(size=cnfg.translation_cache_size, ttl=cnfg.translation_cache_ttl, fname=cnfg.translation_cache_file, prefix="%s\t%d\t%s\t%s\t%s\t%s" % (_model_id, self.beam_size, repr(self.length_penalty), cnfg.shortlist_file, cnfg.quant_decoding, self.max_decode_tokens,))
+		else:
+			self.cache = None
+
+	# only sentences missed by the translation cache are decoded
 
 	def __call__(self, sentences_iter):
+
+		if self.cache is None:
+			return self.translate(sentences_iter)
+
+		_sentences = [clean_str(_.strip()) for _ in sentences_iter]
+		rs = self.cache.get_many(_sentences)
+		_miss = [_s for _s, _t in zip(_sentences, rs) if _t is None]
+		if _miss:
+			_trans = self.translate(_miss)
+			_iter = iter(_trans)
+			rs = [next(_iter) if _t is None else _t for _t in rs]
+			self.cache.put_many(_miss, _trans)
+
+		return rs
+
+	def cache_stats(self):
+
+		return None if self.cache is None else self.cache.stats()
+
+	def translate(self, sentences_iter):
+
+		if self.batcher is not None:
+			return self.batcher(sentences_iter)
+
+		if self.max_decode_tokens is not None:
+			return self.translate_sorted(sentences_iter)
+
 		rs = []
 		with torch.no_grad():
 			for seq_batch in data_loader(sentences_iter, self.vcbi, self.minbsize, self.bsize, self.maxpad, self.maxpart, self.maxtoken):
 				if self.use_cuda:
 					seq_batch = seq_batch.to(self.cuda_device)
 				with autocast(enabled=self.use_amp):
-					output = self.net.decode(seq_batch, self.beam_size, None, self.length_penalty)
+					output = self.net.decode(seq_batch, self.beam_size, None, self.length_penalty, **self.decode_kwargs)
 				if self.multi_gpu:
 					tmp = []
 					for ou in output:
@@ -118,6 +499,43 @@ class TranslatorCore:
 				seq_batch = None
 		return rs
 
+	# sentences are sorted by length and decoded in batches with the decoding memory budget (utils.bucket.decode_batches), translations are returned in the original order.
+
+	def translate_sorted(self, sentences_iter):
+
+		src = []
+		for sentence in sentences_iter:
+			_ = clean_list(sentence.split())
+			src.append(map_batch_core(_, self.vcbi) if _ else [sos_id, eos_id])
+		rs = [None for _ in range(len(src))]
+		if not src:
+			return rs
+		with torch.no_grad():
+			for ind in decode_batches([len(_) for _ in src], beam_size=self.beam_size, maxtoken=self.max_decode_tokens, bsize=self.bsize, minbsize=self.minbsize):
+				seq_batch = torch.from_numpy(pad_sentences(src, ind)).long()
+				if self.use_cuda:
+					seq_batch = seq_batch.to(self.cuda_device)
+				with autocast(enabled=self.use_amp):
+					output = self.net.decode(seq_batch, self.beam_size, None, self.length_penalty, **self.decode_kwargs)
+				if self.multi_gpu:
+					tmp = []
+					for ou in output:
+						tmp.extend(ou.tolist())
+					output = tmp
+				else:
+					output = output.tolist()
+				for _i, tran in zip(ind.tolist(), output):
+					tmp = []
+					for tmpu in tran:
+						if tmpu == eos_id:
+							break
+						else:
+							tmp.append(self.vcbt[tmpu])
+					rs[_i] = " ".join(tmp)
+				seq_batch = None
+
+		return rs
+
 class Translator:
 
 	def __init__(self, trans=None, sent_split=None, tok=None, detok=None, bpe=None, debpe=None, punc_norm=None, truecaser=None, detruecaser=None):
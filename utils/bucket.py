@@ -0,0 +1,168 @@
+#encoding: utf-8
+
+# Online token-budget bucketing: sentences of a per-sentence index (e.g. a flat token store, see utils/mmdata.py) are grouped into buckets of similar lengths, randomly ordered within buckets, and packed into batches of at most maxtoken padded tokens every epoch, so that the composition of batches changes from epoch to epoch without preprocessing the data again. For decoding, sentences of test sets are sorted by length and packed into batches with an estimated decoding memory which accounts for the beam size and the maximum decoding length (decode_batches).
+
+import numpy
+
+from cnfg.vocab.base import pad_id
+
+from cnfg.ihyp import *
+
+class BucketSampler:
+
+	# lsrc, ltgt: numpy arrays of source and target lengths (ltgt is optional)
+	# maxtoken: maximum number of padded (source + target) tokens per batch
+	# bsize: maximum number of sentences per batch
+	# minbsize: minimum number of sentences per batch, i.e. the number of GPUs used by DataParallelMT, the packing of a batch never stops before it is reached
+	# width: width of length buckets, sentences whose lengths differ less than width are shuffled together
+	# seed: random seed, the random state of numpy is used if None
+
+	def __init__(self, lsrc, ltgt=None, maxtoken=max_tokens_gpu, bsize=max_sentences_gpu, minbsize=1, width=bucket_width, seed=None):
+
+		self.lsrc = numpy.asarray(lsrc, dtype=numpy.int64)
+		self.ltgt = None if ltgt is None else numpy.asarray(ltgt, dtype=numpy.int64)
+		self.lens = self.lsrc if self.ltgt is None else (self.lsrc + self.ltgt)
+		self.maxtoken, self.bsize, self.minbsize, self.width = maxtoken, max(bsize, minbsize), minbsize, max(width, 1)
+		self.rand = numpy.random if seed is None else numpy.random.RandomState(seed)
+		self.efficiency = None
+
+	def __len__(self):
+
+		return len(self.lens)
+
+	# shuffle sentences within buckets, pack them into batches and shuffle the order of batches. Returns a list of numpy arrays of sentence indexes, the padding efficiency (real tokens / padded tokens) of the generated batches is kept in self.efficiency.
+
+	def generate(self):
+
+		_ind = self.rand.permutation(len(self.lens))
+		_ind = _ind[numpy.argsort(self.lens[_ind] // self.width, kind="stable")]
+		rs = self.pack(_ind)
+		self.rand.shuffle(rs)
+
+		return rs
+
+	def pack(self, ind):
+
+		_ls = self.lsrc[ind].tolist()
+		_lt = None if self.ltgt is None else self.ltgt[ind].tolist()
+		rs = []
+		_pad = 0
+		_sid = nd = mlen_s = mlen_t = 0
+		for i, _s in enumerate(_ls):
+			_t = 0 if _lt is None else _lt[i]
+			_mls, _mlt = max(mlen_s, _s), max(mlen_t, _t)
+			if (nd < self.minbsize) or ((nd < self.bsize) and ((nd + 1) * (_mls + _mlt) <= self.maxtoken)):
+				mlen_s, mlen_t = _mls, _mlt
+				nd += 1
+			else:
+				rs.append(ind[_sid:i])
+				_last_pad = nd * (mlen_s + mlen_t)
+				_pad += _last_pad
+				_sid, nd, mlen_s, mlen_t = i, 1, _s, _t
+		if nd > 0:
+			# the last batch is merged into the previous one if it has fewer than minbsize sentences
+			if (nd < self.minbsize) and rs:
+				_b = rs.pop()
+				_pad -= _last_pad
+				_sid -= len(_b)
+				nd += len(_b)
+				mlen_s = max(mlen_s, int(self.lsrc[_b].max()))
+				if self.ltgt is not None:
+					mlen_t = max(mlen_t, int(self.ltgt[_b].max()))
+			rs.append(ind[_sid:])
+			_pad += nd * (mlen_s + mlen_t)
+		self.efficiency = float(self.lens.sum()) / float(max(_pad, 1))
+
+		return rs
+
+# the padding efficiency of batches given as sentence offsets (bounds) of a sorted corpus, e.g. batches decided at preprocessing.
+
+def padding_efficiency(bounds, lsrc, ltgt=None):
+
+	_real = _pad = 0
+	for _sid, _eid in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+		_ls = lsrc[_sid:_eid]
+		_pad += (_eid - _sid) * int(_ls.max())
+		_real += int(_ls.sum())
+		if ltgt is not None:
+			_lt = ltgt[_sid:_eid]
+			_pad += (_eid - _sid) * int(_lt.max())
+			_real += int(_lt.sum())
+
+	return float(_real) / float(max(_pad, 1))
+
+# estimated decoding memory (in tokens) of nd sentences padded to source length lsrc: each of the beam_size hypotheses of a sentence keeps the source representation (and extra inputs of length lext attended by the decoder, e.g. the machine translation of APE) and the decoding history of at most max_len tokens, where max_len follows the heuristic of NMT.decode if not given.
+
+def decode_cost(nd, lsrc, beam_size=1, max_len=None, lext=0):
+
+	return nd * beam_size * (lsrc + lext + ((lsrc + max(64, lsrc // 4)) if max_len is None else max_len))
+
+# sort sentences by length (the longest first, so that running out of memory happens at the beginning) and pack them into batches with an estimated decoding memory (decode_cost) of at most maxtoken. Sentences of different groups (e.g. tasks of multilingual models) are not put into the same batch. Returns a list of numpy arrays of sentence indexes.
+# lsrc: source lengths (with <sos> and <eos>)
+# lext: lengths of extra inputs attended by the decoder, optional
+# groups: group ids of sentences, optional
+
+def decode_batches(lsrc, beam_size=1, maxtoken=max_tokens_gpu * 16, bsize=max_sentences_gpu, minbsize=1, max_len=None, lext=None, groups=None):
+
+	_ls = numpy.asarray(lsrc, dtype=numpy.int64)
+	_le = numpy.zeros_like(_ls) if lext is None else numpy.asarray(lext, dtype=numpy.int64)
+	_ind = numpy.argsort(-_ls, kind="stable")
+	if groups is not None:
+		_g = numpy.asarray(groups)
+		_ind = _ind[numpy.argsort(_g[_ind], kind="stable")]
+		_g = _g[_ind].tolist()
+	_bsize = max(bsize, minbsize)
+	rs = []
+	_sid = nd = mlen_s = mlen_e = 0
+	for i, (_s, _e,) in enumerate(zip(_ls[_ind].tolist(), _le[_ind].tolist())):
+		_mls, _mle = max(mlen_s, _s), max(mlen_e, _e)
+		if (nd == 0) or (((groups is None) or (_g[i] == _g[_sid])) and ((nd < minbsize) or ((nd < _bsize) and (decode_cost(nd + 1, _mls, beam_size=beam_size, max_len=max_len, lext=_mle) <= maxtoken)))):
+			mlen_s, mlen_e = _mls, _mle
+			nd += 1
+		else:
+			rs.append(_ind[_sid:i])
+			_sid, nd, mlen_s, mlen_e = i, 1, _s, _e
+	if nd > 0:
+		rs.append(_ind[_sid:])
+
+	return rs
+
+# unpadded sentences (numpy arrays of token ids) of a field of data opened by utils.mmdata.open_data, in their stored order, and the sentence offsets of stored batches (number of batches + 1).
+# ndata: number of batches, td["ndata"] is used if None
+
+def load_sentences(td, field="src", ndata=None, pad_id=pad_id):
+
+	_grp = td[field]
+	if hasattr(_grp, "off"):
+		_off = _grp.off.tolist()
+		rs = [_grp.tok[_s:_e] for _s, _e in zip(_off[:-1], _off[1:])]
+		bounds = numpy.asarray(_grp.bounds, dtype=numpy.int64)
+	else:
+		rs, bounds = [], [0]
+		for i in range(td["ndata"][()].item() if ndata is None else ndata):
+			_b = _grp[str(i)][()]
+			rs.extend(_bu[:_l] for _bu, _l in zip(_b, (_b != pad_id).sum(-1).tolist()))
+			bounds.append(len(rs))
+		bounds = numpy.array(bounds, dtype=numpy.int64)
+
+	return rs, bounds
+
+# pad sentences selected by ind into a numpy array.
+
+def pad_sentences(sents, ind, pad_id=pad_id):
+
+	_sents = [sents[_] for _ in ind.tolist()]
+	_lens = [len(_) for _ in _sents]
+	rs = numpy.full((len(_sents), max(_lens),), pad_id, dtype=numpy.int32)
+	for _i, (_s, _l,) in enumerate(zip(_sents, _lens)):
+		rs[_i, :_l] = _s
+
+	return rs
+
+# batches of sentence indexes from sentence offsets of stored batches.
+
+def bounds_batches(bounds):
+
+	_b = bounds.tolist()
+
+	return [numpy.arange(_s, _e) for _s, _e in zip(_b[:-1], _b[1:])]
@@ -0,0 +1,132 @@
+#encoding: utf-8
+
+# Non-blocking checkpointing: parameters and training states are copied into reusable host buffers (pinned for tensors on GPU) at a step boundary, then a background writer serializes the snapshot to temporary files and atomically renames them to their destinations, so that training only stalls for the copy and a checkpoint file is either the previous or the new complete one. At most one save is in flight, a new save waits for the previous one before overwriting the host buffers.
+
+import torch
+from os import remove, replace
+from os.path import exists as fs_check
+from threading import Thread
+from time import time
+
+from utils.base import SaveModelCleaner
+from utils.h5serial import h5save
+
+from cnfg.ihyp import h5modelwargs
+
+def copy_tensor_to_host(src, buf=None):
+
+	if isinstance(buf, torch.Tensor) and (buf.size() == src.size()) and (buf.dtype == src.dtype):
+		rs = buf
+	else:
+		rs = torch.empty(src.size(), dtype=src.dtype, device="cpu", pin_memory=src.is_cuda)
+	rs.copy_(src.detach(), non_blocking=src.is_cuda)
+
+	return rs
+
+# copy tensors in nested dicts/lists/tuples to host memory, reusing tensors at the same positions of buf (the snapshot returned by the previous call), other values are shallow copied
+def snapshot_to_host(obj, buf=None):
+
+	if isinstance(obj, torch.Tensor):
+		return copy_tensor_to_host(obj, buf)
+	elif isinstance(obj, dict):
+		_buf = buf if isinstance(buf, dict) else {}
+		return {k: snapshot_to_host(v, _buf.get(k, None)) for k, v in obj.items()}
+	elif isinstance(obj, (list, tuple,)):
+		_buf = buf if isinstance(buf, (list, tuple,)) and (len(buf) == len(obj)) else None
+		rs = [snapshot_to_host(v, None if _buf is None else _buf[i]) for i, v in enumerate(obj)]
+		return rs if isinstance(obj, list) else tuple(rs)
+	else:
+		return obj
+
+def atomic_save(save_func, obj, fname, *args, **kwargs):
+
+	_tmpf = fname + ".tmp"
+	try:
+		save_func(obj, _tmpf, *args, **kwargs)
+		replace(_tmpf, fname)
+	except:
+		if fs_check(_tmpf):
+			remove(_tmpf)
+		raise
+
+class CheckpointManager:
+
+	# model: the trained model
+	# state_holder: utils.state.holder.Holder of training states (optimizer, lr scheduler, random states), None to save the model only
+	# sub_module: save model.module (for DataParallelMT)
+	# print_func: logging function for stall time and errors
+	# use_thread: serialize snapshots in a background thread, otherwise in the calling thread
+	# save_model: False for processes of distributed training other than rank 0, which only save their own training states
+
+	def __init__(self, model, state_holder=None, sub_module=False, print_func=print, h5args=h5modelwargs, use_thread=True, save_model=True):
+
+		self.model, self.state_holder, self.print_func, self.h5args, self.use_thread, self.save_model = model.module if sub_module else model, state_holder, print_func, h5args, use_thread, save_model
+		self.use_cuda = any(_.is_cuda for _ in self.model.parameters())
+		# rotation of saved models with the same type (cnfg.save_auto_clean) happens after the new model is written
+		self.cleaner = SaveModelCleaner()
+		self.para_buf = self.states_buf = None
+		self.worker = None
+		self.nsave = 0
+		self.stall_time = self.write_time = 0.0
+
+	# fname: file to save the model into
+	# mtyp: type of the model for rotation, None to keep the file
+	# statesf: file to save training states into, None to skip
+	# kwargs: additional training states (remain_steps, checkpoint_id, etc.)
+
+	def save(self, fname, mtyp=None, statesf=None, **kwargs):
+
+		_st = time()
+		self.wait()
+		_wait_time = time() - _st
+		with torch.no_grad():
+			if self.save_model:
+				self.para_buf = snapshot_to_host([_.data for _ in self.model.parameters()], self.para_buf)
+			if (statesf is not None) and (self.state_holder is not None):
+				self.states_buf = snapshot_to_host(self.state_holder.state_dict(update=False, **kwargs), self.states_buf)
+				_states = self.states_buf
+			else:
+				_states = None
+		if self.use_cuda:
+			torch.cuda.synchronize()
+		_stall_time = time() - _st
+		self.stall_time += _stall_time
+		self.nsave += 1
+		if self.print_func is not None:
+			self.print_func("Checkpoint %s: training stalled %.3f s (waited %.3f s for the previous save)" % (fname, _stall_time, _wait_time,))
+		_paras = self.para_buf if self.save_model else None
+		if self.use_thread:
+			self.worker = Thread(target=self.write, args=(_paras, fname, mtyp, _states, statesf,))
+			self.worker.start()
+		else:
+			self.write(_paras, fname, mtyp, _states, statesf)
+
+	def write(self, paras, fname, mtyp, states, statesf):
+
+		_st = time()
+		try:
+			if paras is not None:
+				atomic_save(h5save, paras, fname, h5args=self.h5args)
+				if mtyp is not None:
+					self.cleaner(fname, mtyp)
+			if states is not None:
+				atomic_save(torch.save, states, statesf)
+		except Exception as e:
+			if self.print_func is not None:
+				self.print_func(str(e))
+		self.write_time += time() - _st
+
+	def wait(self):
+
+		if self.worker is not None:
+			self.worker.join()
+			self.worker = None
+
+	def report(self):
+
+		return "Checkpoints: %d saved, training stalled %.2f s, written in %.2f s" % (self.nsave, self.stall_time, self.write_time,)
+
+	def close(self):
+
+		self.wait()
+		self.para_buf = self.states_buf = None
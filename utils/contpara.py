@@ -105,8 +105,8 @@ def get_contiguous_parameters_m(model, index=0):
 	if is_model_contiguous_parameters(model):
 		return [model._contiguous_parameters[index]]
 	else:
-		_contiguous_parameters = ContiguousParams(parameters=model.parameters()).parameters()
-		model._contiguous_parameters = list(_contiguous_parameters)
+		_contiguous_parameters = list(ContiguousParams(parameters=model.parameters()).parameters())
+		model._contiguous_parameters = _contiguous_parameters
 	return _contiguous_parameters
 
 def get_contiguous_parameters_p(parameters, model=None):
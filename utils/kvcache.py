@@ -0,0 +1,89 @@
+#encoding: utf-8
+
+import torch
+
+# Preallocated self-attention key/value cache for incremental decoding. Keys and values of all layers are kept in one tensor of size (bsize, num_layer, 2, num_head, max_len, attn_dim) which is written in place step by step, reordering beams is a single gather over the filled part of it instead of concatenating and re-indexing a dict of per-layer tuples.
+
+class KVCache:
+
+	# num_layer: number of decoder layers
+	# bsize: number of rows to allocate, bsize * beam_size for beam search
+	# max_len: maximum number of decoding steps
+	# nrow: number of rows in use at the beginning, bsize for the first step of beam search
+
+	def __init__(self, num_layer, bsize, max_len, nrow=None):
+
+		self.num_layer, self.bsize, self.max_len = num_layer, bsize, max_len
+		self.nrow = bsize if nrow is None else nrow
+		self.cache = self.buf = None
+		self.nstep = [0 for i in range(num_layer)]
+		self.layers = [KVCacheLayer(self, i) for i in range(num_layer)]
+
+	def __getitem__(self, i):
+
+		return self.layers[i]
+
+	def __len__(self):
+
+		return self.num_layer
+
+	def build_cache(self, num_head, attn_dim, dtype=None, device=None):
+
+		self.cache = torch.empty(self.bsize, self.num_layer, 2, num_head, self.max_len, attn_dim, dtype=dtype, device=device)
+
+	# real_iK: (nrow, num_head, attn_dim, nquery)
+	# real_iV: (nrow, num_head, nquery, attn_dim)
+	# return keys (nrow, num_head, attn_dim, seql) and values (nrow, num_head, seql, attn_dim) of all steps as views of the cache
+
+	def update(self, layer_id, real_iK, real_iV):
+
+		if self.cache is None:
+			self.build_cache(real_iV.size(1), real_iV.size(-1), dtype=real_iV.dtype, device=real_iV.device)
+		_lind, nquery = self.nstep[layer_id], real_iV.size(2)
+		_rind = _lind + nquery
+		_cache = self.cache.narrow(0, 0, self.nrow).select(1, layer_id)
+		_k, _v = _cache.unbind(1)
+		_k.narrow(2, _lind, nquery).copy_(real_iK.transpose(2, 3))
+		_v.narrow(2, _lind, nquery).copy_(real_iV)
+		self.nstep[layer_id] = _rind
+
+		return _k.narrow(2, 0, _rind).transpose(2, 3), _v.narrow(2, 0, _rind)
+
+	# gather rows of the filled part of the cache with indices into a second buffer, and swap the two buffers after that.
+
+	def index_select(self, indices):
+
+		if self.cache is not None:
+			if self.buf is None:
+				self.buf = torch.empty_like(self.cache)
+			_nrow, _nstep = indices.numel(), min(self.nstep)
+			torch.index_select(self.cache.narrow(0, 0, self.nrow).narrow(4, 0, _nstep), 0, indices, out=self.buf.narrow(0, 0, _nrow).narrow(4, 0, _nstep))
+			self.cache, self.buf = self.buf, self.cache
+			self.nrow = _nrow
+		else:
+			self.nrow = indices.numel()
+
+		return self
+
+	def expand_bsize_for_beam(self, beam_size):
+
+		return self.index_select(torch.arange(self.nrow, dtype=torch.long, device=None if self.cache is None else self.cache.device).repeat_interleave(beam_size))
+
+	def reset(self):
+
+		self.nstep = [0 for i in range(self.num_layer)]
+		self.nrow = self.bsize
+
+		return self
+
+# passed as the states of a self-attention layer, see modules.base.SelfAttn
+
+class KVCacheLayer:
+
+	def __init__(self, kv_cache, layer_id):
+
+		self.kv_cache, self.layer_id = kv_cache, layer_id
+
+	def __call__(self, real_iK, real_iV):
+
+		return self.kv_cache.update(self.layer_id, real_iK, real_iV)
@@ -0,0 +1,134 @@
+#encoding: utf-8
+
+import torch
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+
+from utils.mmdata import MMapData, open_data
+
+from cnfg.ihyp import data_loader_num_worker, data_loader_prefetch, data_loader_use_process
+
+# Read batches from an HDF5 data file (or a flat token store, see utils/mmdata.py) with a pool of background workers, so that decompression of datasets (gzip by default, see hdf5_data_compression in cnfg/hyp.py) and the conversion to torch.long tensors are moved off the main thread. Batches are yielded in the order of bids, with at most prefetch batches decoded ahead.
+
+class H5BatchLoader:
+
+	# h5f: opened h5py file or its file name
+	# bids: batch ids, e.g. the shuffled list of training batches
+	# keys: format strings of dataset paths in the file, which are filled with each batch id (or elements of it), e.g. ("{1}/src/{0}", "{1}/tgt/{0}",) for (batch id, task id,) of multilingual data
+	# mv_device: device to move batches to, with non_blocking transfers from pinned memory on CUDA devices
+	# num_worker: number of workers, batches are read on the main thread if 0
+	# prefetch: maximum number of batches read ahead
+	# use_process: use processes instead of threads, which avoids the global lock of h5py for decompression at the cost of passing arrays across processes
+
+	def __init__(self, h5f, bids, keys=("src/{}", "tgt/{}",), mv_device=None, num_worker=data_loader_num_worker, prefetch=data_loader_prefetch, use_process=data_loader_use_process, pin_memory=None):
+
+		self.h5f, self.bids, self.keys = h5f, bids, keys
+		self.mv_device = mv_device if mv_device else None
+		self.num_worker, self.prefetch = num_worker, max(prefetch, num_worker, 1)
+		self.use_process = use_process and (num_worker > 0) and ("fork" in get_all_start_methods())
+		self.pin_memory = ((self.mv_device is not None) and (self.mv_device.type == "cuda") and torch.cuda.is_available()) if pin_memory is None else pin_memory
+
+	def __len__(self):
+
+		return len(self.bids)
+
+	def __iter__(self):
+
+		_h5f = open_data(self.h5f, "r") if (isinstance(self.h5f, str) and not self.use_process) else self.h5f
+		try:
+			if self.num_worker > 0:
+				yield from self.iter_worker(_h5f)
+			else:
+				for bid in self.bids:
+					yield bid, self.mv(read_batch(_h5f, self.keys, bid, self.pin_memory))
+		finally:
+			if _h5f is not self.h5f:
+				_h5f.close()
+
+	def mv(self, batch):
+
+		return batch if self.mv_device is None else tuple(_.to(self.mv_device, non_blocking=True) for _ in batch)
+
+	def iter_worker(self, h5f):
+
+		_queue, _stop = Queue(maxsize=self.prefetch), Event()
+		_thread = Thread(target=self.feed, args=(h5f, _queue, _stop,), daemon=True)
+		_thread.start()
+		try:
+			for bid in self.bids:
+				_rs = _queue.get()
+				if isinstance(_rs, Exception):
+					raise _rs
+				yield bid, self.mv(_rs)
+		finally:
+			_stop.set()
+			while _thread.is_alive():
+				try:
+					_queue.get_nowait()
+				except Empty:
+					pass
+				_thread.join(0.01)
+
+	# submit reading requests to the worker pool and keep at most self.prefetch of them in flight, results are put into _queue in order.
+
+	def feed(self, h5f, _queue, _stop):
+
+		if self.use_process:
+			_pool = ProcessPoolExecutor(max_workers=self.num_worker, mp_context=get_context("fork"), initializer=init_process_worker, initargs=(h5f if isinstance(h5f, (str, MMapData,)) else h5f.filename,))
+			_func = partial(read_batch_process, self.keys)
+		else:
+			_pool = ThreadPoolExecutor(max_workers=self.num_worker)
+			_func = partial(read_batch, h5f, self.keys, pin_memory=self.pin_memory)
+		_pending = deque()
+		_bids = iter(self.bids)
+		try:
+			for bid in _bids:
+				_pending.append(_pool.submit(_func, bid))
+				if len(_pending) >= self.prefetch:
+					break
+			while _pending and not _stop.is_set():
+				try:
+					_rs = _pending.popleft().result()
+					if self.use_process:
+						_rs = tuple(torch.from_numpy(_).pin_memory() if self.pin_memory else torch.from_numpy(_) for _ in _rs)
+				except Exception as e:
+					_rs = e
+				for bid in _bids:
+					_pending.append(_pool.submit(_func, bid))
+					break
+				while not _stop.is_set():
+					try:
+						_queue.put(_rs, timeout=0.1)
+						break
+					except Full:
+						pass
+		finally:
+			for _ in _pending:
+				_.cancel()
+			_pool.shutdown(wait=True)
+
+def get_path(key, bid):
+
+	return key.format(*bid) if isinstance(bid, (list, tuple,)) else key.format(bid)
+
+def read_batch(h5f, keys, bid, pin_memory=False):
+
+	return tuple(torch.from_numpy(h5f[get_path(_key, bid)][()]).long().pin_memory() if pin_memory else torch.from_numpy(h5f[get_path(_key, bid)][()]).long() for _key in keys)
+
+_process_h5f = None
+
+# flat token stores are inherited by forked workers, while HDF5 files are opened again by their names.
+
+def init_process_worker(fname):
+
+	global _process_h5f
+
+	_process_h5f = open_data(fname, "r") if isinstance(fname, str) else fname
+
+def read_batch_process(keys, bid):
+
+	return tuple(_process_h5f[get_path(_key, bid)][()].astype("int64", copy=False) for _key in keys)
@@ -0,0 +1,131 @@
+#encoding: utf-8
+
+# Accumulate training/evaluation metrics (loss, token counts, error counts) as tensors on the device where they are computed, so that the training loop does not synchronize with the device for every batch with .item(). Values are transferred to host only when they are read (at report boundaries and the end of epochs).
+
+import torch
+from torch import distributed as dist
+
+class MetricAccumulator:
+
+	# nmetric: number of accumulated metrics
+	# device: device of tensors to be added, None (or False as returned by parse_cuda) for CPU
+
+	def __init__(self, nmetric, device=None, dtype=torch.float64):
+
+		self.sums = torch.zeros(nmetric, dtype=dtype, device=device if device else None)
+		self.metrics = self.sums.unbind(0)
+
+	# inputs: one scalar tensor (or number) for each metric
+
+	def add(self, *inputs):
+
+		with torch.no_grad():
+			for _m, _v in zip(self.metrics, inputs):
+				_m.add_(_v)
+
+	# returns accumulated metrics as a list of floats with one synchronization
+
+	def get(self, reset=True):
+
+		rs = self.sums.tolist()
+		if reset:
+			self.reset()
+
+		return rs
+
+	def reset(self):
+
+		self.sums.zero_()
+
+# Count tokens on device for decisions against a threshold (e.g. tokens_optm), each count is added with a host-side upper bound (e.g. the number of elements of the padded batch), and the device is only synchronized when the bound might reach the threshold, so decisions are the same as with exact counts.
+
+class DeferredCounter:
+
+	def __init__(self, value=0, device=None):
+
+		self.value, self.bound = value, 0
+		self.pending = torch.zeros((), dtype=torch.long, device=device if device else None)
+
+	def add(self, v, bound):
+
+		with torch.no_grad():
+			self.pending.add_(v)
+		self.bound += bound
+
+	def ge(self, threshold):
+
+		if (self.value + self.bound) >= threshold:
+			self.sync()
+
+		return self.value >= threshold
+
+	def sync(self):
+
+		if self.bound > 0:
+			self.value += self.pending.item()
+			self.pending.zero_()
+			self.bound = 0
+
+		return self.value
+
+	def get(self):
+
+		return self.sync()
+
+	def reset(self, value=0):
+
+		if self.bound > 0:
+			self.pending.zero_()
+			self.bound = 0
+		self.value = value
+
+# metrics summed over processes of distributed training (parallel/dist.py) when read, reading is a collective operation which all processes have to perform.
+
+class DistMetricAccumulator(MetricAccumulator):
+
+	def __init__(self, nmetric, device=None, dtype=torch.float64, group=None):
+
+		super(DistMetricAccumulator, self).__init__(nmetric, device=device, dtype=dtype)
+		self.group = group
+
+	def get(self, reset=True):
+
+		_sums = self.sums.clone()
+		dist.all_reduce(_sums, group=self.group)
+		rs = _sums.tolist()
+		if reset:
+			self.reset()
+
+		return rs
+
+# counts of all processes of distributed training are summed by all-reduce operations launched when they are added (before the forward pass) and waited for when the threshold is checked (before the backward pass), so that all processes take the same decisions.
+
+class DistDeferredCounter(DeferredCounter):
+
+	def __init__(self, value=0, device=None, group=None):
+
+		super(DistDeferredCounter, self).__init__(value=value, device=device)
+		self.group, self.handles = group, []
+
+	def add(self, v, bound):
+
+		_v = v.detach().to(torch.long, copy=True).view(1)
+		self.handles.append((_v, dist.all_reduce(_v, group=self.group, async_op=True),))
+
+	def ge(self, threshold):
+
+		return self.sync() >= threshold
+
+	def sync(self):
+
+		for _v, _h in self.handles:
+			_h.wait()
+			self.value += _v.item()
+		self.handles.clear()
+
+		return self.value
+
+	def reset(self, value=0):
+
+		self.sync()
+		self.value = value
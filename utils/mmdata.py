@@ -0,0 +1,219 @@
+#encoding: utf-8
+
+# A flat token store is an alternative to the one-dataset-per-batch HDF5 layout created by tools/mkiodata.py. It is a directory that holds:
+#	$field.bin: unpadded sentences (with <sos> and <eos>) of a field (e.g. src, tgt) concatenated as int32 tokens, read through numpy.memmap,
+#	$field.idx.npy: int64 offsets of sentences in $field.bin (number of sentences + 1),
+#	batch.npy: int64 offsets of batches in sentences (number of batches + 1),
+#	nword.npy: vocabulary sizes.
+# Batches are padded when they are read, and can be re-decided from sentence lengths with different batch size settings without preprocessing the data again. MMapData supports the reading interface of h5py files used by training and decoding scripts (td["ndata"][()], td["nword"][()], td["src"][bid][()], td["src/" + bid][()]), and open_data opens either format.
+
+import numpy
+from math import ceil
+from os import makedirs
+from os.path import isdir, join as pjoin, getsize
+
+from utils.fmt.base import get_bsize
+from cnfg.vocab.base import pad_id
+
+from cnfg.ihyp import *
+
+mmdata_batch_file = "batch.npy"
+mmdata_nword_file = "nword.npy"
+
+def open_data(fname, mode="r", **kwargs):
+
+	if isdir(fname):
+		return MMapData(fname, **kwargs)
+	else:
+		from utils.h5serial import h5File
+		return h5File(fname, mode)
+
+def is_mmdata(fname):
+
+	return not fname.endswith(".h5")
+
+class MMapField:
+
+	def __init__(self, tok, off, bounds, pad_id=pad_id):
+
+		self.tok, self.off, self.bounds, self.pad_id = tok, off, bounds, pad_id
+		self.batches = None
+
+	def __len__(self):
+
+		return len(self.bounds) - 1 if self.batches is None else len(self.batches)
+
+	def __getitem__(self, bid):
+
+		_bid = int(bid)
+		if self.batches is None:
+			_sid, _eid = self.bounds[_bid], self.bounds[_bid + 1]
+			_off = self.off[_sid:_eid + 1]
+			_lens = _off[1:] - _off[:-1]
+			_mlen = _lens.max()
+			rs = numpy.full((_eid - _sid, _mlen,), self.pad_id, dtype=numpy.int32)
+			rs[numpy.arange(_mlen) < _lens[:, None]] = self.tok[_off[0]:_off[-1]]
+		else:
+			_ind = self.batches[_bid]
+			_sind, _eind = self.off[_ind], self.off[_ind + 1]
+			_lens = _eind - _sind
+			rs = numpy.full((len(_ind), _lens.max(),), self.pad_id, dtype=numpy.int32)
+			for _i, (_s, _e, _l,) in enumerate(zip(_sind.tolist(), _eind.tolist(), _lens.tolist())):
+				rs[_i, :_l] = self.tok[_s:_e]
+
+		return rs
+
+class MMapData:
+
+	# fname: directory of the flat token store
+	# rebatch: re-decide batches with bsize, maxpad, maxpart and maxtoken, instead of using batches decided at preprocessing
+	# minbsize: minimum number of sentences per batch, the number of GPUs used for training, bsize and maxtoken are scaled with it like tools/mkiodata.py
+
+	def __init__(self, fname, rebatch=False, minbsize=1, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu):
+
+		self.filename = fname
+		self.nword = numpy.load(pjoin(fname, mmdata_nword_file))
+		self.fields = {}
+		_offs = {}
+		for _field in load_fields(fname):
+			_tokf = pjoin(fname, "%s.bin" % _field)
+			_offs[_field] = numpy.load(pjoin(fname, "%s.idx.npy" % _field), mmap_mode="r")
+			self.fields[_field] = numpy.memmap(_tokf, dtype=numpy.int32, mode="r") if getsize(_tokf) > 0 else numpy.zeros(0, dtype=numpy.int32)
+		if rebatch:
+			_lens = [_offs[_field][1:] - _offs[_field][:-1] for _field in ("src", "tgt",) if _field in _offs]
+			self.bounds = numpy.array(list(batch_bounds(*_lens, bsize=bsize * minbsize, maxpad=maxpad, maxpart=maxpart, maxtoken=maxtoken * minbsize, minbsize=minbsize)), dtype=numpy.int64)
+		else:
+			self.bounds = numpy.load(pjoin(fname, mmdata_batch_file))
+		self.fields = {k: MMapField(v, _offs[k], self.bounds) for k, v in self.fields.items()}
+		self.batches = None
+
+	def __getitem__(self, key):
+
+		if key == "ndata":
+			return numpy.array([len(self.bounds) - 1 if self.batches is None else len(self.batches)], dtype=numpy.int32)
+		elif key == "nword":
+			return self.nword
+		elif key in self.fields:
+			return self.fields[key]
+		else:
+			_field, _bid = key.rsplit("/", 1)
+			return self.fields[_field][_bid]
+
+	# lengths of sentences (with <sos> and <eos>) of a field
+
+	def lens(self, field):
+
+		_off = self.fields[field].off
+
+		return _off[1:] - _off[:-1]
+
+	# use batches of sentence indexes (e.g. generated by utils.bucket.BucketSampler) instead of sentence offsets of batches, None to restore the latter.
+
+	def set_batches(self, batches):
+
+		self.batches = batches
+		for _ in self.fields.values():
+			_.batches = batches
+
+	def __contains__(self, key):
+
+		return key in self.fields or key in ("ndata", "nword",)
+
+	def keys(self):
+
+		return self.fields.keys()
+
+	def close(self):
+
+		self.fields = {}
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *inputs, **kwargs):
+
+		self.close()
+
+def load_fields(fname):
+
+	with open(pjoin(fname, "fields"), "rb") as f:
+		return f.read().decode("utf-8").split()
+
+# write batches to a flat token store, batches are either lists of unpadded sentences or padded 2d arrays whose padding tokens are removed.
+
+class MMapWriter:
+
+	def __init__(self, fname, fields=("src", "tgt",), nword=None):
+
+		self.filename, self.fields, self.nword = fname, fields, nword
+		makedirs(fname, exist_ok=True)
+		self.files = [open(pjoin(fname, "%s.bin" % _field), "wb") for _field in fields]
+		self.offs = [[0] for _ in fields]
+		self.bounds = [0]
+
+	def write(self, *batch):
+
+		for _f, _off, _b in zip(self.files, self.offs, batch):
+			if isinstance(_b, numpy.ndarray):
+				_lens = (_b != pad_id).sum(-1).tolist()
+				_tok = _b[_b != pad_id]
+			else:
+				_lens = [len(_) for _ in _b]
+				_tok = numpy.array([_t for _s in _b for _t in _s], dtype=numpy.int32)
+			_f.write(_tok.astype(numpy.int32, copy=False).tobytes())
+			_cur = _off[-1]
+			for _l in _lens:
+				_cur += _l
+				_off.append(_cur)
+		self.bounds.append(len(self.offs[0]) - 1)
+
+	def close(self):
+
+		for _f in self.files:
+			_f.close()
+		for _field, _off in zip(self.fields, self.offs):
+			numpy.save(pjoin(self.filename, "%s.idx.npy" % _field), numpy.array(_off, dtype=numpy.int64))
+		numpy.save(pjoin(self.filename, mmdata_batch_file), numpy.array(self.bounds, dtype=numpy.int64))
+		numpy.save(pjoin(self.filename, mmdata_nword_file), numpy.array(self.nword, dtype=numpy.int32))
+		with open(pjoin(self.filename, "fields"), "wb") as f:
+			f.write(" ".join(self.fields).encode("utf-8"))
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *inputs, **kwargs):
+
+		self.close()
+
+# yield offsets of batches in sentences following the batching of utils.fmt.dual.batch_loader (with source and target lengths) or utils.fmt.single.batch_loader (with source lengths only), lengths include <sos> and <eos> which are excluded like in text files. Like these loaders, a last batch with fewer than minbsize sentences is kept (unlike utils.bucket.BucketSampler), so that batches of sharded preprocessing (utils/shard.py) and of rebatched flat token stores stay identical to those of the serial run.
+
+def batch_bounds(lsrc, ltgt=None, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minbsize=1, extok=2):
+
+	_f_maxpart = float(maxpart)
+	_single = ltgt is None
+	_lens = (lsrc - extok) if _single else (lsrc + ltgt - extok - extok)
+	yield 0
+	nd = maxlen = minlen = 0
+	for i, lgth in enumerate(_lens.tolist()):
+		if maxlen == 0:
+			maxlen, minlen, _bsize = batch_limits(lgth, _single, bsize, maxpad, _f_maxpart, maxtoken)
+		if (nd < minbsize) or (lgth <= maxlen and lgth >= minlen and nd < _bsize):
+			nd += 1
+		else:
+			yield i
+			maxlen, minlen, _bsize = batch_limits(lgth, _single, bsize, maxpad, _f_maxpart, maxtoken)
+			nd = 1
+	if nd > 0:
+		yield len(_lens)
+
+def batch_limits(lgth, single, bsize, maxpad, maxpart, maxtoken):
+
+	if single:
+		_maxpad = max(1, min(maxpad, ceil(lgth / maxpart)) // 2)
+		maxlen, minlen = lgth + _maxpad, lgth - _maxpad
+	else:
+		maxlen, minlen = lgth + min(maxpad, ceil(lgth / maxpart)), 0
+
+	return maxlen, minlen, get_bsize(maxlen, maxtoken, bsize)
@@ -0,0 +1,86 @@
+#encoding: utf-8
+
+# Post-training dynamic int8 quantization for CPU decoding: weights of all nn.Linear layers (feed-forward networks, attention adaptors including the fused key/value adaptor of cross-attention, the classifier) are quantized to int8 with per-channel scales, and activations are quantized on the fly. The classifier bound to the decoder embedding gets its own int8 copy of the weight, while the embedding stays in fp32.
+# Quantized models are saved in the h5 format of utils.h5serial as {"para": [fp32 parameters], "qlinear": [[int8 weight, scales, zero points, (bias)], ...]} in the order of modules, and loaded into quantized instances of the same model.
+
+import torch
+from torch import nn
+from torch.ao.nn.quantized.dynamic import Linear as QLinear
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+from utils.base import load_model_cpu
+from utils.h5serial import h5File, h5load, h5save
+
+from cnfg.ihyp import *
+
+quant_model_key = "qlinear"
+
+def quantize_model(model, dtype=torch.qint8):
+
+	model.eval()
+
+	return quantize_dynamic(model, qconfig_spec={nn.Linear: per_channel_dynamic_qconfig}, dtype=dtype, inplace=False)
+
+def is_quantized_model(model):
+
+	return any(isinstance(_m, QLinear) for _m in model.modules())
+
+def is_quantized_model_file(fname):
+
+	with h5File(fname, "r") as f:
+		return quant_model_key in f
+
+def qlinear_state(module):
+
+	_w, _b = module._packed_params._weight_bias()
+	if _w.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric,):
+		rs = [_w.int_repr(), _w.q_per_channel_scales(), _w.q_per_channel_zero_points()]
+	else:
+		rs = [_w.int_repr(), torch.as_tensor([_w.q_scale()], dtype=torch.double), torch.as_tensor([_w.q_zero_point()], dtype=torch.long)]
+	if _b is not None:
+		rs.append(_b.detach())
+
+	return rs
+
+def load_qlinear_state(module, state):
+
+	_w, _scales, _zps = state[:3]
+	if _scales.numel() > 1:
+		_qw = torch._make_per_channel_quantized_tensor(_w, _scales.double(), _zps.long(), 0)
+	else:
+		_qw = torch._make_per_tensor_quantized_tensor(_w, _scales.item(), _zps.item())
+	module.set_weight_bias(_qw, state[3] if len(state) > 3 else None)
+
+def save_quantized_model(model, fname, sub_module=False, print_func=print, h5args=h5modelwargs):
+
+	_msave = model.module if sub_module else model
+	try:
+		h5save({"para": [t.data for t in _msave.parameters()], quant_model_key: [qlinear_state(_m) for _m in _msave.modules() if isinstance(_m, QLinear)]}, fname, h5args=h5args)
+	except Exception as e:
+		if print_func is not None:
+			print_func(str(e))
+
+# base_model: a fp32 model of the same configuration, which is quantized before loading
+
+def load_quantized_model(modf, base_model):
+
+	rs = quantize_model(base_model)
+	mpg = h5load(modf)
+	for para, mp in zip(rs.parameters(), mpg["para"]):
+		para.data = mp.data
+	for _m, _s in zip((_m for _m in rs.modules() if isinstance(_m, QLinear)), mpg[quant_model_key]):
+		load_qlinear_state(_m, _s)
+
+	return rs
+
+# load either a fp32 model file (quantized after loading if quantize is True, fix_func is applied before quantization) or a quantized model file into base_model.
+
+def load_model_cpu_quant(modf, base_model, quantize=False, fix_func=None):
+
+	if is_quantized_model_file(modf):
+		return load_quantized_model(modf, base_model)
+	rs = load_model_cpu(modf, base_model)
+	if fix_func is not None:
+		rs.apply(fix_func)
+
+	return quantize_model(rs) if quantize else rs
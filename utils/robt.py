@@ -0,0 +1,178 @@
+#encoding: utf-8
+
+# Asynchronous back-translation for round-trip training (adv/train/mulang/train_mulang_robt.py): a background worker translates upcoming training batches with a copy of the model, which is synchronized with the trained model every sync_steps optimizer steps, so that decoding does not block training steps. The worker is a thread decoding on its own CUDA stream for models on GPU, or a forked process sharing the parameters of the model copy for models on CPU. Batches translated with a model copy synchronized more than max_stale optimizer steps ago are translated again with an up-to-date copy.
+
+import torch
+from torch import multiprocessing as mp
+from threading import Thread, Lock
+from queue import Queue
+from collections import deque
+from copy import deepcopy
+from time import time
+
+class BackTranslator:
+
+	# model: the trained model (the module of DataParallelMT for multi-gpu training)
+	# bt_func: function (model, seq_o, taskid) returning source sentences translated from seq_o, e.g. back_translate of train_mulang_robt.py with other arguments bound
+	# sync_steps: synchronize the model copy every sync_steps optimizer steps
+	# max_stale: maximum number of optimizer steps between the synchronization of the model copy used for a batch and the consumption of the batch
+	# prefetch: maximum number of batches translated ahead
+	# use_process: use a forked process instead of a thread, None to use a process for models on CPU
+
+	def __init__(self, model, bt_func, sync_steps=1, max_stale=8, prefetch=4, use_process=None):
+
+		self.model, self.bt_func = model, bt_func
+		self.sync_steps, self.max_stale, self.prefetch = max(sync_steps, 1), max_stale, max(prefetch, 1)
+		self.use_cuda = next(model.parameters()).is_cuda
+		self.use_process = ((not self.use_cuda) if use_process is None else use_process) and ("fork" in mp.get_all_start_methods())
+		self.net = deepcopy(model)
+		self.net.eval()
+		self.src_tensors, self.tensors = [list(_.parameters()) + list(_.buffers()) for _ in (model, self.net,)]
+		# version (the optimizer step of the last synchronization) of the model copy
+		self.version = torch.zeros(1, dtype=torch.long)
+		# ncall identifies the call which batches are submitted by, translations of batches submitted by previous calls and not consumed are discarded
+		self.nstep = self.ninflight = self.ncall = 0
+		self.sync_event = None
+		self.reset_stats()
+		if self.use_process:
+			self.net.share_memory()
+			self.version.share_memory_()
+			_ctx = mp.get_context("fork")
+			self.lock, self.qin, self.qout = _ctx.Lock(), _ctx.Queue(), _ctx.Queue()
+			self.stream = None
+			self.worker = _ctx.Process(target=self.work, daemon=True)
+		else:
+			self.lock, self.qin, self.qout = Lock(), Queue(), Queue()
+			self.stream = torch.cuda.Stream(device=self.tensors[0].device) if self.use_cuda else None
+			self.worker = Thread(target=self.work, daemon=True)
+		self.worker.start()
+
+	def reset_stats(self):
+
+		self.nbatch = self.nsent = self.nretrans = self.sum_stale = 0
+		self.decode_time = self.wait_time = 0.0
+
+	# loader: iterable of (batch id, (seq_o, ...,)), e.g. H5BatchLoader
+	# task_func: function returning the task id to back-translate into from a batch id
+	# yields (batch id, (seq_o, ...,), back-translated seq_o) in the order of loader
+
+	def __call__(self, loader, task_func):
+
+		self.ncall += 1
+		_ncall = self.ncall
+		_pending = deque()
+		for bid, batch in loader:
+			_taskid = task_func(bid)
+			self.submit(batch[0], _taskid, _ncall)
+			_pending.append((bid, batch, _taskid,))
+			if len(_pending) > self.prefetch:
+				_bid, _batch, _taskid = _pending.popleft()
+				yield _bid, _batch, self.fetch(_batch[0], _taskid, _ncall)
+		while _pending:
+			_bid, _batch, _taskid = _pending.popleft()
+			yield _bid, _batch, self.fetch(_batch[0], _taskid, _ncall)
+
+	def submit(self, seq_o, taskid, ncall):
+
+		if self.use_cuda:
+			_event = torch.cuda.Event()
+			_event.record()
+		else:
+			_event = None
+		self.qin.put((seq_o, taskid, _event, ncall,))
+		self.ninflight += 1
+
+	def fetch(self, seq_o, taskid, ncall):
+
+		_st = time()
+		while True:
+			rs, _ver, _t, _ncall = self.qout.get()
+			self.ninflight -= 1
+			if _ncall == ncall:
+				break
+		self.wait_time += time() - _st
+		if isinstance(rs, Exception):
+			raise rs
+		_stale = self.nstep - _ver
+		if _stale > self.max_stale:
+			self.sync()
+			with self.lock:
+				_st = time()
+				rs = self.bt_func(self.net, seq_o, taskid)
+				_t = time() - _st
+			_stale = 0
+			self.nretrans += 1
+		elif self.use_cuda:
+			rs.record_stream(torch.cuda.current_stream(rs.device))
+		self.nbatch += 1
+		self.nsent += seq_o.size(0)
+		self.sum_stale += _stale
+		self.decode_time += _t
+
+		return rs
+
+	# discard translations of batches which are not consumed
+
+	def drain(self):
+
+		while self.ninflight > 0:
+			self.qout.get()
+			self.ninflight -= 1
+
+	def work(self):
+
+		while True:
+			_ = self.qin.get()
+			if _ is None:
+				break
+			seq_o, taskid, _event, _ncall = _
+			try:
+				with self.lock:
+					_ver = self.version.item()
+					_st = time()
+					if self.stream is None:
+						rs = self.bt_func(self.net, seq_o, taskid)
+					else:
+						with torch.cuda.stream(self.stream):
+							if self.sync_event is not None:
+								self.stream.wait_event(self.sync_event)
+							self.stream.wait_event(_event)
+							rs = self.bt_func(self.net, seq_o, taskid)
+						self.stream.synchronize()
+					_t = time() - _st
+			except Exception as e:
+				rs, _ver, _t = e, 0, 0.0
+			seq_o = _event = None
+			self.qout.put((rs, _ver, _t, _ncall,))
+			rs = None
+
+	# to be called after each optimizer step
+
+	def step(self):
+
+		self.nstep += 1
+		if self.nstep % self.sync_steps == 0:
+			self.sync()
+
+	def sync(self):
+
+		with self.lock, torch.no_grad():
+			for _t, _s in zip(self.tensors, self.src_tensors):
+				_t.copy_(_s)
+			self.version.fill_(self.nstep)
+			if self.use_cuda:
+				self.sync_event = torch.cuda.Event()
+				self.sync_event.record()
+
+	def report(self):
+
+		rs = "Back-translation: %d sentences of %d batches decoded in %.2f s (%.2f sentences/s), waited %.2f s, average staleness: %.2f steps, translated again: %d" % (self.nsent, self.nbatch, self.decode_time, self.nsent / max(self.decode_time, 1e-6), self.wait_time, float(self.sum_stale) / max(self.nbatch, 1), self.nretrans,)
+		self.reset_stats()
+
+		return rs
+
+	def close(self):
+
+		self.drain()
+		self.qin.put(None)
+		self.worker.join()
@@ -0,0 +1,202 @@
+#encoding: utf-8
+
+# Sharded parallel preprocessing for tools/mkiodata.py and tools/mktest.py. Batches decided by utils.fmt.dual/single.batch_loader depend on all previous lines, so the data is processed in two passes over byte-range shards of the (sorted) input files:
+#	1. workers count the tokens and bytes of every line in their byte ranges, from which batches are decided serially exactly like the serial run (utils.mmdata.batch_bounds),
+#	2. batches are split into contiguous shards, each worker seeks to the first line of its shard, maps and pads its batches with the same code as the serial run, and writes them (with their global batch ids) to its own shard file.
+# Shard files are merged into the result file in the end (or indexed with external links of HDF5), which is identical to the output of the serial run, including a last batch with fewer than minbsize sentences which is kept by both (checked by tools/check/shard.py).
+
+import numpy
+from h5py import ExternalLink
+from os import remove
+from os.path import getsize, basename
+from shutil import copyfileobj, rmtree
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from utils.fmt.base import pad_batch
+from utils.h5serial import h5File
+from utils.mmdata import MMapWriter, batch_bounds, is_mmdata, load_fields, mmdata_batch_file, mmdata_nword_file
+from utils.tqdm import tqdm
+import utils.fmt.dual as dual
+import utils.fmt.single as single
+
+from cnfg.ihyp import *
+
+# byte offsets of num_shard ranges of a file, aligned to beginnings of lines.
+
+def byte_shards(fname, num_shard):
+
+	_fsize = getsize(fname)
+	rs = [0]
+	with open(fname, "rb") as f:
+		for i in range(1, num_shard):
+			f.seek(max(_fsize * i // num_shard - 1, rs[-1]))
+			f.readline()
+			_pos = f.tell()
+			if _pos < _fsize and _pos > rs[-1]:
+				rs.append(_pos)
+	rs.append(_fsize)
+
+	return rs
+
+# numbers of tokens (counted like utils.fmt.base.list_reader) and bytes of lines in [start, end) of a file.
+
+def count_lines(fname, start, end):
+
+	rsl, rsb = [], []
+	_pos = start
+	with open(fname, "rb") as f:
+		f.seek(start)
+		while _pos < end:
+			_line = f.readline()
+			if not _line:
+				break
+			_pos += len(_line)
+			rsb.append(len(_line))
+			_tmp = _line.strip()
+			rsl.append(len(_tmp.decode("utf-8").split()) if _tmp else 0)
+
+	return numpy.array(rsl, dtype=numpy.int64), numpy.array(rsb, dtype=numpy.int64)
+
+def read_lines(fname, offset, nline):
+
+	with open(fname, "rb") as f:
+		f.seek(offset)
+		for _ in range(nline):
+			_tmp = f.readline().strip()
+			yield _tmp.decode("utf-8").split() if _tmp else []
+
+# a custom_batch_loader of utils.fmt.dual/single.batch_mapper which yields batches of given sizes starting from given byte offsets of the input files.
+
+def shard_batch_loader(*inputs, offsets=None, bsizes=None):
+
+	_readers = [read_lines(_f, _o, sum(bsizes)) for _f, _o in zip(inputs, offsets)]
+	for _bsize in bsizes:
+		rs = [[next(_r) for _ in range(_bsize)] for _r in _readers]
+		yield tuple(rs) + tuple(max(len(_) for _ in _b) for _b in rs)
+
+_vocabs = None
+
+def init_process_worker(vocabs):
+
+	global _vocabs
+
+	_vocabs = vocabs
+
+def map_shard(files, offsets, bsizes, bid, frs, nword):
+
+	_loader = lambda *args: shard_batch_loader(*files, offsets=offsets, bsizes=bsizes)
+	if len(files) > 1:
+		_mapper = dual.batch_mapper(*files, *_vocabs, None, None, None, None, None, custom_batch_loader=_loader)
+	else:
+		_mapper = single.batch_mapper(files[0], _vocabs[0], None, None, None, None, None, custom_batch_loader=_loader)
+	_fields = ("src", "tgt",)[:len(files)]
+	if is_mmdata(frs):
+		with MMapWriter(frs, fields=_fields, nword=nword) as rsf:
+			for _batch in _mapper:
+				rsf.write(*_batch[:len(_fields)])
+	else:
+		with h5File(frs, "w", libver=h5_libver) as rsf:
+			_grps = [rsf.create_group(_) for _ in _fields]
+			for _curd, _batch in enumerate(_mapper, bid):
+				_wid = str(_curd)
+				for _grp, _b, _mlen in zip(_grps, _batch[:len(_fields)], _batch[len(_fields):]):
+					_grp.create_dataset(_wid, data=numpy.array(pad_batch(_b, _mlen), dtype=numpy.int32), **h5datawargs)
+
+	return sum(bsizes)
+
+# files: input files, (source, target) for tools/mkiodata.py, (source,) for tools/mktest.py
+# vocabs: vocabularies of files
+# frs: result file, a flat token store (see utils/mmdata.py) if it does not end with .h5
+# merge: copy shards into frs and remove them, otherwise frs indexes batches in HDF5 shard files with external links (ignored for flat token stores)
+
+def handle_sharded(files, vocabs, frs, nword, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minbsize=1, num_process=4, num_shard=None, merge=True, print_func=print):
+
+	_nshard = num_process * 4 if num_shard is None else num_shard
+	_ctx = get_context("fork")
+	_st = time()
+	with ProcessPoolExecutor(max_workers=num_process, mp_context=_ctx, initializer=init_process_worker, initargs=(vocabs,)) as pool:
+		_lens, _offsets = [], []
+		for _f in files:
+			_bs = byte_shards(_f, _nshard)
+			_rs = list(pool.map(count_lines, [_f] * (len(_bs) - 1), _bs[:-1], _bs[1:]))
+			_lens.append(numpy.concatenate([_[0] for _ in _rs]))
+			_offsets.append(numpy.concatenate([numpy.zeros(1, dtype=numpy.int64)] + [_[1] for _ in _rs]).cumsum())
+		nline = len(_lens[0])
+		if any(len(_) != nline for _ in _lens):
+			raise Exception("Files have different numbers of lines: %s" % " ".join(str(len(_)) for _ in _lens))
+		bounds = numpy.array(list(batch_bounds(*_lens, bsize=bsize, maxpad=maxpad, maxpart=maxpart, maxtoken=maxtoken, minbsize=minbsize, extok=0)), dtype=numpy.int64)
+		ndata = len(bounds) - 1
+		if print_func is not None:
+			print_func("Counted %d lines in %.2f s" % (nline, time() - _st,))
+
+		_bshard = [min(ndata, ndata * i // _nshard) for i in range(_nshard + 1)]
+		_bshard = [_ for i, _ in enumerate(_bshard) if (i == 0) or (_ > _bshard[i - 1])]
+		shards = [shard_name(frs, i) for i in range(len(_bshard) - 1)]
+		_bsizes = (bounds[1:] - bounds[:-1]).tolist()
+		_futures = [pool.submit(map_shard, files, [int(_o[bounds[_sb]]) for _o in _offsets], _bsizes[_sb:_eb], _sb, _shardf, nword) for _sb, _eb, _shardf in zip(_bshard[:-1], _bshard[1:], shards)]
+		_nd = 0
+		_st_map = time()
+		for _ in tqdm(as_completed(_futures), total=len(_futures), mininterval=tqdm_mininterval):
+			_nd += _.result()
+	if print_func is not None:
+		_t = time() - _st_map
+		print_func("Mapped %d lines in %.2f s, %.2f lines/s" % (_nd, _t, _nd / max(_t, 1e-6),))
+	if is_mmdata(frs):
+		merge_mmdata(shards, frs)
+	else:
+		merge_h5(shards, frs, ndata, nword, _bshard, merge=merge, fields=("src", "tgt",)[:len(files)])
+	if print_func is not None:
+		print_func("Finished in %.2f s" % (time() - _st,))
+
+	return ndata
+
+# shard files keep the suffix of frs which decides their format.
+
+def shard_name(frs, i):
+
+	return "%s.shard%d" % (frs, i,) if is_mmdata(frs) else "%s.shard%d.h5" % (frs[:-3], i,)
+
+def merge_h5(shards, frs, ndata, nword, bshard, merge=True, fields=("src", "tgt",)):
+
+	with h5File(frs, "w", libver=h5_libver) as rsf:
+		_grps = [rsf.create_group(_) for _ in fields]
+		for _shardf, _sb, _eb in zip(shards, bshard[:-1], bshard[1:]):
+			if merge:
+				with h5File(_shardf, "r") as _sf:
+					for _field, _grp in zip(fields, _grps):
+						_sgrp = _sf[_field]
+						for i in range(_sb, _eb):
+							_wid = str(i)
+							_sf.copy(_sgrp[_wid], _grp, name=_wid)
+				remove(_shardf)
+			else:
+				_lf = basename(_shardf)
+				for _field, _grp in zip(fields, _grps):
+					for i in range(_sb, _eb):
+						_wid = str(i)
+						_grp[_wid] = ExternalLink(_lf, "%s/%s" % (_field, _wid,))
+		rsf["ndata"] = numpy.array([ndata], dtype=numpy.int32)
+		rsf["nword"] = numpy.array(nword, dtype=numpy.int32)
+
+# concatenate flat token stores of shards into frs, and remove shards.
+
+def merge_mmdata(shards, frs):
+
+	_fields = load_fields(shards[0])
+	_nword = numpy.load("%s/%s" % (shards[0], mmdata_nword_file,)).tolist()
+	with MMapWriter(frs, fields=_fields, nword=_nword) as rsf:
+		for _f, _field in zip(rsf.files, _fields):
+			for _shardf in shards:
+				with open("%s/%s.bin" % (_shardf, _field,), "rb") as _sf:
+					copyfileobj(_sf, _f)
+		for _off, _field in zip(rsf.offs, _fields):
+			for _shardf in shards:
+				_soff = numpy.load("%s/%s.idx.npy" % (_shardf, _field,))
+				_off.extend((_soff[1:] + _off[-1]).tolist())
+		for _shardf in shards:
+			_sb = numpy.load("%s/%s" % (_shardf, mmdata_batch_file,))
+			rsf.bounds.extend((_sb[1:] + rsf.bounds[-1]).tolist())
+	for _shardf in shards:
+		rmtree(_shardf)
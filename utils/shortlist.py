@@ -0,0 +1,87 @@
+#encoding: utf-8
+
+# Lexical shortlists (vocabulary candidate selection) for decoding: the target vocabulary of a batch is restricted to the union of special tokens, the most frequent target tokens and the top-k target tokens associated with every source token (built by tools/shortlist.py from the training data), so that the output projection, log_softmax and topk of every decoding step only cover a small candidate set instead of the full vocabulary.
+
+import torch
+from torch import nn
+from torch.ao.nn.quantized.dynamic import Linear as QLinear
+
+from cnfg.vocab.base import init_normal_token_id
+
+class Shortlist:
+
+	# lex: target token ids associated with source tokens (nwordi, topk), padded with pad_id
+	# freq: ids of the most frequent target tokens
+	# nspecial: ids of special tokens (<pad>, <sos>, <eos>, <unk>) which are always kept, they have to stay at the beginning of candidate sets so that their ids are unchanged during decoding
+
+	def __init__(self, lex, freq, nspecial=init_normal_token_id):
+
+		self.lex, self.freq = lex, freq
+		self.special = torch.arange(nspecial, dtype=freq.dtype, device=freq.device)
+
+	# sorted candidate target ids (ncandidate) for source batch inpute (bsize, seql)
+
+	def __call__(self, inpute):
+
+		_device = inpute.device
+		_inpute = inpute if _device == self.lex.device else inpute.to(self.lex.device)
+		rs = torch.cat((self.special, self.freq, self.lex.index_select(0, _inpute.view(-1)).view(-1),), 0).unique(sorted=True)
+
+		return rs if rs.device == _device else rs.to(_device)
+
+	def to(self, device):
+
+		self.lex, self.freq, self.special = self.lex.to(device), self.freq.to(device), self.special.to(device)
+
+		return self
+
+# topk: number of target tokens used per source token, up to the number kept in the file
+# nfreq: number of frequent target tokens used, up to the number kept in the file
+
+def load_shortlist(fname, topk=None, nfreq=None):
+
+	from utils.h5serial import h5File
+
+	with h5File(fname, "r") as f:
+		lex = torch.from_numpy(f["lex"][()]).long()
+		freq = torch.from_numpy(f["freq"][()]).long()
+	if (topk is not None) and (topk < lex.size(-1)):
+		lex = lex.narrow(-1, 0, topk).contiguous()
+	if (nfreq is not None) and (nfreq < freq.size(0)):
+		freq = freq.narrow(0, 0, nfreq)
+
+	return Shortlist(lex, freq)
+
+# output projection with a given (sliced) weight and bias, which avoids the initialization of a new nn.Linear for every batch.
+
+class ShortlistLinear(nn.Module):
+
+	def __init__(self, weight, bias=None):
+
+		super(ShortlistLinear, self).__init__()
+
+		self.weight, self.bias = weight, bias
+
+	def forward(self, x):
+
+		return nn.functional.linear(x, self.weight, self.bias)
+
+# embedding and classifier restricted to indices, the weight is shared if they are bound. Rows of int8 weights are selected for dynamically quantized classifiers (utils/quant.py).
+
+def shortlist_modules(wemb, classifier, indices):
+
+	if isinstance(classifier, QLinear):
+		_cw, _cb = classifier._packed_params._weight_bias()
+		if _cw.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric,):
+			_cw = torch._make_per_channel_quantized_tensor(_cw.int_repr().index_select(0, indices), _cw.q_per_channel_scales().index_select(0, indices), _cw.q_per_channel_zero_points().index_select(0, indices), 0)
+		else:
+			_cw = torch._make_per_tensor_quantized_tensor(_cw.int_repr().index_select(0, indices), _cw.q_scale(), _cw.q_zero_point())
+		_classifier = QLinear(_cw.size(-1), indices.numel(), dtype=_cw.dtype)
+		_classifier.set_weight_bias(_cw, None if _cb is None else _cb.index_select(0, indices))
+		_ew = wemb.weight.index_select(0, indices)
+	else:
+		_cw = classifier.weight.index_select(0, indices)
+		_classifier = ShortlistLinear(_cw, None if classifier.bias is None else classifier.bias.index_select(0, indices))
+		_ew = _cw if classifier.weight.is_set_to(wemb.weight) else wemb.weight.index_select(0, indices)
+
+	return nn.Embedding.from_pretrained(_ew, freeze=True, padding_idx=wemb.padding_idx), _classifier
@@ -0,0 +1,113 @@
+#encoding: utf-8
+
+# A thread-safe LRU/TTL cache of translations for translator.TranslatorCore, keyed by the (BPE applied) source sentence together with the model and decoding settings, so that repeated sentences across requests (UI strings, boilerplate, retries) skip decoding. An optional persistent tier (a sqlite3 database) keeps translations across restarts, entries missed in memory are looked up there and promoted to memory.
+
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+class TranslationCache:
+
+	# size: maximum number of translations kept in memory
+	# ttl: time (in seconds) for which a translation stays valid, None for no expiration
+	# fname: sqlite3 database file for the persistent tier, None to disable
+	# prefix: model and decoding settings, which are part of keys
+
+	def __init__(self, size=65536, ttl=None, fname=None, prefix=""):
+
+		self.size, self.ttl, self.prefix = size, ttl, prefix
+		self.data = OrderedDict()
+		self.lock = Lock()
+		self.hits = self.misses = self.evictions = self.expirations = self.disk_hits = 0
+		if fname is None:
+			self.db = None
+		else:
+			self.db = sqlite3.connect(fname, check_same_thread=False)
+			self.db.execute("CREATE TABLE IF NOT EXISTS cache (k TEXT PRIMARY KEY, v TEXT, t REAL)")
+			self.db.commit()
+
+	def key(self, sentence):
+
+		return "%s\t%s" % (self.prefix, sentence,)
+
+	def valid(self, t, now):
+
+		return (self.ttl is None) or (now - t <= self.ttl)
+
+	# returns translations of sentences, None for those not in the cache
+
+	def get_many(self, sentences):
+
+		now = time()
+		rs = []
+		_disk = []
+		with self.lock:
+			for _s in sentences:
+				_k = self.key(_s)
+				_v = self.data.get(_k)
+				if _v is not None:
+					if self.valid(_v[1], now):
+						self.data.move_to_end(_k)
+						rs.append(_v[0])
+						self.hits += 1
+						continue
+					del self.data[_k]
+					self.expirations += 1
+				rs.append(None)
+				_disk.append(len(rs) - 1)
+			if _disk and (self.db is not None):
+				for _i in _disk:
+					_k = self.key(sentences[_i])
+					_v = self.db.execute("SELECT v, t FROM cache WHERE k = ?", (_k,)).fetchone()
+					if _v is not None:
+						if self.valid(_v[1], now):
+							rs[_i] = _v[0]
+							self.insert(_k, _v[0], _v[1])
+							self.hits += 1
+							self.disk_hits += 1
+						else:
+							self.db.execute("DELETE FROM cache WHERE k = ?", (_k,))
+							self.expirations += 1
+			self.misses += sum(1 for _ in rs if _ is None)
+
+		return rs
+
+	def put_many(self, sentences, translations):
+
+		now = time()
+		with self.lock:
+			_kv = [(self.key(_s), _t,) for _s, _t in zip(sentences, translations)]
+			for _k, _t in _kv:
+				self.insert(_k, _t, now)
+			if self.db is not None:
+				self.db.executemany("INSERT OR REPLACE INTO cache (k, v, t) VALUES (?, ?, ?)", [(_k, _t, now,) for _k, _t in _kv])
+				self.db.commit()
+
+	def insert(self, key, value, t):
+
+		self.data[key] = (value, t,)
+		self.data.move_to_end(key)
+		while len(self.data) > self.size:
+			self.data.popitem(last=False)
+			self.evictions += 1
+
+	def stats(self):
+
+		with self.lock:
+			_n = self.hits + self.misses
+			return {"size": len(self.data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations, "disk_hits": self.disk_hits, "hit_rate": float(self.hits) / float(_n) if _n > 0 else 0.0}
+
+	def clear(self):
+
+		with self.lock:
+			self.data.clear()
+			if self.db is not None:
+				self.db.execute("DELETE FROM cache")
+				self.db.commit()
+
+	def close(self):
+
+		if self.db is not None:
+			self.db.close()
+			self.db = None